@@ -19,8 +19,14 @@ sudo apt-get install -y python3-pygame
 sudo apt-get install -y python3-serial
 sudo apt-get install -y python3-flask
 sudo apt-get install -y python3-picamera2
+sudo apt-get install -y python3-pil
 sudo apt-get install -y python3-waitress
 
+# audioop was removed from the standard library in Python 3.13
+if python3 -c 'import sys; sys.exit(sys.version_info < (3, 13))'; then
+    sudo pip3 install --break-system-packages audioop-lts
+fi
+
 # Modify the service file directory path
 echo " "
 echo "--------------------------------------------"
@@ -22,6 +22,9 @@
  *    > 0 = LOW servo position, 100 = HIGH servo position as specified in the wall-e_calibration sketch
  *    > If you want the servo to be disabled/not updated by a specific instruction, use -1
  * 3. Make sure that your 'case' statement ends with the "break;" command 
+ *
+ * Animations can also be sent from the web-interface as a stream of keyframes,
+ * without changing this file (see web_interface/trajectory.py).
  */
 
 #ifndef ANIMATIONS_INO
@@ -91,6 +91,18 @@
 #define MAX_SERIAL_LENGTH 5       // Maximum number of characters that can be received
 
 
+/// Binary serial protocol
+// -- -- -- -- -- -- -- -- -- -- -- -- -- --
+// Frame: START | seq | flags | count | count x (command, int16 value) | crc8
+// See web_interface/serial_protocol.py for the full description
+#define PROTOCOL_VERSION 2        // Reported in reply to the "V" command
+#define FRAME_START 0xA5          // First byte of a binary frame
+#define FRAME_HEADER_LENGTH 3     // Sequence number, flags and command count
+#define MAX_FRAME_COMMANDS 8      // Maximum number of commands in one frame
+#define FLAG_ACK 0x01             // Reply with "Ack_<seq>" once frame is processed
+#define FLAG_ECHO 0x02            // Echo every command, like the text protocol
+
+
 
 /// Instantiate Objects
 // -- -- -- -- -- -- -- -- -- -- -- -- -- --
@@ -112,6 +124,11 @@ struct animation_t {
 animation_t buffer[QUEUE_LENGTH];
 Queue <animation_t> queue(QUEUE_LENGTH, buffer);
 
+// Keyframe which is being received from the web-interface
+// (see web_interface/trajectory.py)
+animation_t keyframe;
+bool keyframeOpen = false;
+
 
 /// Motor Control Variables
 // -- -- -- -- -- -- -- -- -- -- -- -- -- --
@@ -137,6 +154,10 @@ bool autoMode = false;
 char firstChar;
 char serialBuffer[MAX_SERIAL_LENGTH];
 uint8_t serialLength = 0;
+uint8_t frameBuffer[FRAME_HEADER_LENGTH + 3 * MAX_FRAME_COMMANDS + 1];
+uint8_t frameLength = 0;
+uint8_t frameExpected = 0;
+bool frameActive = false;
 
 
 // ****** SERVO MOTOR CALIBRATION *********************
@@ -219,7 +240,15 @@ void setup() {
 void readSerial() {
 
 	// Read incoming byte
-	char inchar = Serial.read();
+	uint8_t inbyte = Serial.read();
+
+	// Bytes belonging to a binary frame are handled separately
+	if (frameActive || (serialLength == 0 && inbyte == FRAME_START)) {
+		readFrame(inbyte);
+		return;
+	}
+
+	char inchar = inbyte;
 
 	// If the string has ended, evaluate the serial buffer
 	if (inchar == '\n' || inchar == '\r') {
@@ -248,6 +277,75 @@ void readSerial() {
 
 
 
+// -------------------------------------------------------------------
+/// Read a binary frame from the serial port
+///
+/// Collects the bytes of a frame which started with FRAME_START,
+/// and evaluates each of the commands once the frame is complete.
+///
+/// @param  inbyte  The byte which was received
+// -------------------------------------------------------------------
+
+void readFrame(uint8_t inbyte) {
+
+	// Start of a new frame
+	if (!frameActive) {
+		frameActive = true;
+		frameLength = 0;
+		frameExpected = 0;
+		return;
+	}
+
+	frameBuffer[frameLength++] = inbyte;
+
+	// Once the header is complete, determine the frame length
+	if (frameLength == FRAME_HEADER_LENGTH) {
+		if (frameBuffer[2] > MAX_FRAME_COMMANDS) {
+			Serial.print(F("Nack_")); Serial.println(frameBuffer[0]);
+			frameActive = false;
+			return;
+		}
+		frameExpected = FRAME_HEADER_LENGTH + 3 * frameBuffer[2] + 1;
+	}
+
+	if (frameExpected == 0 || frameLength < frameExpected) return;
+	frameActive = false;
+
+	// Verify the checksum
+	uint8_t crc = 0;
+	for (uint8_t i = 0; i < frameLength - 1; i++) {
+		crc ^= frameBuffer[i];
+		for (uint8_t bit = 0; bit < 8; bit++) {
+			if (crc & 0x80) crc = (crc << 1) ^ 0x07;
+			else crc <<= 1;
+		}
+	}
+
+	if (crc != frameBuffer[frameLength - 1]) {
+		Serial.print(F("Nack_")); Serial.println(frameBuffer[0]);
+		return;
+	}
+
+	// Evaluate each of the commands
+	uint8_t flags = frameBuffer[1];
+	for (uint8_t i = 0; i < frameBuffer[2]; i++) {
+		uint8_t offset = FRAME_HEADER_LENGTH + 3 * i;
+		firstChar = frameBuffer[offset];
+		int number = (int16_t) ((uint16_t) frameBuffer[offset + 1] | ((uint16_t) frameBuffer[offset + 2] << 8));
+
+		if (flags & FLAG_ECHO) {
+			Serial.print(firstChar); Serial.println(number);
+		}
+		evaluateCommand(number);
+	}
+
+	if (flags & FLAG_ACK) {
+		Serial.print(F("Ack_")); Serial.println(frameBuffer[0]);
+	}
+}
+
+
+
 // -------------------------------------------------------------------
 /// Evaluate input from serial port
 ///
@@ -261,6 +359,18 @@ void evaluateSerial() {
 	int number = atoi(serialBuffer);
 
 	Serial.print(firstChar); Serial.println(number);
+	evaluateCommand(number);
+}
+
+
+
+// -------------------------------------------------------------------
+/// Evaluate a command
+///
+/// @param  number  The value of the command stored in "firstChar"
+// -------------------------------------------------------------------
+
+void evaluateCommand(int number) {
 
 
 	// Motor Inputs and Offsets
@@ -282,6 +392,47 @@ void evaluateSerial() {
 	else if (firstChar == 'M' && number == 1) autoMode = true;
 
 
+	// Protocol version request
+	// -- -- -- -- -- -- -- -- -- -- -- -- -- --
+	else if (firstChar == 'V') {
+		Serial.print(F("Protocol_")); Serial.println(PROTOCOL_VERSION);
+	}
+
+
+	// Streamed keyframes
+	// "K<time>" starts a keyframe which is held for <time> milliseconds, and
+	// "J<servo * 1000 + position>" commands set its positions (others are -1, so
+	// they don't move), with the servo numbered as in the animation queue. "P"
+	// adds it to the animation queue. "Q" reports the length of the queue, and
+	// "Q1" clears it. The length is sent as "Queue_<n>" (-1 if it was full).
+	// The positions have their own command, so the manual servo commands below
+	// always move the servos, even if a keyframe was left open (a lost "P")
+	// -- -- -- -- -- -- -- -- -- -- -- -- -- --
+	else if (firstChar == 'K' && number >= 0) {
+		keyframe.timer = number;
+		for (int i = 0; i < NUMBER_OF_SERVOS; i++) keyframe.servos[i] = -1;
+		keyframeOpen = true;
+	}
+	else if (firstChar == 'P' && keyframeOpen) {
+		keyframeOpen = false;
+		Serial.print(F("Queue_"));
+		if (queue.size() < QUEUE_LENGTH) {
+			autoMode = false;
+			queue.push(keyframe);
+			Serial.println(queue.size());
+		} else {
+			Serial.println(-1);
+		}
+	}
+	else if (firstChar == 'Q') {
+		if (number == 1) queue.clear();
+		Serial.print(F("Queue_")); Serial.println(queue.size());
+	}
+	else if (firstChar == 'J' && keyframeOpen && number >= 0 && number / 1000 < NUMBER_OF_SERVOS && number % 1000 <= 100) {
+		keyframe.servos[number / 1000] = number % 1000;
+	}
+
+
 	// Manual servo control
 	// -- -- -- -- -- -- -- -- -- -- -- -- -- --
 	else if (firstChar == 'L' && number >= 0 && number <= 100) {   // Move left arm
@@ -411,10 +562,12 @@ void manageAnimations() {
 		animation_t newValues = queue.pop();
 		animeTimer = millis() + newValues.timer;
 
-		// Set all the joint positions
+		// Set all the joint positions, apart from those which are disabled (-1)
 		for (int i = 0; i < NUMBER_OF_SERVOS; i++) {
 			// Scale the positions using the servo calibration values
-			setpos[i] = int(newValues.servos[i] * 0.01 * (preset[i][1] - preset[i][0]) + preset[i][0]);
+			if (newValues.servos[i] >= 0) {
+				setpos[i] = int(newValues.servos[i] * 0.01 * (preset[i][1] - preset[i][0]) + preset[i][0]);
+			}
 		}
 
 
@@ -13,17 +13,27 @@
 from flask import Flask, request, session, redirect, url_for, jsonify, render_template
 
 import os
+import json
 import sys
-from queue import Queue
-from threading import Event, Thread
-from serial import Serial
-import serial.tools.list_ports
 import subprocess
 import time
-import tempfile
+from threading import Thread
 from picamera2_stream import PiCameraStreamer
+from arduino_device import ArduinoDevice, SERVO_CHANNELS, SERVO_PRESETS
+from serial_ports import PortRegistry
+from control_socket import ControlChannel
+from audio_engine import AudioEngine
+from tts_cache import TTSCache, split_sentences
+from sound_catalog import SoundCatalog
+from job_queue import JobQueue, Job, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from metrics import MetricsRegistry, histogram_samples
+from telemetry import LATENCY_BUCKETS
+from automation import ProgramRunner, parse_program
+from trajectory import TrajectoryLibrary, TrajectoryPlayer, parse_trajectory
+from session_log import SessionRecorder, SessionReplayer, list_recordings, read_recording
+from fast_lane import FastLane
+from governor import CommandGovernor
 import logging
-from waitress import serve
 
 
 app = Flask(__name__)
@@ -37,7 +47,7 @@ else:
 # Set up global variables
 volume: int = 8
 startup: bool = False
-camera: PiCameraStreamer = PiCameraStreamer()
+camera: PiCameraStreamer = PiCameraStreamer(app.config['CAMERA_ADAPTIVE'], server_type=app.config['STREAM_SERVER'])
 
 # Set up logging
 logger = logging.getLogger()
@@ -52,193 +62,199 @@ else:
 
 logger.addHandler(stream_handler)
 
+ports: PortRegistry = PortRegistry()
+arduino: ArduinoDevice = ArduinoDevice(app.config['SERIAL_PROTOCOL'], ports,
+                                       app.config['ARDUINO_PORT'] if app.config['AUTOSTART_ARDUINO'] else "")
+governor: CommandGovernor = CommandGovernor(arduino, app.config['GOVERNOR_RATE'], app.config['GOVERNOR_BURST'],
+                                           app.config['WATCHDOG_TIMEOUT'])
+control: ControlChannel = ControlChannel(arduino, governor)
+player: AudioEngine = AudioEngine(app.config['SOUND_FOLDER'], app.config['SOUND_FORMAT'],
+                                  app.config['AUDIO_SINK_CMD'], app.config['AUDIO_CACHE_SIZE'] * 1024 * 1024,
+                                  app.config['AUDIO_MAX_VOICES'])
+player.set_volume(volume)
+tts_cache: TTSCache = TTSCache(app.config['TTS_CACHE_FOLDER'], app.config['ESPEAK_CMD'], app.config['RB_CMD'],
+                               app.config['TTS_CACHE_SIZE'] * 1024 * 1024, app.config['TTS_MEMORY_CACHE_SIZE'] * 1024 * 1024,
+                               app.config['TTS_WORK_FOLDER'])
+catalog: SoundCatalog = SoundCatalog(app.config['SOUND_FOLDER'], app.config['SOUND_FORMAT'])
+jobs: JobQueue = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'])
+registry: MetricsRegistry = MetricsRegistry('walle_')
+trajectories: TrajectoryLibrary = TrajectoryLibrary(app.config['TRAJECTORY_FOLDER'])
+trajectory_player: TrajectoryPlayer = TrajectoryPlayer(arduino, app.config['TRAJECTORY_WINDOW'])
+recorder: SessionRecorder = SessionRecorder(app.config['SESSION_FOLDER'], app.config['SESSION_SEGMENT_SIZE'] * 1024 * 1024,
+                                            app.config['SESSION_SEGMENTS'])
+replayer: SessionReplayer = SessionReplayer(arduino)
+arduino.set_recorder(recorder)
+fast_lane: FastLane = FastLane(app.wsgi_app, governor)
+
+# Answer the fast lane control requests before they reach Flask
+if app.config['FAST_LANE']:
+    app.wsgi_app = fast_lane
+
+# Tell the control channel clients when the camera starts or stops
+camera.add_listener(lambda state: control.broadcast(dict(state, type='camera')))
+# ... and when the watchdog stops the motors
+governor.add_listener(lambda status: control.broadcast(dict(status, type='governor')))
+
 
 
 ###############################################################
 #
-# Arduino Device Class
+# Metrics, which are rendered by the /metrics page
 #
 ###############################################################
 
-class ArduinoDevice:
-    """Class used for managing communication with the Arduino"""
-
-    # ---------------------------------------------------------
-    def __init__(self):
-        """
-        Constructor for Arduino serial communication thread class
-        :param port:     The serial port where the Arduino is connected
-        """
-        self.queue: Queue = Queue()
-        self.exit_flag: Event = Event()
-        self.port_name: str = ""
-        self.serial_port: Serial | None = None
-        self.serial_thread: Thread | None = None
-        self.battery_level: str | None = None
-        self.exit_flag.clear()
-
-    # ---------------------------------------------------------
-    def __del__(self):
-        """Destructor - ensures serial port is closed correctly"""
-        self.disconnect()
-
-    # ---------------------------------------------------------
-    def connect(self, port: str | int = "") -> bool:
-        """
-        Connect to the serial port
-        :param port: The port to connect to (leave blank to use previous port)
-        :return: True if connected successfully, False otherwise
-        """
-        try:
-            usb_ports = [
-                p.device for p in serial.tools.list_ports.comports()
-            ]
+JOB_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
-            if type(port) is str and port == "":
-                port = self.port_name
+request_seconds = registry.histogram('request_seconds', 'Time taken to handle each request', ('route', 'method'))
+request_count = registry.counter('requests', 'Requests handled, by response status', ('route', 'method', 'status'))
+job_seconds = registry.histogram('job_seconds', 'Run time of audio and speech jobs', ('kind', 'state'), JOB_BUCKETS)
+job_wait_seconds = registry.histogram('job_wait_seconds', 'Time jobs waited in the queue', ('kind',), JOB_BUCKETS)
 
-            if type(port) is int and port >= 0 and port < len(usb_ports):
-                port = usb_ports[port]
 
-            # Check port exists and we are not already connected
-            if ((not self.is_connected() or port != self.port_name) and port in usb_ports):
-                
-               # Ensure old port is properly disconnected first
-                self.disconnect() 
+# =============================================================
+def start_request_timer():
+    """Remember when the request started"""
+    request.environ['walle.request_start'] = time.perf_counter()
 
-                # Connect to the new port
-                self.serial_port = Serial(port, 115200)
-                self.serial_port.flushInput()
-                self.port_name = port
 
-                # Start the command handler in a background thread
-                self.exit_flag.clear()
-                self.serial_thread = Thread(target = self.__communication_thread)
-                self.serial_thread.start()
+# =============================================================
+def record_request(response):
+    """Record the duration and status of a request"""
+    # Each access through the request proxy is slow, so only look it up once
+    current = request._get_current_object()
+    start = current.environ.get('walle.request_start')
+    if start is not None:
+        route = current.url_rule.rule if current.url_rule is not None else 'unmatched'
+        request_seconds.labels(route, current.method).observe(time.perf_counter() - start)
+        request_count.labels(route, current.method, str(response.status_code)).inc()
+    return response
 
-        except Exception as ex:
-            logger.error(f'Serial connect error: {repr(ex)}')
 
-        return self.is_connected()
+# =============================================================
+def record_job(job: Job):
+    """Record the wait and run time of a finished job"""
+    if job.started is not None:
+        job_wait_seconds.labels(job.kind).observe(job.started - job.submitted)
+        job_seconds.labels(job.kind, job.state).observe(job.finished - job.started)
 
-    # ---------------------------------------------------------
-    def disconnect(self) -> bool:
-        """
-        Disconnect from the serial port
-        :return: True if disconnected successfully, False otherwise
-        """
-        try:
-            self.battery_level = None
 
-            if self.serial_thread is not None:
-                self.exit_flag.set()
-                self.serial_thread.join()
-                self.serial_thread = None
+# =============================================================
+def collect_serial_metrics() -> list[tuple]:
+    """Serial link metrics, read from the counters of the Arduino device"""
+    queue = arduino.get_queue_stats()
+    traffic = arduino.get_traffic_stats()
+    latency = arduino.telemetry.get_latency_stats()
+    battery = arduino.telemetry.get_snapshot()['battery']
+    buckets = tuple(bound / 1000 for bound in LATENCY_BUCKETS)
+    types = sorted(command_type for command_type in latency if command_type != 'all')
+
+    return [
+        ('serial_connected', 'gauge', 'Arduino is connected', [({}, int(arduino.is_connected()))]),
+        ('serial_queue_depth', 'gauge', 'Commands waiting in the serial send queue', [({}, queue['depth'])]),
+        ('serial_commands', 'counter', 'Commands by channel and outcome (use rate() for commands per second)',
+         [('serial_commands_total', {'channel': channel, 'outcome': outcome}, value)
+          for channel, counters in sorted(queue['channels'].items()) for outcome, value in counters.items()]),
+        ('serial_bytes', 'counter', 'Bytes sent to and received from the Arduino',
+         [('serial_bytes_total', {'direction': 'out'}, traffic['bytes_sent']),
+          ('serial_bytes_total', {'direction': 'in'}, traffic['bytes_received'])]),
+        ('serial_command_rtt_seconds', 'histogram', 'Time until the Arduino echoed or acknowledged a command',
+         [sample for command_type in types
+          for sample in histogram_samples('serial_command_rtt_seconds', {'command': command_type}, buckets,
+                                          list(latency[command_type]['buckets'].values()),
+                                          latency[command_type]['sum'] / 1000)]),
+        ('serial_commands_lost', 'counter', 'Commands which the Arduino never acknowledged',
+         [('serial_commands_lost_total', {'command': command_type}, latency[command_type]['lost'])
+          for command_type in types]),
+        ('battery_percent', 'gauge', 'Battery level reported by the Arduino',
+         [({}, battery)] if battery is not None else []),
+    ]
+
 
-            if self.serial_port is not None:
-                self.serial_port.close()
-                self.serial_port = None
+# =============================================================
+def collect_audio_metrics() -> list[tuple]:
+    """Audio engine, speech cache and job queue metrics"""
+    audio = player.get_stats()
+    speech = tts_cache.get_stats()
+    queue = jobs.get_stats()
+
+    return [
+        ('audio_voices', 'gauge', 'Sounds playing at the moment', [({}, audio['voices'])]),
+        ('audio_voices_dropped', 'counter', 'Sounds not played because too many were playing',
+         [('audio_voices_dropped_total', {}, audio['dropped'])]),
+        ('audio_cache_requests', 'counter', 'Sound clip cache lookups',
+         [('audio_cache_requests_total', {'result': 'hit'}, audio['cache']['hits']),
+          ('audio_cache_requests_total', {'result': 'miss'}, audio['cache']['misses'])]),
+        ('tts_requests', 'counter', 'Speech requests, by where the audio came from',
+         [('tts_requests_total', {'result': result}, speech[result])
+          for result in ('memory_hits', 'disk_hits', 'misses', 'errors')]),
+        ('tts_render_seconds', 'counter', 'Time spent generating speech',
+         [('tts_render_seconds_total', {}, speech['render_time'])]),
+        ('jobs_queued', 'gauge', 'Jobs waiting to start', [({}, queue['queued'])]),
+        ('jobs_running', 'gauge', 'Jobs running at the moment', [({}, queue['running'])]),
+    ]
 
-        except Exception as ex:
-            logger.error(f'Serial disconnect error: {repr(ex)}')
-
-        return (self.serial_thread is None and self.serial_port is None)
-
-    # ---------------------------------------------------------
-    def is_connected(self) -> bool:
-        """
-        Check if serial device is connected
-        :return: True if connected, False otherwise
-        """
-        return (self.serial_thread is not None and self.serial_thread.is_alive()
-             and self.serial_port is not None and self.serial_port.is_open)
-
-    # ---------------------------------------------------------
-    def send_command(self, command: str) -> bool:
-        """
-        Send a serial command
-        :param command: The command to be sent
-        :return: True if port is open and message has been added to queue
-        """
-        success = False
-
-        if self.is_connected():
-            self.queue.put(command)
-            success = True
-
-        return success
-
-    # ---------------------------------------------------------
-    def clear_queue(self):
-        """
-        Clear the serial send queue
-        """
-        while not queue.empty():
-            self.queue.get()
-
-    # ---------------------------------------------------------
-    def get_battery_level(self) -> str | None:
-        """
-        Get the robot battery level
-        :return: The battery level as a string, or None
-        """
-        return self.battery_level
-
-    # ---------------------------------------------------------
-    def __communication_thread(self):
-        """
-        Handle sending and receiving data with the serial device
-        """
-        dataString: str = ""
-        logger.info(f'Starting Arduino Thread ({self.port_name})')
-
-        # Keep this thread running until the exit_flag changes
-        while not self.exit_flag.is_set():
-            try:
-                # If there are any messages in the queue, send them
-                if not self.queue.empty():
-                    data = self.queue.get() + '\n'
-                    self.serial_port.write(data.encode())
-
-                # Read any incomming messages
-                while (self.serial_port.in_waiting > 0):
-                    data = self.serial_port.read()
-                    if (data.decode() == '\n' or data.decode() == '\r'):
-                        self.__parse_message(dataString)
-                        dataString = ""
-                    else:
-                        dataString += data.decode()
 
-            # If an error occured in the serial communication
-            except Exception as ex:
-                logger.error(f'Serial handler error: {repr(ex)}')
-                #exit_flag.set()
-
-            time.sleep(0.01)
-        
-        logger.info(f'Stopping Arduino Thread ({self.port_name})')
-
-    # ---------------------------------------------------------
-    def __parse_message(self, dataString: str):
-        """
-        Parse messages received from the connected device
-        :param dataString: String containing the serial message to be parsed
-        """
-        try:
-            # Battery level message
-            if "Battery" in dataString:
-                dataList = dataString.split('_')
-                if len(dataList) > 1 and dataList[1].isdigit():
-                    self.battery_level = dataList[1]
+# Only add the request hooks if the metrics are used
+if app.config['METRICS']:
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+    jobs.add_listener(record_job)
+    registry.add_collector(collect_serial_metrics)
+    registry.add_collector(collect_audio_metrics)
+    registry.add_collector(camera.collect_metrics)
+    registry.add_collector(fast_lane.collect_metrics)
+    registry.add_collector(governor.collect_metrics)
 
-        except Exception as ex:
-            logger.error(f'Error parsing message [{dataString}]: {repr(ex)}')
 
-# End of class: ArduinoDevice
+###############################################################
+#
+# Sound and speech jobs, started by the web-interface and by automation programs
+#
+###############################################################
+
+# =============================================================
+def submit_audio(clip: str) -> Job | None:
+    """
+    Play an audio clip in the background
+    :param clip: File name of the clip
+    :return: The job playing the clip, or None if too many jobs are waiting
+    """
+    def play_clip(job: Job):
+        if not player.play(clip, job.id):
+            raise RuntimeError('Unable to play audio clip')
+
+    return jobs.submit('audio', play_clip, PRIORITY_HIGH)
+
+
+# =============================================================
+def submit_speech(text: str) -> Job | None:
+    """
+    Speak a text in the background
+    :param text: Text to speak
+    :return: The job speaking the text, or None if too many jobs are waiting
+    """
+    def speak(job: Job):
+        # In streaming mode, each sentence is played as soon as it has been generated
+        phrases = split_sentences(text) if app.config['TTS_STREAMING'] else [text]
+
+        for phrase in phrases:
+            if job.is_cancelled():
+                break
+            try:
+                speech = tts_cache.get(phrase)
+            except Exception as ex:
+                raise RuntimeError('Unable to generate speech') from ex
+
+            # Play it, unless the user has asked Wall-e to stop talking in the meantime
+            if not job.is_cancelled() and not player.play_wav(speech, job.id, queue=True):
+                raise RuntimeError('Unable to play speech')
 
+    return jobs.submit('tts', speak, PRIORITY_NORMAL)
 
 
-arduino: ArduinoDevice = ArduinoDevice()
+# Automation programs are run on the server, and start sounds and speech without waiting for them
+runner: ProgramRunner = ProgramRunner(arduino, lambda clip: submit_audio(clip) is not None,
+                                      lambda text: submit_speech(text) is not None)
 
 
 ###############################################################
@@ -257,56 +273,22 @@ def index():
         return redirect(url_for('login'))
 
     files = []
+    groups = []
     errors = []
 
     # Get list of audio files
     try:
-        for item in sorted(os.listdir(app.config['SOUND_FOLDER'])):
-            if item.endswith(f".{app.config['SOUND_FORMAT']}"):
-                audiofiles = os.path.splitext(os.path.basename(item))[0]
-
-                # Set up default details
-                audiogroup = "Other"
-                audionames = audiofiles
-                audiotimes = 0
-
-                audio_details = audiofiles.split('_')
-
-                # Get item details from name, and make sure they are valid
-                if len(audio_details) == 2:
-                    if audio_details[1].isdigit():
-                        audionames = audio_details[0]
-                        audiotimes = float(audio_details[1]) / 1000.0
-                    else:
-                        audiogroup = audio_details[0]
-                        audionames = audio_details[1]
-                elif len(audio_details) == 3:
-                    audiogroup = audio_details[0]
-                    audionames = audio_details[1]
-                    if audio_details[2].isdigit():
-                        audiotimes = float(audio_details[2]) / 1000.0
-
-                # Add the details to the list
-                files.append((audiogroup, audiofiles, audionames, audiotimes))
-
+        files = catalog.get_entries()
+        groups = catalog.get_groups()
     except Exception as ex:
         errors.append(repr(ex))
         logging.error(f'Failed to initialise audio files: {repr(ex)}')
 
     # Get list of connected USB devices
-    ports = serial.tools.list_ports.comports()
-    usb_ports = [
-        p.description
-        for p in ports
-    ]
+    usb_ports = ports.get_descriptions()
 
     # Ensure that the preferred Arduino port is selected by default
-    selectedPort: int = 0
-    for index, item in enumerate(usb_ports):
-        if app.config['ARDUINO_PORT'] in item:
-            selectedPort = index
-            logger.info(f'Found serial port ({item}) index [{index}]')
-            break
+    selectedPort: int = ports.find_port(app.config['ARDUINO_PORT']) or 0
 
     # Automatically connect systems on startup
     global startup
@@ -324,12 +306,10 @@ def index():
                 else:
                     logging.warning("Auto-start Failed: Arduino communication")
 
-            # If user has selected for the camera stream to be active by default, turn it on now
+            # If user has selected for the camera stream to be active by default, start it in the background
             if app.config['AUTOSTART_CAM'] and not camera.is_stream_active():
-                if camera.start_stream():
-                    logging.info("Auto-start Complete: Camera stream")
-                else:
-                    logging.warning("Auto-start Failed: Camera stream")
+                camera.request_start()
+                logging.info("Auto-start Requested: Camera stream")
 
         except Exception as ex:
             errors.append(repr(ex))
@@ -337,10 +317,12 @@ def index():
 
     return render_template('index.html',
                            sounds=files,
+                           soundGroups=groups,
+                           lazySounds=len(files) > app.config['SOUND_LAZY_LOAD'],
                            ports=usb_ports,
                            portSelect=selectedPort,
                            connected=arduino.is_connected(),
-                           cameraActive=camera.is_stream_active(),
+                           cameraActive=camera.get_state()['state'] in ("starting", "running"),
                            errorMessages=errors)
 
 
@@ -381,7 +363,7 @@ def motor():
     if not session.get('active'):
         return redirect(url_for('login'))
 
-    global arduino
+    global arduino, governor
     stickX = request.form.get('stickX')
     stickY = request.form.get('stickY')
 
@@ -390,8 +372,8 @@ def motor():
         yVal = int(float(stickY) * 100)
 
         if arduino.is_connected():
-            arduino.send_command("X" + str(xVal))
-            arduino.send_command("Y" + str(yVal))
+            governor.send_command("X" + str(xVal))
+            governor.send_command("Y" + str(yVal))
             return jsonify({'status': 'OK'})
         else:
             return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
@@ -446,26 +428,16 @@ def settings():
         elif thing == "volume":
             global volume
             volume = int(value)
+            player.set_volume(volume)
 
         # Turn on/off the webcam
         elif thing == "streamer":
             logging.info("Turning on/off MJPG Streamer")
             global camera
-            result: int = 0
-
-            if not camera.is_stream_active():
-                response, error = camera.start_stream()
-                if response:
-                    time.sleep(1) # Give time for the stream to start fully
-                    return jsonify({'status': 'OK', 'streamer': 'Active'})
-                else:
-                    return jsonify({'status': 'Error', 'msg': f'Unable to start stream: {error}'})
 
-            else:
-                if camera.stop_stream():
-                    return jsonify({'status': 'OK', 'streamer': 'Offline'})
-                else:
-                    return jsonify({'status': 'Error', 'msg': 'Unable to stop the stream'})
+            # The camera starts or stops in the background; the page follows its state through /cameraStatus
+            state = camera.request_toggle()
+            return jsonify({'status': 'OK', 'streamer': state['state'], 'camera': state})
 
         # Restart the web-interface
         elif thing == "restart":
@@ -488,6 +460,29 @@ def settings():
         return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
 
 
+# =============================================================
+@app.route('/sounds')
+def sounds():
+    """
+    Get the catalog of sound clips, optionally only those of one group
+    Responds with 304 Not Modified if the catalog hasn't changed since the ETag in If-None-Match
+    :return: JSON containing the list of clips
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    try:
+        body, etag = catalog.get_json(request.args.get('group'))
+    except Exception as ex:
+        logger.error(f'Unable to read sound catalog: {repr(ex)}')
+        return jsonify({'status': 'Error', 'msg': 'Unable to read sound catalog'})
+
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
 # =============================================================
 @app.route('/audio', methods=['POST'])
 def audio():
@@ -500,27 +495,11 @@ def audio():
 
     clip = request.form.get('clip')
     if clip is not None:
-        clip = f"{app.config['SOUND_FOLDER']}{clip}.{app.config['SOUND_FORMAT']}"
-
-        # Volume control only on linux via amixer
-        if sys.platform == "linux":
-            audiomixer_cmd = ["amixer", "sset", "Master", "{}%".format(volume * 10)]
-            subprocess.run(audiomixer_cmd,
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
-
-        p = subprocess.Popen(app.config['AUDIOPLAYER_CMD'] + [clip],
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-
-        if app.config['APP_DEBUG']:
-            p.wait()
-            if p.stderr is not None:
-                logger.error(p.stderr.readlines())
-            if p.stdout is not None:
-                logger.info(p.stdout.readlines())
-
-        return jsonify({'status': 'OK'})
+        job = submit_audio(clip)
+        if job is not None:
+            return jsonify({'status': 'OK', 'job': job.id})
+        else:
+            return jsonify({'status': 'Error', 'msg': 'Too many sounds waiting to play'})
     else:
         return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
 
@@ -538,53 +517,74 @@ def tts():
 
     text = request.form.get('text')
 
-    # Shell commands
-    espeak_cmd = app.config['ESPEAK_CMD']
-    rb_cmd = app.config['RB_CMD']
-
     # Don't react to empty strings
     if text is not None and text != "":
+        job = submit_speech(text)
+        if job is not None:
+            return jsonify({'status': 'OK', 'job': job.id})
+        else:
+            return jsonify({'status': 'Error', 'msg': 'Too many phrases waiting to be spoken'})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
 
-        infile = tempfile.NamedTemporaryFile()
-        outfile = tempfile.NamedTemporaryFile()
 
-        text_e = text.encode('utf8')
-        espeak_args = ['-w', infile.name, text_e]
+# =============================================================
+@app.route('/jobStatus', methods=['POST'])
+def jobStatus():
+    """
+    Get the state of a speech or audio job
+    :return: JSON containing the job state and whether its audio is playing, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
 
-        try:
-            # Generate Speech
-            subprocess.run(espeak_cmd + espeak_args,
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
+    job_id = request.form.get('job')
+    job = jobs.get(job_id) if job_id is not None else None
 
-            if not rb_cmd:
-                outfile = infile
+    if job is not None:
+        return jsonify({'status': 'OK', 'job': job.to_dict(), 'playing': player.is_playing(job.id)})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Unknown job'})
 
-            else:
-                # Shift pitch
-                subprocess.run(rb_cmd + [infile.name, outfile.name],
-                               stdout=subprocess.DEVNULL,
-                               stderr=subprocess.DEVNULL)
-
-            # Volume control only on linux via amixer
-            if sys.platform == "linux":
-                audiomixer_cmd = ["amixer", "sset", "Master", "{}%".format(volume * 10)]
-                subprocess.run(audiomixer_cmd,
-                               stdout=subprocess.DEVNULL,
-                               stderr=subprocess.DEVNULL)
-
-            # Play it
-            subprocess.run(app.config['AUDIOPLAYER_CMD'] + [outfile.name],
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL)
-
-        finally:
-            infile.close()
-            outfile.close()
 
-        return jsonify({'status': 'OK'})
+# =============================================================
+@app.route('/jobCancel', methods=['POST'])
+def jobCancel():
+    """
+    Cancel a speech or audio job and stop its audio
+    Use job=all to cancel all jobs and stop all sounds ("stop talking")
+    :return: JSON response with success or error status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    job_id = request.form.get('job')
+
+    if job_id == "all":
+        cancelled = jobs.cancel_all()
+        player.stop_all()
+        return jsonify({'status': 'OK', 'cancelled': cancelled})
+
+    elif job_id is not None and jobs.get(job_id) is not None:
+        cancelled = jobs.cancel(job_id)
+        stopped = player.stop(job_id)
+        return jsonify({'status': 'OK', 'cancelled': int(cancelled or stopped)})
+
     else:
-        return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+        return jsonify({'status': 'Error', 'msg': 'Unknown job'})
+
+
+# =============================================================
+@app.route('/audioStatus', methods=['POST'])
+def audioStatus():
+    """
+    Get the statistics of the audio engine, the speech cache and the job queue
+    :return: JSON containing the statistics
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    return jsonify({'status': 'OK', 'audio': player.get_stats(), 'tts': tts_cache.get_stats(), 'jobs': jobs.get_stats()})
 
 
 # =============================================================
@@ -597,15 +597,17 @@ def animate():
     if not session.get('active'):
         return redirect(url_for('login'))
 
-    global arduino
+    global arduino, governor
     clip = request.form.get('clip')
 
     if clip is not None:
         logger.debug(f"Animate: {clip}")
 
         if arduino.is_connected():
-            arduino.send_command("A" + clip)
-            return jsonify({'status': 'OK'})
+            if governor.send_command("A" + clip):
+                return jsonify({'status': 'OK'})
+            else:
+                return jsonify({'status': 'Error', 'msg': 'Too many commands, please wait'})
         else:
             return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
     else:
@@ -622,7 +624,7 @@ def servoControl():
     if not session.get('active'):
         return redirect(url_for('login'))
 
-    global arduino
+    global arduino, governor
     servo = request.form.get('servo')
     value = request.form.get('value')
 
@@ -630,15 +632,346 @@ def servoControl():
         logger.debug(f"servo: {servo}")
         logger.debug(f"value: {value}")
 
+        if len(servo) != 1 or servo not in SERVO_CHANNELS + SERVO_PRESETS or not value.lstrip('-').isdigit():
+            return jsonify({'status': 'Error', 'msg': 'Unknown servo command'})
+
         if arduino.is_connected():
-            arduino.send_command(servo + value)
-            return jsonify({'status': 'OK'})
+            if governor.send_command(servo + value):
+                return jsonify({'status': 'OK'})
+            else:
+                return jsonify({'status': 'Error', 'msg': 'Too many commands, please wait'})
         else:
             return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
     else:
         return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
 
 
+# =============================================================
+@app.route('/programRun', methods=['POST'])
+def programRun():
+    """
+    Run an automation program on the server, replacing any program which is running
+    :return: JSON containing the id of the run, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global runner
+    program = request.form.get('program')
+
+    if program is not None:
+        try:
+            steps = parse_program(program)
+        except ValueError as ex:
+            return jsonify({'status': 'Error', 'msg': str(ex)})
+
+        if any(step['type'] in ("motor", "servo", "animation") for step in steps) and not arduino.is_connected():
+            return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
+
+        logger.debug(f"Program: {len(steps)} steps")
+        return jsonify({'status': 'OK', 'id': runner.start(steps)})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+
+
+# =============================================================
+@app.route('/programStop', methods=['POST'])
+def programStop():
+    """
+    Stop the automation program, and stop the motors
+    :return: JSON response with success status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global runner
+    return jsonify({'status': 'OK', 'stopped': int(runner.stop())})
+
+
+# =============================================================
+@app.route('/programStatus', methods=['POST'])
+def programStatus():
+    """
+    Get the progress of the automation program
+    :return: JSON containing the state, current block, printed messages and timing of the program
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global runner
+    return jsonify({'status': 'OK', 'program': runner.get_status()})
+
+
+# =============================================================
+@app.route('/trajectories')
+def trajectoryList():
+    """
+    Get the list of saved servo trajectories
+    :return: JSON containing the file name, name and length of each trajectory
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    return jsonify({'status': 'OK', 'trajectories': trajectories.list()})
+
+
+# =============================================================
+@app.route('/trajectoryPlay', methods=['POST'])
+def trajectoryPlay():
+    """
+    Stream a servo trajectory to the Arduino
+    Either the file name of a saved trajectory, or a trajectory as JSON, can be given
+    :return: JSON containing the id of the run, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global trajectory_player
+    name = request.form.get('name')
+    data = request.form.get('trajectory')
+
+    try:
+        if name is not None:
+            trajectory = trajectories.load(name)
+        elif data is not None:
+            trajectory = parse_trajectory(json.loads(data))
+        else:
+            return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+    except FileNotFoundError:
+        return jsonify({'status': 'Error', 'msg': 'Unknown trajectory'})
+    except (OSError, ValueError) as ex:
+        return jsonify({'status': 'Error', 'msg': str(ex)})
+
+    if arduino.is_connected():
+        return jsonify({'status': 'OK', 'id': trajectory_player.play(trajectory)})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
+
+
+# =============================================================
+@app.route('/trajectoryStop', methods=['POST'])
+def trajectoryStop():
+    """
+    Stop streaming the servo trajectory
+    :return: JSON response with success status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global trajectory_player
+    return jsonify({'status': 'OK', 'stopped': int(trajectory_player.stop())})
+
+
+# =============================================================
+@app.route('/trajectoryStatus', methods=['POST'])
+def trajectoryStatus():
+    """
+    Get the progress of the servo trajectory
+    :return: JSON containing the state and flow control statistics of the trajectory
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global trajectory_player
+    return jsonify({'status': 'OK', 'trajectory': trajectory_player.get_status()})
+
+
+# =============================================================
+@app.route('/trajectorySave', methods=['POST'])
+def trajectorySave():
+    """
+    Save a servo trajectory in the library, replacing any with the same file name
+    :return: JSON response with success or error status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    name = request.form.get('name')
+    data = request.form.get('trajectory')
+
+    if name is not None and data is not None:
+        try:
+            trajectories.save(name, parse_trajectory(json.loads(data)))
+            return jsonify({'status': 'OK'})
+        except ValueError as ex:
+            return jsonify({'status': 'Error', 'msg': str(ex)})
+        except OSError as ex:
+            logger.error(f'Unable to save trajectory: {repr(ex)}')
+            return jsonify({'status': 'Error', 'msg': 'Unable to save trajectory'})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+
+
+# =============================================================
+@app.route('/trajectoryDelete', methods=['POST'])
+def trajectoryDelete():
+    """
+    Delete a saved servo trajectory
+    :return: JSON response with success or error status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    name = request.form.get('name')
+
+    try:
+        if name is not None and trajectories.delete(name):
+            return jsonify({'status': 'OK'})
+        else:
+            return jsonify({'status': 'Error', 'msg': 'Unknown trajectory'})
+    except (OSError, ValueError) as ex:
+        return jsonify({'status': 'Error', 'msg': str(ex)})
+
+
+# =============================================================
+@app.route('/sessions')
+def sessionList():
+    """
+    Get the list of recorded control sessions
+    :return: JSON containing the name, number of log files and size of each recording
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    return jsonify({'status': 'OK', 'sessions': list_recordings(app.config['SESSION_FOLDER'])})
+
+
+# =============================================================
+@app.route('/sessionRecord', methods=['POST'])
+def sessionRecord():
+    """
+    Start or stop recording the commands sent to the Arduino
+    :return: JSON containing the name of the recording, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global recorder
+    action = request.form.get('action')
+
+    if action == 'start':
+        try:
+            return jsonify({'status': 'OK', 'name': recorder.start(request.form.get('name', ''))})
+        except ValueError as ex:
+            return jsonify({'status': 'Error', 'msg': str(ex)})
+    elif action == 'stop':
+        return jsonify({'status': 'OK', 'name': recorder.stop()})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+
+
+# =============================================================
+@app.route('/sessionReplay', methods=['POST'])
+def sessionReplay():
+    """
+    Send the commands of a recorded session to the Arduino again
+    The speed is a factor of the recorded speed, or 0 to send the commands as fast as possible
+    :return: JSON containing the id of the replay, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global replayer
+    name = request.form.get('name')
+
+    try:
+        speed = float(request.form.get('speed', 1))
+        if name is None or not 0 <= speed <= 1000:
+            return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
+        entries = read_recording(app.config['SESSION_FOLDER'], name)
+    except FileNotFoundError:
+        return jsonify({'status': 'Error', 'msg': 'Unknown recording'})
+    except (OSError, ValueError) as ex:
+        return jsonify({'status': 'Error', 'msg': str(ex)})
+
+    if arduino.is_connected():
+        return jsonify({'status': 'OK', 'id': replayer.play(name, entries, speed)})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
+
+
+# =============================================================
+@app.route('/sessionStop', methods=['POST'])
+def sessionStop():
+    """
+    Stop replaying a recorded session
+    :return: JSON response with success status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global replayer
+    return jsonify({'status': 'OK', 'stopped': int(replayer.stop())})
+
+
+# =============================================================
+@app.route('/sessionStatus', methods=['POST'])
+def sessionStatus():
+    """
+    Get the state of the session recording and replay
+    :return: JSON containing the recording and replay status
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global recorder, replayer
+    return jsonify({'status': 'OK', 'recording': recorder.get_status(), 'replay': replayer.get_status()})
+
+
+# =============================================================
+@app.route('/controlToken', methods=['POST'])
+def controlToken():
+    """
+    Issue a token for the WebSocket control channel
+    :return: JSON containing the token and port of the control channel, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global control
+
+    if control.is_active():
+        return jsonify({'status': 'OK', 'token': control.issue_token(), 'port': app.config['CONTROL_PORT']})
+    else:
+        return jsonify({'status': 'Error', 'msg': 'Control channel not active'})
+
+
+# =============================================================
+@app.route('/fastToken', methods=['POST'])
+def fastToken():
+    """
+    Get the token for the fast lane control endpoint, which is kept for the whole session
+    :return: JSON containing the token and path of the fast lane, or an error
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global fast_lane
+
+    if not app.config['FAST_LANE']:
+        return jsonify({'status': 'Error', 'msg': 'Fast lane not active'})
+
+    token = session.get('fast_token')
+    if token is None or not fast_lane.is_valid_token(token):
+        token = fast_lane.issue_token()
+        session['fast_token'] = token
+    return jsonify({'status': 'OK', 'token': token, 'path': fast_lane.path})
+
+
+# =============================================================
+@app.route('/cameraStatus', methods=['POST'])
+def cameraStatus():
+    """
+    Get the state of the camera stream
+    :return: JSON containing the active stream profile and client statistics
+    """
+    if not session.get('active'):
+        return redirect(url_for('login'))
+
+    global camera
+    return jsonify({'status': 'OK', 'camera': camera.get_status()})
+
+
 # =============================================================
 @app.route('/arduinoConnect', methods=['POST'])
 def arduinoConnect():
@@ -658,17 +991,13 @@ def arduinoConnect():
             logger.debug("Reload list of connected USB ports")
 
             # Get list of connected USB devices
-            ports = serial.tools.list_ports.comports()
-            usb_ports = [p.description for p in ports]
+            usb_ports = ports.get_descriptions()
 
             # Ensure that the preferred Arduino port is selected by default
-            selectedPort = 0
-            for index, item in enumerate(usb_ports):
-                if app.config['ARDUINO_PORT'] in item:
-                    selectedPort = index
-                    break
+            selectedPort = ports.find_port(app.config['ARDUINO_PORT']) or 0
 
-            return jsonify({'status': 'OK', 'ports': usb_ports, 'portSelect': selectedPort})
+            return jsonify({'status': 'OK', 'ports': usb_ports, 'portSelect': selectedPort,
+                            'version': ports.get_stats()['version']})
 
         # If we want to connect/disconnect Arduino device
         elif action == "reconnect":
@@ -685,20 +1014,13 @@ def arduinoConnect():
                 if port is not None and port.isdigit():
                     portNum = int(port)
 
-                    # Test whether connection to the selected port is possible
-                    ports = serial.tools.list_ports.comports()
-                    usb_ports = [p.device for p in ports]
+                    usb_ports = ports.get_devices()
 
                     if portNum >= 0 and portNum < len(usb_ports):
-                        # Try opening and closing port to see if connection is possible
-                        try:
-                            ser = serial.Serial(usb_ports[portNum], 115200)
-                            if (ser.inWaiting() > 0):
-                                ser.flushInput()
-                            ser.close()
-                            arduino.connect(usb_ports[portNum])
+                        # The input buffer is cleared when the port is opened
+                        if arduino.connect(usb_ports[portNum]):
                             return jsonify({'status': 'OK', 'arduino': 'Connected'})
-                        except:
+                        else:
                             return jsonify({'status': 'Error', 'msg': 'Unable to connect to selected serial port'})
                     else:
                         return jsonify({'status': 'Error', 'msg': 'Invalid serial port selected'})
@@ -710,12 +1032,31 @@ def arduinoConnect():
         return jsonify({'status': 'Error', 'msg': 'Unable to read [action] POST data'})
 
 
+# =============================================================
+@app.route('/metrics')
+def metrics():
+    """
+    Get the metrics in the Prometheus text exposition format
+    Available to logged-in browsers, or to scrapers which send the METRICS_TOKEN
+    :return: The metrics document
+    """
+    token = app.config['METRICS_TOKEN']
+    authorised = session.get('active') or (token != "" and request.headers.get('Authorization') == f'Bearer {token}')
+
+    if not app.config['METRICS']:
+        return ('Metrics are disabled', 404)
+    if not authorised:
+        return ('Unauthorised', 401)
+
+    return app.response_class(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # =============================================================
 @app.route('/arduinoStatus', methods=['POST'])
 def arduinoStatus():
     """
     Update the Arduino Status
-    :return: JSON containing the current battery level, or an error
+    :return: JSON containing the battery level, queue statistics or serial port changes, or an error
     """
 
     if not session.get('active'):
@@ -737,6 +1078,35 @@ def arduinoStatus():
             else:
                 return jsonify({'status': 'Error', 'msg': 'Arduino not connected'})
 
+        # Serial send queue depth and coalesced/dropped command counters
+        elif action == "queue":
+            return jsonify({'status': 'OK', 'queue': arduino.get_queue_stats()})
+
+        # Rate limiting counters and watchdog state of the commands sent by clients
+        elif action == "governor":
+            return jsonify({'status': 'OK', 'governor': governor.get_status()})
+
+        # Serial ports which have been plugged in or removed since the given version
+        elif action == "ports":
+            since = request.form.get('since', '0')
+            events = ports.get_events(int(since) if since.isdigit() else 0)
+            return jsonify({'status': 'OK', 'ports': ports.get_descriptions(), 'events': events,
+                            'connected': arduino.is_connected(), 'version': ports.get_stats()['version']})
+
+        # Latest telemetry values, a time series and the events newer than the given id
+        elif action == "telemetry":
+            since = request.form.get('since', '0')
+            series = request.form.get('series', 'battery')
+            telemetry = arduino.telemetry
+            return jsonify({'status': 'OK', 'telemetry': telemetry.get_snapshot(),
+                            'series': telemetry.get_series(series),
+                            'events': telemetry.wait_for_events(int(since) if since.isdigit() else 0, 0)})
+
+        # Round-trip latency percentiles and lost commands for each command type
+        elif action == "latency":
+            return jsonify({'status': 'OK', 'latency': arduino.telemetry.get_latency_stats(),
+                            'queue': arduino.get_queue_stats()})
+
     return jsonify({'status': 'Error', 'msg': 'Unable to read POST data'})
 
 
@@ -748,10 +1118,33 @@ def arduinoStatus():
 ###############################################################
 
 if __name__ == '__main__':
+    # Report how long each module takes to import, instead of starting the web-interface
+    if '--profile-startup' in sys.argv:
+        from startup_profile import profile_startup
+        sys.exit(profile_startup())
+
+    # Start the WebSocket control channel next to the web server
+    # (in debug mode, only in the reloader process which serves requests)
+    if app.config['CONTROL_SOCKET'] and (not app.config['APP_DEBUG'] or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        control.start(app.config['CONTROL_PORT'])
+
+    # Watch for the Arduino being unplugged and plugged back in, and for clients which stop sending motor commands
+    if not app.config['APP_DEBUG'] or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ports.start()
+        governor.start()
+
+    # Decode the sound clips, generate common phrases and open the camera in the background,
+    # so the first playback and the first stream start quickly
+    if not app.config['APP_DEBUG'] or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        Thread(target=player.preload, daemon=True).start()
+        jobs.submit('warmup', lambda job: tts_cache.warm_up(app.config['TTS_WARMUP']), PRIORITY_LOW)
+        camera.warm_up()
+
     # Debug mode
     if app.config['APP_DEBUG']:
         app.run(port=app.config['APP_PORT'], debug=app.config['APP_DEBUG'], host='0.0.0.0')
     
     # Production mode
     else:
+        from waitress import serve
         serve(app, host='0.0.0.0', port=app.config['APP_PORT'])
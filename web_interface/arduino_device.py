@@ -0,0 +1,626 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       arduino_device.py
+# @brief      Serial communication with the Wall-e Arduino controller
+# @author     Simon Bluett
+# @website    https://wired.chillibasket.com
+# @copyright  Copyright (C) 2021-2024 - Distributed under MIT license
+#############################################
+
+import os
+import time
+import logging
+from collections import deque
+from threading import Condition, Event, Thread
+from serial import Serial
+import serial_protocol
+from serial_ports import PortRegistry, port_matches, list_ports
+from telemetry import Telemetry
+
+
+logger = logging.getLogger(__name__)
+
+# Timeout (seconds) for blocking serial reads; this bounds how long the
+# reader thread takes to notice that the device is being disconnected
+READ_TIMEOUT: float = 0.1
+
+# Commands which set a continuous value (motors and servos); a new value
+# for one of these channels replaces any value which has not been sent yet
+SETPOINT_CHANNELS: str = "XYLRBTGEU"
+
+# Servo commands which clients can send: the position (0-100) of each servo,
+# and the head, eye and arm presets. The keyframe and queue commands used to
+# stream trajectories (K, J, P, Q) are only sent by the web-interface itself
+SERVO_CHANNELS: str = "LRBTGEU"
+SERVO_PRESETS: str = "fghijklbnm"
+
+# Maximum number of one-shot commands (animations, settings) which can be
+# waiting to be sent; further commands are dropped until there is space
+MAX_QUEUE_LENGTH: int = 100
+
+# Attempts to reconnect when the serial port reappears, and the delay (seconds)
+# between them; udev may need a moment to set the permissions of a new device
+RECONNECT_ATTEMPTS: int = 3
+RECONNECT_DELAY: float = 0.5
+
+
+
+###############################################################
+#
+# Command Queue Class
+#
+###############################################################
+
+class CommandQueue:
+    """
+    Outbound command queue with "latest-value-wins" setpoint channels
+
+    Setpoint commands (see SETPOINT_CHANNELS) are keyed by their first
+    character: if an unsent command for the same channel is already in
+    the queue, its value is replaced in place. All other commands are
+    one-shot and keep strict FIFO order.
+    """
+
+    # ---------------------------------------------------------
+    def __init__(self, max_length: int = MAX_QUEUE_LENGTH):
+        """
+        Constructor
+        :param max_length: Maximum number of one-shot commands in the queue
+        """
+        self.max_length: int = max_length
+        self.condition: Condition = Condition()
+        self.entries: deque[list[str]] = deque()
+        self.pending: dict[str, list[str]] = {}
+        self.one_shot_count: int = 0
+        self.stats: dict[str, dict[str, int]] = {}
+
+    # ---------------------------------------------------------
+    def __channel_stats(self, channel: str) -> dict[str, int]:
+        """
+        Get the counters of a channel, creating them if necessary
+        :param channel: The command character
+        :return: Dictionary of counters for the channel
+        """
+        stats = self.stats.get(channel)
+        if stats is None:
+            stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'dropped': 0}
+            self.stats[channel] = stats
+        return stats
+
+    # ---------------------------------------------------------
+    def put(self, command: str) -> bool:
+        """
+        Add a command to the queue
+        :param command: The command to be sent
+        :return: True if the command was queued, False if it was dropped
+        """
+        if not command:
+            return False
+
+        channel = command[0]
+
+        with self.condition:
+            stats = self.__channel_stats(channel)
+
+            if channel in SETPOINT_CHANNELS:
+                entry = self.pending.get(channel)
+
+                # Replace the unsent value, keeping its place in the queue
+                if entry is not None:
+                    entry[1] = command
+                    stats['coalesced'] += 1
+                    return True
+
+                entry = [channel, command]
+                self.pending[channel] = entry
+
+            elif self.one_shot_count >= self.max_length:
+                stats['dropped'] += 1
+                return False
+
+            else:
+                entry = [channel, command]
+                self.one_shot_count += 1
+
+            self.entries.append(entry)
+            stats['queued'] += 1
+            self.condition.notify()
+
+        return True
+
+    # ---------------------------------------------------------
+    def put_group(self, commands: list[str]) -> bool:
+        """
+        Add a group of commands which must reach the device together and in order
+        The group is a single one-shot entry, so setpoint commands inside it are
+        never coalesced, and no other command can be sent in the middle of it.
+        :param commands: The commands to be sent
+        :return: True if the group was queued, False if it was dropped
+        """
+        if not commands:
+            return False
+
+        channel = commands[0][0]
+
+        with self.condition:
+            stats = self.__channel_stats(channel)
+
+            if self.one_shot_count >= self.max_length:
+                stats['dropped'] += 1
+                return False
+
+            self.entries.append([channel, list(commands)])
+            self.one_shot_count += 1
+            stats['queued'] += 1
+            self.condition.notify()
+
+        return True
+
+    # ---------------------------------------------------------
+    def get(self, timeout: float | None = None) -> str | list[str] | None:
+        """
+        Remove the oldest command from the queue, waiting if it is empty
+        :param timeout: Maximum time to wait in seconds (None = forever)
+        :return: The command (or list of commands added by put_group), or None if woken up without a command
+        """
+        with self.condition:
+            if not self.entries:
+                self.condition.wait(timeout)
+            return self.__pop()
+
+    # ---------------------------------------------------------
+    def get_nowait(self) -> str | list[str] | None:
+        """
+        Remove the oldest command from the queue without waiting
+        :return: The command (or list of commands), or None if the queue is empty
+        """
+        with self.condition:
+            return self.__pop()
+
+    # ---------------------------------------------------------
+    def __pop(self) -> str | list[str] | None:
+        """
+        Remove the oldest command; the condition lock must be held
+        :return: The command (or list of commands), or None if the queue is empty
+        """
+        if not self.entries:
+            return None
+
+        channel, command = self.entries.popleft()
+
+        if channel in SETPOINT_CHANNELS and type(command) is str:
+            del self.pending[channel]
+        else:
+            self.one_shot_count -= 1
+
+        self.stats[channel]['sent'] += 1
+        return command
+
+    # ---------------------------------------------------------
+    def wake(self):
+        """
+        Wake up any threads waiting in get()
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    # ---------------------------------------------------------
+    def clear(self) -> int:
+        """
+        Drop all unsent commands
+        :return: The number of commands which were dropped
+        """
+        with self.condition:
+            dropped = len(self.entries)
+            for channel, command in self.entries:
+                self.stats[channel]['dropped'] += 1
+            self.entries.clear()
+            self.pending.clear()
+            self.one_shot_count = 0
+        return dropped
+
+    # ---------------------------------------------------------
+    def qsize(self) -> int:
+        """
+        Get the number of commands waiting to be sent
+        :return: Number of commands in the queue
+        """
+        return len(self.entries)
+
+    # ---------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the queue depth and per-channel counters
+        :return: Dictionary containing the queue statistics
+        """
+        with self.condition:
+            return {
+                'depth': len(self.entries),
+                'coalesced': sum(s['coalesced'] for s in self.stats.values()),
+                'dropped': sum(s['dropped'] for s in self.stats.values()),
+                'channels': {c: dict(s) for c, s in self.stats.items()},
+            }
+
+# End of class: CommandQueue
+
+
+
+###############################################################
+#
+# Arduino Device Class
+#
+###############################################################
+
+class ArduinoDevice:
+    """Class used for managing communication with the Arduino"""
+
+    # ---------------------------------------------------------
+    def __init__(self, protocol: str = "ascii", ports: PortRegistry | None = None,
+                 preferred_port: str = ""):
+        """
+        Constructor for Arduino serial communication thread class
+        :param protocol: "ascii" for the text protocol, or "binary" to use the
+                         compact framed protocol if the Arduino supports it
+        :param ports: Registry of serial ports; if given, the device disconnects when
+                      its port is removed, and reconnects when the port reappears
+        :param preferred_port: Device path or description of a port which is connected
+                               automatically when it is plugged in (blank = none)
+        """
+        self.protocol: str = protocol
+        self.ports: PortRegistry | None = ports
+        self.preferred_port: str = preferred_port
+        self.reconnect_paused: bool = False
+        self.binary_active: bool = False
+        self.sequence: int = 0
+        self.queue: CommandQueue = CommandQueue()
+        self.exit_flag: Event = Event()
+        self.port_name: str = ""
+        self.serial_port: Serial | None = None
+        self.writer_thread: Thread | None = None
+        self.reader_thread: Thread | None = None
+        self.battery_level: str | None = None
+        self.telemetry: Telemetry = Telemetry()
+        self.bytes_sent: int = 0
+        self.bytes_received: int = 0
+        self.listeners: list = []
+        self.recorder = None
+        self.exit_flag.clear()
+
+        if self.ports is not None:
+            self.ports.add_listener(self.__ports_changed)
+
+    # ---------------------------------------------------------
+    def __del__(self):
+        """Destructor - ensures serial port is closed correctly"""
+        self.disconnect()
+
+    # ---------------------------------------------------------
+    def connect(self, port: str | int = "") -> bool:
+        """
+        Connect to the serial port
+        :param port: The port to connect to (leave blank to use previous port)
+        :return: True if connected successfully, False otherwise
+        """
+        try:
+            if self.ports is not None:
+                usb_ports = self.ports.get_devices()
+            else:
+                usb_ports = [
+                    p.device for p in list_ports()
+                ]
+
+            if type(port) is str and port == "":
+                port = self.port_name
+
+            if type(port) is int and port >= 0 and port < len(usb_ports):
+                port = usb_ports[port]
+
+            # Devices which are not enumerated (eg. /dev/serial/by-id links)
+            # can still be opened directly using their path
+            port_exists = port in usb_ports or (type(port) is str and os.path.exists(port))
+
+            # Check port exists and we are not already connected
+            if ((not self.is_connected() or port != self.port_name) and port_exists):
+
+                # Ensure old port is properly disconnected first
+                self.disconnect()
+
+                # Connect to the new port
+                self.serial_port = Serial(port, 115200, timeout=READ_TIMEOUT)
+                self.serial_port.reset_input_buffer()
+                self.port_name = port
+
+                # Ask the Arduino whether it supports the binary protocol;
+                # commands are sent as text until it confirms that it does
+                self.binary_active = False
+                if self.protocol == "binary":
+                    self.queue.put(f"V{serial_protocol.PROTOCOL_VERSION}")
+
+                # Start the command handlers in background threads
+                self.exit_flag.clear()
+                self.writer_thread = Thread(target = self.__writer_thread)
+                self.reader_thread = Thread(target = self.__reader_thread)
+                self.writer_thread.start()
+                self.reader_thread.start()
+                self.telemetry.set_connected(True)
+
+            self.reconnect_paused = False
+
+        except Exception as ex:
+            logger.error(f'Serial connect error: {repr(ex)}')
+
+        return self.is_connected()
+
+    # ---------------------------------------------------------
+    def disconnect(self) -> bool:
+        """
+        Disconnect from the serial port
+        The port is not reconnected automatically until connect() is called again.
+        :return: True if disconnected successfully, False otherwise
+        """
+        try:
+            self.reconnect_paused = True
+            self.battery_level = None
+            self.binary_active = False
+            self.exit_flag.set()
+
+            if self.writer_thread is not None:
+                # Wake up the writer thread if it is waiting for commands
+                self.queue.wake()
+                self.writer_thread.join()
+                self.writer_thread = None
+
+            if self.reader_thread is not None:
+                self.reader_thread.join()
+                self.reader_thread = None
+
+            if self.serial_port is not None:
+                self.serial_port.close()
+                self.serial_port = None
+
+            self.clear_queue()
+            self.telemetry.set_connected(False)
+
+        except Exception as ex:
+            logger.error(f'Serial disconnect error: {repr(ex)}')
+
+        return (self.writer_thread is None and self.reader_thread is None
+            and self.serial_port is None)
+
+    # ---------------------------------------------------------
+    def is_connected(self) -> bool:
+        """
+        Check if serial device is connected
+        :return: True if connected, False otherwise
+        """
+        return (self.writer_thread is not None and self.writer_thread.is_alive()
+             and self.reader_thread is not None and self.reader_thread.is_alive()
+             and self.serial_port is not None and self.serial_port.is_open)
+
+    # ---------------------------------------------------------
+    def send_command(self, command: str) -> bool:
+        """
+        Send a serial command
+        :param command: The command to be sent
+        :return: True if port is open and message has been added to queue
+        """
+        success = False
+
+        if self.is_connected():
+            success = self.queue.put(command)
+            if success and self.recorder is not None:
+                self.recorder.record_command(command)
+
+        return success
+
+    # ---------------------------------------------------------
+    def send_commands(self, commands: list[str]) -> bool:
+        """
+        Send a group of serial commands, which reach the Arduino together and in order
+        :param commands: The commands to be sent
+        :return: True if port is open and the commands have been added to queue
+        """
+        success = False
+
+        if self.is_connected():
+            success = self.queue.put_group(commands)
+            if success and self.recorder is not None:
+                self.recorder.record_command(commands)
+
+        return success
+
+    # ---------------------------------------------------------
+    def add_listener(self, listener):
+        """
+        Register a function which is called with every message received from the Arduino
+        :param listener: Function called with (event type, value), as returned by telemetry.parse_message()
+        """
+        self.listeners = self.listeners + [listener]
+
+    # ---------------------------------------------------------
+    def set_recorder(self, recorder):
+        """
+        Log the commands sent to, and the messages received from, the Arduino
+        :param recorder: SessionRecorder to log to, or None to stop logging
+        """
+        self.recorder = recorder
+
+    # ---------------------------------------------------------
+    def clear_queue(self):
+        """
+        Clear the serial send queue
+        """
+        self.queue.clear()
+
+    # ---------------------------------------------------------
+    def get_queue_stats(self) -> dict:
+        """
+        Get statistics about the serial send queue
+        :return: Dictionary with the queue depth and per-channel counters
+        """
+        return self.queue.get_stats()
+
+    # ---------------------------------------------------------
+    def get_traffic_stats(self) -> dict:
+        """
+        Get the amount of data sent and received over the serial port
+        :return: Dictionary with the byte counters since the device was created
+        """
+        return {'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
+
+    # ---------------------------------------------------------
+    def get_battery_level(self) -> str | None:
+        """
+        Get the robot battery level
+        :return: The battery level as a string, or None
+        """
+        return self.battery_level
+
+    # ---------------------------------------------------------
+    def __ports_changed(self, added: list, removed: list):
+        """
+        Disconnect when the serial port is removed, and reconnect when it reappears
+        :param added: List of ports which have been plugged in
+        :param removed: List of ports which have been removed
+        """
+        if self.serial_port is not None and any(p.device == self.port_name for p in removed):
+            logger.warning(f'Arduino port removed ({self.port_name})')
+            self.disconnect()
+            self.reconnect_paused = False
+
+        if self.is_connected() or self.reconnect_paused:
+            return
+
+        for port in added:
+            if (port.device == self.port_name
+                    or (self.preferred_port != "" and port_matches(port, self.preferred_port))):
+                logger.info(f'Reconnecting to Arduino ({port.device})')
+                for attempt in range(RECONNECT_ATTEMPTS):
+                    if attempt > 0:
+                        time.sleep(RECONNECT_DELAY)
+                    if self.connect(port.device):
+                        break
+
+                # Allow another attempt the next time the port is plugged in
+                if not self.is_connected():
+                    self.reconnect_paused = False
+                break
+
+    # ---------------------------------------------------------
+    def __writer_thread(self):
+        """
+        Send queued commands to the serial device as soon as they arrive
+        """
+        logger.info(f'Starting Arduino writer thread ({self.port_name})')
+
+        while not self.exit_flag.is_set():
+            try:
+                # Block until at least one command is available
+                command = self.queue.get()
+                if command is None:
+                    continue
+
+                # Drain any other commands which are already waiting,
+                # so that they go out together in a single write
+                commands = []
+
+                while command is not None:
+                    if type(command) is list:
+                        commands.extend(command)
+                    else:
+                        commands.append(command)
+                    command = self.queue.get_nowait()
+
+                if self.binary_active:
+                    data, self.sequence, frames = serial_protocol.encode_commands(
+                        commands, self.sequence, serial_protocol.FLAG_ACK)
+                    self.telemetry.record_sent(commands, frames)
+                else:
+                    data = ''.join(f'{c}\n' for c in commands).encode()
+                    self.telemetry.record_sent(commands)
+
+                self.serial_port.write(data)
+                self.bytes_sent += len(data)
+
+            # If an error occured in the serial communication
+            except Exception as ex:
+                logger.error(f'Serial writer error: {repr(ex)}')
+                self.exit_flag.wait(READ_TIMEOUT)
+
+        logger.info(f'Stopping Arduino writer thread ({self.port_name})')
+
+    # ---------------------------------------------------------
+    def __reader_thread(self):
+        """
+        Receive data from the serial device and split it into messages
+        """
+        buffer = bytearray()
+        logger.info(f'Starting Arduino reader thread ({self.port_name})')
+
+        while not self.exit_flag.is_set():
+            try:
+                # Block until data arrives (or the read times out), then
+                # read everything which is already waiting in one go
+                data = self.serial_port.read(max(1, self.serial_port.in_waiting))
+                if not data:
+                    continue
+                self.bytes_received += len(data)
+
+                # Messages can be terminated by either '\n' or '\r'
+                buffer += data.replace(b'\r', b'\n')
+
+                if b'\n' in data or b'\r' in data:
+                    *lines, remainder = buffer.split(b'\n')
+                    buffer = bytearray(remainder)
+
+                    for line in lines:
+                        if line:
+                            self.__parse_message(line.decode(errors='replace'))
+
+            # If an error occured in the serial communication
+            except Exception as ex:
+                logger.error(f'Serial reader error: {repr(ex)}')
+                self.exit_flag.wait(READ_TIMEOUT)
+
+        logger.info(f'Stopping Arduino reader thread ({self.port_name})')
+
+    # ---------------------------------------------------------
+    def __parse_message(self, dataString: str):
+        """
+        Parse messages received from the connected device
+        :param dataString: String containing the serial message to be parsed
+        """
+        try:
+            if self.recorder is not None:
+                self.recorder.record_message(dataString)
+
+            kind, value = self.telemetry.handle_message(dataString)
+
+            # Battery level message
+            if kind == "battery":
+                self.battery_level = str(value)
+
+            # Arduino confirms that it supports the binary protocol
+            elif kind == "protocol" and value == serial_protocol.PROTOCOL_VERSION:
+                if self.protocol == "binary" and not self.binary_active:
+                    logger.info(f'Using binary serial protocol ({self.port_name})')
+                    self.binary_active = True
+
+            # Arduino has (re)started, so negotiate the protocol again
+            elif kind == "startup":
+                self.binary_active = False
+                if self.protocol == "binary":
+                    self.queue.put(f"V{serial_protocol.PROTOCOL_VERSION}")
+
+            # Frame was corrupted on the way to the Arduino
+            elif kind == "nack":
+                logger.warning(f'Arduino rejected frame {value} ({self.port_name})')
+
+            for listener in self.listeners:
+                listener(kind, value)
+
+        except Exception as ex:
+            logger.error(f'Error parsing message [{dataString}]: {repr(ex)}')
+
+# End of class: ArduinoDevice
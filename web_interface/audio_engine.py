@@ -0,0 +1,448 @@
+"""
+Audio engine for the Wall-e web-interface
+
+Sound clips are decoded once into PCM and kept in a memory-limited LRU
+cache. Playback goes through a single long-lived output sink (by default
+an aplay process reading raw PCM from a pipe), fed by a mixer thread
+which can play a limited number of overlapping clips. The volume is
+applied to the samples in software.
+
+Mixing and the volume are done with arrays of samples. Clips which are
+not already 16-bit 44.1 kHz stereo are converted with the audioop
+module, which is imported when it is first needed: it is part of the
+standard library up to Python 3.12 (deprecated from 3.11), and is
+provided by the "audioop-lts" package from 3.13.
+"""
+
+import io
+import os
+import math
+import time
+import wave
+import logging
+import warnings
+import subprocess
+from array import array
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+
+
+SAMPLE_RATE = 44100         # All clips are converted to this format
+CHANNELS = 2
+SAMPLE_WIDTH = 2            # Bytes per sample (signed 16-bit)
+FRAME_SIZE = CHANNELS * SAMPLE_WIDTH
+PERIOD_FRAMES = 512         # Frames mixed at a time (~12ms)
+MAX_LEAD = 0.05             # Seconds of audio written ahead of real time
+MAX_VOLUME = 10             # Same scale as the volume slider in the web-interface
+SINK_RETRY_INTERVAL = 5.0   # Seconds to wait before restarting a player which failed
+SAMPLE_MIN = -32768
+SAMPLE_MAX = 32767
+
+logger = logging.getLogger(__name__)
+_audioop = None
+
+
+# ----------------------------------------------------------------
+def get_audioop():
+    """
+    Import the audioop module the first time it is needed
+    :return: The audioop module
+    :raises ImportError: If audioop is not available (Python 3.13+ without audioop-lts)
+    """
+    global _audioop
+    if _audioop is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            import audioop
+        _audioop = audioop
+    return _audioop
+
+
+# ----------------------------------------------------------------
+def mix_samples(chunks: list[bytes], gain: float = 1.0) -> bytes:
+    """
+    Add blocks of 16-bit samples together and scale them, clipping the result
+    :param chunks: Blocks of PCM samples, all the same length
+    :param gain: Factor applied to the mixed samples
+    :return: The mixed PCM samples
+    """
+    if len(chunks) == 1 and gain == 1.0:
+        return chunks[0]
+
+    if len(chunks) == 1:
+        samples = array('h', chunks[0])
+    else:
+        samples = [sum(values) for values in zip(*(array('h', chunk) for chunk in chunks))]
+    if gain != 1.0:
+        samples = [math.floor(value * gain) for value in samples]
+
+    return array('h', [SAMPLE_MIN if value < SAMPLE_MIN else SAMPLE_MAX if value > SAMPLE_MAX else value
+                       for value in samples]).tobytes()
+
+
+# ----------------------------------------------------------------
+def decode_wav(source) -> bytes:
+    """
+    Read a WAV file and convert it to the output format of the engine
+    :param source: Location of the file, or a file-like object
+    :return: The PCM samples
+    """
+    with wave.open(source, 'rb') as file:
+        channels = file.getnchannels()
+        width = file.getsampwidth()
+        rate = file.getframerate()
+        pcm = file.readframes(file.getnframes())
+
+    if width == SAMPLE_WIDTH and channels == CHANNELS and rate == SAMPLE_RATE:
+        return pcm
+
+    audioop = get_audioop()
+    if width == 1:
+        # 8-bit WAV files are unsigned
+        pcm = audioop.bias(pcm, 1, -128)
+    if width != SAMPLE_WIDTH:
+        pcm = audioop.lin2lin(pcm, width, SAMPLE_WIDTH)
+    if channels > 2:
+        raise ValueError(f'Unsupported number of channels: {channels}')
+    if rate != SAMPLE_RATE:
+        pcm = audioop.ratecv(pcm, SAMPLE_WIDTH, channels, rate, SAMPLE_RATE, None)[0]
+    if channels == 1:
+        pcm = audioop.tostereo(pcm, SAMPLE_WIDTH, 1, 1)
+
+    return pcm
+
+
+# ================================================================
+class ClipCache:
+    """Least-recently-used cache of decoded clips, limited by total size"""
+
+    def __init__(self, max_bytes: int):
+        """
+        Constructor
+        :param max_bytes: Maximum size of all cached clips together
+        """
+        self.max_bytes = max_bytes
+        self.clips: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock = Lock()
+
+    # ------------------------------------------------------------
+    def get(self, path: str) -> bytes:
+        """
+        Get the PCM samples of a clip, decoding it if it isn't cached yet
+        :param path: Location of the clip
+        :return: The PCM samples
+        """
+        mtime = os.path.getmtime(path)
+
+        with self.lock:
+            cached = self.clips.get(path)
+            if cached is not None and cached[0] == mtime:
+                self.clips.move_to_end(path)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        pcm = decode_wav(path)
+
+        with self.lock:
+            old = self.clips.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.clips[path] = (mtime, pcm)
+            self.size += len(pcm)
+
+            # Always keep the newest clip, even if it is larger than the limit
+            while self.size > self.max_bytes and len(self.clips) > 1:
+                _, (_, evicted) = self.clips.popitem(last=False)
+                self.size -= len(evicted)
+
+        return pcm
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the cache statistics
+        :return: Dictionary containing the number of clips, size, hits and misses
+        """
+        with self.lock:
+            return {'clips': len(self.clips), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+# ================================================================
+class ProcessSink:
+    """Output audio through a long-lived player process reading raw PCM from its stdin"""
+
+    def __init__(self, command: list[str]):
+        """
+        Constructor
+        :param command: The player command, which must accept raw PCM in the engine format
+        """
+        self.command = command
+        self.process: subprocess.Popen | None = None
+        self.retry_time: float = 0.0
+
+    def write(self, data: bytes):
+        """Send samples to the player, restarting it if it has exited"""
+        try:
+            if self.process is None or self.process.poll() is not None:
+                if time.monotonic() < self.retry_time:
+                    return
+                self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+        except OSError as ex:
+            logger.error(f'Audio player failed: {repr(ex)}')
+            self.process = None
+            self.retry_time = time.monotonic() + SINK_RETRY_INTERVAL
+
+    def close(self):
+        """Stop the player process"""
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(1)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process = None
+
+
+# ================================================================
+class NullSink:
+    """Discard all audio, for machines without a sound card"""
+
+    def write(self, data: bytes):
+        pass
+
+    def close(self):
+        pass
+
+
+# ================================================================
+class AudioEngine:
+    """Play sound clips from memory through a single output sink"""
+
+    def __init__(self, sound_folder: str, sound_format: str = "wav", sink_cmd: list[str] | None = None,
+                 cache_size: int = 32 * 1024 * 1024, max_voices: int = 4, sink=None):
+        """
+        Constructor
+        :param sound_folder: Folder containing the sound clips
+        :param sound_format: File extension of the sound clips
+        :param sink_cmd: Player command which reads raw PCM from stdin (None = discard audio)
+        :param cache_size: Maximum number of bytes of decoded audio to keep in memory
+        :param max_voices: Maximum number of clips playing at the same time
+        :param sink: Output sink to use instead of the player command
+        """
+        self.sound_folder = sound_folder
+        self.sound_format = sound_format
+        self.sink = sink if sink is not None else ProcessSink(sink_cmd) if sink_cmd else NullSink()
+        self.cache = ClipCache(cache_size)
+        self.max_voices = max_voices
+        self.volume: int = MAX_VOLUME
+        self.voices: list[list] = []
+        self.condition = Condition()
+        self.exit_flag = False
+        self.mixer_thread: Thread | None = None
+        self.dropped: int = 0
+
+    # ------------------------------------------------------------
+    def get_clip_path(self, clip: str) -> str:
+        """Location of a clip in the sound folder"""
+        return os.path.join(self.sound_folder, f'{clip}.{self.sound_format}')
+
+    # ------------------------------------------------------------
+    def play(self, clip: str, tag: str | None = None) -> bool:
+        """
+        Start playing a clip from the sound folder
+        :param clip: Name of the clip, without the file extension
+        :param tag: Label used to stop the clip later, such as a job id
+        :return: True if the clip is playing, False otherwise
+        """
+        path = self.get_clip_path(clip)
+        if os.path.basename(path) != f'{clip}.{self.sound_format}':
+            return False
+
+        try:
+            return self.play_pcm(self.cache.get(path), tag)
+        except Exception as ex:
+            logger.error(f'Unable to play clip {clip}: {repr(ex)}')
+            return False
+
+    # ------------------------------------------------------------
+    def play_file(self, path: str, tag: str | None = None) -> bool:
+        """
+        Play a WAV file which isn't cached, such as a generated voice clip
+        :param path: Location of the file
+        :param tag: Label used to stop the audio later, such as a job id
+        :return: True if the file is playing, False otherwise
+        """
+        try:
+            return self.play_pcm(decode_wav(path), tag)
+        except Exception as ex:
+            logger.error(f'Unable to play file {path}: {repr(ex)}')
+            return False
+
+    # ------------------------------------------------------------
+    def play_wav(self, data: bytes, tag: str | None = None, queue: bool = False) -> bool:
+        """
+        Play the contents of a WAV file held in memory
+        :param data: The WAV file contents
+        :param tag: Label used to stop the audio later, such as a job id
+        :param queue: Play after the audio with the same tag has finished, instead of mixing it
+        :return: True if the audio is playing, False otherwise
+        """
+        try:
+            return self.play_pcm(decode_wav(io.BytesIO(data)), tag, queue)
+        except Exception as ex:
+            logger.error(f'Unable to play audio: {repr(ex)}')
+            return False
+
+    # ------------------------------------------------------------
+    def play_pcm(self, pcm: bytes, tag: str | None = None, queue: bool = False) -> bool:
+        """
+        Add samples in the engine format to the mix
+        If the maximum number of voices is playing, the oldest one is stopped.
+        :param pcm: The PCM samples
+        :param tag: Label used to stop the samples later, such as a job id
+        :param queue: If audio with the same tag is playing, append the samples to it
+        :return: True if the samples were added
+        """
+        with self.condition:
+            if self.exit_flag:
+                return False
+
+            if self.mixer_thread is None:
+                self.mixer_thread = Thread(target=self.__mixer_thread, daemon=True)
+                self.mixer_thread.start()
+
+            if queue and tag is not None:
+                for voice in self.voices:
+                    if voice[2] == tag:
+                        voice[0] = memoryview(bytes(voice[0][voice[1]:]) + pcm)
+                        voice[1] = 0
+                        return True
+
+            while len(self.voices) >= self.max_voices:
+                self.voices.pop(0)
+                self.dropped += 1
+
+            self.voices.append([memoryview(pcm), 0, tag])
+            self.condition.notify()
+
+        return True
+
+    # ------------------------------------------------------------
+    def stop(self, tag: str) -> bool:
+        """
+        Stop the clips which were started with a tag
+        :param tag: The label given when the clips were started
+        :return: True if any clips were stopped
+        """
+        with self.condition:
+            count = len(self.voices)
+            self.voices = [voice for voice in self.voices if voice[2] != tag]
+            return len(self.voices) < count
+
+    # ------------------------------------------------------------
+    def is_playing(self, tag: str) -> bool:
+        """
+        Check whether a clip started with a tag is still playing
+        :param tag: The label given when the clip was started
+        :return: True if the clip is playing
+        """
+        with self.condition:
+            return any(voice[2] == tag for voice in self.voices)
+
+    # ------------------------------------------------------------
+    def stop_all(self):
+        """Stop all clips which are currently playing"""
+        with self.condition:
+            self.voices.clear()
+
+    # ------------------------------------------------------------
+    def set_volume(self, volume: int):
+        """
+        Set the playback volume
+        :param volume: Volume from 0 (silent) to 10 (full volume)
+        """
+        self.volume = max(0, min(MAX_VOLUME, int(volume)))
+
+    # ------------------------------------------------------------
+    def preload(self):
+        """Decode all clips in the sound folder, until the cache is full"""
+        try:
+            for filename in sorted(os.listdir(self.sound_folder)):
+                if filename.endswith(f'.{self.sound_format}'):
+                    self.cache.get(os.path.join(self.sound_folder, filename))
+                    if self.cache.size >= self.cache.max_bytes:
+                        break
+        except Exception as ex:
+            logger.error(f'Unable to preload sound clips: {repr(ex)}')
+
+    # ------------------------------------------------------------
+    def close(self):
+        """Stop playback and the output sink"""
+        with self.condition:
+            self.exit_flag = True
+            self.voices.clear()
+            self.condition.notify()
+
+        if self.mixer_thread is not None:
+            self.mixer_thread.join(1)
+            self.mixer_thread = None
+        self.sink.close()
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the engine statistics
+        :return: Dictionary containing the cache statistics, voices playing and voices dropped
+        """
+        return {'cache': self.cache.get_stats(), 'voices': len(self.voices), 'dropped': self.dropped}
+
+    # ------------------------------------------------------------
+    def __mix(self) -> bytes:
+        """Mix the next period of all voices, removing those which have finished"""
+        length = PERIOD_FRAMES * FRAME_SIZE
+        chunks = []
+
+        with self.condition:
+            for voice in self.voices:
+                pcm, position, _ = voice
+                chunk = bytes(pcm[position:position + length])
+                voice[1] = position + length
+                if len(chunk) < length:
+                    chunk += bytes(length - len(chunk))
+                chunks.append(chunk)
+
+            self.voices = [voice for voice in self.voices if voice[1] < len(voice[0])]
+
+        if not chunks:
+            return bytes(length)
+        return mix_samples(chunks, self.volume / MAX_VOLUME)
+
+    # ------------------------------------------------------------
+    def __mixer_thread(self):
+        """Write mixed audio to the sink in real time whenever clips are playing"""
+        while True:
+            with self.condition:
+                while not self.voices and not self.exit_flag:
+                    self.condition.wait()
+                if self.exit_flag:
+                    break
+
+            # Stay just ahead of real time, so new clips are heard quickly
+            start = time.perf_counter()
+            frames = 0
+
+            while self.voices:
+                ahead = frames / SAMPLE_RATE - (time.perf_counter() - start)
+                if ahead > MAX_LEAD:
+                    time.sleep(ahead - MAX_LEAD)
+
+                self.sink.write(self.__mix())
+                frames += PERIOD_FRAMES
@@ -0,0 +1,380 @@
+"""
+Server-side execution of Blockly automation programs
+
+The browser compiles the Blockly workspace into a program: a list of
+primitive steps (motor, servo, animation, sound, speak, print and
+wait), with the loops, conditions, variables and functions of the
+blocks already evaluated. Loops which never end (such as "repeat while
+true") can't be evaluated, so they are sent as a repeat step holding
+the steps of one pass, which the runner repeats a number of times (or
+forever when the count is 0). The program is uploaded once and run
+here, so its timing doesn't depend on the network or on the browser
+tab staying awake.
+
+Steps are scheduled against a monotonic clock: each wait moves the due
+time of the following steps forward, rather than starting a new delay
+after the previous step has finished, so small delays don't add up
+over a long program. How late each step was is kept for the status.
+
+    {"steps": [{"type": "motor", "x": 0, "y": 0.8}, {"type": "wait", "seconds": 1.5},
+               {"type": "motor", "x": 0, "y": 0}, {"type": "servo", "servo": "G", "value": 50},
+               {"type": "repeat", "count": 0, "steps": [{"type": "servo", "servo": "E", "value": 80},
+                                                        {"type": "wait", "seconds": 2}]}]}
+"""
+
+import json
+import time
+import logging
+from collections import deque
+from threading import Thread, Event, Lock
+
+from arduino_device import SERVO_CHANNELS, SERVO_PRESETS
+
+
+MAX_STEPS = 10000           # Longest program which can be uploaded (counting the steps inside loops once)
+MAX_DEPTH = 20              # Deepest nesting of repeat steps
+MAX_REPEAT = 1000000        # Largest count of a repeat step
+MAX_WAIT = 600.0            # Longest single wait (seconds), the limit of the wait block
+MAX_TEXT = 500              # Longest text of a speak or print step
+MAX_MESSAGES = 20           # Number of printed messages kept for the status
+
+# Program states
+IDLE = "idle"
+RUNNING = "running"
+FINISHED = "finished"
+STOPPED = "stopped"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------
+def parse_program(text: str) -> list[dict]:
+    """
+    Read and check an uploaded program
+    :param text: The program as JSON
+    :return: List of steps, with the values converted to the expected types
+    :raises ValueError: If the program is invalid
+    """
+    try:
+        program = json.loads(text)
+    except json.JSONDecodeError as ex:
+        raise ValueError(f'Program is not valid JSON: {ex.msg}') from ex
+
+    raw_steps = program.get('steps') if isinstance(program, dict) else None
+    if not isinstance(raw_steps, list):
+        raise ValueError('Program has no list of steps')
+
+    steps = parse_steps(raw_steps, 0, 0)
+    if count_steps(steps) > MAX_STEPS:
+        raise ValueError(f'Program has more than {MAX_STEPS} steps')
+    return steps
+
+
+# ----------------------------------------------------------------
+def parse_steps(raw_steps: list, depth: int, first: int) -> list[dict]:
+    """
+    Check a list of steps, such as the program or the steps of a repeat step
+    :param raw_steps: The steps as uploaded
+    :param depth: Number of repeat steps around the list
+    :param first: Number of the steps in the program before the list
+    :return: List of steps, with the values converted to the expected types
+    """
+    if len(raw_steps) > MAX_STEPS:
+        raise ValueError(f'Program has more than {MAX_STEPS} steps')
+
+    steps = []
+    number = first
+    for raw in raw_steps:
+        number += 1
+        try:
+            step = parse_step(raw, depth)
+        except (KeyError, TypeError, ValueError) as ex:
+            raise ValueError(f'Step {number} is invalid: {ex}') from ex
+
+        if step['type'] == "repeat":
+            step['steps'] = parse_steps(raw['steps'], depth + 1, number)
+            # Without a wait, a loop would send its commands as fast as the thread can run
+            if wait_time(step['steps']) == 0 and (step['count'] == 0 or step['count'] * count_steps(step['steps']) > MAX_STEPS):
+                raise ValueError(f'Step {number} is invalid: a long or endless repeat must contain a wait')
+            if step['count'] == 0 and count_steps(step['steps']) == count_waits(step['steps']):
+                raise ValueError(f'Step {number} is invalid: an endless repeat must contain a command')
+            number += count_steps(step['steps'])
+
+        steps.append(step)
+    return steps
+
+
+# ----------------------------------------------------------------
+def parse_step(raw: dict, depth: int = 0) -> dict:
+    """
+    Check one step of a program
+    :param raw: The step as uploaded
+    :param depth: Number of repeat steps around the step
+    :return: The step, with its values converted to the expected types
+    """
+    kind = raw['type']
+    step = {'type': kind, 'block': str(raw.get('block') or '')}
+
+    if kind == "motor":
+        step['x'] = min(max(float(raw['x']), -1.0), 1.0)
+        step['y'] = min(max(float(raw['y']), -1.0), 1.0)
+    elif kind == "servo":
+        servo = str(raw['servo'])
+        if len(servo) != 1 or servo not in SERVO_CHANNELS + SERVO_PRESETS:
+            raise ValueError(f'unknown servo "{servo}"')
+        step['servo'] = servo
+        step['value'] = int(float(raw['value']))
+    elif kind == "animation":
+        step['clip'] = int(raw['clip'])
+    elif kind == "sound":
+        step['clip'] = str(raw['clip'])
+        if step['clip'] == "":
+            raise ValueError('no clip')
+    elif kind in ("speak", "print"):
+        step['text'] = str(raw['text'])[:MAX_TEXT]
+    elif kind == "wait":
+        step['seconds'] = float(raw['seconds'])
+        if not 0 <= step['seconds'] <= MAX_WAIT:
+            raise ValueError(f'wait must be between 0 and {MAX_WAIT} seconds')
+    elif kind == "repeat":
+        if depth >= MAX_DEPTH:
+            raise ValueError(f'more than {MAX_DEPTH} nested repeat steps')
+        if not isinstance(raw['steps'], list):
+            raise TypeError('steps of the repeat is not a list')
+        step['count'] = int(raw.get('count') or 0)
+        if not 0 <= step['count'] <= MAX_REPEAT:
+            raise ValueError(f'count must be between 0 (forever) and {MAX_REPEAT}')
+        # The steps to repeat are checked by parse_steps()
+        step['steps'] = []
+    else:
+        raise ValueError(f'unknown type "{kind}"')
+
+    return step
+
+
+# ----------------------------------------------------------------
+def count_steps(steps: list[dict]) -> int:
+    """
+    Count the steps of a program, including those inside repeat steps (once)
+    :param steps: Steps returned by parse_program()
+    :return: Number of steps
+    """
+    return sum(1 + count_steps(step['steps']) if step['type'] == "repeat" else 1 for step in steps)
+
+
+# ----------------------------------------------------------------
+def count_waits(steps: list[dict]) -> int:
+    """
+    Count the wait steps and repeat steps of a program, which send no commands themselves
+    :param steps: Steps returned by parse_program()
+    :return: Number of steps
+    """
+    return sum(1 + count_waits(step['steps']) if step['type'] == "repeat" else step['type'] == "wait" for step in steps)
+
+
+# ----------------------------------------------------------------
+def wait_time(steps: list[dict]) -> float:
+    """
+    Seconds waited by one pass through a list of steps
+    :param steps: Steps returned by parse_program()
+    :return: Total of the waits, or infinity if they contain a repeat step which never ends
+    """
+    total = 0.0
+    for step in steps:
+        if step['type'] == "wait":
+            total += step['seconds']
+        elif step['type'] == "repeat":
+            inner = wait_time(step['steps'])
+            total += inner * step['count'] if step['count'] or inner == 0 else float('inf')
+    return total
+
+
+# ----------------------------------------------------------------
+def expand_steps(steps: list[dict], first: int = 0):
+    """
+    Go through the steps of a program in the order they are run, repeating the steps of the repeat steps
+    :param steps: Steps returned by parse_program()
+    :param first: Number of the steps in the program before the list
+    :return: Generator of (number of the step in the program, step)
+    """
+    number = first
+    for step in steps:
+        number += 1
+        if step['type'] == "repeat":
+            iteration = 0
+            while step['count'] == 0 or iteration < step['count']:
+                yield from expand_steps(step['steps'], number)
+                iteration += 1
+            number += count_steps(step['steps'])
+        else:
+            yield number, step
+
+
+# ================================================================
+class ProgramRunner:
+    """Run one automation program at a time in a background thread"""
+
+    def __init__(self, arduino, play_sound=None, speak=None):
+        """
+        Constructor
+        :param arduino: The ArduinoDevice which receives the motor, servo and animation commands
+        :param play_sound: Function which plays a sound clip, returning False on failure
+        :param speak: Function which speaks a text, returning False on failure
+        """
+        self.arduino = arduino
+        self.play_sound = play_sound
+        self.speak = speak
+        self.lock = Lock()
+        self.thread: Thread | None = None
+        self.exit_flag = Event()
+        self.run_id: int = 0
+        self.status: dict = self.__new_status(IDLE, 0)
+
+    # ------------------------------------------------------------
+    def start(self, steps: list[dict]) -> int:
+        """
+        Run a program, stopping any program which is already running
+        :param steps: Steps returned by parse_program()
+        :return: Id of this run
+        """
+        self.stop()
+
+        with self.lock:
+            self.run_id += 1
+            self.exit_flag = Event()
+            self.status = self.__new_status(RUNNING, count_steps(steps))
+            self.thread = Thread(target=self.__run_thread, args=(steps, self.status, self.exit_flag), daemon=True)
+            self.thread.start()
+            return self.run_id
+
+    # ------------------------------------------------------------
+    def stop(self) -> bool:
+        """
+        Stop the running program, and stop the motors
+        :return: True if a program was running
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+            self.exit_flag.set()
+
+        if thread is None:
+            return False
+        thread.join()
+        return True
+
+    # ------------------------------------------------------------
+    def is_running(self) -> bool:
+        """
+        Check if a program is running
+        :return: True if a program is running
+        """
+        return self.status['state'] == RUNNING
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the progress of the current (or last) program
+        :return: Dictionary with the state, the current step and block, the elapsed time, the last
+                 printed messages and the number printed so far, and how late the last steps were (in milliseconds)
+        """
+        with self.lock:
+            status = self.status
+            result = dict(status, id=self.run_id, messages=list(status['messages']))
+
+        lateness = result.pop('lateness')
+        result['elapsed'] = round((status['finished'] or time.monotonic()) - status['started'], 3) if status['started'] else 0
+        result.pop('started')
+        result.pop('finished')
+        result['timing'] = {
+            'steps': len(lateness),
+            'mean_ms': round(sum(lateness) / len(lateness) * 1000, 3) if lateness else 0,
+            'max_ms': round(max(lateness) * 1000, 3) if lateness else 0,
+        }
+        return result
+
+    # ------------------------------------------------------------
+    def get_lateness(self) -> list[float]:
+        """
+        How late the steps of the current (or last) program were started
+        :return: List of seconds after the due time of each step, for the last MAX_STEPS steps
+        """
+        return list(self.status['lateness'])
+
+    # ------------------------------------------------------------
+    def __new_status(self, state: str, steps: int) -> dict:
+        """Status of a new run"""
+        return {'state': state, 'step': 0, 'steps': steps, 'block': '', 'error': '', 'messages': [], 'printed': 0,
+                'lateness': deque(maxlen=MAX_STEPS), 'started': time.monotonic() if state == RUNNING else None, 'finished': None}
+
+    # ------------------------------------------------------------
+    def __run_thread(self, steps: list[dict], status: dict, exit_flag: Event):
+        """Run the steps at their due times"""
+        start = status['started']
+        due = 0.0
+
+        try:
+            for number, step in expand_steps(steps):
+                status['step'] = number
+                if step['type'] == "wait":
+                    due += step['seconds']
+                    continue
+
+                # Sleep until the step is due, unless the program is stopped in the meantime
+                delay = start + due - time.monotonic()
+                if delay > 0 and exit_flag.wait(delay):
+                    break
+                if exit_flag.is_set():
+                    break
+
+                status['lateness'].append(max(0.0, time.monotonic() - start - due))
+                status['block'] = step['block']
+                self.__execute(step, status)
+
+            else:
+                # A program can end with a wait, such as to let a movement finish
+                delay = start + due - time.monotonic()
+                if delay <= 0 or not exit_flag.wait(delay):
+                    status['state'] = FINISHED
+
+        except Exception as ex:
+            status['error'] = str(ex)
+            status['state'] = FAILED
+            logger.error(f'Program failed at step {status["step"]}: {repr(ex)}')
+
+        if status['state'] == RUNNING:
+            status['state'] = STOPPED
+
+        # Never leave the robot driving when a program ends early
+        if status['state'] != FINISHED and self.arduino.is_connected():
+            self.arduino.send_command("X0")
+            self.arduino.send_command("Y0")
+
+        status['block'] = ''
+        status['finished'] = time.monotonic()
+
+    # ------------------------------------------------------------
+    def __execute(self, step: dict, status: dict):
+        """Carry out one step"""
+        kind = step['type']
+
+        if kind in ("motor", "servo", "animation") and not self.arduino.is_connected():
+            raise RuntimeError('Arduino not connected')
+
+        if kind == "motor":
+            self.arduino.send_command("X" + str(int(step['x'] * 100)))
+            self.arduino.send_command("Y" + str(int(step['y'] * 100)))
+        elif kind == "servo":
+            self.arduino.send_command(step['servo'] + str(step['value']))
+        elif kind == "animation":
+            self.arduino.send_command("A" + str(step['clip']))
+        elif kind == "sound":
+            if self.play_sound is None or self.play_sound(step['clip']) is False:
+                raise RuntimeError(f'Unable to play audio clip {step["clip"]}')
+        elif kind == "speak":
+            if step['text'] != "" and (self.speak is None or self.speak(step['text']) is False):
+                raise RuntimeError('Unable to speak')
+        elif kind == "print":
+            status['messages'] = (status['messages'] + [step['text']])[-MAX_MESSAGES:]
+            status['printed'] += 1
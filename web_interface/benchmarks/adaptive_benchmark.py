@@ -0,0 +1,95 @@
+"""
+Adaptive stream quality with a simulated camera and network
+
+First the QualityController is fed a scripted series of measurements,
+to check when it steps the profile down and up. Then the stream is run
+with the FakeCameraBackend, while the bandwidth of a simulated viewer
+is reduced and restored, and the profile changes are printed:
+    python3 benchmarks/adaptive_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import picamera2_stream
+from picamera2_stream import PiCameraStreamer, QualityController, STREAM_PROFILES
+from fake_camera import FakeCameraBackend
+from stream_benchmark import Viewer
+
+
+# ----------------------------------------------------------------
+def check_controller():
+    """Step through measurements of (skip ratio, send load, CPU load) and check the chosen profiles"""
+    controller = QualityController(STREAM_PROFILES)
+    script = [
+        (None, None, 0.1, 2),       # No clients: keep the current profile
+        (0.5, 0.9, 0.1, 1),         # Client can't keep up: step down straight away
+        (0.0, 0.9, 0.1, 0),         # Client is waiting to send most of the time
+        (0.5, 0.9, 0.1, 0),         # Already at the lowest profile
+        (0.0, 0.1, 0.1, 0),
+        (0.0, 0.1, 0.1, 0),
+        (0.0, 0.1, 0.1, 1),         # Three good intervals: try the next profile
+        (0.0, 0.5, 0.1, 1),         # Neither overloaded nor idle
+        (0.3, 0.9, 0.1, 0),         # Failed soon after: wait twice as long next time
+        (0.0, 0.1, 0.1, 0), (0.0, 0.1, 0.1, 0), (0.0, 0.1, 0.1, 0), (0.0, 0.1, 0.1, 0), (0.0, 0.1, 0.1, 0),
+        (0.0, 0.1, 0.1, 1),
+        (0.0, 0.1, 0.95, 0),        # CPU overloaded
+        (0.0, 0.1, 0.8, 0),         # Neither overloaded nor idle
+    ]
+
+    for step, (skip_ratio, send_load, cpu_load, expected) in enumerate(script):
+        controller.update(skip_ratio, send_load, cpu_load)
+        assert controller.index == expected, f'Step {step}: profile {controller.index}, expected {expected}'
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--interval', type=float, default=2.0, help='Seconds between adaptation checks')
+    parser.add_argument('--phase', type=float, default=20.0, help='Seconds per bandwidth phase')
+    parser.add_argument('--port', type=int, default=8091)
+    args = parser.parse_args()
+
+    check_controller()
+    print('QualityController: scripted measurements OK')
+
+    picamera2_stream.ADAPT_INTERVAL = args.interval
+    backend = FakeCameraBackend()
+    camera = PiCameraStreamer(adaptive=True, backend=backend, port=args.port)
+    active, error = camera.start_stream()
+    if not active:
+        print(f'Unable to start stream: {error}')
+        return 1
+
+    viewer = Viewer(args.port)
+    viewer.start()
+    start = time.perf_counter()
+
+    try:
+        phases = [('Unlimited', None), ('200 kB/s', 200000), ('60 kB/s', 60000), ('Unlimited', None)]
+        for name, bandwidth in phases:
+            viewer.bandwidth = bandwidth
+            viewer.latencies.clear()
+            time.sleep(args.phase)
+            status = camera.get_status()
+            latency = statistics.median(viewer.latencies) * 1000 if viewer.latencies else float('nan')
+            print(f'{name:<10} -> profile {status["profile"]:<7} median latency {latency:8.1f} ms')
+
+    finally:
+        viewer.stop()
+        camera.stop_stream()
+
+    print('Profile changes:')
+    for timestamp, name in backend.changes:
+        print(f'  {max(0, timestamp - start):6.1f} s  {name}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Playback latency of the audio engine, using a null audio sink
+
+Measures the time from asking for a clip to be played until its first
+audible samples are written to the output sink, for clips which have to
+be decoded first and for clips already in the cache. This is compared
+with the previous approach, which started new processes for every
+request (amixer + aplay). A burst of overlapping requests checks that
+the number of voices stays bounded:
+    python3 benchmarks/audio_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from array import array
+from threading import Event
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from audio_engine import AudioEngine, NullSink
+
+
+# ================================================================
+class RecordingSink(NullSink):
+    """Discard audio, but note when the first audible samples arrive"""
+
+    def __init__(self):
+        self.audible = Event()
+        self.audible_time: float = 0.0
+        self.writes: int = 0
+
+    def write(self, data: bytes):
+        self.writes += 1
+        if not self.audible.is_set() and any(array('h', data)):
+            self.audible_time = time.perf_counter()
+            self.audible.set()
+
+
+# ----------------------------------------------------------------
+def measure_engine(engine: AudioEngine, sink: RecordingSink, clips: list[str]) -> list[float]:
+    """Play each clip once, returning the latency of each"""
+    latencies = []
+    for clip in clips:
+        engine.stop_all()
+        time.sleep(0.05)
+        sink.audible.clear()
+        start = time.perf_counter()
+        if engine.play(clip) and sink.audible.wait(2):
+            latencies.append(sink.audible_time - start)
+    engine.stop_all()
+    return latencies
+
+
+# ----------------------------------------------------------------
+def measure_fork(sound_folder: str, clips: list[str]) -> list[float]:
+    """
+    Lower bound of the previous approach: start two processes per request,
+    one of which reads the clip. Opening the sound card is not included.
+    """
+    latencies = []
+    for clip in clips:
+        start = time.perf_counter()
+        subprocess.run(['true'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(['cat', os.path.join(sound_folder, f'{clip}.wav')], stdout=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--folder', default=os.path.join(BASE_DIR, 'static', 'sounds'), help='Folder of WAV clips')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of times each clip is played')
+    parser.add_argument('--burst', type=int, default=20, help='Number of overlapping requests')
+    args = parser.parse_args()
+
+    clips = sorted(name[:-4] for name in os.listdir(args.folder) if name.endswith('.wav'))
+    sink = RecordingSink()
+    engine = AudioEngine(args.folder, sink=sink, max_voices=4)
+
+    cold = measure_engine(engine, sink, clips)
+    warm = measure_engine(engine, sink, clips * args.rounds)
+    fork = measure_fork(args.folder, clips * args.rounds)
+
+    print(f'{"Method":<26} {"Plays":>6} {"Mean (ms)":>10} {"Max (ms)":>9}')
+    for name, latencies in (('Engine, not cached', cold), ('Engine, cached', warm), ('Process per request', fork)):
+        print(f'{name:<26} {len(latencies):>6} {statistics.mean(latencies) * 1000:>10.2f} {max(latencies) * 1000:>9.2f}')
+
+    for _ in range(args.burst):
+        engine.play(clips[0])
+    stats = engine.get_stats()
+    print(f'Burst of {args.burst}: {stats["voices"]} voices playing, {stats["dropped"]} oldest voices stopped, '
+          f'1 output sink')
+    print(f'Cache: {stats["cache"]["clips"]} clips, {stats["cache"]["bytes"] / 1e6:.1f} MB, '
+          f'{stats["cache"]["hits"]} hits, {stats["cache"]["misses"]} misses')
+
+    engine.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Responsiveness of the web-interface while the camera starts and stops
+
+The camera is simulated by a FakeCameraBackend which takes as long as
+the Raspberry Pi camera to open and configure. Toggling the stream
+through /settings is timed, and compared with the previous approach of
+starting the stream inside the request (followed by a 1 second sleep).
+The time until the stream is running is measured with a cold camera
+and after warm_up(). The script also checks /motor is answered while
+the camera is starting, that quick start-stop-start requests only
+start the camera once, and that a failed start ends in the error state:
+    python3 benchmarks/camera_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from picamera2_stream import PiCameraStreamer, CAMERA_RUNNING, CAMERA_STOPPED, CAMERA_ERROR
+from fake_camera import FakeCameraBackend
+
+
+# ================================================================
+class SlowCameraBackend(FakeCameraBackend):
+    """Fake camera which is as slow to open and configure as the real one"""
+
+    def __init__(self, open_time: float, configure_time: float, fail: bool = False):
+        super().__init__()
+        self.open_time = open_time
+        self.configure_time = configure_time
+        self.fail = fail
+        self.opened = False
+        self.configured: set[tuple] = set()
+        self.starts = 0
+
+    def prepare(self, profile: dict):
+        self.__open()
+        self.__configure(profile)
+
+    def start(self, output, profile: dict):
+        self.__open()
+        self.__configure(profile)
+        if self.fail:
+            raise RuntimeError('Camera not detected')
+        self.starts += 1
+        super().start(output, profile)
+
+    def __open(self):
+        if not self.opened:
+            time.sleep(self.open_time)
+            self.opened = True
+
+    def __configure(self, profile: dict):
+        if profile['size'] not in self.configured:
+            time.sleep(self.configure_time)
+            self.configured.add(profile['size'])
+
+
+# ----------------------------------------------------------------
+def wait_for_state(camera: PiCameraStreamer, state: str, timeout: float = 10.0) -> float:
+    """Seconds until the camera reaches a state"""
+    start = time.perf_counter()
+    while camera.get_state()['state'] != state:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f'Camera did not reach the {state} state: {camera.get_state()}')
+        time.sleep(0.002)
+    return time.perf_counter() - start
+
+
+# ----------------------------------------------------------------
+def measure_start(args, port: int, warm: bool) -> tuple[float, float]:
+    """
+    Start the stream in the background
+    :return: Tuple of (seconds until request_start() returned, seconds until the stream was running)
+    """
+    camera = PiCameraStreamer(backend=SlowCameraBackend(args.open_time, args.configure_time), port=port)
+    if warm:
+        camera.warm_up()
+        time.sleep(args.open_time + args.configure_time + 0.2)
+
+    try:
+        start = time.perf_counter()
+        camera.request_start()
+        returned = time.perf_counter() - start
+        wait_for_state(camera, CAMERA_RUNNING)
+        return (returned, time.perf_counter() - start)
+    finally:
+        camera.request_stop()
+        wait_for_state(camera, CAMERA_STOPPED)
+
+
+# ----------------------------------------------------------------
+def check_routes(args, port: int):
+    """Time /settings streamer, and /motor while the camera is starting"""
+    import app as webapp
+
+    camera = PiCameraStreamer(backend=SlowCameraBackend(args.open_time, args.configure_time), port=port)
+    webapp.camera = camera
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    try:
+        start = time.perf_counter()
+        reply = client.post('/settings', data={'type': 'streamer', 'value': '1'}).get_json()
+        toggle_time = time.perf_counter() - start
+        assert reply['status'] == 'OK' and reply['streamer'] == 'starting', reply
+
+        # Other requests are answered while the camera is still starting
+        motor = []
+        while camera.get_state()['state'] != CAMERA_RUNNING:
+            start = time.perf_counter()
+            client.post('/motor', data={'stickX': '0.5', 'stickY': '0.5'})
+            motor.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+        status = client.post('/cameraStatus').get_json()['camera']
+        assert status['state'] == CAMERA_RUNNING and status['active']
+
+        reply = client.post('/settings', data={'type': 'streamer', 'value': '1'}).get_json()
+        assert reply['streamer'] == 'stopping', reply
+        wait_for_state(camera, CAMERA_STOPPED)
+
+        # The previous approach: start the camera inside the request, then wait for it to settle
+        camera = PiCameraStreamer(backend=SlowCameraBackend(args.open_time, args.configure_time), port=port + 1)
+        start = time.perf_counter()
+        camera.start_stream()
+        time.sleep(1)
+        blocking_time = time.perf_counter() - start
+        camera.stop_stream()
+
+        print(f'/settings streamer: {toggle_time * 1000:.1f} ms (was {blocking_time * 1000:.0f} ms); '
+              f'{len(motor)} /motor requests while starting, max {max(motor) * 1000:.1f} ms')
+        assert toggle_time < 0.1 and max(motor) < 0.1
+
+    finally:
+        webapp.camera.request_stop()
+
+
+# ----------------------------------------------------------------
+def check_transitions(args, port: int):
+    """Quick toggles are combined, failures are reported, and listeners see every state"""
+    backend = SlowCameraBackend(args.open_time, args.configure_time)
+    camera = PiCameraStreamer(backend=backend, port=port)
+    states = []
+    camera.add_listener(lambda state: states.append(state['state']))
+
+    camera.request_start()
+    camera.request_stop()
+    camera.request_start()
+    wait_for_state(camera, CAMERA_RUNNING)
+    camera.request_stop()
+    wait_for_state(camera, CAMERA_STOPPED)
+    assert backend.starts == 1, backend.starts
+    assert states[-2:] == ['stopping', 'stopped'] and 'running' in states, states
+    print(f'Start, stop, start, stop: camera started {backend.starts} time, states {" > ".join(states)}')
+
+    camera = PiCameraStreamer(backend=SlowCameraBackend(0, 0, fail=True), port=port)
+    camera.request_start()
+    wait_for_state(camera, CAMERA_ERROR)
+    print(f'Failed start: {camera.get_state()}')
+    assert 'Camera not detected' in camera.get_state()['error'] and not camera.is_stream_active()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--open-time', type=float, default=1.5, help='Seconds to open the simulated camera')
+    parser.add_argument('--configure-time', type=float, default=0.5, help='Seconds to configure the simulated camera')
+    parser.add_argument('--rounds', type=int, default=3, help='Number of starts of each kind')
+    parser.add_argument('--port', type=int, default=5094)
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests')
+    args = parser.parse_args()
+
+    print(f'{"Start":<16} {"Request (ms)":>13} {"Running after (ms)":>19}')
+    for name, warm in (('Cold camera', False), ('After warm-up', True)):
+        results = [measure_start(args, args.port, warm) for _ in range(args.rounds)]
+        returned = statistics.mean(result[0] for result in results)
+        running = statistics.mean(result[1] for result in results)
+        print(f'{name:<16} {returned * 1000:>13.2f} {running * 1000:>19.0f}')
+        assert returned < 0.05
+        if warm:
+            assert running < args.open_time
+
+    check_transitions(args, args.port)
+
+    if not args.no_routes:
+        check_routes(args, args.port + 2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+Cost of listing a large sound library on every page load
+
+A temporary folder is filled with small WAV clips, half of which have
+the duration in their name. The previous approach (listing and parsing
+the folder for every page load) is compared with the sound catalog,
+when unchanged and after a clip has been added. The main page and the
+/sounds JSON route are then requested through the Flask test client,
+with the clips rendered into the page and loaded lazily:
+    python3 benchmarks/catalog_benchmark.py
+"""
+
+import os
+import sys
+import time
+import wave
+import argparse
+import tempfile
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from sound_catalog import SoundCatalog
+
+
+# ----------------------------------------------------------------
+def make_library(folder: str, count: int):
+    """Create clips named group_name_duration and group_name"""
+    for i in range(count):
+        name = f'Group{i % 20}_Clip{i}_{1000 + i}.wav' if i % 2 else f'Group{i % 20}_Clip{i}.wav'
+        with wave.open(os.path.join(folder, name), 'wb') as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(8000)
+            file.writeframes(bytes(1600 + i))
+
+
+# ----------------------------------------------------------------
+def scan_folder(folder: str, sound_format: str = "wav") -> list:
+    """The previous page-load code, which lists and parses the whole folder"""
+    files = []
+    for item in sorted(os.listdir(folder)):
+        if item.endswith(f".{sound_format}"):
+            audiofiles = os.path.splitext(os.path.basename(item))[0]
+            audiogroup = "Other"
+            audionames = audiofiles
+            audiotimes = 0
+            audio_details = audiofiles.split('_')
+
+            if len(audio_details) == 2:
+                if audio_details[1].isdigit():
+                    audionames = audio_details[0]
+                    audiotimes = float(audio_details[1]) / 1000.0
+                else:
+                    audiogroup = audio_details[0]
+                    audionames = audio_details[1]
+            elif len(audio_details) == 3:
+                audiogroup = audio_details[0]
+                audionames = audio_details[1]
+                if audio_details[2].isdigit():
+                    audiotimes = float(audio_details[2]) / 1000.0
+
+            files.append((audiogroup, audiofiles, audionames, audiotimes))
+    return files
+
+
+# ----------------------------------------------------------------
+def timed(function, rounds: int) -> float:
+    """Mean time of a function call in milliseconds"""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.mean(times) * 1000
+
+
+# ----------------------------------------------------------------
+def check_routes(folder: str, rounds: int):
+    """Render the main page and request the JSON catalog through Flask"""
+    import app as webapp
+
+    webapp.startup = True
+    webapp.catalog = SoundCatalog(folder)
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    for lazy in (False, True):
+        webapp.app.config['SOUND_LAZY_LOAD'] = 0 if lazy else 10 ** 9
+        size = len(client.get('/').data)
+        mean = timed(lambda: client.get('/'), rounds)
+        print(f'Page with {"lazy-loaded" if lazy else "all"} clips: {mean:.1f} ms, {size / 1000:.0f} kB')
+
+    response = client.get('/sounds')
+    etag = response.headers['ETag']
+    group = client.get('/sounds?group=Group3')
+    cached = client.get('/sounds', headers={'If-None-Match': etag})
+    print(f'/sounds: {len(response.data) / 1000:.0f} kB, one group {len(group.data) / 1000:.0f} kB, '
+          f'status {cached.status_code} with If-None-Match')
+    assert response.status_code == 200 and cached.status_code == 304 and len(group.json['sounds']) > 0
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clips', type=int, default=3000, help='Number of clips in the library')
+    parser.add_argument('--rounds', type=int, default=20, help='Number of page loads per test')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests (which need the camera library)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        make_library(folder, args.clips)
+        catalog = SoundCatalog(folder)
+
+        start = time.perf_counter()
+        entries = catalog.get_entries()
+        first = (time.perf_counter() - start) * 1000
+
+        def unchanged():
+            catalog.check_time = 0.0
+            catalog.get_entries()
+
+        def added():
+            path = os.path.join(folder, f'New_Clip{time.perf_counter_ns()}_500.wav')
+            os.link(os.path.join(folder, 'Group0_Clip0.wav'), path)
+            catalog.check_time = 0.0
+            catalog.get_entries()
+
+        print(f'{"Method":<30} {"Mean (ms)":>10}')
+        print(f'{"Scan on every page load":<30} {timed(lambda: scan_folder(folder), args.rounds):>10.2f}')
+        print(f'{"Catalog, first build":<30} {first:>10.2f}')
+        print(f'{"Catalog, unchanged":<30} {timed(unchanged, args.rounds):>10.3f}')
+        print(f'{"Catalog, one clip added":<30} {timed(added, args.rounds):>10.2f}')
+
+        stats = catalog.get_stats()
+        print(f'{stats["clips"]} clips, {stats["scans"]} folder listings, {stats["clips_read"]} clips examined')
+        assert stats['clips_read'] == args.clips + args.rounds
+        assert all(entry[3] > 0 for entry in entries)
+
+        if not args.no_routes:
+            check_routes(folder, args.rounds)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Compare the /motor route with the WebSocket control channel
+
+The web-interface is started in a child process under waitress and
+connected to a pty-backed FakeArduino. The benchmark measures the
+end-to-end latency from sending a motor command until the simulated
+device has parsed it, and the CPU time the server spends per command:
+    python3 benchmarks/control_benchmark.py
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import struct
+import base64
+import argparse
+import statistics
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_arduino import FakeArduino, wait_for
+from stream_benchmark import cpu_time
+
+
+# ----------------------------------------------------------------
+def serve(port_name: str, http_port: int, control_port: int):
+    """Run the web-interface connected to the given serial port"""
+    from waitress import serve as waitress_serve
+    import app as webapp
+
+    webapp.arduino.connect(port_name)
+    # Measure the transport alone, without the rate limit on client commands
+    webapp.governor.rate = 0
+    webapp.control.start(control_port)
+    waitress_serve(webapp.app, host='127.0.0.1', port=http_port, _quiet=True)
+
+
+# ================================================================
+class WebSocketClient:
+    """Minimal WebSocket client used to drive the control channel"""
+
+    def __init__(self, port: int, token: str):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.socket.sendall((f'GET /control?token={token} HTTP/1.1\r\n'
+                             f'Host: 127.0.0.1:{port}\r\n'
+                             'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                             f'Sec-WebSocket-Key: {key}\r\n'
+                             'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            response += self.socket.recv(1024)
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+
+    def send(self, opcode: int, payload: bytes):
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.socket.sendall(struct.pack('!BB', 0x80 | opcode, 0x80 | len(payload)) + mask + masked)
+
+    def close(self):
+        self.send(0x8, struct.pack('!H', 1000))
+        self.socket.close()
+
+
+# ----------------------------------------------------------------
+def run_commands(name: str, send, device: FakeArduino, pid: int, count: int) -> dict:
+    """
+    Send motor commands one at a time, waiting for each to arrive
+    :param send: Function which sends the motor command for an index
+    :return: Dictionary of results
+    """
+    latencies = []
+    start_cpu = cpu_time(pid)
+
+    for i in range(count):
+        expected = len(device.received) + 2
+        start = time.perf_counter()
+        send(i)
+        if wait_for(lambda: len(device.received) >= expected, 2.0):
+            latencies.append(device.received[-1][0] - start)
+
+    cpu = cpu_time(pid) - start_cpu
+    latencies.sort()
+
+    return {
+        'name': name,
+        'commands': len(latencies),
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'cpu_per_command_ms': cpu / count * 1000,
+    }
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=500, help='Number of commands per test')
+    parser.add_argument('--password', default='walle', help='Login password of the web-interface')
+    parser.add_argument('--http-port', type=int, default=5080)
+    parser.add_argument('--control-port', type=int, default=5081)
+    parser.add_argument('--serve', metavar='PORT_NAME', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        os.chdir(BASE_DIR)
+        serve(args.serve, args.http_port, args.control_port)
+        return 0
+
+    device = FakeArduino()
+    device.start()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', device.port_name,
+                               '--http-port', str(args.http_port), '--control-port', str(args.control_port)],
+                              cwd=BASE_DIR)
+
+    try:
+        # Wait for the server to start, then log in
+        conn = http.client.HTTPConnection('127.0.0.1', args.http_port)
+        for attempt in range(100):
+            try:
+                conn.request('POST', '/login_request', body=urlencode({'password': args.password}),
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+                response = conn.getresponse()
+                response.read()
+                break
+            except OSError:
+                conn.close()
+                time.sleep(0.1)
+        cookie = response.getheader('Set-Cookie', '').split(';')[0]
+        headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Cookie': cookie}
+
+        def send_http(i: int):
+            value = (i % 100) / 100
+            conn.request('POST', '/motor', body=f'stickX={value}&stickY={-value}', headers=headers)
+            conn.getresponse().read()
+
+        conn.request('POST', '/controlToken', headers=headers)
+        token = json.loads(conn.getresponse().read())['token']
+        client = WebSocketClient(args.control_port, token)
+
+        def send_json(i: int):
+            value = (i % 100) / 100
+            client.send(0x1, json.dumps({'type': 'motor', 'x': value, 'y': -value}).encode())
+
+        def send_binary(i: int):
+            client.send(0x2, struct.pack('!cbb', b'm', i % 100, -(i % 100)))
+
+        results = [
+            run_commands('POST /motor', send_http, device, server.pid, args.count),
+            run_commands('WebSocket JSON', send_json, device, server.pid, args.count),
+            run_commands('WebSocket binary', send_binary, device, server.pid, args.count),
+        ]
+
+        # Motor values outside -100 to 100 are clamped, in both kinds of frames
+        for frame in ((0x2, struct.pack('!cbb', b'm', 127, -128)),
+                      (0x1, json.dumps({'type': 'motor', 'x': 1.2, 'y': -3}).encode())):
+            expected = len(device.received) + 2
+            client.send(*frame)
+            assert wait_for(lambda: len(device.received) >= expected, 2.0)
+            assert [command for _, command in device.received[-2:]] == ['X100', 'Y-100'], device.received[-2:]
+        client.close()
+
+        print(f'{"Transport":<18} {"Commands":>8} {"Mean (ms)":>10} {"p95 (ms)":>10} {"CPU/cmd (ms)":>13}')
+        for r in results:
+            print(f'{r["name"]:<18} {r["commands"]:>8} {r["mean_ms"]:>10.3f} {r["p95_ms"]:>10.3f} {r["cpu_per_command_ms"]:>13.3f}')
+
+    finally:
+        server.terminate()
+        server.wait()
+        device.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
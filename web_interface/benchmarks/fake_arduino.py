@@ -0,0 +1,267 @@
+"""
+Simulated Wall-e Arduino connected through a pseudo-terminal
+
+The device behaves like the serial handling in wall-e.ino: each
+line is split into a command character and a number (truncated to
+MAX_SERIAL_LENGTH characters), and the parsed command is echoed back.
+Binary frames (see serial_protocol.py) are understood as well, if the
+device is created with binary=True. Streamed keyframes are added to an
+animation queue of QUEUE_LENGTH entries, which is played back in real
+time, recording when each keyframe was applied. The slave end of the
+pty can be opened by ArduinoDevice like any other serial port, or
+connected with connect().
+"""
+
+import os
+import sys
+import time
+import tty
+import select
+from collections import deque
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial_protocol
+from arduino_device import ArduinoDevice
+
+
+# Same limits as MAX_SERIAL_LENGTH and QUEUE_LENGTH in wall-e.ino
+MAX_SERIAL_LENGTH = 5
+QUEUE_LENGTH = 40
+
+# Servo commands, in the order of the servo numbers of keyframe positions ("J" commands)
+KEYFRAME_SERVOS = "GTBUELR"
+
+
+# ================================================================
+class FakeArduino:
+    """pty-backed simulation of the wall-e.ino serial protocol"""
+
+    def __init__(self, battery_interval: float | None = None, battery_level: int = 87,
+                 binary: bool = False, baudrate: int | None = None, loop_time: float = 0.0,
+                 keyframes: bool = True):
+        """
+        Constructor
+        :param battery_interval: Seconds between battery messages (None to disable)
+        :param battery_level:    Battery percentage which is reported
+        :param binary:           Whether the binary protocol is supported
+        :param baudrate:         Limit the rate at which bytes are received, like
+                                 a real serial link would (None = no limit)
+        :param loop_time:        Seconds spent in the rest of loop() (updating the
+                                 servos and motors) after each serial read
+        :param keyframes:        Whether streamed keyframes are supported
+        """
+        self.battery_interval = battery_interval
+        self.battery_level = battery_level
+        self.binary = binary
+        self.baudrate = baudrate
+        self.loop_time = loop_time
+        self.keyframes = keyframes
+        self.animation_queue: deque[tuple[int, dict]] = deque()
+        self.animation_timer: float = 0.0
+        self.keyframe: tuple[int, dict] | None = None
+        self.applied: list[tuple[float, int, dict]] = []
+        self.max_queue: int = 0
+        self.underruns: int = 0
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port_name: str = os.ttyname(self.slave_fd)
+        self.received: list[tuple[float, str]] = []
+        self.frames: int = 0
+        self.bytes_received: int = 0
+        self.bytes_sent: int = 0
+        self.exit_flag = Event()
+        self.paused = Event()
+        self.thread: Thread | None = None
+
+    # ------------------------------------------------------------
+    def start(self):
+        """Start simulating the device in a background thread"""
+        self.exit_flag.clear()
+        self.thread = Thread(target=self.__device_thread, daemon=True)
+        self.thread.start()
+
+    # ------------------------------------------------------------
+    def stop(self):
+        """Stop the simulation and close the pty"""
+        self.exit_flag.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    # ------------------------------------------------------------
+    def pause(self):
+        """Stop reading from the serial link, simulating a stalled device"""
+        self.paused.set()
+
+    # ------------------------------------------------------------
+    def resume(self):
+        """Continue reading from the serial link"""
+        self.paused.clear()
+
+    # ------------------------------------------------------------
+    def write(self, message: str):
+        """Send a line from the device to the host"""
+        data = message.encode() + b'\r\n'
+        self.bytes_sent += len(data)
+        os.write(self.master_fd, data)
+
+    # ------------------------------------------------------------
+    def evaluate(self, first_char: str, number: int, echo: bool = True):
+        """
+        Handle a parsed command, equivalent to evaluateCommand()
+        :param first_char: The command character
+        :param number:     The value of the command
+        :param echo:       Whether the command is echoed back
+        """
+        self.received.append((time.perf_counter(), f'{first_char}{number}'))
+        if echo:
+            self.write(f'{first_char}{number}')
+
+        if first_char == 'V' and self.binary:
+            self.write(f'Protocol_{serial_protocol.PROTOCOL_VERSION}')
+
+        elif not self.keyframes:
+            return
+
+        elif first_char == 'K' and number >= 0:
+            self.keyframe = (number, {})
+        elif first_char == 'P' and self.keyframe is not None:
+            # The previous keyframe has already ended, so the servos have stopped
+            if self.applied and not self.animation_queue and time.perf_counter() > self.animation_timer:
+                self.underruns += 1
+            if len(self.animation_queue) < QUEUE_LENGTH:
+                self.animation_queue.append(self.keyframe)
+                self.max_queue = max(self.max_queue, len(self.animation_queue))
+                self.write(f'Queue_{len(self.animation_queue)}')
+            else:
+                self.write('Queue_-1')
+            self.keyframe = None
+        elif first_char == 'Q':
+            if number == 1:
+                self.animation_queue.clear()
+            self.write(f'Queue_{len(self.animation_queue)}')
+        elif (first_char == 'J' and self.keyframe is not None and 0 <= number
+              and number // 1000 < len(KEYFRAME_SERVOS) and number % 1000 <= 100):
+            self.keyframe[1][KEYFRAME_SERVOS[number // 1000]] = number % 1000
+
+    # ------------------------------------------------------------
+    def __play_animations(self):
+        """Apply the next keyframe once the previous one has been held for its time, like manageAnimations()"""
+        now = time.perf_counter()
+        if self.animation_queue and self.animation_timer <= now:
+            hold, values = self.animation_queue.popleft()
+            self.animation_timer = now + hold / 1000
+            self.applied.append((now, hold, values))
+
+    # ------------------------------------------------------------
+    def __handle(self, item: tuple):
+        """Respond to a line or frame decoded from the serial stream"""
+        if item[0] == 'text':
+            try:
+                number = int(item[1][1:])
+            except ValueError:
+                number = 0
+            self.evaluate(item[1][0], number)
+
+        elif not self.binary:
+            return
+
+        elif item[0] == 'frame':
+            seq, flags, commands = item[1:]
+            self.frames += 1
+            for first_char, number in commands:
+                self.evaluate(first_char, number, bool(flags & serial_protocol.FLAG_ECHO))
+            if flags & serial_protocol.FLAG_ACK:
+                self.write(f'Ack_{seq}')
+
+        else:
+            self.write(f'Nack_{item[1]}')
+
+    # ------------------------------------------------------------
+    def __device_thread(self):
+        """Read incoming bytes and respond like the Arduino would"""
+        decoder = serial_protocol.FrameDecoder(MAX_SERIAL_LENGTH)
+        next_battery = time.monotonic()
+
+        while not self.exit_flag.is_set():
+            timeout = 0.05
+            if self.battery_interval is not None:
+                timeout = max(0, min(timeout, next_battery - time.monotonic()))
+
+            if self.paused.is_set():
+                self.exit_flag.wait(timeout)
+                continue
+
+            if self.animation_queue:
+                timeout = max(0, min(timeout, self.animation_timer - time.perf_counter()))
+
+            ready, _, _ = select.select([self.master_fd], [], [], timeout)
+
+            if ready:
+                # A real link transfers 10 bits per byte (start + 8 data + stop)
+                data = os.read(self.master_fd, 64 if self.baudrate else 4096)
+                self.bytes_received += len(data)
+                if self.baudrate:
+                    time.sleep(len(data) * 10 / self.baudrate)
+
+                for item in decoder.feed(data):
+                    self.__handle(item)
+
+                if self.loop_time:
+                    time.sleep(self.loop_time)
+
+            self.__play_animations()
+
+            if self.battery_interval is not None and time.monotonic() >= next_battery:
+                self.write(f'Battery_{self.battery_level}')
+                next_battery = time.monotonic() + self.battery_interval
+
+
+# ----------------------------------------------------------------
+def connect(device: FakeArduino, protocol: str = "ascii") -> ArduinoDevice:
+    """
+    Connect an ArduinoDevice to the simulated Arduino
+    :param device: The started FakeArduino
+    :param protocol: Serial protocol of the ArduinoDevice ("ascii" or "binary")
+    :return: The connected ArduinoDevice, with the binary protocol active if it was requested
+    """
+    arduino = ArduinoDevice(protocol)
+    arduino.connect(device.port_name)
+    if protocol == "binary":
+        wait_until(lambda: arduino.binary_active, 5.0)
+    else:
+        time.sleep(0.2)
+    return arduino
+
+
+# ----------------------------------------------------------------
+def wait_for(condition, timeout: float, interval: float = 0.0001) -> bool:
+    """
+    Poll until the condition is true or the timeout has passed
+    :param condition: Function returning True once the wait is over
+    :param timeout: Seconds to wait
+    :param interval: Seconds between checks (short, so latencies can be measured)
+    :return: True if the condition became true
+    """
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+
+# ----------------------------------------------------------------
+def wait_until(condition, timeout: float = 30.0):
+    """
+    Wait for a condition to become true
+    :param condition: Function returning True once the wait is over
+    :param timeout: Seconds to wait
+    :raises TimeoutError: If the condition is still false after the timeout
+    """
+    if not wait_for(condition, timeout, 0.01):
+        raise TimeoutError('Timed out')
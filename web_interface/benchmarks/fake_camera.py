@@ -0,0 +1,89 @@
+"""
+Simulated camera backend for the MJPEG stream
+
+Produces synthetic JPEG frames at the frame rate of the active stream
+profile. The size of each frame scales with the resolution and quality
+of the profile, roughly like the hardware encoder. Every frame carries
+its sequence number and creation time in a JPEG comment segment, so
+viewers can measure the latency and detect skipped frames.
+"""
+
+import os
+import sys
+import time
+import struct
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from picamera2_stream import CameraBackend, StreamingOutput
+
+
+# Frame header stored in a JPEG comment segment: sequence number, timestamp
+FRAME_INFO = struct.Struct('!Qd')
+
+# Approximate encoded bytes per pixel for each profile quality
+BYTES_PER_PIXEL = {'LOW': 0.06, 'MEDIUM': 0.1, None: 0.15}
+
+
+# ----------------------------------------------------------------
+def make_frame(sequence: int, size: int) -> bytes:
+    """Create a synthetic JPEG containing its sequence number and creation time"""
+    info = FRAME_INFO.pack(sequence, time.time())
+    comment = b'\xff\xfe' + struct.pack('!H', len(info) + 2) + info
+    return b'\xff\xd8' + comment + bytes(size) + b'\xff\xd9'
+
+
+# ----------------------------------------------------------------
+def read_frame_info(frame: bytes) -> tuple[int, float]:
+    """
+    Read the header of a synthetic frame
+    :return: Tuple of (sequence number, creation time)
+    """
+    return FRAME_INFO.unpack_from(frame, 6)
+
+
+# ================================================================
+class FakeCameraBackend(CameraBackend):
+    """Camera backend which doesn't need any camera hardware"""
+
+    def __init__(self):
+        """Constructor"""
+        self.output: StreamingOutput | None = None
+        self.profile: dict | None = None
+        self.changes: list[tuple[float, str]] = []
+        self.exit_flag = Event()
+        self.thread: Thread | None = None
+
+    def start(self, output: StreamingOutput, profile: dict):
+        self.output = output
+        self.profile = profile
+        self.changes.append((time.perf_counter(), profile['name']))
+        self.exit_flag.clear()
+        self.thread = Thread(target=self.__camera_thread, daemon=True)
+        self.thread.start()
+
+    def apply(self, profile: dict):
+        self.profile = profile
+        self.changes.append((time.perf_counter(), profile['name']))
+
+    def stop(self):
+        self.exit_flag.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_active(self) -> bool:
+        return self.thread is not None
+
+    def __camera_thread(self):
+        """Write frames to the output at the frame rate of the profile"""
+        sequence = 0
+        next_frame = time.perf_counter()
+
+        while not self.exit_flag.is_set():
+            width, height = self.profile['size']
+            sequence += 1
+            self.output.write(make_frame(sequence, int(width * height * BYTES_PER_PIXEL[self.profile['quality']])))
+            next_frame = max(next_frame + 1 / self.profile['fps'], time.perf_counter() - 1)
+            self.exit_flag.wait(max(0, next_frame - time.perf_counter()))
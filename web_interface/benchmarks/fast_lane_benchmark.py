@@ -0,0 +1,292 @@
+"""
+Control commands per second through the fast lane and the Flask routes
+
+The web-interface is served by waitress in a child process, connected
+to a pty-backed FakeArduino, and several clients send motor, servo and
+animation commands over keep-alive connections as fast as they can:
+once through the /motor, /servoControl and /animate routes, and once
+through the fast lane (/c). The CPU time used by the server process is
+read from /proc, so the result is given per core: commands handled for
+each second of server CPU time, whatever else the clients are doing.
+This is measured with the Arduino connected (the sending and the
+replies on the serial link cost the same for both lanes) and with it
+disconnected, which gives the cost of the request handling alone.
+The script also checks the replies of the fast lane, the tokens, and
+that the commands reach the Arduino:
+    python3 benchmarks/fast_lane_benchmark.py
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import http.client
+from threading import Thread
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino, connect
+from stream_benchmark import cpu_time
+
+
+# ----------------------------------------------------------------
+def serve(port: int, threads: int, device_port: str):
+    """Run the web-interface under waitress, with the Arduino replaced by the FakeArduino of the parent process"""
+    import logging
+    from waitress import serve as waitress_serve
+    import app as webapp
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    arduino = ArduinoDevice()
+    if device_port:
+        arduino.connect(device_port)
+    webapp.arduino = arduino
+    webapp.governor.arduino = arduino
+    # Measure the request handling alone, without the rate limit on client commands
+    webapp.governor.rate = 0
+    waitress_serve(webapp.app, host='127.0.0.1', port=port, threads=threads, _quiet=True)
+
+
+# ----------------------------------------------------------------
+def free_port() -> int:
+    """Find a free TCP port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# ----------------------------------------------------------------
+def login(port: int) -> tuple[str, str]:
+    """
+    Log in, and get a fast lane token
+    :return: Session cookie and token
+    """
+    import config
+
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/login_request', f'password={config.LOGIN_PASSWORD}',
+                       {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = connection.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie').split(';')[0]
+
+    connection.request('POST', '/fastToken', headers={'Cookie': cookie})
+    response = connection.getresponse()
+    token = json.loads(response.read())['token']
+    connection.close()
+    return cookie, token
+
+
+# ----------------------------------------------------------------
+def requests_for(lane: str, cookie: str, token: str, connected: bool) -> list[tuple[str, str, str, dict, int]]:
+    """
+    Requests which move the motors, a servo and start an animation
+    :return: List of (method, path, body, headers, expected status)
+    """
+    if lane == 'fast':
+        return [('POST', f'/c?t={token}&m=50,-20', '', {}, 204 if connected else 503),
+                ('POST', f'/c?t={token}&s=G40', '', {}, 204 if connected else 503),
+                ('POST', f'/c?t={token}&a=1', '', {}, 204 if connected else 503)]
+
+    form = {'Cookie': cookie, 'Content-Type': 'application/x-www-form-urlencoded'}
+    return [('POST', '/motor', 'stickX=0.5&stickY=-0.2', form, 200),
+            ('POST', '/servoControl', 'servo=G&value=40', form, 200),
+            ('POST', '/animate', 'clip=1', form, 200)]
+
+
+# ----------------------------------------------------------------
+def client(port: int, requests: list, end: float, results: list):
+    """Send requests over one keep-alive connection until the end time"""
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    count = 0
+    errors = 0
+    while time.perf_counter() < end:
+        method, path, body, headers, expected = requests[count % len(requests)]
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        if response.status != expected:
+            errors += 1
+        count += 1
+    connection.close()
+    results.append((count, errors))
+
+
+# ----------------------------------------------------------------
+def run(port: int, pid: int, lane: str, cookie: str, token: str, connected: bool, args) -> dict:
+    """
+    Load the server with concurrent clients
+    :return: Dictionary of the results
+    """
+    requests = requests_for(lane, cookie, token, connected)
+    results: list = []
+    cpu_start = cpu_time(pid)
+    start = time.perf_counter()
+    end = start + args.duration
+    threads = [Thread(target=client, args=(port, requests, end, results)) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_time(pid) - cpu_start
+
+    count = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return {'requests': count, 'errors': errors, 'per_second': count / elapsed, 'per_core': count / cpu,
+            'cpu': cpu / elapsed, 'us_per_request': cpu / count * 1e6}
+
+
+# ----------------------------------------------------------------
+def check_replies():
+    """Replies of the fast lane, the session token, and the commands reaching the Arduino"""
+    import app as webapp
+
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    webapp.arduino = arduino
+    webapp.fast_lane.arduino = arduino
+    client = webapp.app.test_client()
+
+    try:
+        assert client.post('/fastToken').status_code == 302
+        client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+        token = client.post('/fastToken').get_json()['token']
+        assert client.post('/fastToken').get_json()['token'] == token
+        other = webapp.app.test_client()
+        other.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+        assert other.post('/fastToken').get_json()['token'] != token
+
+        device.received.clear()
+        # Wait between the requests, so the motor values aren't replaced before they are sent
+        assert client.post(f'/c?t={token}&m=150,-20&s=G40').status_code == 204
+        time.sleep(0.05)
+        assert client.post('/c', data=f't={token}&a=2', content_type='text/plain').status_code == 204
+        assert client.post(f'/c?t={token}', data='m=10%2C20', content_type='application/x-www-form-urlencoded').status_code == 204
+        time.sleep(0.2)
+        commands = [command for _, command in device.received]
+        assert commands == ['X100', 'Y-20', 'G40', 'A2', 'X10', 'Y20'], commands
+
+        replies = {
+            'unknown token': client.post('/c?t=nope&m=0,0').status_code,
+            'no token': client.post('/c?m=0,0').status_code,
+            'no command': client.post(f'/c?t={token}').status_code,
+            'bad command': client.post(f'/c?t={token}&m=1').status_code,
+            'unknown parameter': client.post(f'/c?t={token}&x=1').status_code,
+            'keyframe command': client.post(f'/c?t={token}&s=K100').status_code,
+            'preset command': client.post(f'/c?t={token}&s=g0').status_code,
+            'GET': client.get(f'/c?t={token}&m=0,0').status_code,
+            'large body': client.post(f'/c?t={token}', data='a=1&' * 500).status_code,
+        }
+        print('Fast lane replies: ' + ', '.join(f'{name} {status}' for name, status in replies.items()))
+        assert list(replies.values()) == [401, 401, 400, 400, 400, 400, 400, 405, 413], replies
+
+        # The counters stay exact when several threads handle requests at once
+        before = webapp.fast_lane.get_stats()
+        threads = [Thread(target=lambda: [webapp.app.test_client().post(f'/c?t={token}') for _ in range(200)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        after = webapp.fast_lane.get_stats()
+        assert after['requests'] - before['requests'] == 800 and after['rejected'] - before['rejected'] == 800, after
+
+        # Requests for other paths still reach Flask
+        assert client.post('/arduinoStatus').status_code == 200
+
+        arduino.disconnect()
+        assert client.post(f'/c?t={token}&m=0,0').status_code == 503
+
+        # After a restart, the token in the session is replaced
+        webapp.fast_lane.tokens.clear()
+        assert client.post('/fastToken').get_json()['token'] != token
+        print(f'Fast lane counters: {webapp.fast_lane.get_stats()}')
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def measure(connected: bool, args) -> float:
+    """
+    Start a server, and compare the lanes
+    :param connected: True to connect the server to a FakeArduino, False to measure the request handling alone
+    :return: Commands per second per core of the fast lane, divided by that of the Flask routes
+    """
+    # The simulated Arduino runs in this process, so its work isn't counted as server CPU time
+    device = FakeArduino()
+    device.start()
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(port),
+                               '--threads', str(args.threads), '--device', device.port_name if connected else ''])
+    try:
+        end = time.perf_counter() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.5).close()
+                break
+            except OSError:
+                if time.perf_counter() > end or server.poll() is not None:
+                    raise RuntimeError('Server did not start')
+                time.sleep(0.1)
+        time.sleep(0.5)
+        cookie, token = login(port)
+
+        print(f'{"Arduino connected" if connected else "Arduino disconnected (request handling alone)"}:')
+        results = {}
+        for lane in ('routes', 'fast'):
+            result = run(port, server.pid, lane, cookie, token, connected, args)
+            results[lane] = result
+            print(f'{lane:<8} {result["requests"]:>9} {result["errors"]:>7} {result["per_second"]:>11.0f} '
+                  f'{result["cpu"] * 100:>10.0f}% {result["per_core"]:>16.0f} {result["us_per_request"]:>15.1f}')
+            assert result['errors'] == 0
+
+        speedup = results['fast']['per_core'] / results['routes']['per_core']
+        print(f'Fast lane: {speedup:.1f}x the commands per second per core of the Flask routes')
+        return speedup
+
+    finally:
+        server.terminate()
+        server.wait()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds of load for each lane')
+    parser.add_argument('--clients', type=int, default=4, help='Number of concurrent clients')
+    parser.add_argument('--threads', type=int, default=4, help='Number of waitress threads')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--device', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.threads, args.device)
+        return 0
+
+    check_replies()
+
+    print(f'{args.clients} clients, {args.threads} waitress threads, {args.duration:.0f} s per lane')
+    print(f'{"Lane":<8} {"Requests":>9} {"Errors":>7} {"Commands/s":>11} {"Server CPU":>11} '
+          f'{"Commands/s/core":>16} {"CPU us/command":>15}')
+    connected = measure(True, args)
+    alone = measure(False, args)
+
+    # Both lanes pay the same for the serial link, so the gain is largest in the request handling
+    assert connected > 1.5 and alone > connected, (connected, alone)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""
+Queue growth under a command flood, and the motor watchdog
+
+A misbehaving client floods motor, servo and animation commands as fast
+as it can for a few seconds, once straight into ArduinoDevice and once
+through the CommandGovernor, while the depth of the serial send queue
+is sampled. The commands reaching the pty-backed FakeArduino are
+counted per channel, and the last motor value received is checked
+against the last one sent (smoothing keeps the newest value). The
+watchdog is then timed: a client drives, goes quiet, and the time until
+the Arduino receives X0 and Y0 is measured. Heartbeats with network
+delays (and one long stall) show how the timeout trades off
+stopping quickly against stopping when the connection is only slow.
+The script also checks the Flask routes, the status and the fast lane:
+    python3 benchmarks/governor_benchmark.py
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from threading import Thread
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_arduino import FakeArduino, connect
+from governor import CommandGovernor, IDLE, DRIVING, STOPPED
+
+
+# ================================================================
+class NullArduino:
+    """Connected Arduino which ignores the commands"""
+
+    def is_connected(self) -> bool:
+        return True
+
+    # ------------------------------------------------------------
+    def send_command(self, command: str) -> bool:
+        return True
+
+
+# ----------------------------------------------------------------
+def flood(governed: bool, args) -> dict:
+    """
+    Send commands as fast as possible, straight to the Arduino or through the governor
+    :return: Dictionary of the results
+    """
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    governor = CommandGovernor(arduino, args.rate, args.burst, 0)
+    governor.start()
+    target = governor if governed else arduino
+    depths = []
+    running = True
+
+    def sample():
+        while running:
+            depths.append(arduino.get_queue_stats()['depth'])
+            time.sleep(0.005)
+
+    sampler = Thread(target=sample)
+    sampler.start()
+
+    try:
+        device.received.clear()
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            value = sent % 200 - 100
+            target.send_command(f'X{value}')
+            target.send_command(f'Y{-value}')
+            target.send_command(f'G{sent % 100}')
+            target.send_command(f'A{sent % 3}')
+            sent += 4
+        last = f'X{(sent - 4) % 200 - 100}'
+        time.sleep(0.5)
+
+        running = False
+        sampler.join()
+        commands = [command for _, command in device.received]
+        return {'sent': sent, 'max_depth': max(depths), 'dropped': arduino.get_queue_stats()['dropped'],
+                'received': {channel: sum(command[0] == channel for command in commands) for channel in 'XGA'},
+                'latest': [command for command in commands if command[0] == 'X'][-1] == last,
+                'status': governor.get_status()}
+
+    finally:
+        running = False
+        sampler.join()
+        governor.stop()
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_watchdog(args):
+    """Time from the last motor command until the Arduino receives X0 and Y0"""
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    governor = CommandGovernor(arduino, args.rate, args.burst, args.timeout)
+    trips = []
+    governor.add_listener(trips.append)
+    governor.start()
+
+    try:
+        delays = []
+        for _ in range(5):
+            last_input = time.perf_counter()
+            governor.send_command('X40')
+            governor.send_command('Y60')
+            time.sleep(0.05)
+            assert governor.get_status()['state'] == DRIVING
+            device.received.clear()
+
+            while not any(command == 'Y0' for _, command in device.received):
+                time.sleep(0.001)
+            delays.append(device.received[-1][0] - last_input)
+            assert [command for _, command in device.received] == ['X0', 'Y0'], device.received
+            assert governor.get_status()['state'] == STOPPED
+
+        print(f'Watchdog ({args.timeout:.1f} s timeout): motors stopped {min(delays):.3f}-{max(delays):.3f} s '
+              f'after the last motor command')
+        assert len(trips) == 5 and trips[-1]['trips'] == 5
+        assert all(args.timeout <= delay < args.timeout + 0.1 for delay in delays), delays
+
+        # Releasing the joystick sends 0, so the watchdog has nothing to do
+        governor.send_command('X0')
+        governor.send_command('Y0')
+        time.sleep(args.timeout + 0.2)
+        assert governor.get_status()['state'] == IDLE and len(trips) == 5
+
+    finally:
+        governor.stop()
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_network(args):
+    """Stops while driving with heartbeats over a slow network which stalls once, for several timeouts"""
+    random.seed(1)
+    print(f'{"Timeout (s)":>12} {"Heartbeats":>11} {"Stall":>6} {"Stops":>6}')
+
+    for timeout in (0.5, 1.0, 2.0):
+        governor = CommandGovernor(NullArduino(), args.rate, args.burst, timeout)
+        governor.start()
+        try:
+            # Heartbeats every 300 ms, delayed by the network (mostly a little, and one stall of 1.5 s)
+            end = time.perf_counter() + 4.0
+            count = 0
+            stalled = False
+            while time.perf_counter() < end:
+                delay = 0.3 + random.lognormvariate(0, 0.5) * 0.03
+                if not stalled and count == 5:
+                    delay = 1.5
+                    stalled = True
+                time.sleep(delay)
+                governor.send_command('X0')
+                governor.send_command('Y50')
+                count += 1
+            trips = governor.get_status()['trips']
+            print(f'{timeout:>12.1f} {count:>11} {"1.5 s":>6} {trips:>6}')
+
+            # The jitter never stops the motors, only the stall does when it is longer than the timeout
+            assert trips == (1 if timeout < 1.5 else 0), (timeout, trips)
+        finally:
+            governor.stop()
+
+
+# ----------------------------------------------------------------
+def check_routes(args):
+    """Rate limited replies of the Flask routes and the fast lane, and the governor status"""
+    import app as webapp
+
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    webapp.arduino = arduino
+    webapp.governor = CommandGovernor(arduino, args.rate, args.burst, args.timeout)
+    webapp.fast_lane.arduino = webapp.governor
+    webapp.governor.start()
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    try:
+        replies = [client.post('/animate', data={'clip': '1'}).get_json()['status'] for _ in range(args.burst + 5)]
+        assert replies.count('OK') >= args.burst and replies[-1] == 'Error', replies
+        token = client.post('/fastToken').get_json()['token']
+        statuses = [client.post(f'/c?t={token}&a=2').status_code for _ in range(args.burst + 5)]
+        assert statuses[-1] == 429, statuses
+
+        assert client.post('/motor', data={'stickX': '0.3', 'stickY': '0.5'}).get_json()['status'] == 'OK'
+        status = client.post('/arduinoStatus', data={'type': 'governor'}).get_json()['governor']
+        assert status['state'] == DRIVING and status['motors'] == {'X': 30, 'Y': 50}, status
+        time.sleep(args.timeout + 0.1)
+        status = client.post('/arduinoStatus', data={'type': 'governor'}).get_json()['governor']
+        assert status['state'] == STOPPED and status['trips'] == 1, status
+        print(f'Routes: {replies.count("OK")} of {len(replies)} /animate accepted, '
+              f'{statuses.count(429)} of {len(statuses)} fast lane animations refused, watchdog state {status["state"]}, '
+              f'{status["limited"]} commands limited')
+
+    finally:
+        webapp.governor.stop()
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=2.0, help='Seconds of flooding')
+    parser.add_argument('--rate', type=float, default=50, help='Commands per second allowed on each channel')
+    parser.add_argument('--burst', type=int, default=10, help='Commands allowed at once on each channel')
+    parser.add_argument('--timeout', type=float, default=1.0, help='Watchdog timeout (seconds)')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests')
+    args = parser.parse_args()
+
+    print(f'Flooding for {args.duration:.0f} s, limit {args.rate:.0f} commands/s per channel, burst {args.burst}')
+    print(f'{"Path":<10} {"Sent":>8} {"Max queue":>10} {"Dropped":>8} {"X received":>11} {"G received":>11} '
+          f'{"A received":>11} {"Latest X":>9}')
+    results = {}
+    for governed in (False, True):
+        result = flood(governed, args)
+        results[governed] = result
+        received = result['received']
+        print(f'{"governor" if governed else "direct":<10} {result["sent"]:>8} {result["max_depth"]:>10} '
+              f'{result["dropped"]:>8} {received["X"]:>11} {received["G"]:>11} {received["A"]:>11} '
+              f'{"yes" if result["latest"] else "no":>9}')
+
+    # Through the governor, each channel stays within its rate and the queue doesn't fill up
+    governed = results[True]
+    limit = args.rate * (args.duration + 0.5) + args.burst
+    assert all(count <= limit for count in governed['received'].values()), governed
+    assert governed['max_depth'] < results[False]['max_depth'] and governed['dropped'] == 0, governed
+    assert governed['latest'], governed
+    print(f'Governor: {governed["status"]["limited"]} commands limited, {governed["status"]["deferred"]} setpoints deferred')
+
+    check_watchdog(args)
+    check_network(args)
+    if not args.no_routes:
+        check_routes(args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
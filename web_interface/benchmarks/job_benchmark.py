@@ -0,0 +1,246 @@
+"""
+Latency of /motor while text-to-speech jobs keep the server busy
+
+The web-interface is started in a child process under waitress (4
+threads, as in production) and connected to a pty-backed FakeArduino.
+Speech is generated by the stand-ins in benchmarks/stubs, with audio
+output discarded. Several clients keep asking for new phrases, while
+the /motor round-trip time is measured. This is compared with running
+the speech pipeline inside the request handler, as before the job
+queue. Finally, the queue is filled up and everything is cancelled:
+    python3 benchmarks/job_benchmark.py
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+import http.client
+from threading import Thread, Event
+from urllib.parse import urlencode
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_arduino import FakeArduino
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+
+# ================================================================
+class InlineJobs:
+    """Run jobs inside the request handler, like the routes did before the job queue"""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def submit(self, kind: str, function, priority: int = 0):
+        from job_queue import Job, DONE, FAILED
+        job = Job(kind, function, priority, 0)
+        try:
+            function(job)
+            job.state = DONE
+        except Exception:
+            job.state = FAILED
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+
+# ----------------------------------------------------------------
+def serve(port_name: str, http_port: int, inline: bool, espeak_delay: float, rubberband_delay: float):
+    """Run the web-interface with the speech stand-ins and no audio output"""
+    from waitress import serve as waitress_serve
+    from audio_engine import AudioEngine, NullSink
+    from tts_cache import TTSCache
+    import app as webapp
+
+    espeak_cmd = [sys.executable, os.path.join(STUBS_DIR, 'espeak_stub.py'), '--delay', str(espeak_delay)]
+    rb_cmd = [sys.executable, os.path.join(STUBS_DIR, 'rubberband_stub.py'), '--delay', str(rubberband_delay)]
+
+    webapp.player = AudioEngine(webapp.app.config['SOUND_FOLDER'], sink=NullSink())
+    webapp.tts_cache = TTSCache(tempfile.mkdtemp(), espeak_cmd, rb_cmd)
+    if inline:
+        webapp.jobs = InlineJobs()
+
+    webapp.arduino.connect(port_name)
+    waitress_serve(webapp.app, host='127.0.0.1', port=http_port, threads=4, _quiet=True)
+
+
+# ================================================================
+class Client:
+    """HTTP connection logged in to the web-interface"""
+
+    def __init__(self, port: int, password: str):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.connection.request('POST', '/login_request', body=urlencode({'password': password}),
+                                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        response = self.connection.getresponse()
+        response.read()
+        self.headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                        'Cookie': response.getheader('Set-Cookie', '').split(';')[0]}
+
+    def post(self, path: str, data: dict) -> dict:
+        self.connection.request('POST', path, body=urlencode(data), headers=self.headers)
+        return json.loads(self.connection.getresponse().read())
+
+    def close(self):
+        self.connection.close()
+
+
+# ----------------------------------------------------------------
+def talker(port: int, password: str, number: int, stop: Event, spoken: list):
+    """Keep asking for new phrases, waiting for each to be generated"""
+    client = Client(port, password)
+    count = 0
+
+    while not stop.is_set():
+        count += 1
+        result = client.post('/tts', {'text': f'Talker {number} phrase {count}'})
+        job = result.get('job')
+
+        # With the job queue, the response arrives immediately, so poll until the job is done
+        while job is not None and not stop.is_set():
+            state = client.post('/jobStatus', {'job': job})['job']['state']
+            if state not in ('queued', 'running'):
+                break
+            time.sleep(0.1)
+        spoken.append(count)
+
+    client.close()
+
+
+# ----------------------------------------------------------------
+def measure_motor(client: Client, count: int, interval: float) -> list[float]:
+    """Send motor commands at the rate of the joystick, returning the round-trip times"""
+    latencies = []
+    for i in range(count):
+        value = (i % 100) / 100
+        start = time.perf_counter()
+        client.post('/motor', {'stickX': value, 'stickY': -value})
+        latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return sorted(latencies)
+
+
+# ----------------------------------------------------------------
+def start_server(args, device: FakeArduino, inline: bool) -> tuple[subprocess.Popen, Client]:
+    """Start the web-interface in a child process and log in"""
+    command = [sys.executable, os.path.abspath(__file__), '--serve', device.port_name,
+               '--http-port', str(args.http_port), '--espeak-delay', str(args.espeak_delay),
+               '--rubberband-delay', str(args.rubberband_delay)]
+    server = subprocess.Popen(command + (['--inline'] if inline else []), cwd=BASE_DIR)
+
+    for attempt in range(100):
+        try:
+            return (server, Client(args.http_port, args.password))
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('Web-interface did not start')
+
+
+# ----------------------------------------------------------------
+def run(name: str, args, device: FakeArduino, inline: bool) -> list[dict]:
+    """Measure /motor while idle and while the talkers are running"""
+    server, client = start_server(args, device, inline)
+    results = []
+
+    try:
+        latencies = measure_motor(client, args.count, args.interval)
+        results.append({'name': f'{name}, idle', 'latencies': latencies, 'phrases': 0})
+
+        stop = Event()
+        spoken: list[int] = []
+        threads = [Thread(target=talker, args=(args.http_port, args.password, number, stop, spoken))
+                   for number in range(args.talkers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+
+        latencies = measure_motor(client, args.count, args.interval)
+        results.append({'name': f'{name}, speaking', 'latencies': latencies, 'phrases': len(spoken)})
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        if not inline:
+            check_cancel(client, args.talkers)
+
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+
+    return results
+
+
+# ----------------------------------------------------------------
+def check_cancel(client: Client, talkers: int):
+    """Fill the queue, then cancel everything as the "stop talking" button does"""
+    jobs = []
+    while True:
+        result = client.post('/tts', {'text': f'Queued phrase {len(jobs)}'})
+        if result['status'] != 'OK':
+            break
+        jobs.append(result['job'])
+
+    stats = client.post('/audioStatus', {})['jobs']
+    cancelled = client.post('/jobCancel', {'job': 'all'})['cancelled']
+    states = [client.post('/jobStatus', {'job': job})['job']['state'] for job in jobs]
+
+    print(f'Queue full after {len(jobs)} phrases ({stats["running"]} running, {stats["queued"]} waiting), '
+          f'"{result["msg"]}"; {cancelled} cancelled')
+    assert cancelled == stats['running'] + stats['queued']
+    assert states.count('cancelled') >= len(jobs) - stats['running']
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=100, help='Number of motor commands per test')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between motor commands')
+    parser.add_argument('--talkers', type=int, default=6, help='Number of clients asking for speech')
+    parser.add_argument('--espeak-delay', type=float, default=0.3, help='Run time of the espeak stand-in')
+    parser.add_argument('--rubberband-delay', type=float, default=0.2, help='Run time of the rubberband stand-in')
+    parser.add_argument('--password', default='walle', help='Login password of the web-interface')
+    parser.add_argument('--http-port', type=int, default=5082)
+    parser.add_argument('--serve', metavar='PORT_NAME', help=argparse.SUPPRESS)
+    parser.add_argument('--inline', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        os.chdir(BASE_DIR)
+        serve(args.serve, args.http_port, args.inline, args.espeak_delay, args.rubberband_delay)
+        return 0
+
+    device = FakeArduino()
+    device.start()
+
+    try:
+        results = run('Job queue', args, device, False) + run('In request', args, device, True)
+    finally:
+        device.stop()
+
+    print(f'{"Test":<22} {"Phrases":>8} {"Mean (ms)":>10} {"p95 (ms)":>10} {"Max (ms)":>10}')
+    for r in results:
+        latencies = r['latencies']
+        print(f'{r["name"]:<22} {r["phrases"]:>8} {statistics.mean(latencies) * 1000:>10.2f} '
+              f'{latencies[int(len(latencies) * 0.95) - 1] * 1000:>10.2f} {latencies[-1] * 1000:>10.2f}')
+
+    # With the job queue, speech must not hold up the motor commands
+    idle, speaking = results[0]['latencies'], results[1]['latencies']
+    assert speaking[int(len(speaking) * 0.95) - 1] < max(0.05, 5 * idle[int(len(idle) * 0.95) - 1])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Command round-trip latency, measured from the Arduino's echoes and acks
+
+A pty-backed FakeArduino echoes every command (or acks every binary
+frame), optionally spending some time in the rest of its loop() after
+each serial read, like the servo and motor updates of wall-e.ino. Motor
+and servo commands are sent at several rates, and the per-command-type
+percentiles collected by the telemetry are reported with the queue
+statistics. The script also checks the histogram's percentile estimates
+against exact values, and that commands sent while the device is
+stalled are counted as lost:
+    python3 benchmarks/latency_benchmark.py
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino, connect
+import telemetry
+
+
+# ----------------------------------------------------------------
+def check_histogram(samples: int):
+    """Percentiles estimated from the buckets should be close to the exact values"""
+    values = sorted(random.lognormvariate(1.5, 1.0) for _ in range(samples))
+    histogram = telemetry.LatencyHistogram()
+    for value in values:
+        histogram.add(value)
+
+    for fraction in (0.5, 0.95, 0.99):
+        exact = values[int(fraction * samples) - 1]
+        estimate = histogram.get_percentile(fraction)
+        index = next((i for i, bound in enumerate(telemetry.LATENCY_BUCKETS) if exact <= bound),
+                     len(telemetry.LATENCY_BUCKETS))
+        lower = telemetry.LATENCY_BUCKETS[index - 1] if index > 0 else 0
+        upper = telemetry.LATENCY_BUCKETS[index] if index < len(telemetry.LATENCY_BUCKETS) else max(values)
+        assert lower <= estimate <= upper, (fraction, exact, estimate)
+        print(f'p{int(fraction * 100)}: exact {exact:.2f} ms, estimated {estimate:.2f} ms')
+
+
+# ----------------------------------------------------------------
+def run(protocol: str, loop_time: float, rate: float, duration: float) -> dict:
+    """
+    Send motor and servo commands at a fixed rate
+    :param loop_time: Seconds the simulated Arduino spends in loop() after each read
+    :param rate:      Number of updates per second (each update sets 4 channels)
+    :return: Latency statistics of the telemetry
+    """
+    device = FakeArduino(binary=(protocol == 'binary'), loop_time=loop_time)
+    device.start()
+    arduino = connect(device, protocol)
+
+    try:
+        start = time.perf_counter()
+        tick = 0
+        while time.perf_counter() - start < duration:
+            value = int(100 * ((tick % 40) / 20 - 1))
+            for command in (f'X{value}', f'Y{-value}', f'L{abs(value)}', f'R{abs(value) // 2}'):
+                arduino.send_command(command)
+            tick += 1
+            time.sleep(max(0, start + tick / rate - time.perf_counter()))
+
+        time.sleep(0.2)
+        stats = arduino.telemetry.get_latency_stats()
+        stats['queue'] = arduino.get_queue_stats()
+        return stats
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_lost():
+    """Commands sent while the device isn't reading are counted as lost once it restarts"""
+    device = FakeArduino()
+    device.start()
+    arduino = ArduinoDevice("ascii")
+
+    try:
+        arduino.connect(device.port_name)
+        for i in range(5):
+            arduino.send_command(f'A{i}')
+        time.sleep(0.2)
+
+        # Commands sent while the device is stalled are read and discarded after it resumes
+        device.pause()
+        time.sleep(0.1)
+        for i in range(5):
+            arduino.send_command(f'A{i + 10}')
+        time.sleep(0.1)
+        os.read(device.master_fd, 4096)
+        device.resume()
+
+        time.sleep(telemetry.LOST_TIMEOUT * 1.5)
+        stats = arduino.telemetry.get_latency_stats()
+        assert stats['A']['count'] == 5 and stats['A']['lost'] == 5, stats['A']
+        print(f'Stalled device: {stats["A"]["count"]} commands acknowledged, {stats["A"]["lost"]} lost')
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=2.0, help='Seconds per test')
+    parser.add_argument('--rates', default='20,100,400', help='Comma-separated update rates (per second)')
+    parser.add_argument('--loop-times', default='0,0.01', help='Comma-separated loop() times of the device')
+    args = parser.parse_args()
+
+    check_histogram(10000)
+    check_lost()
+
+    print(f'{"Protocol":<9} {"Loop (ms)":>9} {"Rate":>6} {"Type":>5} {"Count":>7} '
+          f'{"p50 (ms)":>9} {"p95 (ms)":>9} {"p99 (ms)":>9} {"Lost":>5} {"Coalesced":>10}')
+
+    loop_times = [float(t) for t in args.loop_times.split(',')]
+    rates = [float(r) for r in args.rates.split(',')]
+
+    for protocol in ('ascii', 'binary'):
+        busiest = []
+        for loop_time in loop_times:
+            for rate in rates:
+                stats = run(protocol, loop_time, rate, args.duration)
+                coalesced = sum(channel['coalesced'] for channel in stats['queue']['channels'].values())
+
+                for command_type in ('X', 'L', 'all'):
+                    result = stats[command_type]
+                    print(f'{protocol:<9} {loop_time * 1000:>9.0f} {rate:>6.0f} {command_type:>5} '
+                          f'{result["count"]:>7} {result["p50"]:>9.2f} {result["p95"]:>9.2f} '
+                          f'{result["p99"]:>9.2f} {result["lost"]:>5} {coalesced:>10}')
+
+                assert stats['all']['count'] > 0 and stats['all']['lost'] == 0
+                if rate == max(rates):
+                    busiest.append(stats['all']['p99'])
+
+        # Commands which arrive while loop() is busy wait for the next serial read
+        assert busiest == sorted(busiest), busiest
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
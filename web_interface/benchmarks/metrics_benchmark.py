@@ -0,0 +1,180 @@
+"""
+Cost of the metrics on the hot paths
+
+Compares updating a sharded (lock-free) counter and histogram with
+a lock-protected equivalent, from one thread and from several threads
+at once, and checks no updates are lost. Then /motor is requested
+through the Flask test client, connected to a pty-backed FakeArduino,
+with and without the request metrics hooks, and the /metrics document
+is checked against the text exposition format:
+    python3 benchmarks/metrics_benchmark.py
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+from bisect import bisect_left
+from threading import Lock, Thread
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import metrics
+from fake_arduino import FakeArduino
+
+
+SAMPLE_PATTERN = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="[^"]*",?)*\})? '
+                            r'(-?[0-9.e+-]+|\+Inf|-Inf|NaN)$')
+
+
+# ================================================================
+class LockedHistogram:
+    """The straightforward alternative: one lock around every update"""
+
+    def __init__(self, buckets: tuple = metrics.DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.total += value
+
+
+# ----------------------------------------------------------------
+def per_call(function, calls: int, threads: int = 1) -> float:
+    """Wall time per call in nanoseconds, with the calls split between threads"""
+    def worker():
+        for _ in range(calls // threads):
+            function()
+
+    workers = [Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+# ----------------------------------------------------------------
+def check_updates(calls: int, threads: int):
+    """Updates from several threads at once must all be counted"""
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter('updates', 'Updates').labels()
+    histogram = registry.histogram('values', 'Values').labels()
+
+    def worker():
+        for _ in range(calls):
+            counter.inc()
+            histogram.observe(0.003)
+
+    workers = [Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    counts, total = histogram.get()
+    assert counter.get() == calls * threads and sum(counts) == calls * threads
+    assert abs(total - 0.003 * calls * threads) < 1e-6
+    print(f'{threads} threads x {calls} updates: none lost')
+
+
+# ----------------------------------------------------------------
+def time_request(client, index: int) -> float:
+    """Duration (microseconds) of a /motor request"""
+    start = time.perf_counter()
+    client.post('/motor', data={'stickX': f'{(index % 200 - 100) / 100}', 'stickY': '0.5'})
+    return (time.perf_counter() - start) * 1e6
+
+
+# ----------------------------------------------------------------
+def check_routes(rounds: int):
+    """Time /motor with and without the metrics hooks, and validate /metrics"""
+    import app as webapp
+
+    device = FakeArduino()
+    device.start()
+    webapp.arduino.connect(device.port_name)
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    try:
+        hooks = (webapp.app.before_request_funcs, webapp.app.after_request_funcs)
+        saved = [dict(functions) for functions in hooks]
+
+        # Alternate between the two configurations on every request to cancel out any drift
+        enabled, disabled = [], []
+        for i in range(rounds * 2):
+            for functions, values in zip(hooks, saved):
+                functions.clear()
+                if i % 2:
+                    functions.update(values)
+            (enabled if i % 2 else disabled).append(time_request(client, i))
+
+        # The cost of the hooks themselves, without the noise of the rest of the request
+        with webapp.app.test_request_context('/motor', method='POST'):
+            webapp.app.preprocess_request()
+            response = webapp.app.response_class('')
+            start = time.perf_counter()
+            for _ in range(rounds * 10):
+                webapp.start_request_timer()
+                webapp.record_request(response)
+            hook_time = (time.perf_counter() - start) / (rounds * 10) * 1e6
+
+        baseline = statistics.median(disabled)
+        print(f'/motor median: {baseline:.1f} us without metrics, {statistics.median(enabled):.1f} us with metrics; '
+              f'the hooks take {hook_time:.1f} us ({hook_time / baseline:.1%})')
+        assert hook_time < baseline * 0.05
+
+        document = client.get('/metrics').data.decode()
+        samples = [line for line in document.splitlines() if line and not line.startswith('#')]
+        invalid = [line for line in samples if not SAMPLE_PATTERN.match(line)]
+        assert not invalid, invalid[:5]
+        assert 'walle_requests_total{route="/motor",method="POST",status="200"}' in document
+        assert 'walle_serial_bytes_total{direction="out"}' in document
+        print(f'/metrics: {len(samples)} samples, {len(document) / 1000:.1f} kB')
+
+    finally:
+        webapp.arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=400000, help='Number of updates per measurement')
+    parser.add_argument('--threads', type=int, default=4, help='Number of threads updating at once')
+    parser.add_argument('--rounds', type=int, default=3000, help='Number of /motor requests per configuration')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests (which need the camera library)')
+    args = parser.parse_args()
+
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter('counter', 'Counter').labels()
+    histogram = registry.histogram('histogram', 'Histogram').labels()
+    locked = LockedHistogram()
+
+    print(f'{"Update":<24} {"1 thread (ns)":>14} {f"{args.threads} threads (ns)":>15}')
+    for name, function in (('Empty call', lambda: None),
+                           ('Counter.inc', counter.inc),
+                           ('Histogram.observe', lambda: histogram.observe(0.002)),
+                           ('Locked histogram', lambda: locked.observe(0.002))):
+        print(f'{name:<24} {per_call(function, args.calls):>14.0f} '
+              f'{per_call(function, args.calls, args.threads):>15.0f}')
+
+    check_updates(args.calls // args.threads, args.threads)
+
+    if not args.no_routes:
+        check_routes(args.rounds)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
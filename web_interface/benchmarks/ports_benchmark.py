@@ -0,0 +1,184 @@
+"""
+Serial port registry: cost of listing ports, and Arduino hotplug handling
+
+First the time taken by pyserial's comports() (which walks sysfs) is
+compared with the cached list of the registry. Then a fake enumerator
+simulates the Arduino being plugged in, unplugged and plugged back in,
+with a pty-backed FakeArduino as the device. The script checks that the
+device is connected automatically, disconnected when removed, not
+reconnected after the user has disconnected it, and that a watched
+folder only causes new scans when it changes:
+    python3 benchmarks/ports_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import serial.tools.list_ports
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from serial_ports import PortRegistry
+from fake_arduino import FakeArduino
+
+
+# ================================================================
+class FakePort:
+    """Port information in the same form as pyserial's ListPortInfo"""
+
+    def __init__(self, device: str, description: str):
+        self.device = device
+        self.description = description
+
+
+# ================================================================
+class FakeEnumerator:
+    """List of ports which can be changed by the test, counting the number of scans"""
+
+    def __init__(self, ports: list[FakePort] | None = None):
+        self.ports = list(ports or [])
+        self.calls = 0
+
+    def __call__(self) -> list[FakePort]:
+        self.calls += 1
+        return list(self.ports)
+
+
+# ----------------------------------------------------------------
+def wait_for(condition, timeout: float = 5.0) -> float | None:
+    """Wait until the condition is true, returning how long it took (None on timeout)"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if condition():
+            return time.perf_counter() - start
+        time.sleep(0.001)
+    return None
+
+
+# ----------------------------------------------------------------
+def timed(function, rounds: int) -> float:
+    """Mean time of a function call in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+# ----------------------------------------------------------------
+def check_hotplug(interval: float):
+    """Plug the simulated Arduino in and out, checking the device follows"""
+    device = FakeArduino()
+    device.start()
+    port = FakePort(device.port_name, 'Arduino Uno (ttyACM0)')
+    other = FakePort('/dev/ttyUSB7', 'USB Serial')
+
+    enumerator = FakeEnumerator([other])
+    registry = PortRegistry(enumerator, watch_path=None, interval=interval)
+    arduino = ArduinoDevice("ascii", registry, preferred_port="Arduino")
+    events = []
+    registry.add_listener(lambda added, removed: events.append((len(added), len(removed))))
+    registry.start()
+
+    def command_arrives(command: str) -> bool:
+        count = len(device.received)
+        arduino.send_command(command)
+        return wait_for(lambda: len(device.received) > count, 1.0) is not None
+
+    try:
+        assert not arduino.is_connected()
+
+        # Plugged in for the first time: connects to the preferred port
+        enumerator.ports.append(port)
+        plugged = wait_for(arduino.is_connected)
+        assert plugged is not None and arduino.port_name == port.device and command_arrives('X10')
+        print(f'Connected {plugged * 1000:.0f} ms after being plugged in')
+
+        # Unplugged: the device notices and stops its threads
+        enumerator.ports.remove(port)
+        removed = wait_for(lambda: not arduino.is_connected())
+        assert removed is not None
+        print(f'Disconnected {removed * 1000:.0f} ms after being removed')
+
+        # Plugged back in: reconnects
+        enumerator.ports.append(port)
+        replugged = wait_for(arduino.is_connected)
+        assert replugged is not None and command_arrives('Y20')
+        print(f'Reconnected {replugged * 1000:.0f} ms after being plugged back in')
+
+        # Once the user has disconnected, the port is left alone
+        arduino.disconnect()
+        enumerator.ports.remove(port)
+        assert wait_for(lambda: registry.get_stats()['version'] == 5) is not None
+        enumerator.ports.append(port)
+        assert wait_for(lambda: registry.get_stats()['version'] == 6) is not None
+        time.sleep(interval * 3)
+        assert not arduino.is_connected()
+        print('Not reconnected after the user disconnected')
+
+        # Connecting by index uses the cached list
+        index = registry.get_devices().index(port.device)
+        assert arduino.connect(index) and command_arrives('X30')
+
+        history = registry.get_events()
+        assert [event['version'] for event in history] == [1, 2, 3, 4, 5, 6]
+        assert registry.get_events(since=3) == history[3:]
+        assert events == [(1, 0), (1, 0), (0, 1), (1, 0), (0, 1), (1, 0)]
+        print(f'{len(history)} change events, {enumerator.calls} scans')
+
+    finally:
+        registry.stop()
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_watch_path(interval: float):
+    """With a watched folder, ports are only listed again when the folder changes"""
+    with tempfile.TemporaryDirectory() as folder:
+        enumerator = FakeEnumerator([FakePort('/dev/ttyACM0', 'Arduino')])
+        registry = PortRegistry(enumerator, watch_path=folder, interval=interval)
+        registry.start()
+
+        try:
+            time.sleep(interval * 10)
+            idle_scans = enumerator.calls
+
+            # A new device node changes the folder's modification time
+            enumerator.ports.append(FakePort('/dev/ttyACM1', 'Arduino'))
+            time.sleep(0.01)
+            open(os.path.join(folder, 'ttyACM1'), 'w').close()
+            found = wait_for(lambda: len(registry.get_ports()) == 2)
+
+            assert idle_scans == 1 and found is not None
+            print(f'Watched folder: {idle_scans} scan while idle, new port found after {found * 1000:.0f} ms')
+
+        finally:
+            registry.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200, help='Number of times the ports are listed')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between checks of the watcher')
+    args = parser.parse_args()
+
+    registry = PortRegistry()
+    comports = timed(serial.tools.list_ports.comports, args.rounds)
+    cached = timed(registry.get_devices, args.rounds)
+    print(f'{"Method":<24} {"Mean (ms)":>10}')
+    print(f'{"comports()":<24} {comports:>10.3f}')
+    print(f'{"PortRegistry (cached)":<24} {cached:>10.4f}')
+
+    check_hotplug(args.interval)
+    check_watch_path(args.interval)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+"""
+Timing accuracy of automation programs run on the server
+
+A program of servo and motor steps separated by short waits is run by
+the ProgramRunner against a pty-backed FakeArduino, and the time each
+command reaches the simulated Arduino is compared with its due time.
+The same program is also run the way the browser used to run it: each
+wait started by a timer after the previous step (with the 10 ms polling
+of the interpreter), and each step sent as a separate request with some
+network delay. The script also checks that loops which never end are
+repeated on time until they are stopped, that stopping a program stops
+the motors, that a missing Arduino is reported, that bad programs are
+rejected, and the /programRun, /programStatus and /programStop routes:
+    python3 benchmarks/program_benchmark.py
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino, connect
+from automation import ProgramRunner, parse_program, FINISHED, STOPPED, FAILED
+
+
+# ----------------------------------------------------------------
+def make_program(steps: int, interval: float) -> list[dict]:
+    """Program which moves the head and drives forwards and backwards, with a wait after each command"""
+    program = []
+    for index in range(steps):
+        if index % 2 == 0:
+            program.append({'type': 'servo', 'servo': 'G', 'value': index % 100})
+        else:
+            program.append({'type': 'motor', 'x': 0, 'y': 0.5 if index % 4 == 1 else -0.5})
+        program.append({'type': 'wait', 'seconds': interval})
+    program.append({'type': 'motor', 'x': 0, 'y': 0})
+    return parse_program(json.dumps({'steps': program}))
+
+
+# ----------------------------------------------------------------
+def due_times(program: list[dict]) -> list[tuple[float, str]]:
+    """Due time of the last command sent by each step, relative to the start of the program"""
+    due = 0.0
+    commands = []
+    for step in program:
+        if step['type'] == 'wait':
+            due += step['seconds']
+        elif step['type'] == 'servo':
+            commands.append((due, f'{step["servo"]}{step["value"]}'))
+        elif step['type'] == 'motor':
+            commands.append((due, f'Y{int(step["y"] * 100)}'))
+    return commands
+
+
+# ----------------------------------------------------------------
+def lateness(device: FakeArduino, program: list[dict], start: float) -> list[float]:
+    """Seconds between the due time of each command and its arrival at the simulated Arduino"""
+    expected = due_times(program)
+    arrivals = [entry for entry in device.received if entry[0] >= start and entry[1][0] in 'GY']
+    assert len(arrivals) >= len(expected), (len(arrivals), len(expected))
+
+    # Match the commands in order, skipping repeated motor values (the Y of a servo step is never sent)
+    results = []
+    index = 0
+    for due, command in expected:
+        while arrivals[index][1] != command:
+            index += 1
+        results.append(arrivals[index][0] - start - due)
+        index += 1
+    return results
+
+
+# ----------------------------------------------------------------
+def run_server(arduino: ArduinoDevice, device: FakeArduino, program: list[dict]) -> list[float]:
+    """Upload the program once, and let the ProgramRunner schedule it"""
+    runner = ProgramRunner(arduino)
+    device.received.clear()
+    start = time.perf_counter()
+    runner.start(program)
+    while runner.is_running():
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert runner.get_status()['state'] == FINISHED, runner.get_status()
+    return lateness(device, program, start)
+
+
+# ----------------------------------------------------------------
+def run_browser(arduino: ArduinoDevice, device: FakeArduino, program: list[dict], network: float) -> list[float]:
+    """Run the program like the browser interpreter: timers between steps, and a request for each step"""
+    device.received.clear()
+    start = time.perf_counter()
+    for step in program:
+        if step['type'] == 'wait':
+            # setTimeout starts when the previous step has been sent, and the interpreter
+            # only notices the timer has fired at its next 10 ms poll
+            time.sleep(step['seconds'] + random.uniform(0, 0.01))
+            continue
+
+        # The request travels over WiFi before the server sends the command
+        time.sleep(random.lognormvariate(0, 0.5) * network)
+        if step['type'] == 'servo':
+            arduino.send_command(step['servo'] + str(step['value']))
+        else:
+            arduino.send_command("X" + str(int(step['x'] * 100)))
+            arduino.send_command("Y" + str(int(step['y'] * 100)))
+    time.sleep(0.05)
+    return lateness(device, program, start)
+
+
+# ----------------------------------------------------------------
+def check_repeat(arduino: ArduinoDevice, device: FakeArduino):
+    """A program which ends with a loop repeating forever, until it is stopped"""
+    runner = ProgramRunner(arduino)
+    device.received.clear()
+    runner.start(parse_program(json.dumps({'steps': [
+        {'type': 'servo', 'servo': 'G', 'value': 0},
+        {'type': 'repeat', 'count': 0, 'steps': [
+            {'type': 'repeat', 'count': 2, 'steps': [{'type': 'servo', 'servo': 'G', 'value': 50},
+                                                    {'type': 'wait', 'seconds': 0.05},
+                                                    {'type': 'servo', 'servo': 'G', 'value': 0},
+                                                    {'type': 'wait', 'seconds': 0.05}]},
+            {'type': 'motor', 'x': 0, 'y': 0.5}, {'type': 'wait', 'seconds': 0.1}]},
+        {'type': 'print', 'text': 'Never'}]})))
+    time.sleep(2.0)
+    status = runner.get_status()
+    assert status['state'] == 'running' and status['steps'] == 10 and 4 <= status['step'] <= 9, status
+    assert runner.stop()
+
+    # One pass of the loop takes 0.3 s and moves the head four times
+    moves = [command for _, command in device.received if command == 'G50']
+    status = runner.get_status()
+    print(f'Endless loop: {len(moves)} head moves in {status["elapsed"]:.1f} s, '
+          f'lateness mean {status["timing"]["mean_ms"]} ms, max {status["timing"]["max_ms"]} ms')
+    assert abs(len(moves) - 2 / 0.3 * 2) <= 2 and status['state'] == STOPPED and status['messages'] == [], (moves, status)
+    assert status['timing']['max_ms'] < 50, status
+
+    for steps in ([{'type': 'repeat', 'steps': [{'type': 'servo', 'servo': 'G', 'value': 1}]}],
+                  [{'type': 'repeat', 'steps': [{'type': 'wait', 'seconds': 1}]}],
+                  [{'type': 'repeat', 'count': -1, 'steps': []}]):
+        try:
+            parse_program(json.dumps({'steps': steps}))
+            raise AssertionError(f'Program was accepted: {steps}')
+        except ValueError:
+            pass
+
+
+# ----------------------------------------------------------------
+def check_control(arduino: ArduinoDevice, device: FakeArduino):
+    """Stopping a program stops the motors, and a missing Arduino fails the program"""
+    runner = ProgramRunner(arduino)
+    runner.start(parse_program(json.dumps({'steps': [
+        {'type': 'motor', 'x': 0, 'y': 0.8}, {'type': 'wait', 'seconds': 30},
+        {'type': 'motor', 'x': 0, 'y': 0}]})))
+    time.sleep(0.2)
+    device.received.clear()
+
+    start = time.perf_counter()
+    assert runner.stop()
+    stop_time = time.perf_counter() - start
+    time.sleep(0.1)
+    status = runner.get_status()
+    commands = [command for _, command in device.received]
+    print(f'Stopped during a 30 s wait after {stop_time * 1000:.1f} ms, state {status["state"]}, '
+          f'Arduino received {" ".join(commands)}')
+    assert status['state'] == STOPPED and 'Y0' in commands and stop_time < 0.1
+
+    disconnected = ProgramRunner(ArduinoDevice())
+    disconnected.start(parse_program('{"steps": [{"type": "print", "text": "Hello"}, {"type": "servo", "servo": "G", "value": 10}]}'))
+    time.sleep(0.1)
+    status = disconnected.get_status()
+    assert status['state'] == FAILED and status['error'] == 'Arduino not connected', status
+    assert status['messages'] == ['Hello'] and status['printed'] == 1, status
+
+    for text in ('', '[]', '{"steps": [{"type": "jump"}]}', '{"steps": [{"type": "wait", "seconds": -1}]}',
+                 '{"steps": [{"type": "servo", "servo": "GG", "value": 1}]}', '{"steps": [{"type": "motor", "x": 0}]}',
+                 '{"steps": [{"type": "animation", "clip": "1\\nX100"}]}'):
+        try:
+            parse_program(text)
+            raise AssertionError(f'Program was accepted: {text}')
+        except ValueError:
+            pass
+
+
+# ----------------------------------------------------------------
+def check_routes(arduino: ArduinoDevice, device: FakeArduino):
+    """Run a program through the Flask routes"""
+    import app as webapp
+
+    webapp.arduino = arduino
+    webapp.runner = ProgramRunner(arduino)
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    program = {'steps': [{'type': 'print', 'text': 'Start', 'block': 'a'}, {'type': 'animation', 'clip': '1', 'block': 'b'},
+                         {'type': 'wait', 'seconds': 0.5}, {'type': 'print', 'text': 'End', 'block': 'c'}]}
+    reply = client.post('/programRun', data={'program': json.dumps(program)}).get_json()
+    assert reply['status'] == 'OK', reply
+    time.sleep(0.1)
+
+    status = client.post('/programStatus').get_json()['program']
+    assert status['state'] == 'running' and status['block'] == 'b' and status['messages'] == ['Start'], status
+    assert client.post('/programStop').get_json()['stopped'] == 1
+    status = client.post('/programStatus').get_json()['program']
+    assert status['state'] == STOPPED and status['id'] == reply['id'], status
+
+    reply = client.post('/programRun', data={'program': '{"steps": 5}'}).get_json()
+    assert reply['status'] == 'Error', reply
+    print(f'Routes: program stopped at block {status["block"] or "-"} after {status["elapsed"]} s, '
+          f'bad program: {reply["msg"]}')
+
+
+# ----------------------------------------------------------------
+def summary(name: str, results: list[float]):
+    """Print the lateness of the commands of one run"""
+    ms = sorted(value * 1000 for value in results)
+    print(f'{name:<10} {statistics.mean(ms):>10.1f} {ms[int(len(ms) * 0.95) - 1]:>10.1f} '
+          f'{ms[-1]:>10.1f} {ms[-1] - ms[0]:>10.1f}')
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--steps', type=int, default=100, help='Number of commands in the program')
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds to wait after each command')
+    parser.add_argument('--network', type=float, default=0.015, help='Typical WiFi delay of a request (seconds)')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests')
+    args = parser.parse_args()
+
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+
+    try:
+        program = make_program(args.steps, args.interval)
+
+        print(f'{args.steps} commands, {args.interval * 1000:.0f} ms apart')
+        print(f'{"Lateness":<10} {"Mean (ms)":>10} {"p95 (ms)":>10} {"Max (ms)":>10} {"Spread":>10}')
+        server = run_server(arduino, device, program)
+        browser = run_browser(arduino, device, program, args.network)
+        summary('Server', server)
+        summary('Browser', browser)
+
+        # The server doesn't drift: the last command is as punctual as the first
+        assert max(server) < 0.02, max(server)
+        assert max(server) < max(browser)
+
+        check_repeat(arduino, device)
+        check_control(arduino, device)
+        if not args.no_routes:
+            check_routes(arduino, device)
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
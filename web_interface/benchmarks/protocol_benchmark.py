@@ -0,0 +1,109 @@
+"""
+Throughput of the text and binary serial protocols
+
+A simulated Arduino, limited to the 115200 baud of the real link,
+receives multi-axis setpoint updates as fast as ArduinoDevice can send
+them. The benchmark reports the negotiated protocol, the number of
+setpoints delivered per second, and the bytes on the wire in each
+direction:
+    python3 benchmarks/protocol_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serial_protocol
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino
+
+
+# ----------------------------------------------------------------
+def check_codec():
+    """Round-trip a few frames through the encoder and decoder"""
+    commands = ['X-100', 'Y100', 'L50', 'R0', 'A2', 'w', 'O250', 'S-7', 'B12']
+    data, seq, frames = serial_protocol.encode_commands(commands, 254, serial_protocol.FLAG_ACK)
+    items = serial_protocol.FrameDecoder().feed(data)
+
+    decoded = [f'{c}{v}' for item in items for c, v in item[3]]
+    assert decoded == [c if len(c) > 1 else c + '0' for c in commands], decoded
+    assert frames == [254, 255] and seq == 0, (frames, seq)
+
+    corrupted = bytearray(data)
+    corrupted[5] ^= 0x01
+    assert serial_protocol.FrameDecoder().feed(bytes(corrupted))[0] == ('error', 254)
+
+
+# ----------------------------------------------------------------
+def run(protocol: str, binary_device: bool, duration: float, baudrate: int) -> dict:
+    """
+    Send setpoints for several axes as fast as possible
+    :param protocol:      Protocol requested by ArduinoDevice
+    :param binary_device: Whether the simulated firmware supports frames
+    :return: Dictionary of results
+    """
+    device = FakeArduino(binary=binary_device, baudrate=baudrate)
+    device.start()
+    arduino = ArduinoDevice(protocol)
+
+    try:
+        arduino.connect(device.port_name)
+        time.sleep(0.5)
+
+        start_received = len(device.received)
+        start_rx, start_tx = device.bytes_received, device.bytes_sent
+        start = time.perf_counter()
+        tick = 0
+
+        while time.perf_counter() - start < duration:
+            value = tick % 201 - 100
+            for axis in 'XYLR':
+                arduino.send_command(f'{axis}{value}')
+            tick += 1
+            time.sleep(0.0005)
+
+        elapsed = time.perf_counter() - start
+        received = len(device.received) - start_received
+
+        return {
+            'protocol': protocol,
+            'firmware': 'binary' if binary_device else 'text only',
+            'active': 'binary' if arduino.binary_active else 'ascii',
+            'setpoints_per_s': received / elapsed,
+            'host_bytes_per_setpoint': (device.bytes_received - start_rx) / max(1, received),
+            'device_bytes_per_setpoint': (device.bytes_sent - start_tx) / max(1, received),
+        }
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds per test')
+    parser.add_argument('--baudrate', type=int, default=115200, help='Simulated serial link speed')
+    args = parser.parse_args()
+
+    check_codec()
+
+    results = [
+        run('ascii', True, args.duration, args.baudrate),
+        run('binary', False, args.duration, args.baudrate),
+        run('binary', True, args.duration, args.baudrate),
+    ]
+
+    print(f'{"Requested":<10} {"Firmware":<10} {"Active":<7} {"Setpoints/s":>12} {"Host B/sp":>10} {"Device B/sp":>12}')
+    for r in results:
+        print(f'{r["protocol"]:<10} {r["firmware"]:<10} {r["active"]:<7} {r["setpoints_per_s"]:>12.0f} '
+              f'{r["host_bytes_per_setpoint"]:>10.2f} {r["device_bytes_per_setpoint"]:>12.2f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
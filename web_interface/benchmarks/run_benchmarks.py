@@ -0,0 +1,358 @@
+"""
+Hardware-free benchmark suite of the web-interface
+
+The web-interface is started in a child process under waitress, with
+a pty-backed FakeArduino instead of the Arduino, a FakeCameraBackend
+writing synthetic JPEG frames instead of the Raspberry Pi camera, and
+the stand-ins in benchmarks/stubs instead of espeak-ng, rubberband and
+aplay. It reports:
+  - /motor throughput and latency with several keep-alive clients, and
+    the server CPU time per request
+  - the frame rate, latency and skipped frames of each stream viewer
+  - the time from POST /tts or /audio until the sound reaches aplay
+The results are saved as JSON, so runs can be compared over time:
+    python3 benchmarks/run_benchmarks.py
+    python3 benchmarks/run_benchmarks.py --compare benchmarks/results/<earlier run>.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from threading import Thread
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_arduino import FakeArduino
+from job_benchmark import Client
+from stream_benchmark import Viewer, cpu_time
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+# ----------------------------------------------------------------
+def serve(port_name: str, args):
+    """Run the web-interface with the fake devices and the stand-in commands"""
+    from waitress import serve as waitress_serve
+    from audio_engine import AudioEngine
+    from tts_cache import TTSCache
+    from picamera2_stream import PiCameraStreamer
+    from fake_camera import FakeCameraBackend
+    import app as webapp
+
+    espeak_cmd = [sys.executable, os.path.join(STUBS_DIR, 'espeak_stub.py'), '--delay', str(args.espeak_delay)]
+    rb_cmd = [sys.executable, os.path.join(STUBS_DIR, 'rubberband_stub.py'), '--delay', str(args.rubberband_delay)]
+    aplay_cmd = [sys.executable, os.path.join(STUBS_DIR, 'aplay_stub.py'), '--log', args.audio_log]
+
+    webapp.tts_cache = TTSCache(os.path.join(args.work_folder, 'tts'), espeak_cmd, rb_cmd)
+    webapp.player = AudioEngine(webapp.app.config['SOUND_FOLDER'], webapp.app.config['SOUND_FORMAT'], aplay_cmd)
+    webapp.player.preload()
+
+    webapp.camera = PiCameraStreamer(backend=FakeCameraBackend(), port=args.stream_port,
+                                     server_type=webapp.app.config['STREAM_SERVER'])
+    webapp.camera.start_stream()
+
+    webapp.arduino.connect(port_name)
+    # Measure the transport alone, without the rate limit on client commands
+    webapp.governor.rate = 0
+
+    # The clients keep every worker thread busy, so a queue of waiting requests is expected
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    waitress_serve(webapp.app, host='127.0.0.1', port=args.http_port, _quiet=True)
+
+
+# ----------------------------------------------------------------
+def percentiles(values: list[float]) -> dict:
+    """Mean, median, p95 and maximum of some durations, in milliseconds"""
+    values = sorted(values)
+    return {
+        'mean_ms': statistics.mean(values) * 1000,
+        'p50_ms': values[len(values) // 2] * 1000,
+        'p95_ms': values[max(0, int(len(values) * 0.95) - 1)] * 1000,
+        'max_ms': values[-1] * 1000,
+    }
+
+
+# ----------------------------------------------------------------
+def measure_motor(args, device: FakeArduino, pid: int) -> dict:
+    """Several clients sending /motor as fast as the server answers"""
+    latencies: list[list[float]] = [[] for _ in range(args.clients)]
+    errors = []
+    received = len(device.received)
+    end = time.perf_counter() + args.duration
+
+    def sender(results: list[float]):
+        client = Client(args.http_port, args.password)
+        i = 0
+        while time.perf_counter() < end:
+            value = (i % 200 - 100) / 100
+            start = time.perf_counter()
+            if client.post('/motor', {'stickX': value, 'stickY': -value})['status'] != 'OK':
+                errors.append(i)
+            results.append(time.perf_counter() - start)
+            i += 1
+        client.close()
+
+    start_cpu = cpu_time(pid)
+    threads = [Thread(target=sender, args=(results,)) for results in latencies]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_time(pid) - start_cpu
+
+    requests = sum(len(results) for results in latencies)
+    time.sleep(0.5)
+    assert not errors and requests > 0
+
+    return {
+        'clients': args.clients,
+        'requests': requests,
+        'requests_per_s': requests / elapsed,
+        **percentiles([value for results in latencies for value in results]),
+        'cpu_per_request_ms': cpu / requests * 1000,
+        # Commands waiting in the queue are replaced by newer ones, so fewer may arrive than were sent
+        'commands_received': len(device.received) - received,
+    }
+
+
+# ----------------------------------------------------------------
+def measure_stream(args, viewers: int, pid: int) -> dict:
+    """Frame rate, latency and skipped frames of several viewers at once"""
+    clients = [Viewer(args.stream_port) for _ in range(viewers)]
+    start_cpu = cpu_time(pid)
+    for viewer in clients:
+        viewer.start()
+    time.sleep(args.duration)
+    for viewer in clients:
+        viewer.exit_flag.set()
+    cpu = cpu_time(pid) - start_cpu
+    for viewer in clients:
+        viewer.thread.join(2.0)
+
+    assert all(viewer.frames > 0 for viewer in clients)
+    return {
+        'viewers': viewers,
+        'fps_per_viewer': statistics.mean(viewer.frames for viewer in clients) / args.duration,
+        'min_fps': min(viewer.frames for viewer in clients) / args.duration,
+        **percentiles([latency for viewer in clients for latency in viewer.latencies]),
+        'skipped': sum(viewer.skipped for viewer in clients),
+        'server_cpu_percent': cpu / args.duration * 100,
+    }
+
+
+# ----------------------------------------------------------------
+def read_starts(log_file: str) -> list[float]:
+    """Times at which aplay started receiving sound"""
+    if not os.path.exists(log_file):
+        return []
+    with open(log_file) as file:
+        return [float(line) for line in file if line.strip()]
+
+
+# ----------------------------------------------------------------
+def measure_sound(args, client: Client, path: str, values: list[str]) -> dict:
+    """
+    Time from each request until its sound reaches aplay
+    :param path:   /tts or /audio
+    :param values: Texts or clip names, requested one after the other
+    :return: Latency statistics
+    """
+    field = 'text' if path == '/tts' else 'clip'
+    latencies = []
+
+    for value in values:
+        count = len(read_starts(args.audio_log))
+        start = time.time()
+        result = client.post(path, {field: value})
+        assert result['status'] == 'OK', result
+
+        end = time.time() + 10.0
+        while len(read_starts(args.audio_log)) == count and time.time() < end:
+            time.sleep(0.002)
+        starts = read_starts(args.audio_log)
+        assert len(starts) > count, f'{path} {value}: no sound'
+        latencies.append(starts[count] - start)
+
+        # Stop the sound, leaving a gap so aplay sees the next one as a new sound
+        while client.post('/jobStatus', {'job': result['job']})['job']['state'] in ('queued', 'running'):
+            time.sleep(0.01)
+        client.post('/jobCancel', {'job': result['job']})
+        time.sleep(0.25)
+
+    return {'sounds': len(latencies), **percentiles(latencies)}
+
+
+# ----------------------------------------------------------------
+def get_metadata(args) -> dict:
+    """Describe the run, so results from different machines and commits can be told apart"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        commit = ''
+
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'settings': {name: getattr(args, name) for name in ('duration', 'clients', 'viewers', 'phrases',
+                                                             'espeak_delay', 'rubberband_delay')},
+    }
+
+
+# ----------------------------------------------------------------
+def flatten(results, prefix: str = '') -> dict:
+    """Numeric values of the results, keyed by their path such as "motor.p95_ms" """
+    values = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            values.update(flatten(value, f'{prefix}.{key}' if prefix else key))
+    elif isinstance(results, list):
+        for index, value in enumerate(results):
+            values.update(flatten(value, f'{prefix}[{index}]'))
+    elif isinstance(results, (int, float)) and not isinstance(results, bool):
+        values[prefix] = results
+    return values
+
+
+# ----------------------------------------------------------------
+def compare(old: dict, new: dict):
+    """Print the change of every result compared with an earlier run"""
+    print(f'\nCompared with {old["meta"]["time"]} (commit {old["meta"]["commit"] or "unknown"}):')
+    print(f'{"Result":<36} {"Before":>10} {"After":>10} {"Change":>8}')
+
+    old_values = flatten(old['results'])
+    for name, value in flatten(new['results']).items():
+        before = old_values.get(name)
+        if before is None:
+            continue
+        change = f'{(value - before) / before:+.0%}' if before else ''
+        print(f'{name:<36} {before:>10.2f} {value:>10.2f} {change:>8}')
+
+
+# ----------------------------------------------------------------
+def report(results: dict):
+    """Print the results as tables"""
+    motor = results['motor']
+    print(f'/motor, {motor["clients"]} clients: {motor["requests_per_s"]:.0f} requests/s, '
+          f'p50 {motor["p50_ms"]:.2f} ms, p95 {motor["p95_ms"]:.2f} ms, '
+          f'{motor["cpu_per_request_ms"]:.2f} ms CPU per request')
+
+    print(f'{"Viewers":>7} {"fps":>6} {"Min fps":>8} {"p50 (ms)":>9} {"p95 (ms)":>9} {"Skipped":>8} {"CPU":>6}')
+    for stream in results['stream']:
+        print(f'{stream["viewers"]:>7} {stream["fps_per_viewer"]:>6.1f} {stream["min_fps"]:>8.1f} '
+              f'{stream["p50_ms"]:>9.1f} {stream["p95_ms"]:>9.1f} {stream["skipped"]:>8} '
+              f'{stream["server_cpu_percent"]:>5.1f}%')
+
+    print(f'{"Sound":<20} {"Count":>6} {"p50 (ms)":>9} {"p95 (ms)":>9} {"Max (ms)":>9}')
+    for name in ('tts_generated', 'tts_cached', 'audio'):
+        sound = results[name]
+        print(f'{name:<20} {sound["sounds"]:>6} {sound["p50_ms"]:>9.1f} {sound["p95_ms"]:>9.1f} {sound["max_ms"]:>9.1f}')
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per throughput and stream test')
+    parser.add_argument('--clients', type=int, default=4, help='Number of clients sending /motor at once')
+    parser.add_argument('--viewers', default='1,4', help='Comma-separated numbers of stream viewers')
+    parser.add_argument('--phrases', type=int, default=5, help='Number of phrases spoken')
+    parser.add_argument('--espeak-delay', type=float, default=0.3, help='Run time of the espeak stand-in')
+    parser.add_argument('--rubberband-delay', type=float, default=0.2, help='Run time of the rubberband stand-in')
+    parser.add_argument('--password', default='walle', help='Login password of the web-interface')
+    parser.add_argument('--http-port', type=int, default=5090)
+    parser.add_argument('--stream-port', type=int, default=5092)
+    parser.add_argument('--output', help='JSON file for the results (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', metavar='JSON_FILE', help='Earlier results to compare with')
+    parser.add_argument('--serve', metavar='PORT_NAME', help=argparse.SUPPRESS)
+    parser.add_argument('--work-folder', help=argparse.SUPPRESS)
+    parser.add_argument('--audio-log', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        os.chdir(BASE_DIR)
+        serve(args.serve, args)
+        return 0
+
+    from picamera2_stream import STREAM_PROFILES
+
+    device = FakeArduino()
+    device.start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        args.work_folder = folder
+        args.audio_log = os.path.join(folder, 'aplay.log')
+        command = [sys.executable, os.path.abspath(__file__), '--serve', device.port_name,
+                   '--work-folder', folder, '--audio-log', args.audio_log]
+        for name in ('http_port', 'stream_port', 'espeak_delay', 'rubberband_delay'):
+            command += [f'--{name.replace("_", "-")}', str(getattr(args, name))]
+        server = subprocess.Popen(command, cwd=BASE_DIR)
+
+        try:
+            # Wait for the server to start, then log in
+            for attempt in range(150):
+                try:
+                    client = Client(args.http_port, args.password)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                raise RuntimeError('Web-interface did not start')
+
+            clips = sorted(name[:-4] for name in os.listdir(os.path.join(BASE_DIR, 'static', 'sounds'))
+                           if name.endswith('.wav'))
+            phrases = [f'Benchmark phrase number {i}' for i in range(args.phrases)]
+
+            results = {
+                'motor': measure_motor(args, device, server.pid),
+                'stream': [measure_stream(args, int(viewers), server.pid) for viewers in args.viewers.split(',')],
+                'tts_generated': measure_sound(args, client, '/tts', phrases),
+                'tts_cached': measure_sound(args, client, '/tts', phrases),
+                'audio': measure_sound(args, client, '/audio', clips),
+            }
+            client.close()
+
+        finally:
+            server.terminate()
+            server.wait()
+            device.stop()
+
+    report(results)
+
+    # Every viewer should get most of the frames, and speech from the cache shouldn't wait for espeak
+    camera_fps = STREAM_PROFILES[-1]['fps']
+    assert all(stream['min_fps'] > camera_fps * 0.8 for stream in results['stream']), results['stream']
+    assert results['tts_cached']['p50_ms'] < results['tts_generated']['p50_ms']
+    assert results['tts_generated']['p50_ms'] >= (args.espeak_delay + args.rubberband_delay) * 1000
+
+    run = {'meta': get_metadata(args), 'results': results}
+    output = args.output or os.path.join(RESULTS_DIR, f'{datetime.now().strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(run, file, indent=2)
+    print(f'Results saved to {output}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), run)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
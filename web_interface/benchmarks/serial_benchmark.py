@@ -0,0 +1,125 @@
+"""
+Latency and throughput benchmark for the ArduinoDevice serial transport
+
+Runs against the pty-backed FakeArduino, so no hardware is needed:
+    python3 benchmarks/serial_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino, wait_for
+
+
+# ----------------------------------------------------------------
+def measure_latency(arduino: ArduinoDevice, device: FakeArduino, samples: int) -> list[float]:
+    """Time from send_command() until the device has parsed the command"""
+    latencies = []
+    for i in range(samples):
+        expected = len(device.received) + 1
+        start = time.perf_counter()
+        arduino.send_command(f'X{i % 100}')
+        if wait_for(lambda: len(device.received) >= expected, 1.0):
+            latencies.append(device.received[-1][0] - start)
+        time.sleep(0.005)
+    return latencies
+
+
+# ----------------------------------------------------------------
+def measure_throughput(arduino: ArduinoDevice, device: FakeArduino, count: int) -> float:
+    """Number of commands per second which reach the device"""
+    expected = len(device.received) + count
+    start = time.perf_counter()
+    for i in range(count):
+        # Setpoints would be coalesced, so use one-shot commands and
+        # retry whenever the queue is full
+        while not arduino.send_command('q'):
+            time.sleep(0.0001)
+    wait_for(lambda: len(device.received) >= expected, 30.0)
+    return (len(device.received) - expected + count) / (time.perf_counter() - start)
+
+
+# ----------------------------------------------------------------
+def measure_stall(arduino: ArduinoDevice, device: FakeArduino, ticks: int) -> tuple[int, list[str]]:
+    """
+    Simulate joystick updates every 100 ms while the serial link is stalled
+    :return: Number of commands sent during the stall, and the commands
+             which reached the device once the link recovered
+    """
+    # Fill the pty buffer so that the writer thread blocks
+    device.pause()
+    while arduino.queue.qsize() == 0:
+        arduino.send_command('q')
+        time.sleep(0.0005)
+    arduino.clear_queue()
+
+    before = len(device.received)
+    for i in range(ticks):
+        arduino.send_command(f'X{i % 100}')
+        arduino.send_command(f'Y{-(i % 100)}')
+        arduino.send_command(f'L{i % 100}')
+
+    device.resume()
+    wait_for(lambda: arduino.queue.qsize() == 0, 5.0)
+    time.sleep(0.2)
+    commands = [c for t, c in device.received[before:] if c[0] != 'q']
+    return ticks * 3, commands
+
+
+# ----------------------------------------------------------------
+def measure_battery(arduino: ArduinoDevice, device: FakeArduino) -> float:
+    """Time from the device sending a battery message until it is parsed"""
+    arduino.battery_level = None
+    start = time.perf_counter()
+    device.write(f'Battery_{device.battery_level}')
+    wait_for(lambda: arduino.get_battery_level() is not None, 1.0)
+    return time.perf_counter() - start
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', type=int, default=200, help='Number of latency samples')
+    parser.add_argument('--count', type=int, default=5000, help='Number of commands for throughput test')
+    args = parser.parse_args()
+
+    device = FakeArduino()
+    device.start()
+    arduino = ArduinoDevice()
+
+    try:
+        if not arduino.connect(device.port_name):
+            print('Unable to connect to the simulated Arduino')
+            return 1
+
+        latencies = sorted(measure_latency(arduino, device, args.samples))
+        throughput = measure_throughput(arduino, device, args.count)
+        battery = measure_battery(arduino, device)
+        stalled, delivered = measure_stall(arduino, device, 300)
+        stats = arduino.get_queue_stats()
+
+        print(f'Command latency ({len(latencies)} samples):')
+        print(f'  mean   {statistics.mean(latencies) * 1000:8.3f} ms')
+        print(f'  median {statistics.median(latencies) * 1000:8.3f} ms')
+        print(f'  p95    {latencies[int(len(latencies) * 0.95) - 1] * 1000:8.3f} ms')
+        print(f'  max    {latencies[-1] * 1000:8.3f} ms')
+        print(f'Throughput:      {throughput:10.0f} commands/s')
+        print(f'Battery message: {battery * 1000:8.3f} ms until parsed')
+        print(f'Stalled link:    {stalled} setpoints queued, {len(delivered)} delivered {delivered}')
+        print(f'Queue counters:  {stats["coalesced"]} coalesced, {stats["dropped"]} dropped')
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Compare the threaded and asyncio MJPEG streaming servers
+
+Each server is run in a child process and fed with synthetic frames.
+The number of viewers is increased step by step, and for each step the
+benchmark reports the memory and threads used by the server, its CPU
+usage, and whether every viewer still receives the full frame rate:
+    python3 benchmarks/server_benchmark.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from threading import Thread
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_camera import make_frame
+
+
+# ----------------------------------------------------------------
+def serve(server_type: str, port: int, fps: float, frame_size: int):
+    """Run a streaming server with a synthetic frame source"""
+    import picamera2_stream
+
+    if server_type == 'async':
+        server = picamera2_stream.AsyncStreamingServer(('127.0.0.1', port))
+    else:
+        server = picamera2_stream.StreamingServer(('127.0.0.1', port), picamera2_stream.StreamingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    sequence = 0
+    next_frame = time.perf_counter()
+    while True:
+        sequence += 1
+        picamera2_stream.output.write(make_frame(sequence, frame_size))
+        next_frame += 1 / fps
+        time.sleep(max(0, next_frame - time.perf_counter()))
+
+
+# ----------------------------------------------------------------
+def process_info(pid: int) -> dict:
+    """Resident memory (kB), thread count and CPU time (s) of a process"""
+    info = {}
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            key, value = line.split(':', 1)
+            if key == 'VmRSS':
+                info['rss'] = int(value.split()[0])
+            elif key == 'Threads':
+                info['threads'] = int(value)
+    with open(f'/proc/{pid}/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    info['cpu'] = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return info
+
+
+# ----------------------------------------------------------------
+async def viewer(port: int, counts: list[int], index: int):
+    """Read the stream as fast as possible, counting the bytes received"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /stream.mjpg HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+    try:
+        while data := await reader.read(65536):
+            counts[index] += len(data)
+    finally:
+        writer.close()
+
+
+# ----------------------------------------------------------------
+async def ramp(server_type: str, pid: int, port: int, levels: list[int], fps: float, frame_size: int,
+               duration: float) -> list[dict]:
+    """Increase the number of viewers until the server can't keep up"""
+    counts: list[int] = []
+    tasks = []
+    results = []
+    expected = fps * frame_size
+    baseline = process_info(pid)
+
+    for level in levels:
+        while len(tasks) < level:
+            counts.append(0)
+            tasks.append(asyncio.create_task(viewer(port, counts, len(counts) - 1)))
+        await asyncio.sleep(2)
+
+        start_counts = list(counts)
+        start_info = process_info(pid)
+        await asyncio.sleep(duration)
+        info = process_info(pid)
+
+        rates = sorted((end - begin) / duration for begin, end in zip(start_counts, counts))
+        worst = rates[len(rates) // 10] / expected if rates else 1.0
+        results.append({
+            'server': server_type,
+            'viewers': level,
+            'rss_mb': info['rss'] / 1024,
+            'kb_per_viewer': (info['rss'] - baseline['rss']) / level if level else 0,
+            'threads': info['threads'],
+            'cpu_percent': (info['cpu'] - start_info['cpu']) / duration * 100,
+            'rate': worst,
+            'ok': worst >= 0.9,
+        })
+        if worst < 0.9:
+            break
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--levels', default='10,50,100,200,400', help='Comma separated numbers of viewers')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds to measure per step')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of the synthetic camera')
+    parser.add_argument('--frame-size', type=int, default=10000, help='Bytes per frame')
+    parser.add_argument('--port', type=int, default=8092)
+    parser.add_argument('--serve', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.fps, args.frame_size)
+        return 0
+
+    levels = [int(level) for level in args.levels.split(',')]
+    results = []
+
+    for server_type in ('threaded', 'async'):
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', server_type,
+                                   '--port', str(args.port), '--fps', str(args.fps),
+                                   '--frame-size', str(args.frame_size)], cwd=BASE_DIR,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(1)
+            results += asyncio.run(ramp(server_type, server.pid, args.port, levels, args.fps,
+                                        args.frame_size, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f'{"Server":<9} {"Viewers":>7} {"RSS (MB)":>9} {"kB/viewer":>10} {"Threads":>8} {"CPU (%)":>8} {"Rate":>6}')
+    for r in results:
+        print(f'{r["server"]:<9} {r["viewers"]:>7} {r["rss_mb"]:>9.1f} {r["kb_per_viewer"]:>10.1f} '
+              f'{r["threads"]:>8} {r["cpu_percent"]:>8.1f} {r["rate"]:>5.0%}{"" if r["ok"] else "  (not sustained)"}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
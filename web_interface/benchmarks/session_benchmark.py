@@ -0,0 +1,284 @@
+"""
+Overhead of recording control sessions, and accuracy of their replay
+
+A driving session (joystick updates and servo moves at a steady rate)
+is sent to a pty-backed FakeArduino while the SessionRecorder logs it,
+and the cost of a send_command() call is compared with and without
+recording. The recording is then replayed to a new FakeArduino at the
+recorded speed, faster, and as fast as possible: the lateness of the
+replayed commands, how closely the commands the Arduino received match
+the original session (setpoints which are replaced before they are sent
+depend on timing, so a replay can differ slightly), and the command rate reached (the load a replay puts
+on the serial path) are reported. The script also checks the rotation
+of the log files, stopping a replay, and the Flask routes:
+    python3 benchmarks/session_benchmark.py
+"""
+
+import os
+import sys
+import math
+import time
+import argparse
+import difflib
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from fake_arduino import FakeArduino, connect, wait_until
+from session_log import (SessionRecorder, SessionReplayer, list_segments, list_recordings, read_recording,
+                         SENT, RECEIVED, FINISHED, STOPPED)
+
+
+# ----------------------------------------------------------------
+def drive(arduino: ArduinoDevice, duration: float, rate: float) -> int:
+    """
+    Send joystick updates at a steady rate, with a head move every tenth update
+    :return: Number of commands sent
+    """
+    sent = 0
+    start = time.perf_counter()
+    for index in range(int(duration * rate)):
+        delay = start + index / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        angle = index / rate * 2
+        sent += arduino.send_command(f'X{int(60 * math.sin(angle))}')
+        sent += arduino.send_command(f'Y{int(60 * math.cos(angle))}')
+        if index % 10 == 0:
+            sent += arduino.send_commands([f'G{index % 100}', f'T{(index * 3) % 100}'])
+    return sent
+
+
+# ----------------------------------------------------------------
+def call_time(arduino: ArduinoDevice, calls: int) -> float:
+    """Mean seconds taken by a send_command() call"""
+    start = time.perf_counter()
+    for index in range(calls):
+        arduino.send_command(f'X{index % 100}')
+    return (time.perf_counter() - start) / calls
+
+
+# ----------------------------------------------------------------
+def device_commands(device: FakeArduino) -> list[str]:
+    """Driving and servo commands received by the simulated Arduino"""
+    return [command for _, command in device.received if command[0] in 'XYGT']
+
+
+# ----------------------------------------------------------------
+def record(folder: str, args) -> tuple[list[str], int]:
+    """
+    Record a driving session, and measure the cost of recording
+    :return: Commands received by the Arduino during the session, and the number sent
+    """
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+
+    try:
+        plain = call_time(arduino, args.calls)
+        recorder = SessionRecorder(folder)
+        arduino.set_recorder(recorder)
+        recorder.start('overhead')
+        recording = call_time(arduino, args.calls)
+        recorder.stop()
+        print(f'send_command(): {plain * 1e6:.2f} us, {recording * 1e6:.2f} us while recording '
+              f'(+{(recording - plain) * 1e6:.2f} us)')
+        assert recording - plain < 20e-6
+
+        time.sleep(0.2)
+        device.received.clear()
+        recorder.start('drive')
+        sent = drive(arduino, args.duration, args.rate)
+        time.sleep(0.2)
+        recorder.stop()
+        status = recorder.get_status()
+        assert not status['recording'] and status['name'] is None
+        return device_commands(device), sent
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def replay(folder: str, speed: float) -> tuple[list[str], dict, float]:
+    """
+    Replay the driving session to a new simulated Arduino
+    :return: Commands received by the Arduino, status of the replay, and its length in seconds
+    """
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    replayer = SessionReplayer(arduino)
+
+    try:
+        entries = read_recording(folder, 'drive')
+        device.received.clear()
+        start = time.perf_counter()
+        replayer.play('drive', entries, speed)
+        wait_until(lambda: replayer.get_status()['state'] != 'playing', 120)
+        length = time.perf_counter() - start
+        time.sleep(0.2)
+
+        status = replayer.get_status()
+        assert status['state'] == FINISHED, status
+        status['coalesced'] = arduino.get_queue_stats()['coalesced']
+        return device_commands(device), status, length
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_rotation():
+    """A new log file is started when one is full, and only the newest are kept"""
+    with tempfile.TemporaryDirectory() as folder:
+        recorder = SessionRecorder(folder, max_size=2000, max_segments=3)
+        recorder.start('rotate')
+        for index in range(2000):
+            recorder.record_command(f'X{index}')
+            recorder.record_message(f'X{index}')
+        recorder.stop()
+
+        segments = list_segments(folder, 'rotate')
+        entries = read_recording(folder, 'rotate')
+        sizes = [os.path.getsize(path) for path in segments]
+        print(f'Rotation: {recorder.get_status()["segments"]} log files written, {len(segments)} kept '
+              f'({", ".join(str(size) for size in sizes)} bytes), {len(entries)} entries left')
+        assert len(segments) == 3 and max(sizes) < 2100
+        assert segments[-1].endswith('rotate.22.log') and entries[-1][1:] == (RECEIVED, 'X1999')
+        assert list_recordings(folder) == [{'name': 'rotate', 'segments': 3, 'size': sum(sizes)}]
+
+        # Recording again under the same name replaces the earlier recording
+        recorder.start('rotate')
+        for index in range(3):
+            recorder.record_command(f'X{index}')
+        recorder.stop()
+        assert [path[len(folder):] for path in list_segments(folder, 'rotate')] == ['/rotate.0.log']
+        assert [text for _, _, text in read_recording(folder, 'rotate')] == ['X0', 'X1', 'X2']
+
+        for name in ('../rotate', 'a/b', '.hidden', 'x' * 65):
+            try:
+                recorder.start(name)
+                raise AssertionError(f'Name was accepted: {name}')
+            except ValueError:
+                pass
+
+
+# ----------------------------------------------------------------
+def check_stop(folder: str):
+    """Stopping a replay part way through stops the motors"""
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+    replayer = SessionReplayer(arduino)
+
+    try:
+        replayer.play('drive', read_recording(folder, 'drive'), 1.0)
+        time.sleep(0.5)
+        device.received.clear()
+        assert replayer.stop()
+        time.sleep(0.1)
+        status = replayer.get_status()
+        commands = [command for _, command in device.received]
+        print(f'Stopped replay after {status["sent"]} of {status["commands"]} commands, '
+              f'Arduino received {" ".join(commands)}')
+        assert status['state'] == STOPPED and commands[-2:] == ['X0', 'Y0'], (status, commands)
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_routes(folder: str):
+    """Record, list, replay and stop a session through the Flask routes"""
+    import app as webapp
+
+    device = FakeArduino()
+    device.start()
+    arduino = connect(device)
+
+    webapp.arduino = arduino
+    webapp.app.config['SESSION_FOLDER'] = folder
+    webapp.recorder = SessionRecorder(folder)
+    webapp.replayer = SessionReplayer(arduino)
+    arduino.set_recorder(webapp.recorder)
+    client = webapp.app.test_client()
+    client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+    try:
+        assert client.post('/sessionRecord', data={'action': 'start', 'name': 'web'}).get_json()['name'] == 'web'
+        drive(arduino, 1.0, 20)
+        time.sleep(0.1)
+        status = client.post('/sessionStatus').get_json()['recording']
+        assert status['recording'] and status['name'] == 'web', status
+        assert client.post('/sessionRecord', data={'action': 'stop'}).get_json()['name'] == 'web'
+        assert 'web' in [entry['name'] for entry in client.get('/sessions').get_json()['sessions']]
+
+        reply = client.post('/sessionReplay', data={'name': 'web', 'speed': '2'}).get_json()
+        assert reply['status'] == 'OK', reply
+        time.sleep(0.2)
+        status = client.post('/sessionStatus').get_json()['replay']
+        assert status['state'] == 'playing' and status['id'] == reply['id'] and status['sent'] > 0, status
+        assert client.post('/sessionStop').get_json()['stopped'] == 1
+
+        for data in ({'name': 'missing'}, {'name': '../web'}, {'name': 'web', 'speed': '-1'}, {}):
+            reply = client.post('/sessionReplay', data=data).get_json()
+            assert reply['status'] == 'Error', (data, reply)
+        reply = client.post('/sessionRecord', data={'action': 'start', 'name': 'a/b'}).get_json()
+        assert reply['status'] == 'Error', reply
+        print(f'Routes: recorded "web", replayed {status["sent"]} commands before stopping')
+
+    finally:
+        arduino.set_recorder(None)
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=3.0, help='Length of the driving session (seconds)')
+    parser.add_argument('--rate', type=float, default=50, help='Joystick updates per second')
+    parser.add_argument('--calls', type=int, default=20000, help='send_command() calls timed for the overhead')
+    parser.add_argument('--speeds', default='1,4,0', help='Comma separated replay speeds (0 = as fast as possible)')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests')
+    args = parser.parse_args()
+
+    check_rotation()
+
+    with tempfile.TemporaryDirectory() as folder:
+        original, sent = record(folder, args)
+        entries = read_recording(folder, 'drive')
+        recorded = [entry for entry in entries if entry[1] == SENT]
+        replies = [entry for entry in entries if entry[1] == RECEIVED]
+        size = sum(os.path.getsize(path) for path in list_segments(folder, 'drive'))
+        print(f'Recorded {len(recorded)} sends and {len(replies)} replies in {args.duration:.0f} s '
+              f'({size} bytes, {size / len(entries):.1f} bytes/entry)')
+        assert len(recorded) == sent and replies
+
+        print(f'{"Speed":>6} {"Length (s)":>11} {"Commands/s":>11} {"Mean late (ms)":>15} {"Max late (ms)":>14} '
+              f'{"Coalesced":>10} {"Match":>7}')
+        for speed in [float(speed) for speed in args.speeds.split(',')]:
+            commands, status, length = replay(folder, speed)
+            match = difflib.SequenceMatcher(None, original, commands, autojunk=False).ratio()
+            print(f'{speed if speed else "max":>6} {length:>11.2f} {status["sent"] / length:>11.0f} '
+                  f'{status["timing"]["mean_ms"]:>15.2f} {status["timing"]["max_ms"]:>14.2f} '
+                  f'{status["coalesced"]:>10} {match * 100:>6.1f}%')
+            assert status['sent'] == len(recorded)
+            if speed == 1:
+                # At the recorded speed the Arduino sees (almost) exactly the original session
+                assert match > 0.98 and status['timing']['max_ms'] < 20, (match, status)
+
+        check_stop(folder)
+        if not args.no_routes:
+            check_routes(folder)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
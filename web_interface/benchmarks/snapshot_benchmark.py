@@ -0,0 +1,161 @@
+"""
+Cost of polling /snapshot.jpg on the streaming server
+
+The streaming server is run in a child process with a synthetic camera
+producing real 640x480 JPEG frames (requires Pillow). Several pollers
+request the full snapshot, the snapshot with If-None-Match, and the
+thumbnail as fast as they can. The benchmark reports the request rate,
+the server CPU time per request, and how many thumbnails were encoded:
+    python3 benchmarks/snapshot_benchmark.py
+"""
+
+import os
+import io
+import sys
+import time
+import signal
+import random
+import argparse
+import subprocess
+import http.client
+from threading import Thread, Event
+
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from stream_benchmark import cpu_time
+
+
+# ----------------------------------------------------------------
+def make_jpeg(seed: int) -> bytes:
+    """Create a 640x480 JPEG of random blocks"""
+    generator = random.Random(seed)
+    image = Image.new('RGB', (64, 48))
+    image.putdata([tuple(generator.randrange(256) for _ in range(3)) for _ in range(64 * 48)])
+    result = io.BytesIO()
+    image.resize((640, 480)).save(result, 'JPEG', quality=80)
+    return result.getvalue()
+
+
+# ----------------------------------------------------------------
+def serve(server_type: str, port: int, fps: float):
+    """Run the streaming server with a synthetic camera, counting the thumbnails made"""
+    import picamera2_stream
+
+    thumbnails = 0
+    make_thumbnail = picamera2_stream.make_thumbnail
+
+    def counting_make_thumbnail(frame: bytes) -> bytes:
+        nonlocal thumbnails
+        thumbnails += 1
+        return make_thumbnail(frame)
+
+    def stop(signum, frame):
+        print(thumbnails, flush=True)
+        os._exit(0)
+
+    picamera2_stream.make_thumbnail = counting_make_thumbnail
+    signal.signal(signal.SIGTERM, stop)
+
+    if server_type == 'async':
+        server = picamera2_stream.AsyncStreamingServer(('127.0.0.1', port))
+    else:
+        server = picamera2_stream.StreamingServer(('127.0.0.1', port), picamera2_stream.StreamingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    frames = [make_jpeg(seed) for seed in range(8)]
+    next_frame = time.perf_counter()
+    while True:
+        for frame in frames:
+            picamera2_stream.output.write(frame)
+            next_frame += 1 / fps
+            time.sleep(max(0, next_frame - time.perf_counter()))
+
+
+# ----------------------------------------------------------------
+def poller(port: int, path: str, use_etag: bool, stop: Event, counts: dict):
+    """Request a snapshot repeatedly, remembering the last ETag if requested"""
+    etag = None
+    while not stop.is_set():
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        connection.request('GET', path, headers={'If-None-Match': etag} if etag else {})
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        counts[response.status] = counts.get(response.status, 0) + 1
+        if use_etag:
+            etag = response.getheader('ETag')
+
+
+# ----------------------------------------------------------------
+def run(name: str, port: int, pid: int, path: str, use_etag: bool, pollers: int, duration: float) -> dict:
+    """Run a group of pollers and measure the results"""
+    stop = Event()
+    counts: dict[int, int] = {}
+    threads = [Thread(target=poller, args=(port, path, use_etag, stop, counts)) for _ in range(pollers)]
+
+    start_cpu = cpu_time(pid)
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    cpu = cpu_time(pid) - start_cpu
+
+    requests = sum(counts.values())
+    return {
+        'name': name,
+        'requests_per_s': requests / duration,
+        'not_modified': counts.get(304, 0) / max(1, requests),
+        'cpu_per_request_ms': cpu / max(1, requests) * 1000,
+    }
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--pollers', type=int, default=10, help='Number of concurrent pollers')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds per test')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of the synthetic camera')
+    parser.add_argument('--port', type=int, default=8093)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.server, args.port, args.fps)
+        return 0
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--server', args.server,
+                               '--port', str(args.port), '--fps', str(args.fps)],
+                              cwd=BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+    try:
+        time.sleep(2)
+        results = [
+            run('Full frame', args.port, server.pid, '/snapshot.jpg', False, args.pollers, args.duration),
+            run('Full + ETag', args.port, server.pid, '/snapshot.jpg', True, args.pollers, args.duration),
+        ]
+        start = time.perf_counter()
+        results.append(run('Thumbnail', args.port, server.pid, '/snapshot.jpg?thumbnail', False,
+                           args.pollers, args.duration))
+        elapsed = time.perf_counter() - start
+
+    finally:
+        server.terminate()
+        thumbnails = int(server.communicate()[0].strip() or 0)
+
+    print(f'{"Request":<12} {"Req/s":>8} {"304 (%)":>8} {"CPU/req (ms)":>13}')
+    for r in results:
+        print(f'{r["name"]:<12} {r["requests_per_s"]:>8.0f} {r["not_modified"] * 100:>8.1f} {r["cpu_per_request_ms"]:>13.3f}')
+    print(f'Thumbnails encoded: {thumbnails} for {results[2]["requests_per_s"] * args.duration:.0f} requests '
+          f'({args.fps * elapsed:.0f} frames produced)')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
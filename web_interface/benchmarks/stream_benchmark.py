@@ -0,0 +1,197 @@
+"""
+Load test of the MJPEG camera stream
+
+The streaming server from picamera2_stream.py is run in a child process
+and fed with synthetic JPEG frames at the camera frame rate. Simulated
+viewers connect to /stream.mjpg, and the benchmark reports the server
+CPU usage, the latency from a frame being written until a viewer has
+received it, and how many frames each viewer had to skip:
+    python3 benchmarks/stream_benchmark.py
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+from threading import Thread, Event
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_camera import make_frame, read_frame_info
+
+
+# ----------------------------------------------------------------
+def serve(port: int, fps: float, frame_size: int):
+    """Run the streaming server with a synthetic frame source"""
+    import picamera2_stream
+
+    server = picamera2_stream.StreamingServer(('127.0.0.1', port), picamera2_stream.StreamingHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    sequence = 0
+    next_frame = time.perf_counter()
+    while True:
+        sequence += 1
+        picamera2_stream.output.write(make_frame(sequence, frame_size))
+        next_frame += 1 / fps
+        time.sleep(max(0, next_frame - time.perf_counter()))
+
+
+# ----------------------------------------------------------------
+def cpu_time(pid: int) -> float:
+    """User + system CPU time (seconds) used by a process"""
+    with open(f'/proc/{pid}/stat') as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+# ================================================================
+class Viewer:
+    """Simulated browser reading the MJPEG stream"""
+
+    def __init__(self, port: int, delay: float = 0, bandwidth: float | None = None):
+        """
+        Constructor
+        :param port:      Port of the streaming server
+        :param delay:     Seconds to wait after each frame, to simulate a slow client
+        :param bandwidth: Bytes per second the client can receive (None = no limit)
+        """
+        self.port = port
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.latencies: list[float] = []
+        self.frames: int = 0
+        self.skipped: int = 0
+        self.exit_flag = Event()
+        self.thread = Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.exit_flag.set()
+        self.thread.join()
+
+    def __run(self):
+        connection = socket.create_connection(('127.0.0.1', self.port))
+        if self.delay or self.bandwidth:
+            # A slow network link doesn't buffer seconds of video
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        connection.sendall(b'GET /stream.mjpg HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+        stream = connection.makefile('rb')
+        last_sequence = None
+
+        # Skip the response headers
+        while stream.readline() not in (b'\r\n', b''):
+            pass
+
+        while not self.exit_flag.is_set():
+            length = 0
+            while (line := stream.readline()) not in (b'\r\n', b''):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            frame = stream.read(length + 2)
+            if len(frame) < length + 2:
+                break
+
+            sequence, timestamp = read_frame_info(frame)
+            self.latencies.append(time.time() - timestamp)
+            if last_sequence is not None:
+                self.skipped += sequence - last_sequence - 1
+            last_sequence = sequence
+            self.frames += 1
+
+            if self.delay:
+                time.sleep(self.delay)
+            if self.bandwidth:
+                time.sleep(len(frame) / self.bandwidth)
+
+        connection.close()
+
+
+# ----------------------------------------------------------------
+def run(name: str, viewers: list[Viewer], pid: int, duration: float) -> dict:
+    """
+    Stream to a group of viewers and measure the results
+    :return: Dictionary of results
+    """
+    for viewer in viewers:
+        viewer.start()
+    time.sleep(0.5)
+
+    for viewer in viewers:
+        viewer.latencies.clear()
+        viewer.frames = viewer.skipped = 0
+    start_cpu = cpu_time(pid)
+    time.sleep(duration)
+    cpu = cpu_time(pid) - start_cpu
+
+    for viewer in viewers:
+        viewer.stop()
+
+    fast = [viewer for viewer in viewers if not viewer.delay]
+    slow = [viewer for viewer in viewers if viewer.delay]
+    latencies = sorted(latency for viewer in fast for latency in viewer.latencies)
+
+    return {
+        'name': name,
+        'cpu_percent': cpu / duration * 100,
+        'fps': statistics.mean(viewer.frames for viewer in fast) / duration,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'skipped': sum(viewer.skipped for viewer in fast),
+        'slow_skipped': sum(viewer.skipped for viewer in slow) if slow else None,
+        'slow_ms': statistics.mean(latency for viewer in slow for latency in viewer.latencies) * 1000 if slow else None,
+    }
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per test')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of the synthetic camera')
+    parser.add_argument('--frame-size', type=int, default=40000, help='Bytes per frame')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.fps, args.frame_size)
+        return 0
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port),
+                               '--fps', str(args.fps), '--frame-size', str(args.frame_size)], cwd=BASE_DIR)
+
+    try:
+        for attempt in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', args.port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        results = [run(f'{count} viewers', [Viewer(args.port) for _ in range(count)], server.pid, args.duration)
+                   for count in (1, 5, 20)]
+        results.append(run('5 + 1 slow viewer', [Viewer(args.port) for _ in range(5)] + [Viewer(args.port, 0.2)],
+                           server.pid, args.duration))
+
+        print(f'{"Viewers":<18} {"CPU (%)":>8} {"FPS":>6} {"Mean (ms)":>10} {"p95 (ms)":>9} {"Skipped":>8} {"Slow skipped":>13} {"Slow (ms)":>10}')
+        for r in results:
+            slow = '-' if r['slow_skipped'] is None else r['slow_skipped']
+            slow_ms = '-' if r['slow_ms'] is None else f'{r["slow_ms"]:.1f}'
+            print(f'{r["name"]:<18} {r["cpu_percent"]:>8.1f} {r["fps"]:>6.1f} {r["mean_ms"]:>10.2f} '
+                  f'{r["p95_ms"]:>9.2f} {r["skipped"]:>8} {slow:>13} {slow_ms:>10}')
+
+    finally:
+        server.terminate()
+        server.wait()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+"""
+Stand-in for aplay used by the benchmarks
+
+Accepts the same arguments as the AUDIO_SINK_CMD configuration, which
+are ignored apart from --log. Reads raw PCM from stdin until it is
+closed, discarding it. The audio engine only writes while clips are
+playing, so when --log is given, the time (time.time()) at which each
+burst of audio starts is appended to that file, giving the moment a
+sound would have been heard:
+    python3 benchmarks/stubs/aplay_stub.py --log starts.txt -t raw -f cd -
+"""
+
+import sys
+import time
+
+
+def get_option(name: str, default: str | None) -> str | None:
+    return arguments[arguments.index(name) + 1] if name in arguments else default
+
+
+arguments = sys.argv[1:]
+log_file = get_option('--log', None)
+gap = float(get_option('--gap', '0.1'))
+
+last_read = 0.0
+while data := sys.stdin.buffer.read1(65536):
+    now = time.time()
+    if log_file and now - last_read > gap and any(data):
+        with open(log_file, 'a') as file:
+            file.write(f'{now:.6f}\n')
+    last_read = now
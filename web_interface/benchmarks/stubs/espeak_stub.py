@@ -0,0 +1,52 @@
+"""
+Stand-in for espeak-ng used by the speech benchmarks
+
+Accepts the same arguments as the ESPEAK_CMD configuration, with the
+text as the last argument and "-w <file>" to write to a file instead
+of stdout. Apart from --delay, --word-delay and --word-time, options
+are ignored. Waits to simulate the synthesis time, then writes a
+22.05kHz mono tone whose length depends on the number of words. Like
+espeak-ng, the lengths in the header are unknown when writing to stdout:
+    python3 benchmarks/stubs/espeak_stub.py --delay 0.3 -w out.wav "Hello"
+"""
+
+import io
+import sys
+import math
+import time
+import wave
+import struct
+
+
+def get_option(name: str, default: str | None) -> str | None:
+    return arguments[arguments.index(name) + 1] if name in arguments else default
+
+
+arguments = sys.argv[1:]
+output_file = get_option('-w', None)
+delay = float(get_option('--delay', '0.3'))
+word_delay = float(get_option('--word-delay', '0.0'))
+word_time = float(get_option('--word-time', '0.35'))
+text = arguments[-1] if arguments else ''
+
+time.sleep(delay + word_delay * len(text.split()))
+
+rate = 22050
+frames = int(rate * word_time * max(1, len(text.split())))
+samples = b''.join(struct.pack('<h', int(8000 * math.sin(i * 0.05))) for i in range(frames))
+
+result = io.BytesIO()
+output = wave.open(result, 'wb')
+output.setnchannels(1)
+output.setsampwidth(2)
+output.setframerate(rate)
+output.writeframes(samples)
+output.close()
+data = result.getvalue()
+
+if output_file:
+    with open(output_file, 'wb') as file:
+        file.write(data)
+else:
+    sys.stdout.buffer.write(data[:4] + struct.pack('<I', 0x7FFFFFFF) + data[8:40] + struct.pack('<I', 0x7FFFFFFF)
+                            + data[44:])
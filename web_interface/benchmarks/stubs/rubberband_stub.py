@@ -0,0 +1,25 @@
+"""
+Stand-in for rubberband used by the speech benchmarks
+
+Accepts "<options> <input> <output>" like the RB_CMD configuration,
+waits to simulate the processing time, and copies the input file.
+The processing time is --delay plus --per-second for every second of
+audio. The other options are ignored:
+    python3 benchmarks/stubs/rubberband_stub.py --delay 0.2 -p 2 in.wav out.wav
+"""
+
+import sys
+import time
+import wave
+import shutil
+
+
+arguments = sys.argv[1:]
+delay = float(arguments[arguments.index('--delay') + 1]) if '--delay' in arguments else 0.2
+per_second = float(arguments[arguments.index('--per-second') + 1]) if '--per-second' in arguments else 0.0
+
+with wave.open(arguments[-2], 'rb') as source:
+    duration = source.getnframes() / source.getframerate()
+
+time.sleep(delay + per_second * duration)
+shutil.copyfile(arguments[-2], arguments[-1])
@@ -0,0 +1,203 @@
+"""
+How quickly Arduino telemetry reaches the browser
+
+A pty-backed FakeArduino reports its battery level, and the level is
+changed at random moments. The delay until the change arrives over the
+WebSocket control channel and the Server-Sent Events stream is compared
+with the previous approach of polling /arduinoStatus every 10 seconds.
+The script also checks that echoes and acks are matched with the
+commands sent (giving the link latency), and that an event stream
+resumes from the Last-Event-ID header:
+    python3 benchmarks/telemetry_benchmark.py
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import socket
+import struct
+import base64
+import argparse
+import statistics
+import http.client
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from arduino_device import ArduinoDevice
+from control_socket import ControlChannel
+from fake_arduino import FakeArduino
+import telemetry
+
+
+# ================================================================
+class WebSocketListener:
+    """Minimal WebSocket client which reads the messages pushed by the server"""
+
+    def __init__(self, port: int, token: str):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.socket.sendall((f'GET /control?token={token} HTTP/1.1\r\n'
+                             f'Host: 127.0.0.1:{port}\r\n'
+                             'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                             f'Sec-WebSocket-Key: {key}\r\n'
+                             'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+        self.file = self.socket.makefile('rb')
+        while self.file.readline() not in (b'\r\n', b''):
+            pass
+
+    def read(self) -> dict:
+        header = self.file.read(2)
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.file.read(2))[0]
+        return json.loads(self.file.read(length))
+
+    def close(self):
+        self.socket.close()
+
+
+# ================================================================
+class EventStream:
+    """Minimal Server-Sent Events client"""
+
+    def __init__(self, port: int, token: str, last_id: int | None = None):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        headers = {'Last-Event-ID': str(last_id)} if last_id is not None else {}
+        self.connection.request('GET', f'/telemetry?token={token}', headers=headers)
+        self.response = self.connection.getresponse()
+        assert self.response.status == 200
+
+    def read(self) -> dict:
+        """Read the next event, skipping heartbeat comments"""
+        event = {}
+        while True:
+            line = self.response.fp.readline().decode().rstrip('\n')
+            if line == '' and event:
+                return event
+            if line and not line.startswith(':'):
+                field, _, value = line.partition(': ')
+                event[field] = value
+
+    def close(self):
+        self.connection.close()
+
+
+# ----------------------------------------------------------------
+def read_until(read, condition, timeout: float = 5.0) -> dict:
+    """Read messages until one matches the condition"""
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        message = read()
+        if condition(message):
+            return message
+    raise TimeoutError('Expected message was not received')
+
+
+# ----------------------------------------------------------------
+def measure_battery(device: FakeArduino, changes: int, read, is_battery) -> list[float]:
+    """Change the battery level, returning the delay until each change is received"""
+    delays = []
+    for i in range(changes):
+        time.sleep(random.uniform(0.01, 0.1))
+        level = 40 + i % 50
+        start = time.perf_counter()
+        device.battery_level = level
+        read_until(read, lambda message: is_battery(message, level))
+        delays.append(time.perf_counter() - start)
+    return delays
+
+
+# ----------------------------------------------------------------
+def check_link(arduino: ArduinoDevice, commands: int):
+    """Send commands and check they are matched with their echoes or acks"""
+    before = arduino.telemetry.get_snapshot()['acked']
+    for i in range(commands):
+        arduino.send_command(f'{"LRUB"[i % 4]}{i % 100}')
+        time.sleep(0.002)
+    time.sleep(telemetry.LINK_INTERVAL * 2)
+    arduino.send_command('X0')
+    time.sleep(0.1)
+
+    snapshot = arduino.telemetry.get_snapshot()
+    series = arduino.telemetry.get_series('latency')
+    assert snapshot['acked'] - before >= commands and series and snapshot['latency'] > 0
+    return snapshot
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--changes', type=int, default=30, help='Number of battery level changes')
+    parser.add_argument('--commands', type=int, default=200, help='Number of commands sent for the link test')
+    parser.add_argument('--battery-interval', type=float, default=0.05,
+                        help='Seconds between battery messages from the simulated Arduino')
+    parser.add_argument('--poll-interval', type=float, default=10.0, help='Polling interval of the old interface')
+    parser.add_argument('--control-port', type=int, default=5091)
+    args = parser.parse_args()
+
+    for protocol in ('ascii', 'binary'):
+        device = FakeArduino(battery_interval=args.battery_interval, binary=(protocol == 'binary'))
+        device.start()
+        arduino = ArduinoDevice(protocol)
+        control = ControlChannel(arduino)
+
+        try:
+            assert arduino.connect(device.port_name) and control.start(args.control_port)
+            end = time.perf_counter() + 5.0
+            while protocol == 'binary' and not arduino.binary_active and time.perf_counter() < end:
+                time.sleep(0.01)
+
+            snapshot = check_link(arduino, args.commands)
+            print(f'{protocol:>6}: {snapshot["acked"]} commands acknowledged, '
+                  f'link latency {snapshot["latency"]:.2f} ms, {snapshot["unmatched"]} unmatched')
+
+            if protocol == 'binary':
+                continue
+
+            # Battery changes pushed over the WebSocket
+            socket_client = WebSocketListener(args.control_port, control.issue_token())
+            socket_delays = measure_battery(
+                device, args.changes, socket_client.read,
+                lambda message, level: message.get('event') == 'battery' and message['value'] == level)
+            socket_client.close()
+
+            # Battery changes on the event stream, which then resumes after a reconnect
+            stream = EventStream(args.control_port, control.issue_token())
+            assert stream.read()['event'] == 'snapshot'
+            stream_delays = measure_battery(
+                device, args.changes, stream.read,
+                lambda event, level: event['event'] == 'battery' and json.loads(event['data'])['value'] == level)
+            last_id = arduino.telemetry.get_last_event_id()
+            stream.close()
+
+            device.battery_level = 5
+            resumed = EventStream(args.control_port, control.issue_token(), last_id)
+            event = read_until(resumed.read, lambda event: event['event'] == 'battery')
+            assert int(event['id']) > last_id and json.loads(event['data'])['value'] == 5
+            resumed.close()
+            print('Event stream resumed from Last-Event-ID after reconnecting')
+
+            # With polling, a change is seen at the next poll: on average half an interval later
+            polled = [random.uniform(0, args.poll_interval) + args.battery_interval / 2 for _ in socket_delays]
+
+            print(f'{"Method":<26} {"Mean (ms)":>10} {"Max (ms)":>10}')
+            for name, delays in (('Polling (simulated)', polled), ('WebSocket push', socket_delays),
+                                 ('Server-Sent Events', stream_delays)):
+                print(f'{name:<26} {statistics.mean(delays) * 1000:>10.1f} {max(delays) * 1000:>10.1f}')
+
+            assert max(socket_delays) < args.battery_interval + 0.5 and max(stream_delays) < args.battery_interval + 0.5
+            assert len(arduino.telemetry.get_series('battery')) <= telemetry.SERIES_LENGTH
+
+        finally:
+            control.stop()
+            arduino.disconnect()
+            device.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
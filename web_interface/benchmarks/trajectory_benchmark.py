@@ -0,0 +1,277 @@
+"""
+Keyframe rate which can be streamed over the 115200 baud serial link
+
+Trajectories moving all seven servos are sampled at increasing rates
+and streamed by the TrajectoryPlayer to a FakeArduino, whose serial
+link is limited to 115200 baud and which plays its animation queue back
+in real time. For each rate, the bytes per keyframe, the share of the
+link used, and the underruns (a keyframe arrived after the queue had
+run empty) are reported, giving the highest rate which plays smoothly.
+The lateness of the keyframes (beyond the end of the previous one) and
+the stretch of the whole trajectory show the timing jitter. The
+script also checks the sampling, that the Arduino's queue never holds
+more than the window, that stopping clears the queue, that old sketches
+are detected, the trajectory library, and the Flask routes:
+    python3 benchmarks/trajectory_benchmark.py
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from fake_arduino import FakeArduino, connect, wait_until
+from trajectory import (TrajectoryLibrary, TrajectoryPlayer, parse_trajectory, sample_trajectory,
+                        SERVOS, FINISHED, STOPPED, FAILED)
+
+BAUDRATE = 115200
+
+
+# ----------------------------------------------------------------
+def make_trajectory(rate: float, duration: int) -> dict:
+    """Every servo swings back and forth, with a different period, so all of them change in every sample"""
+    keyframes = []
+    for time_ms in range(0, duration + 1, 100):
+        keyframe = {'time': time_ms}
+        for index, (name, _) in enumerate(SERVOS):
+            keyframe[name] = round(50 + 45 * math.sin(time_ms / (300 + 70 * index)))
+        keyframes.append(keyframe)
+    return parse_trajectory({'name': 'Sweep', 'rate': rate, 'keyframes': keyframes})
+
+
+# ----------------------------------------------------------------
+def run(protocol: str, rate: float, args) -> dict:
+    """
+    Stream one trajectory
+    :return: Dictionary of the results
+    """
+    device = FakeArduino(binary=(protocol == 'binary'), baudrate=BAUDRATE, loop_time=args.loop_time)
+    device.start()
+    arduino = connect(device, protocol)
+    player = TrajectoryPlayer(arduino, args.window)
+
+    try:
+        trajectory = make_trajectory(rate, args.duration)
+        samples = sample_trajectory(trajectory)
+        device.applied.clear()
+        device.underruns = 0
+        sent_before = arduino.bytes_sent
+
+        player.play(trajectory)
+        wait_until(lambda: player.get_status()['state'] != 'playing')
+        wait_until(lambda: len(device.applied) == len(samples) or player.get_status()['state'] != FINISHED, 10)
+        status = player.get_status()
+        assert status['state'] == FINISHED, status
+
+        applied = device.applied
+        late = [start - (previous + hold / 1000) for (previous, hold, _), (start, _, _) in zip(applied, applied[1:])]
+        played = applied[-1][0] - applied[0][0]
+        expected = sum(hold for hold, _ in samples[:-1]) / 1000
+        data = arduino.bytes_sent - sent_before
+
+        return {'keyframes': len(samples), 'bytes': data / len(samples), 'load': data * 10 / BAUDRATE / played,
+                'underruns': device.underruns, 'max_late': max(late),
+                'stretch': played / expected - 1, 'max_queue': device.max_queue}
+
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_sampling():
+    """Interpolation, the hold times, and only sending the servos which changed"""
+    trajectory = parse_trajectory({'rate': 10, 'keyframes': [
+        {'time': 0, 'head': 0, 'arm_left': 40}, {'time': 1000, 'head': 100}, {'time': 500, 'arm_right': 20}]})
+    samples = sample_trajectory(trajectory)
+    assert [values.get('G') for _, values in samples] == list(range(0, 101, 10)), samples
+    assert samples[0][1] == {'G': 0, 'L': 40} and samples[5][1] == {'G': 50, 'R': 20}, samples
+    assert sum(hold for hold, _ in samples) == 1100
+
+    smooth = sample_trajectory(dict(trajectory, interpolation='smooth'))
+    assert smooth[5][1]['G'] == 50 and smooth[1][1]['G'] < 10, smooth
+
+    odd = sample_trajectory(parse_trajectory({'rate': 30, 'keyframes': [{'time': 0, 'head': 0}, {'time': 1000, 'head': 90}]}))
+    assert len(odd) == 31 and sum(hold for hold, _ in odd[:-1]) == 1000, odd
+
+    # Samples held for longer than a keyframe can be are split into several keyframes
+    slow = sample_trajectory(parse_trajectory({'rate': 0.04, 'keyframes': [{'time': 0, 'head': 0}, {'time': 25000, 'head': 90}]}))
+    assert slow == [(9999, {'G': 0}), (9999, {}), (5002, {}), (9999, {'G': 90}), (9999, {}), (5002, {})], slow
+
+    for data in ({}, {'keyframes': []}, {'keyframes': [{'head': 5}]}, {'keyframes': [{'time': 0, 'nose': 5}]},
+                 {'keyframes': [{'time': 0, 'head': 101}]}, {'rate': 0, 'keyframes': [{'time': 0}]}, {'rate': 0.001, 'keyframes': [{'time': 0}]},
+                 {'interpolation': 'cubic', 'keyframes': [{'time': 0}]}):
+        try:
+            parse_trajectory(data)
+            raise AssertionError(f'Trajectory was accepted: {data}')
+        except ValueError:
+            pass
+
+
+# ----------------------------------------------------------------
+def check_library():
+    """Saving, listing, loading and deleting trajectories"""
+    with tempfile.TemporaryDirectory() as folder:
+        library = TrajectoryLibrary(folder)
+        trajectory = make_trajectory(20, 1000)
+        library.save('sweep', trajectory)
+        assert library.load('sweep') == trajectory
+        assert library.list() == [{'file': 'sweep', 'name': 'Sweep', 'length': 1.0}]
+        for name in ('../sweep', '', 'a/b', '.hidden'):
+            try:
+                library.load(name)
+                raise AssertionError(f'Name was accepted: {name}')
+            except ValueError:
+                pass
+        assert library.delete('sweep') and not library.delete('sweep') and library.list() == []
+
+    library = TrajectoryLibrary(os.path.join(BASE_DIR, 'trajectories'))
+    print(f'Library: {", ".join(entry["name"] for entry in library.list())}')
+
+
+# ----------------------------------------------------------------
+def check_control(args):
+    """Stopping clears the queue on the Arduino, and old sketches are detected"""
+    device = FakeArduino(baudrate=BAUDRATE)
+    device.start()
+    arduino = connect(device, 'ascii')
+    player = TrajectoryPlayer(arduino, args.window)
+
+    try:
+        player.play(make_trajectory(20, 5000))
+        time.sleep(1.0)
+        start = time.perf_counter()
+        assert player.stop()
+        wait_until(lambda: not device.animation_queue, 2)
+        print(f'Stopped after {player.get_status()["sent"]} keyframes, Arduino queue cleared after '
+              f'{(time.perf_counter() - start) * 1000:.1f} ms')
+        assert player.get_status()['state'] == STOPPED
+
+        # Restarting straight after a stop: the replies to the previous run aren't taken for this one's
+        device.max_queue = 0
+        for _ in range(5):
+            player.play(make_trajectory(50, 1000))
+            time.sleep(0.1)
+        wait_until(lambda: player.get_status()['state'] != 'playing', 5)
+        status = player.get_status()
+        assert status['state'] == FINISHED and device.max_queue <= args.window, (status, device.max_queue)
+        wait_until(lambda: not device.animation_queue, 2)
+        time.sleep(0.1)
+
+        # A keyframe left open (its P was lost) only takes keyframe positions, not manual servo commands
+        arduino.send_commands(['K100', 'J2050'])
+        arduino.send_command('G30')
+        device.applied.clear()
+        arduino.send_commands(['J6070', 'P'])
+        wait_until(lambda: device.applied, 2)
+        assert device.applied[0][1:] == (100, {'B': 50, 'R': 70}), device.applied
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+    device = FakeArduino(keyframes=False)
+    device.start()
+    arduino = connect(device, 'ascii')
+    player = TrajectoryPlayer(arduino, args.window)
+
+    try:
+        player.play(make_trajectory(20, 1000))
+        wait_until(lambda: player.get_status()['state'] != 'playing', 5)
+        status = player.get_status()
+        print(f'Sketch without keyframes: {status["state"]}, {status["error"]}')
+        assert status['state'] == FAILED and status['sent'] == args.window
+    finally:
+        arduino.disconnect()
+        device.stop()
+
+
+# ----------------------------------------------------------------
+def check_routes(args):
+    """Save, list, play and stop a trajectory through the Flask routes"""
+    import app as webapp
+
+    device = FakeArduino(baudrate=BAUDRATE)
+    device.start()
+    arduino = connect(device, 'ascii')
+
+    with tempfile.TemporaryDirectory() as folder:
+        webapp.arduino = arduino
+        webapp.trajectories = TrajectoryLibrary(folder)
+        webapp.trajectory_player = TrajectoryPlayer(arduino, args.window)
+        client = webapp.app.test_client()
+        client.post('/login_request', data={'password': webapp.app.config['LOGIN_PASSWORD']})
+
+        try:
+            data = json.dumps(make_trajectory(20, 3000))
+            assert client.post('/trajectorySave', data={'name': 'sweep', 'trajectory': data}).get_json()['status'] == 'OK'
+            assert client.get('/trajectories').get_json()['trajectories'][0]['file'] == 'sweep'
+
+            reply = client.post('/trajectoryPlay', data={'name': 'sweep'}).get_json()
+            assert reply['status'] == 'OK', reply
+            time.sleep(0.5)
+            status = client.post('/trajectoryStatus').get_json()['trajectory']
+            assert status['state'] == 'playing' and status['id'] == reply['id'] and status['sent'] > 0, status
+            assert client.post('/trajectoryStop').get_json()['stopped'] == 1
+
+            reply = client.post('/trajectoryPlay', data={'name': 'missing'}).get_json()
+            assert reply['status'] == 'Error', reply
+            reply = client.post('/trajectorySave', data={'name': '../x', 'trajectory': data}).get_json()
+            assert reply['status'] == 'Error', reply
+            assert client.post('/trajectoryDelete', data={'name': 'sweep'}).get_json()['status'] == 'OK'
+
+            # Clients can't send the keyframe and queue commands
+            for servo, value in (('K', '100'), ('J', '2050'), ('P', '0'), ('Q', '1'), ('GG', '1'), ('G', '5\nQ1')):
+                reply = client.post('/servoControl', data={'servo': servo, 'value': value}).get_json()
+                assert reply['msg'] == 'Unknown servo command', (servo, reply)
+            print(f'Routes: played {status["sent"]} keyframes of "sweep" before stopping')
+
+        finally:
+            arduino.disconnect()
+            device.stop()
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rates', default='20,50,100,150,200', help='Comma separated sample rates')
+    parser.add_argument('--duration', type=int, default=3000, help='Length of each trajectory (milliseconds)')
+    parser.add_argument('--window', type=int, default=10, help='Keyframes allowed to wait on the Arduino')
+    parser.add_argument('--loop-time', type=float, default=0.0005, help='Seconds the simulated Arduino spends in loop()')
+    parser.add_argument('--no-routes', action='store_true', help='Skip the Flask tests')
+    args = parser.parse_args()
+
+    check_sampling()
+    check_library()
+
+    print(f'{"Protocol":<9} {"Rate":>5} {"Bytes/keyframe":>15} {"Link load":>10} {"Underruns":>10} '
+          f'{"Max late (ms)":>14} {"Stretch":>8} {"Max queue":>10}')
+    for protocol in ('ascii', 'binary'):
+        smooth = 0
+        failed = False
+        for rate in [float(rate) for rate in args.rates.split(',')]:
+            result = run(protocol, rate, args)
+            print(f'{protocol:<9} {rate:>5.0f} {result["bytes"]:>15.1f} {result["load"] * 100:>9.0f}% {result["underruns"]:>10} '
+                  f'{result["max_late"] * 1000:>14.1f} {result["stretch"] * 100:>7.1f}% {result["max_queue"]:>10}')
+            assert result['max_queue'] <= args.window
+            if result['underruns'] == 0 and not failed:
+                smooth = rate
+            else:
+                failed = True
+        print(f'{protocol}: highest rate without underruns {smooth:.0f} keyframes/s')
+        assert smooth >= 20
+
+    check_control(args)
+    if not args.no_routes:
+        check_routes(args)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Latency of text-to-speech requests with the TTS cache
+
+By default espeak-ng and rubberband are replaced by the stand-ins in
+benchmarks/stubs, which take a similar time to run on a Raspberry Pi
+(use --real for the commands from config.py). A workload in which a
+few phrases are much more common than others is run through the cache,
+followed by a simulated restart (memory empty, files on disk) and a
+check of the size limits:
+    python3 benchmarks/tts_benchmark.py
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from tts_cache import TTSCache
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+PHRASES = ["Wall-e!", "Eva?", "Hello there", "Whoa", "Directive?", "Ta-da!", "Hi, I am Wall-e",
+           "Where is Eva?", "Time to clean up", "Look at that", "Put on your dancing shoes",
+           "La vie en rose", "Plant!", "Goodbye", "Oh no", "Hmm", "Beep beep", "Thank you",
+           "Welcome to the Axiom", "I love you Eva"]
+
+
+# ----------------------------------------------------------------
+def timed_get(cache: TTSCache, text: str) -> tuple[str, float]:
+    """Request a phrase, returning how it was served and how long it took"""
+    before = cache.get_stats()
+    start = time.perf_counter()
+    cache.get(text)
+    elapsed = time.perf_counter() - start
+    after = cache.get_stats()
+    kind = next(name for name in ('memory_hits', 'disk_hits', 'misses') if after[name] > before[name])
+    return (kind, elapsed)
+
+
+# ----------------------------------------------------------------
+def report(name: str, results: list[tuple[str, float]]):
+    """Print the latency of each kind of request"""
+    for kind in ('misses', 'disk_hits', 'memory_hits'):
+        latencies = [elapsed for result, elapsed in results if result == kind]
+        if latencies:
+            print(f'{name:<18} {kind:<12} {len(latencies):>6} {statistics.mean(latencies) * 1000:>10.2f} '
+                  f'{max(latencies) * 1000:>9.2f}')
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests in the workload')
+    parser.add_argument('--espeak-delay', type=float, default=0.3, help='Run time of the espeak stand-in')
+    parser.add_argument('--rubberband-delay', type=float, default=0.2, help='Run time of the rubberband stand-in')
+    parser.add_argument('--real', action='store_true', help='Use ESPEAK_CMD and RB_CMD from config.py')
+    args = parser.parse_args()
+
+    if args.real:
+        import config
+        espeak_cmd, rb_cmd = config.ESPEAK_CMD, config.RB_CMD
+    else:
+        espeak_cmd = [sys.executable, os.path.join(STUBS_DIR, 'espeak_stub.py'), '--delay', str(args.espeak_delay)]
+        rb_cmd = [sys.executable, os.path.join(STUBS_DIR, 'rubberband_stub.py'), '--delay', str(args.rubberband_delay)]
+
+    generator = random.Random(1)
+    weights = [1 / (rank + 1) for rank in range(len(PHRASES))]
+    workload = generator.choices(PHRASES, weights, k=args.requests)
+
+    with tempfile.TemporaryDirectory() as folder:
+        cache = TTSCache(folder, espeak_cmd, rb_cmd)
+
+        start = time.perf_counter()
+        cache.warm_up(PHRASES[:2])
+        print(f'Warm-up of 2 phrases: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+        print(f'{"Phase":<18} {"Served by":<12} {"Count":>6} {"Mean (ms)":>10} {"Max (ms)":>9}')
+        report('Workload', [timed_get(cache, text) for text in workload])
+
+        # Simulate a restart of the web-interface
+        cache = TTSCache(folder, espeak_cmd, rb_cmd)
+        report('After restart', [timed_get(cache, text) for text in PHRASES])
+
+        stats = cache.get_stats()
+        print(f'Disk: {stats["disk_entries"]} files, {stats["disk_bytes"] / 1000:.0f} kB')
+
+        # Size limits: only a few phrases fit on disk and in memory
+        limit = stats['disk_bytes'] // 4
+        cache = TTSCache(folder, espeak_cmd, rb_cmd, max_disk_bytes=limit, max_memory_bytes=limit // 2)
+        for text in PHRASES:
+            cache.get(text)
+        stats = cache.get_stats()
+        print(f'Limited to {limit / 1000:.0f} kB on disk, {limit / 2000:.0f} kB in memory: '
+              f'{stats["disk_entries"]} files ({stats["disk_bytes"] / 1000:.0f} kB), '
+              f'{stats["memory_entries"]} in memory ({stats["memory_bytes"] / 1000:.0f} kB)')
+        assert stats['disk_bytes'] <= limit and stats['memory_bytes'] <= limit // 2
+        assert len([name for name in os.listdir(folder) if name.endswith('.wav')]) == stats['disk_entries']
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
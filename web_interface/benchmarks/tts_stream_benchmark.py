@@ -0,0 +1,102 @@
+"""
+Time until the first speech is heard, for text of increasing length
+
+Speech is generated by the stand-ins in benchmarks/stubs, whose run
+time grows with the length of the text like the real espeak-ng and
+rubberband (use --real for the commands from config.py). Each text is
+either generated as a whole before playing, or split into sentences
+which are played as soon as each one is ready, as /tts does with
+TTS_STREAMING. The audio is written to a null sink which records when
+the first audible samples arrive:
+    python3 benchmarks/tts_stream_benchmark.py
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from audio_engine import AudioEngine
+from audio_benchmark import RecordingSink
+from tts_cache import TTSCache, split_sentences
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+SENTENCES = ["Hello, I am Wall-e.", "I like to collect interesting things.", "Have you seen Eva?",
+             "She went to look for plants.", "I will wait for her here.", "The city is very quiet today.",
+             "Let me show you my collection.", "This one is my favourite."]
+
+
+# ----------------------------------------------------------------
+def speak(cache: TTSCache, engine: AudioEngine, sink: RecordingSink, text: str, streaming: bool) -> tuple[float, float]:
+    """
+    Generate and play text in the same way as the /tts job
+    :return: Tuple of (seconds until audio was heard, seconds until all audio was generated)
+    """
+    engine.stop_all()
+    time.sleep(0.05)
+    sink.audible.clear()
+    start = time.perf_counter()
+
+    for phrase in split_sentences(text) if streaming else [text]:
+        engine.play_wav(cache.get(phrase), 'speech', queue=True)
+    generated = time.perf_counter() - start
+
+    sink.audible.wait(5)
+    return (sink.audible_time - start, generated)
+
+
+# ----------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--espeak-delay', type=float, default=0.05, help='Start-up time of the espeak stand-in')
+    parser.add_argument('--word-delay', type=float, default=0.02, help='Synthesis time per word of the espeak stand-in')
+    parser.add_argument('--rubberband-delay', type=float, default=0.1, help='Start-up time of the rubberband stand-in')
+    parser.add_argument('--per-second', type=float, default=0.15, help='Processing time per second of audio of the rubberband stand-in')
+    parser.add_argument('--real', action='store_true', help='Use ESPEAK_CMD and RB_CMD from config.py')
+    args = parser.parse_args()
+
+    if args.real:
+        import config
+        espeak_cmd, rb_cmd = config.ESPEAK_CMD, config.RB_CMD
+    else:
+        espeak_cmd = [sys.executable, os.path.join(STUBS_DIR, 'espeak_stub.py'), '--delay', str(args.espeak_delay),
+                      '--word-delay', str(args.word_delay)]
+        rb_cmd = [sys.executable, os.path.join(STUBS_DIR, 'rubberband_stub.py'), '--delay', str(args.rubberband_delay),
+                  '--per-second', str(args.per_second)]
+
+    sink = RecordingSink()
+    engine = AudioEngine(BASE_DIR, sink=sink)
+
+    with tempfile.TemporaryDirectory() as folder:
+        print(f'Intermediate files in {TTSCache(folder, espeak_cmd, rb_cmd).work_folder}')
+    print(f'{"Sentences":>9} {"Mode":<10} {"First audio (ms)":>17} {"Generated (ms)":>15}')
+    results = {}
+
+    for count in (1, 2, 4, 8):
+        for streaming in (False, True):
+            # Start with an empty cache every time
+            with tempfile.TemporaryDirectory() as folder:
+                cache = TTSCache(folder, espeak_cmd, rb_cmd)
+                first, generated = speak(cache, engine, sink, ' '.join(SENTENCES[:count]), streaming)
+                assert cache.get_stats()['memory_hits'] + cache.get_stats()['disk_hits'] == 0
+
+            mode = 'Sentences' if streaming else 'Whole'
+            results[count, streaming] = first
+            print(f'{count:>9} {mode:<10} {first * 1000:>17.0f} {generated * 1000:>15.0f}')
+
+    engine.close()
+
+    # When speaking sentence by sentence, the wait must not grow with the length of the text
+    assert results[8, True] < results[8, False] / 2
+    assert results[8, True] < results[1, True] * 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,13 +13,40 @@ APP_PORT = 5000                                         # Port of the applicatio
 APP_DEBUG = False                                       # Enable / Disable Python Server Debugging
 LOGIN_PASSWORD = "walle"                                # Password for web-interface
 ARDUINO_PORT = "/dev/ttyACM0"                           # Default port which will be selected
+SERIAL_PROTOCOL = "ascii"                               # "ascii" = text commands, "binary" = compact frames (falls back to ascii on older Arduino sketches)
 AUTOSTART_ARDUINO = True                                # False = no auto connect, True = automatically try to connect to default port
 AUTOSTART_CAM = True                                    # False = no auto start, True = automatically start up the camera
+CAMERA_ADAPTIVE = False                                 # True = lower the stream resolution, frame rate and quality when the network or CPU can't keep up
+STREAM_SERVER = "threaded"                              # "threaded" = one thread per stream viewer, "async" = all viewers served by one event loop
+CONTROL_SOCKET = True                                   # Enable / Disable the WebSocket control channel
+CONTROL_PORT = 5001                                     # Port of the WebSocket control channel
+FAST_LANE = True                                        # Enable / Disable the lightweight /c control endpoint (used when the control channel is not connected)
+GOVERNOR_RATE = 50                                      # Commands per second each client command type (motor X/Y, each servo, animations) is limited to (0 = no limit)
+GOVERNOR_BURST = 10                                     # Commands of one type which can be sent at once before the rate limit applies
+WATCHDOG_TIMEOUT = 1.0                                  # Seconds without joystick updates before the motors are stopped (0 = disabled)
 SOUND_FOLDER = os.path.join(BASEDIR, "static/sounds/")  # Location of the folder containing all audio files
 ESPEAK_CMD = ['espeak-ng', '-v', 'en', '-b', '1']       # ESpeak Command and Language
 RB_CMD = ['rubberband', '-t', '1.1', '-p', '2', '-c', '6', '-f', '1.8', '-q']  # Rubberband for pitch shifting TTS
-AUDIOPLAYER_CMD = ['aplay']                             # Command for local audioplayer
+TTS_CACHE_FOLDER = os.path.join(BASEDIR, "tts_cache/")  # Location where generated speech is stored
+TTS_CACHE_SIZE = 50                                     # Megabytes of generated speech kept on disk
+TTS_MEMORY_CACHE_SIZE = 8                               # Megabytes of generated speech kept in memory
+TTS_WARMUP = ["Wall-e!", "Eva?"]                        # Phrases which are generated when the web-interface starts
+TTS_STREAMING = True                                    # True = start speaking after the first sentence is generated, False = generate all text first
+TTS_WORK_FOLDER = "/dev/shm"                            # RAM folder for intermediate speech files (falls back to TTS_CACHE_FOLDER if missing)
+AUDIO_SINK_CMD = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-r', '44100', '-c', '2', '--buffer-time=100000']  # Long-running player which receives raw audio (None = no audio output)
+AUDIO_CACHE_SIZE = 32                                   # Megabytes of decoded sound clips kept in memory
+AUDIO_MAX_VOICES = 4                                    # Maximum number of sounds playing at the same time
+JOB_WORKERS = 2                                         # Number of speech/audio jobs processed at the same time
+JOB_QUEUE_SIZE = 16                                     # Maximum number of speech/audio jobs waiting to start
 SOUND_FORMAT = "wav"                                    # Audio file format
+SOUND_LAZY_LOAD = 300                                   # Sound libraries with more clips are loaded by the browser one group at a time
+TRAJECTORY_FOLDER = os.path.join(BASEDIR, "trajectories/")  # Location of the saved servo trajectories
+TRAJECTORY_WINDOW = 10                                  # Most streamed keyframes waiting on the Arduino (at most 40, the size of its animation queue)
+SESSION_FOLDER = os.path.join(BASEDIR, "sessions/")     # Location of the recorded control sessions
+SESSION_SEGMENT_SIZE = 1                                # Megabytes written to each log file of a recording before a new one is started
+SESSION_SEGMENTS = 10                                   # Log files kept for each recording (the oldest are deleted)
+METRICS = True                                          # Enable / Disable the /metrics endpoint (Prometheus text format)
+METRICS_TOKEN = ""                                      # Scrapers send "Authorization: Bearer <token>" ("" = only logged-in browsers can read /metrics)
 
 # Values for Codeblock Movement
 CODEBLOCK_MOTORPOWER = 0.8   # Motorpower at which the speed below is reached
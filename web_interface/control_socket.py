@@ -0,0 +1,440 @@
+"""
+WebSocket control channel for the Wall-e web-interface
+
+A persistent connection over which the browser sends motor, servo
+and animation commands, and the robot pushes status events back.
+This avoids a full Flask request cycle for every joystick update.
+Clients authenticate using a token issued by the /controlToken route.
+
+Telemetry events from the Arduino (see telemetry.py) are pushed over
+the WebSocket as {"type": "telemetry", "event": ..., "value": ...}.
+Clients which only need to listen can instead open the Server-Sent
+Events stream at /telemetry?token=..., which resumes from the
+Last-Event-ID header after a reconnect. Both are served by this
+server's threads, so they don't tie up the web-interface's workers.
+
+Command frames can either be JSON text frames:
+    {"type": "motor", "x": 0.5, "y": -0.2}     (same scale as /motor)
+    {"type": "servo", "servo": "L", "value": 50}
+    {"type": "animate", "clip": 1}
+
+or compact binary frames:
+    b'm' <int8 x> <int8 y>                      (-100 to 100)
+    b's' <servo character> <uint8 value>
+    b'a' <uint8 animation number>
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import socket
+import socketserver
+import struct
+from http import server
+from threading import Thread, Lock, Event
+from urllib.parse import urlsplit, parse_qs
+
+from arduino_device import SERVO_CHANNELS, SERVO_PRESETS
+from token_store import TokenStore
+
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_FRAME_LENGTH = 4096    # Larger frames from clients are rejected
+STATUS_INTERVAL = 1.0      # Seconds between checks for status changes
+HEARTBEAT_INTERVAL = 15.0  # Seconds between keep-alive comments on idle event streams
+
+# WebSocket frame opcodes
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+# ================================================================
+class ControlConnection:
+    """A single WebSocket client connection"""
+
+    def __init__(self, handler: server.BaseHTTPRequestHandler):
+        """
+        Constructor
+        :param handler: The request handler which accepted the connection
+        """
+        self.rfile = handler.rfile
+        self.wfile = handler.wfile
+        self.socket = handler.connection
+        self.address = handler.client_address
+        self.write_lock = Lock()
+
+        # Commands are tiny, so send them without waiting to fill a packet
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # ------------------------------------------------------------
+    def read_frame(self) -> tuple[int, bytes] | None:
+        """
+        Read a single frame from the client
+        :return: Tuple of (opcode, payload), or None if the connection closed
+        """
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+
+        opcode = header[0] & 0x0F
+        masked = header[1] & 0x80
+        length = header[1] & 0x7F
+
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+
+        # Clients are required to mask all frames they send
+        if not masked or length > MAX_FRAME_LENGTH:
+            return None
+
+        mask = self.rfile.read(4)
+        payload = self.rfile.read(length)
+        if len(payload) < length:
+            return None
+
+        if length > 0:
+            key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+            payload = (int.from_bytes(payload, 'big') ^ key).to_bytes(length, 'big')
+
+        return (opcode, payload)
+
+    # ------------------------------------------------------------
+    def send_frame(self, opcode: int, payload: bytes = b''):
+        """
+        Send a single (unmasked) frame to the client
+        :param opcode:  The frame opcode
+        :param payload: The frame contents
+        """
+        length = len(payload)
+
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+        with self.write_lock:
+            self.wfile.write(header + payload)
+
+    # ------------------------------------------------------------
+    def send_json(self, message: dict):
+        """
+        Send a JSON text frame to the client
+        :param message: The message to be sent
+        """
+        self.send_frame(OP_TEXT, json.dumps(message, separators=(',', ':')).encode())
+
+    # ------------------------------------------------------------
+    def close(self):
+        """Close the underlying socket, which ends the handler thread"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+# ================================================================
+class ControlHandler(server.BaseHTTPRequestHandler):
+    """Handle the WebSocket upgrade request and the frames which follow"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        token = parse_qs(url.query).get('token', [''])[0]
+        channel: ControlChannel = self.server.channel
+
+        if url.path not in ('/control', '/telemetry'):
+            self.send_error(404)
+            return
+
+        if not channel.is_valid_token(token):
+            self.send_error(403)
+            return
+
+        if url.path == '/telemetry':
+            self.send_events(channel)
+            return
+
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key is None or 'websocket' not in self.headers.get('Upgrade', '').lower():
+            self.send_error(400)
+            return
+
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.end_headers()
+
+        connection = ControlConnection(self)
+        channel.add_client(connection)
+        self.close_connection = True
+
+        try:
+            while True:
+                frame = connection.read_frame()
+                if frame is None:
+                    break
+
+                opcode, payload = frame
+                if opcode == OP_CLOSE:
+                    connection.send_frame(OP_CLOSE, payload[:2])
+                    break
+                elif opcode == OP_PING:
+                    connection.send_frame(OP_PONG, payload)
+                elif opcode in (OP_TEXT, OP_BINARY):
+                    channel.handle_message(connection, opcode, payload)
+
+        except Exception as ex:
+            logging.debug(f'Control client {self.client_address} error: {repr(ex)}')
+
+        finally:
+            channel.remove_client(connection)
+
+    def send_events(self, channel):
+        """Stream the telemetry events to the client until it disconnects"""
+        telemetry = channel.arduino.telemetry
+        last_event = self.headers.get('Last-Event-ID', '0')
+        last_id = int(last_event) if last_event.isdigit() else 0
+
+        # Start again if the events the client has seen are no longer known
+        if last_id > telemetry.get_last_event_id():
+            last_id = 0
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            if last_id == 0:
+                snapshot = json.dumps(telemetry.get_snapshot(), separators=(',', ':'))
+                self.wfile.write(f'event: snapshot\ndata: {snapshot}\n\n'.encode())
+                last_id = telemetry.get_last_event_id()
+                self.wfile.flush()
+
+            while not channel.exit_flag.is_set():
+                events = telemetry.wait_for_events(last_id, HEARTBEAT_INTERVAL)
+                if events:
+                    self.wfile.write(''.join(f"id: {event['id']}\nevent: {event['type']}\n"
+                                             f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+                                             for event in events).encode())
+                    last_id = events[-1]['id']
+                else:
+                    self.wfile.write(b': heartbeat\n\n')
+                self.wfile.flush()
+
+        except OSError as ex:
+            logging.debug(f'Telemetry client {self.client_address} disconnected: {repr(ex)}')
+
+    def log_message(self, format, *args):
+        logging.debug(f'Control channel: {format % args}')
+
+
+# ================================================================
+class ControlServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+# ================================================================
+class ControlChannel:
+    """Class to manage the WebSocket control server and its clients"""
+
+    def __init__(self, arduino, governor=None):
+        """
+        Constructor
+        :param arduino: The ArduinoDevice which receives the commands
+        :param governor: CommandGovernor which limits the rate of the commands (None = send them directly)
+        """
+        self.arduino = arduino
+        self.governor = governor if governor is not None else arduino
+        self.tokens = TokenStore()
+        self.clients: set[ControlConnection] = set()
+        self.lock = Lock()
+        self.exit_flag = Event()
+        self.control_server: ControlServer | None = None
+        self.server_thread: Thread | None = None
+        self.status_thread: Thread | None = None
+        self.last_status: dict | None = None
+
+    # ------------------------------------------------------------
+    def is_active(self) -> bool:
+        """
+        Check if the control server is running
+        :return: True if the server is running, False otherwise
+        """
+        return self.control_server is not None and self.server_thread is not None
+
+    # ------------------------------------------------------------
+    def start(self, port: int) -> bool:
+        """
+        Start the control server in a background thread
+        :param port: The TCP port to listen on
+        :return: True if the server is now running, False otherwise
+        """
+        try:
+            if not self.is_active():
+                self.control_server = ControlServer(('', port), ControlHandler)
+                self.control_server.channel = self
+                self.exit_flag.clear()
+                self.server_thread = Thread(target=self.control_server.serve_forever, daemon=True)
+                self.status_thread = Thread(target=self.__status_thread, daemon=True)
+                self.server_thread.start()
+                self.status_thread.start()
+                logging.info(f'Control channel listening on port {port}')
+
+        except Exception as ex:
+            logging.error(f'Failed to start control channel: {repr(ex)}')
+            self.stop()
+
+        return self.is_active()
+
+    # ------------------------------------------------------------
+    def stop(self):
+        """Stop the control server and disconnect all clients"""
+        self.exit_flag.set()
+
+        if self.control_server is not None:
+            if self.server_thread is not None:
+                self.control_server.shutdown()
+            self.control_server.server_close()
+            self.control_server = None
+
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+
+        for thread in (self.server_thread, self.status_thread):
+            if thread is not None:
+                thread.join(1)
+        self.server_thread = None
+        self.status_thread = None
+
+    # ------------------------------------------------------------
+    def issue_token(self) -> str:
+        """
+        Create a new token which allows a client to connect
+        :return: The token string
+        """
+        return self.tokens.issue()
+
+    # ------------------------------------------------------------
+    def is_valid_token(self, token: str) -> bool:
+        """
+        Check whether a token was issued by this server
+        :param token: The token to check
+        :return: True if the token is valid, False otherwise
+        """
+        return self.tokens.is_valid(token)
+
+    # ------------------------------------------------------------
+    def add_client(self, client: ControlConnection):
+        """Register a new client, and send it the current status"""
+        with self.lock:
+            self.clients.add(client)
+        logging.info(f'Control client connected: {client.address}')
+        client.send_json(self.__get_status())
+
+    # ------------------------------------------------------------
+    def remove_client(self, client: ControlConnection):
+        """Remove a client which has disconnected"""
+        with self.lock:
+            self.clients.discard(client)
+        logging.info(f'Control client disconnected: {client.address}')
+
+    # ------------------------------------------------------------
+    def broadcast(self, message: dict):
+        """
+        Send a JSON message to all connected clients
+        :param message: The message to be sent
+        """
+        with self.lock:
+            clients = list(self.clients)
+
+        for client in clients:
+            try:
+                client.send_json(message)
+            except Exception:
+                client.close()
+
+    # ------------------------------------------------------------
+    def handle_message(self, client: ControlConnection, opcode: int, payload: bytes):
+        """
+        Convert a message from a client into Arduino commands
+        :param client:  The client which sent the message
+        :param opcode:  Whether this is a text or binary frame
+        :param payload: The frame contents
+        """
+        commands: list[str] = []
+
+        try:
+            if opcode == OP_BINARY:
+                kind = payload[:1]
+                if kind == b'm' and len(payload) == 3:
+                    x, y = struct.unpack('bb', payload[1:3])
+                    commands = [f'X{max(-100, min(100, x))}', f'Y{max(-100, min(100, y))}']
+                elif kind == b's' and len(payload) == 3 and chr(payload[1]) in SERVO_CHANNELS + SERVO_PRESETS:
+                    commands = [f'{chr(payload[1])}{payload[2]}']
+                elif kind == b'a' and len(payload) == 2:
+                    commands = [f'A{payload[1]}']
+
+            else:
+                message = json.loads(payload)
+                kind = message.get('type')
+                if kind == 'motor':
+                    x, y = int(float(message['x']) * 100), int(float(message['y']) * 100)
+                    commands = [f'X{max(-100, min(100, x))}', f'Y{max(-100, min(100, y))}']
+                elif kind == 'servo' and len(str(message['servo'])) == 1 and str(message['servo']) in SERVO_CHANNELS + SERVO_PRESETS:
+                    commands = [f"{message['servo']}{int(message['value'])}"]
+                elif kind == 'animate':
+                    commands = [f"A{int(message['clip'])}"]
+
+        except Exception as ex:
+            logging.debug(f'Invalid control message {payload!r}: {repr(ex)}')
+
+        if not commands:
+            client.send_json({'type': 'error', 'msg': 'Unable to read command'})
+        elif not self.arduino.is_connected():
+            client.send_json({'type': 'error', 'msg': 'Arduino not connected'})
+        elif not all([self.governor.send_command(command) for command in commands]):
+            client.send_json({'type': 'error', 'msg': 'Too many commands, some were dropped'})
+
+    # ------------------------------------------------------------
+    def __get_status(self) -> dict:
+        """
+        Get the current robot status
+        :return: Dictionary containing the status event
+        """
+        return {
+            'type': 'status',
+            'connected': self.arduino.is_connected(),
+            'battery': self.arduino.get_battery_level(),
+        }
+
+    # ------------------------------------------------------------
+    def __status_thread(self):
+        """Push telemetry events to all clients as they arrive, and the status whenever it changes"""
+        telemetry = self.arduino.telemetry
+        last_id = telemetry.get_last_event_id()
+
+        while not self.exit_flag.is_set():
+            events = telemetry.wait_for_events(last_id, STATUS_INTERVAL)
+            if events:
+                last_id = events[-1]['id']
+                for event in events:
+                    self.broadcast(dict(event, type='telemetry', event=event['type']))
+
+            status = self.__get_status()
+            if status != self.last_status:
+                self.last_status = status
+                self.broadcast(status)
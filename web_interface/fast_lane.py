@@ -0,0 +1,185 @@
+"""
+Lightweight control endpoint for high-frequency commands
+
+Joystick and servo updates sent to /motor, /servoControl or /animate
+each pay for a full Flask request: session cookie verification, form
+parsing, JSON responses and the request hooks. The fast lane is a WSGI
+middleware in front of the Flask app which answers one path itself:
+
+    POST /c?t=<token>&m=<x>,<y>&s=<servo><value>&a=<animation>
+
+The parameters can also be sent in the request body, in the same
+format. Motor values are -100 to 100 (like the X/Y commands), servos
+are the letters of the manual servo commands (LRBTGEU), and several
+commands can be sent in one request. Clients authenticate with a token
+issued by the /fastToken route, which is cached in their session.
+Replies have no body:
+    204 = commands queued, 400 = unable to read the commands,
+    401 = unknown token, 429 = command dropped by the rate limit,
+    503 = Arduino not connected
+
+All other requests are passed on to Flask unchanged.
+"""
+
+from threading import Lock
+from urllib.parse import unquote
+
+from arduino_device import SERVO_CHANNELS
+from token_store import TokenStore
+
+
+MAX_BODY_LENGTH = 1024     # Larger request bodies are rejected
+
+
+# ----------------------------------------------------------------
+def parse_commands(query: str) -> tuple[str, list[str]] | None:
+    """
+    Read the token and commands of a fast lane request
+    :param query: Query string or body, e.g. "t=abc&m=50,-20&s=G40"
+    :return: Token and list of Arduino commands, or None if a parameter can't be read
+    """
+    token = ''
+    commands = []
+
+    for pair in query.split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        if '%' in value:
+            value = unquote(value)
+
+        try:
+            if key == 't':
+                token = value
+            elif key == 'm':
+                x, y = value.split(',')
+                commands.append(f'X{max(-100, min(100, int(x)))}')
+                commands.append(f'Y{max(-100, min(100, int(y)))}')
+            elif key == 's' and len(value) > 1 and value[0] in SERVO_CHANNELS:
+                commands.append(f'{value[0]}{int(value[1:])}')
+            elif key == 'a':
+                commands.append(f'A{int(value)}')
+            else:
+                return None
+        except ValueError:
+            return None
+
+    return token, commands
+
+
+# ================================================================
+class FastLane:
+    """WSGI middleware which sends control commands straight to the Arduino"""
+
+    def __init__(self, app, arduino, path: str = '/c'):
+        """
+        Constructor
+        :param app: The WSGI application which handles all other requests
+        :param arduino: The ArduinoDevice (or CommandGovernor) which receives the commands
+        :param path: Path of the fast lane endpoint
+        """
+        self.app = app
+        self.arduino = arduino
+        self.path = path
+        self.lock = Lock()
+        self.tokens = TokenStore()
+        self.stats = {'requests': 0, 'commands': 0, 'rejected': 0}
+
+    # ------------------------------------------------------------
+    def issue_token(self) -> str:
+        """
+        Create a new token which allows a client to use the fast lane
+        :return: The token string
+        """
+        return self.tokens.issue()
+
+    # ------------------------------------------------------------
+    def is_valid_token(self, token: str) -> bool:
+        """
+        Check whether a token was issued by this server
+        :param token: The token to check
+        :return: True if the token is valid, False otherwise
+        """
+        return self.tokens.is_valid(token)
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the request counters
+        :return: Dictionary with the number of requests, commands sent, and requests rejected
+        """
+        with self.lock:
+            return dict(self.stats)
+
+    # ------------------------------------------------------------
+    def collect_metrics(self) -> list[tuple]:
+        """
+        Get the fast lane metrics, for MetricsRegistry.add_collector()
+        :return: List of (name, type, help, samples)
+        """
+        stats = self.get_stats()
+        return [
+            ('fast_requests', 'counter', 'Requests to the fast lane control endpoint',
+             [('fast_requests_total', {'outcome': 'accepted'}, stats['requests'] - stats['rejected']),
+              ('fast_requests_total', {'outcome': 'rejected'}, stats['rejected'])]),
+            ('fast_commands', 'counter', 'Commands sent to the Arduino through the fast lane',
+             [('fast_commands_total', {}, stats['commands'])]),
+        ]
+
+    # ------------------------------------------------------------
+    def __call__(self, environ: dict, start_response):
+        """
+        Handle a WSGI request
+        :param environ: The WSGI environment
+        :param start_response: The WSGI start_response function
+        :return: The response body
+        """
+        if environ.get('PATH_INFO') != self.path:
+            return self.app(environ, start_response)
+
+        status, sent = self.__handle(environ)
+        # Requests are handled by several server threads at once
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['commands'] += sent
+            if status[0] != '2':
+                self.stats['rejected'] += 1
+
+        start_response(status, [('Cache-Control', 'no-store')])
+        return [b'']
+
+    # ------------------------------------------------------------
+    def __handle(self, environ: dict) -> tuple[str, int]:
+        """
+        Send the commands of a request to the Arduino
+        :param environ: The WSGI environment
+        :return: The HTTP status line of the reply, and the number of commands sent
+        """
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return '405 Method Not Allowed', 0
+
+        query = environ.get('QUERY_STRING', '')
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return '400 Bad Request', 0
+        if length > MAX_BODY_LENGTH:
+            return '413 Payload Too Large', 0
+        if length > 0:
+            body = environ['wsgi.input'].read(length).decode('ascii', 'replace')
+            query = f'{query}&{body}' if query else body
+
+        parsed = parse_commands(query)
+        if parsed is None:
+            return '400 Bad Request', 0
+        token, commands = parsed
+
+        if not self.tokens.is_valid(token):
+            return '401 Unauthorized', 0
+        if not commands:
+            return '400 Bad Request', 0
+        if not self.arduino.is_connected():
+            return '503 Service Unavailable', 0
+
+        sent = sum(self.arduino.send_command(command) for command in commands)
+        return '204 No Content' if sent == len(commands) else '429 Too Many Requests', sent
@@ -0,0 +1,254 @@
+"""
+Rate limiting and deadman watchdog for the commands sent by clients
+
+The motor, servo and animation commands of the web-interface (the
+/motor, /servoControl and /animate routes, the WebSocket control
+channel and the fast lane) go through the CommandGovernor before they
+reach ArduinoDevice. Automation programs, trajectories and replays
+send their commands to the Arduino directly.
+
+Each command channel (the first character of the command) has a token
+bucket: a client can send a burst of commands, after which they are
+limited to the configured rate. Setpoints (see SETPOINT_CHANNELS) above
+the rate aren't lost: the latest value is kept and sent as soon as the
+channel has a token again, so a burst is smoothed out into the newest
+value. Other commands above the rate are dropped, which keeps a
+misbehaving client from filling the serial send queue.
+
+The browser repeats the joystick values while the robot is driving. If
+no motor command arrives within the timeout while the motors are
+running (the tab froze, or the network dropped), the watchdog stops the
+motors by sending X0 and Y0.
+"""
+
+import time
+import logging
+from threading import Thread, Event, Lock
+
+from arduino_device import SETPOINT_CHANNELS
+
+
+MOTOR_CHANNELS = "XY"       # Commands which keep the watchdog from stopping the motors
+CHECK_INTERVAL = 0.02       # Seconds between sending deferred setpoints and checking the watchdog
+
+# Watchdog states
+IDLE = "idle"               # Motors are not running
+DRIVING = "driving"         # Motors are running, and motor commands are arriving
+STOPPED = "stopped"         # Motors were stopped by the watchdog
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================
+class CommandGovernor:
+    """Limit the rate of commands from clients, and stop the motors if they go quiet"""
+
+    def __init__(self, arduino, rate: float = 50.0, burst: int = 10, timeout: float = 1.0):
+        """
+        Constructor
+        :param arduino: The ArduinoDevice which receives the commands
+        :param rate: Commands per second allowed on each channel (0 = no limit)
+        :param burst: Commands which can be sent on a channel at once, before the rate applies
+        :param timeout: Seconds without motor commands before the motors are stopped (0 = no watchdog)
+        """
+        self.arduino = arduino
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.timeout = timeout
+        self.lock = Lock()
+        self.buckets: dict[str, list[float]] = {}
+        self.deferred: dict[str, str] = {}
+        self.motors: dict[str, int] = {channel: 0 for channel in MOTOR_CHANNELS}
+        self.last_motor_input: float = 0.0
+        self.state: str = IDLE
+        self.trips: int = 0
+        self.stats: dict[str, dict[str, int]] = {}
+        self.listeners: list = []
+        self.exit_flag = Event()
+        self.thread: Thread | None = None
+
+    # ------------------------------------------------------------
+    def start(self):
+        """Start the thread which sends deferred setpoints and runs the watchdog"""
+        if self.thread is None or not self.thread.is_alive():
+            self.exit_flag.clear()
+            self.thread = Thread(target=self.__governor_thread, daemon=True)
+            self.thread.start()
+
+    # ------------------------------------------------------------
+    def stop(self):
+        """Stop the thread"""
+        self.exit_flag.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # ------------------------------------------------------------
+    def add_listener(self, listener):
+        """
+        Register a function which is called when the watchdog stops the motors
+        :param listener: Function called with the governor status
+        """
+        self.listeners = self.listeners + [listener]
+
+    # ------------------------------------------------------------
+    def is_connected(self) -> bool:
+        """
+        Check if the Arduino is connected
+        :return: True if connected
+        """
+        return self.arduino.is_connected()
+
+    # ------------------------------------------------------------
+    def send_command(self, command: str) -> bool:
+        """
+        Send a command from a client, if its channel is below the rate limit
+        :param command: The command to be sent
+        :return: True if the command was sent or deferred, False if it was dropped
+        """
+        if not command or not self.arduino.is_connected():
+            return False
+
+        channel = command[0]
+        now = time.monotonic()
+
+        with self.lock:
+            stats = self.__channel_stats(channel)
+
+            if channel in MOTOR_CHANNELS:
+                self.__motor_input(channel, command, now)
+
+            if self.__take_token(channel, now):
+                # A newer value replaces any deferred one
+                self.deferred.pop(channel, None)
+                stats['sent'] += 1
+                return self.arduino.send_command(command)
+
+            if channel in SETPOINT_CHANNELS:
+                if channel in self.deferred:
+                    stats['replaced'] += 1
+                self.deferred[channel] = command
+                stats['deferred'] += 1
+                return True
+
+            stats['limited'] += 1
+            return False
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the watchdog state and the rate limiting counters
+        :return: Dictionary containing the governor status
+        """
+        with self.lock:
+            channels = {channel: dict(stats) for channel, stats in self.stats.items()}
+            return {
+                'state': self.state,
+                'motors': dict(self.motors),
+                'input_age': round(time.monotonic() - self.last_motor_input, 3) if self.last_motor_input else None,
+                'trips': self.trips,
+                'rate': self.rate,
+                'burst': self.burst,
+                'timeout': self.timeout,
+                'pending': len(self.deferred),
+                'sent': sum(stats['sent'] for stats in channels.values()),
+                'deferred': sum(stats['deferred'] for stats in channels.values()),
+                'limited': sum(stats['limited'] for stats in channels.values()),
+                'channels': channels,
+            }
+
+    # ------------------------------------------------------------
+    def collect_metrics(self) -> list[tuple]:
+        """
+        Get the governor metrics, for MetricsRegistry.add_collector()
+        :return: List of (name, type, help, samples)
+        """
+        status = self.get_status()
+        return [
+            ('governor_commands', 'counter', 'Commands from clients by channel and outcome',
+             [('governor_commands_total', {'channel': channel, 'outcome': outcome}, value)
+              for channel, counters in sorted(status['channels'].items()) for outcome, value in counters.items()]),
+            ('governor_watchdog_trips', 'counter', 'Times the watchdog stopped the motors',
+             [('governor_watchdog_trips_total', {}, status['trips'])]),
+            ('governor_driving', 'gauge', 'Motors are running under client control',
+             [({}, int(status['state'] == DRIVING))]),
+        ]
+
+    # ------------------------------------------------------------
+    def __channel_stats(self, channel: str) -> dict[str, int]:
+        """
+        Get the counters of a channel, creating them if necessary
+        :param channel: The command character
+        :return: Dictionary of counters for the channel
+        """
+        stats = self.stats.get(channel)
+        if stats is None:
+            stats = {'sent': 0, 'deferred': 0, 'replaced': 0, 'limited': 0}
+            self.stats[channel] = stats
+        return stats
+
+    # ------------------------------------------------------------
+    def __take_token(self, channel: str, now: float) -> bool:
+        """
+        Refill the token bucket of a channel, and take a token if there is one
+        :param channel: The command character
+        :param now: The current monotonic time
+        :return: True if the command can be sent now
+        """
+        if self.rate <= 0:
+            return True
+
+        bucket = self.buckets.get(channel)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self.buckets[channel] = bucket
+
+        bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return True
+        return False
+
+    # ------------------------------------------------------------
+    def __motor_input(self, channel: str, command: str, now: float):
+        """Remember the motor value sent by a client, and when it arrived"""
+        try:
+            value = int(command[1:])
+        except ValueError:
+            value = 1
+        self.motors[channel] = value
+        self.last_motor_input = now
+        self.state = DRIVING if any(self.motors.values()) else IDLE
+
+    # ------------------------------------------------------------
+    def __governor_thread(self):
+        """Send deferred setpoints when their channel has a token, and stop the motors if the input stops"""
+        while not self.exit_flag.wait(CHECK_INTERVAL):
+            tripped = None
+            now = time.monotonic()
+
+            with self.lock:
+                for channel, command in list(self.deferred.items()):
+                    if self.__take_token(channel, now):
+                        del self.deferred[channel]
+                        self.stats[channel]['sent'] += 1
+                        self.arduino.send_command(command)
+
+                if self.state == DRIVING and 0 < self.timeout < now - self.last_motor_input:
+                    for channel in MOTOR_CHANNELS:
+                        self.deferred.pop(channel, None)
+                        self.motors[channel] = 0
+                        self.arduino.send_command(f'{channel}0')
+                    self.state = STOPPED
+                    self.trips += 1
+                    tripped = now - self.last_motor_input
+
+            if tripped is not None:
+                logger.warning(f'No motor commands for {tripped:.2f} s, stopped the motors')
+                status = self.get_status()
+                for listener in self.listeners:
+                    try:
+                        listener(status)
+                    except Exception as ex:
+                        logger.error(f'Governor listener error: {repr(ex)}')
@@ -0,0 +1,259 @@
+"""
+Background job queue for the Wall-e web-interface
+
+Slow work such as generating speech is run by a small pool of worker
+threads, so the web server's threads are free to handle motor commands.
+Jobs are started in order of priority, and then in the order they were
+submitted. The number of waiting jobs is limited; when the queue is
+full, a new job replaces the newest job of lower priority, or is
+rejected. Jobs can be cancelled, and their state can be polled using
+the job id for a while after they have finished.
+"""
+
+import time
+import heapq
+import logging
+import secrets
+from collections import OrderedDict
+from threading import Thread, Condition, Event
+
+
+# Job priorities (lower numbers are started first)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================
+class Job:
+    """A unit of work and its current state"""
+
+    def __init__(self, kind: str, function, priority: int, sequence: int):
+        """
+        Constructor
+        :param kind: Type of job, such as "tts" or "audio"
+        :param function: Function to run, which receives the job as its only argument
+        :param priority: Priority of the job (PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW)
+        :param sequence: Order in which the job was submitted
+        """
+        self.id = secrets.token_hex(6)
+        self.kind = kind
+        self.function = function
+        self.priority = priority
+        self.sequence = sequence
+        self.state = QUEUED
+        self.error: str | None = None
+        self.submitted = time.monotonic()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.cancelled = Event()
+
+    def __lt__(self, other: 'Job') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    # ------------------------------------------------------------
+    def is_cancelled(self) -> bool:
+        """Check whether the job has been cancelled, so a running job can stop early"""
+        return self.cancelled.is_set()
+
+    # ------------------------------------------------------------
+    def to_dict(self) -> dict:
+        """
+        Get the state of the job
+        :return: Dictionary containing the job id, kind, state, error and timing (in seconds)
+        """
+        now = time.monotonic()
+        started = self.started if self.started is not None else now
+        finished = self.finished if self.finished is not None else now
+        return {'id': self.id, 'kind': self.kind, 'priority': self.priority, 'state': self.state,
+                'error': self.error, 'wait_time': round(started - self.submitted, 3),
+                'run_time': round(finished - started, 3) if self.started is not None else 0.0}
+
+
+# ================================================================
+class JobQueue:
+    """Run jobs in the background using a fixed number of worker threads"""
+
+    def __init__(self, workers: int = 2, max_queued: int = 16, history: int = 64):
+        """
+        Constructor
+        :param workers: Number of jobs which can run at the same time
+        :param max_queued: Maximum number of jobs waiting to start
+        :param history: Number of finished jobs whose state is remembered
+        """
+        self.workers = workers
+        self.max_queued = max_queued
+        self.history = history
+
+        self.queue: list[Job] = []
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.threads: list[Thread] = []
+        self.condition = Condition()
+        self.exit_flag = False
+        self.sequence: int = 0
+        self.listeners: list = []
+        self.stats = {'submitted': 0, 'rejected': 0, 'replaced': 0, 'done': 0, 'failed': 0, 'cancelled': 0}
+
+    # ------------------------------------------------------------
+    def submit(self, kind: str, function, priority: int = PRIORITY_NORMAL) -> Job | None:
+        """
+        Add a job to the queue
+        :param kind: Type of job, such as "tts" or "audio"
+        :param function: Function to run, which receives the job as its only argument
+        :param priority: Priority of the job
+        :return: The job, or None if the queue is full
+        """
+        with self.condition:
+            if self.exit_flag:
+                return None
+
+            if len(self.queue) >= self.max_queued:
+                newest = max(self.queue, key=lambda queued: (queued.priority, queued.sequence))
+                if newest.priority <= priority:
+                    self.stats['rejected'] += 1
+                    return None
+                self.__remove_queued(newest)
+                self.stats['replaced'] += 1
+
+            if len(self.threads) < self.workers:
+                thread = Thread(target=self.__worker_thread, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+            self.sequence += 1
+            job = Job(kind, function, priority, self.sequence)
+            heapq.heappush(self.queue, job)
+            self.jobs[job.id] = job
+            self.stats['submitted'] += 1
+            self.__forget_finished()
+            self.condition.notify()
+            return job
+
+    # ------------------------------------------------------------
+    def get(self, job_id: str) -> Job | None:
+        """
+        Find a job which is waiting, running, or has recently finished
+        :param job_id: The job id
+        :return: The job, or None if it is unknown
+        """
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    # ------------------------------------------------------------
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job. Waiting jobs are removed from the queue, while running
+        jobs are asked to stop (they can check Job.is_cancelled).
+        :param job_id: The job id
+        :return: True if the job was waiting or running, False otherwise
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in (QUEUED, RUNNING):
+                return False
+
+            job.cancelled.set()
+            if job.state == QUEUED:
+                self.__remove_queued(job)
+            return True
+
+    # ------------------------------------------------------------
+    def cancel_all(self, kind: str | None = None) -> int:
+        """
+        Cancel all waiting and running jobs
+        :param kind: Only cancel jobs of this type (None = all jobs)
+        :return: Number of jobs which were cancelled
+        """
+        with self.condition:
+            job_ids = [job.id for job in self.jobs.values()
+                       if job.state in (QUEUED, RUNNING) and kind in (None, job.kind)]
+        return sum(self.cancel(job_id) for job_id in job_ids)
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the queue statistics
+        :return: Dictionary containing the number of waiting and running jobs, and job counters
+        """
+        with self.condition:
+            running = sum(job.state == RUNNING for job in self.jobs.values())
+            return dict(self.stats, queued=len(self.queue), running=running)
+
+    # ------------------------------------------------------------
+    def add_listener(self, listener):
+        """
+        Register a function which is called (from the worker thread) when a job has finished
+        :param listener: Function receiving the finished job
+        """
+        self.listeners = self.listeners + [listener]
+
+    # ------------------------------------------------------------
+    def close(self):
+        """Cancel all jobs and stop the worker threads"""
+        self.cancel_all()
+        with self.condition:
+            self.exit_flag = True
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join(1)
+        self.threads.clear()
+
+    # ------------------------------------------------------------
+    def __remove_queued(self, job: Job):
+        """Remove a job which hasn't started yet from the queue"""
+        self.queue.remove(job)
+        heapq.heapify(self.queue)
+        job.state = CANCELLED
+        job.finished = time.monotonic()
+        self.stats['cancelled'] += 1
+
+    # ------------------------------------------------------------
+    def __forget_finished(self):
+        """Forget the oldest finished jobs once the history is full"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.state not in (QUEUED, RUNNING)]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    # ------------------------------------------------------------
+    def __worker_thread(self):
+        """Run jobs from the queue until the queue is closed"""
+        while True:
+            with self.condition:
+                while not self.queue and not self.exit_flag:
+                    self.condition.wait()
+                if self.exit_flag:
+                    break
+
+                job = heapq.heappop(self.queue)
+                job.state = RUNNING
+                job.started = time.monotonic()
+
+            try:
+                job.function(job)
+                state = CANCELLED if job.is_cancelled() else DONE
+
+            except Exception as ex:
+                logger.error(f'Job {job.kind} failed: {repr(ex)}')
+                job.error = str(ex) or type(ex).__name__
+                state = FAILED
+
+            with self.condition:
+                job.state = state
+                job.finished = time.monotonic()
+                self.stats[state] += 1
+
+            for listener in self.listeners:
+                try:
+                    listener(job)
+                except Exception as ex:
+                    logger.error(f'Job listener error: {repr(ex)}')
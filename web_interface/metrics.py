@@ -0,0 +1,330 @@
+"""
+Low-overhead metrics in the Prometheus text exposition format
+
+Counters and histograms are updated without taking a lock: each thread
+adds to its own shard of the values, and the shards are only summed
+when the metrics are rendered. Values which are already counted
+elsewhere (such as the serial queue depth, or the frames sent to each
+stream client) are read by collector functions when /metrics is
+requested, so they cost nothing in between.
+
+    registry = MetricsRegistry('walle_')
+    requests = registry.histogram('request_seconds', 'Request duration', ('route',))
+    requests.labels('/motor').observe(0.002)
+
+Shards are kept per thread id, so this suits long-lived worker threads
+(such as the waitress pool) rather than a new thread per request.
+"""
+
+import math
+import time
+from bisect import bisect_left
+from threading import Lock, get_ident
+
+
+# Upper bounds (seconds) of the default histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# ----------------------------------------------------------------
+def format_value(value: float) -> str:
+    """
+    Format a sample value as required by the exposition format
+    :param value: The value
+    :return: The formatted value, such as "12", "0.25" or "+Inf"
+    """
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ----------------------------------------------------------------
+def format_labels(labels: dict) -> str:
+    """
+    Format the labels of a sample
+    :param labels: Dictionary of label names and values
+    :return: The formatted labels, such as '{route="/motor"}', or "" if there are none
+    """
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+# ================================================================
+class CounterChild:
+    """Counter value for one combination of label values"""
+
+    def __init__(self):
+        self.shards: dict[int, list[float]] = {}
+        self.lock = Lock()
+
+    # ------------------------------------------------------------
+    def inc(self, amount: float = 1):
+        """
+        Increase the counter
+        :param amount: Amount to add, which must not be negative
+        """
+        shard = self.shards.get(get_ident())
+        if shard is None:
+            shard = self.__add_shard()
+        shard[0] += amount
+
+    # ------------------------------------------------------------
+    def get(self) -> float:
+        """Current value of the counter"""
+        return sum(shard[0] for shard in list(self.shards.values()))
+
+    # ------------------------------------------------------------
+    def __add_shard(self) -> list[float]:
+        """Create the shard of the calling thread"""
+        with self.lock:
+            return self.shards.setdefault(get_ident(), [0])
+
+
+# ================================================================
+class HistogramChild:
+    """Histogram for one combination of label values"""
+
+    def __init__(self, buckets: tuple):
+        """
+        Constructor
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        self.buckets = buckets
+        self.shards: dict[int, list[float]] = {}
+        self.lock = Lock()
+
+    # ------------------------------------------------------------
+    def observe(self, value: float):
+        """
+        Add a sample to the histogram
+        :param value: The sample, such as a duration in seconds
+        """
+        shard = self.shards.get(get_ident())
+        if shard is None:
+            shard = self.__add_shard()
+
+        # Shard layout: one count per bucket (the last is +Inf), then the sum
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    # ------------------------------------------------------------
+    def time(self) -> 'Timer':
+        """
+        Measure the duration of a block of code
+        :return: Context manager which observes the elapsed seconds when it exits
+        """
+        return Timer(self)
+
+    # ------------------------------------------------------------
+    def get(self) -> tuple[list[int], float]:
+        """
+        Get the combined values of all threads
+        :return: Tuple of (count in each bucket including +Inf, sum of the samples)
+        """
+        totals = [0] * (len(self.buckets) + 2)
+        for shard in list(self.shards.values()):
+            for index, value in enumerate(shard):
+                totals[index] += value
+        return (totals[:-1], totals[-1])
+
+    # ------------------------------------------------------------
+    def __add_shard(self) -> list[float]:
+        """Create the shard of the calling thread"""
+        with self.lock:
+            return self.shards.setdefault(get_ident(), [0] * (len(self.buckets) + 1) + [0.0])
+
+
+# ================================================================
+class Timer:
+    """Context manager which observes the time spent inside it"""
+
+    def __init__(self, histogram: HistogramChild):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+# ================================================================
+class Metric:
+    """A named metric, with a child for each combination of label values"""
+
+    def __init__(self, kind: str, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Constructor
+        :param kind: Metric type, "counter" or "histogram"
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: Names of the labels
+        :param buckets: Upper bounds of the histogram buckets
+        """
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.children: dict[tuple, CounterChild | HistogramChild] = {}
+        self.lock = Lock()
+
+    # ------------------------------------------------------------
+    def labels(self, *values) -> CounterChild | HistogramChild:
+        """
+        Get the child for some label values, which callers on hot paths can keep
+        :param values: Value of each label, in the order of the label names
+        :return: The counter or histogram for these label values
+        """
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f'{self.name} expects labels {self.label_names}')
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = CounterChild() if self.kind == 'counter' else HistogramChild(self.buckets)
+                    # Replace the dictionary rather than changing it, so it can be read without the lock
+                    self.children = {**self.children, values: child}
+        return child
+
+    # ------------------------------------------------------------
+    def inc(self, amount: float = 1):
+        """Increase a counter which has no labels"""
+        self.labels().inc(amount)
+
+    # ------------------------------------------------------------
+    def observe(self, value: float):
+        """Add a sample to a histogram which has no labels"""
+        self.labels().observe(value)
+
+    # ------------------------------------------------------------
+    def collect(self) -> list[tuple[str, dict, float]]:
+        """
+        Get the samples of the metric
+        :return: List of (sample name, labels, value)
+        """
+        samples = []
+        for values, child in sorted(self.children.items()):
+            labels = dict(zip(self.label_names, values))
+
+            if self.kind == 'counter':
+                samples.append((f'{self.name}_total', labels, child.get()))
+            else:
+                counts, total = child.get()
+                samples.extend(histogram_samples(self.name, labels, self.buckets, counts, total))
+
+        return samples
+
+
+# ================================================================
+class MetricsRegistry:
+    """Collection of metrics, which can be rendered for Prometheus"""
+
+    def __init__(self, prefix: str = ""):
+        """
+        Constructor
+        :param prefix: Prefix added to the name of every metric, such as "walle_"
+        """
+        self.prefix = prefix
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list = []
+        self.lock = Lock()
+
+    # ------------------------------------------------------------
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Metric:
+        """
+        Create a counter (the "_total" suffix is added when it is rendered)
+        :param name: Name of the counter, without the prefix
+        :param help_text: Description of the counter
+        :param labels: Names of the labels
+        :return: The counter
+        """
+        return self.__add(Metric('counter', self.prefix + name, help_text, labels))
+
+    # ------------------------------------------------------------
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Metric:
+        """
+        Create a histogram
+        :param name: Name of the histogram, without the prefix
+        :param help_text: Description of the histogram
+        :param labels: Names of the labels
+        :param buckets: Upper bounds of the buckets, in increasing order
+        :return: The histogram
+        """
+        return self.__add(Metric('histogram', self.prefix + name, help_text, labels, buckets))
+
+    # ------------------------------------------------------------
+    def add_collector(self, collector):
+        """
+        Register a function which provides metrics when they are rendered
+        The function returns a list of (name, type, help, samples) tuples, where
+        the name is without the prefix, the type is "gauge", "counter" or "histogram",
+        and the samples are a list of (labels, value) or (sample name, labels, value).
+        :param collector: Function without arguments
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    # ------------------------------------------------------------
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format
+        :return: The metrics document
+        """
+        lines = []
+
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{format_labels(labels)} {format_value(value)}'
+                         for name, labels, value in metric.collect())
+
+        for collector in list(self.collectors):
+            for name, kind, help_text, samples in collector():
+                name = self.prefix + name
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for sample in samples:
+                    sample_name, labels, value = (self.prefix + sample[0], *sample[1:]) if len(sample) == 3 else (name, *sample)
+                    lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    # ------------------------------------------------------------
+    def __add(self, metric: Metric) -> Metric:
+        """Register a new metric"""
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f'Metric {metric.name} already exists')
+            self.metrics[metric.name] = metric
+        return metric
+
+
+# ----------------------------------------------------------------
+def histogram_samples(name: str, labels: dict, buckets: tuple, counts: list[int], total: float) -> list[tuple]:
+    """
+    Convert bucket counts into histogram samples, for use in collectors
+    :param name: Name of the histogram, without the prefix
+    :param labels: Labels of the histogram
+    :param buckets: Upper bounds of the buckets
+    :param counts: Number of samples in each bucket, with the +Inf bucket last
+    :param total: Sum of the samples
+    :return: List of (sample name, labels, value)
+    """
+    samples = []
+    cumulative = 0
+    for bound, count in zip(tuple(buckets) + (math.inf,), counts):
+        cumulative += count
+        samples.append((f'{name}_bucket', dict(labels, le=format_value(bound)), cumulative))
+    samples.append((f'{name}_count', labels, cumulative))
+    samples.append((f'{name}_sum', labels, total))
+    return samples
@@ -7,13 +7,22 @@ not supported by this code.
 """
 
 import io
+import time
+import socket
+import secrets
 import logging
 import socketserver
-from http import server
-from threading import Thread, Condition, Event
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.outputs import FileOutput
+from abc import ABC, abstractmethod
+from http import server, HTTPStatus
+from threading import Thread, Condition, Event, Lock
+from urllib.parse import urlsplit, parse_qs
+
+# Libraries which are slow to import are only loaded when they are first needed, see
+# load_picamera2(), load_pillow() and AsyncStreamingServer. picamera2 pulls in libcamera
+# and numpy, which take seconds to import on a Pi Zero, and is only available on the Pi.
+picamera2 = None
+Image = None
+asyncio = None
 
 
 PAGE = """\
@@ -28,27 +37,275 @@ PAGE = """\
 </html>
 """
 
+FRAME_TIMEOUT = 1.0         # Seconds to wait for a frame before checking if the stream stopped
+SEND_BUFFER_SIZE = 65536    # Limit how many old frames can queue up in the kernel for a slow client
+THUMBNAIL_SIZE = (160, 120) # Maximum size of the /snapshot.jpg?thumbnail image
+THUMBNAIL_QUALITY = 70      # JPEG quality of the thumbnail
+
+# Stream profiles used by the adaptive mode, from lowest to highest bandwidth.
+# The highest profile matches the settings used when adaptive mode is off.
+STREAM_PROFILES = [
+    {'name': 'Low',    'size': (320, 240), 'fps': 10, 'quality': 'LOW'},
+    {'name': 'Medium', 'size': (480, 360), 'fps': 15, 'quality': 'MEDIUM'},
+    {'name': 'High',   'size': (640, 480), 'fps': 30, 'quality': None},
+]
+
+ADAPT_INTERVAL = 2.0        # Seconds between checks of the client and CPU load
+SKIP_RATIO_HIGH = 0.2       # Step down if a client skips more than this fraction of frames,
+SEND_LOAD_HIGH = 0.8        # ...or spends more than this fraction of the time waiting to send,
+CPU_LOAD_HIGH = 0.9         # ...or if the CPU is busier than this
+SKIP_RATIO_LOW = 0.02       # Step up if all clients skip fewer frames than this,
+SEND_LOAD_LOW = 0.3         # ...and spend less than this fraction of the time sending,
+CPU_LOAD_LOW = 0.7          # ...and the CPU is less busy than this
+STEP_UP_INTERVALS = 3       # Number of good intervals before trying a better profile
+MAX_STEP_UP_INTERVALS = 15  # Upper limit of the back-off after a failed step up
+
+# States of the camera, which change in the worker thread of PiCameraStreamer
+CAMERA_STOPPED = "stopped"
+CAMERA_STARTING = "starting"
+CAMERA_RUNNING = "running"
+CAMERA_STOPPING = "stopping"
+CAMERA_ERROR = "error"
+
+
+# ================================================================
+class StreamingClient:
+    """Statistics of a single client viewing the stream"""
+
+    def __init__(self, address: tuple):
+        """
+        Constructor
+        :param address: The client IP address and port
+        """
+        self.address = address
+        self.connected = time.time()
+        self.frames_sent: int = 0
+        self.frames_skipped: int = 0
+        self.bytes_sent: int = 0
+        self.send_time: float = 0.0
+
+    def get_stats(self) -> dict:
+        """
+        Get the statistics of this client
+        :return: Dictionary containing the client statistics
+        """
+        return {
+            'address': f'{self.address[0]}:{self.address[1]}',
+            'connected': round(time.time() - self.connected, 1),
+            'frames_sent': self.frames_sent,
+            'frames_skipped': self.frames_skipped,
+            'bytes_sent': self.bytes_sent,
+        }
+
 
 # ================================================================
 class StreamingOutput(io.BufferedIOBase):
+    """
+    Hold the newest frame from the encoder, which is shared by all clients
+    Clients that are slower than the camera skip the frames they missed,
+    rather than falling further and further behind.
+    """
+
     def __init__(self):
         self.frame = None
+        self.sequence: int = 0
+        self.stream_id: str = secrets.token_hex(4)
+        self.started: float = time.monotonic()
         self.condition = Condition()
+        self.thumbnail: tuple[int, bytes] | None = None
+        self.thumbnail_lock = Lock()
+        self.clients: set[StreamingClient] = set()
+        self.clients_lock = Lock()
+        self.listeners: list = []
 
     def write(self, buf):
         with self.condition:
             self.frame = buf
+            self.sequence += 1
             self.condition.notify_all()
 
+        for listener in self.listeners:
+            listener()
+
+    def get_frame(self) -> tuple[int, bytes]:
+        """
+        Get the newest frame without waiting
+        :return: Tuple of (sequence number, frame)
+        """
+        with self.condition:
+            return (self.sequence, self.frame)
+
+    def get_thumbnail(self, sequence: int, frame: bytes) -> bytes:
+        """
+        Get a downscaled copy of a frame, which is only created once per frame
+        :param sequence: Sequence number of the frame
+        :param frame: The JPEG frame
+        :return: The thumbnail JPEG
+        """
+        with self.thumbnail_lock:
+            if self.thumbnail is None or self.thumbnail[0] != sequence:
+                self.thumbnail = (sequence, make_thumbnail(frame))
+            return self.thumbnail[1]
+
+    def add_listener(self, listener):
+        """
+        Register a function which is called (from the encoder thread) after each new frame
+        :param listener: Function without arguments
+        """
+        # Replace the list rather than changing it, so the encoder thread can iterate without a lock
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        """Remove a function registered using add_listener"""
+        self.listeners = [item for item in self.listeners if item is not listener]
+
+    def wait_for_frame(self, last_sequence: int, timeout: float | None = None) -> tuple[int, bytes] | None:
+        """
+        Wait until a frame newer than the last one a client received is available
+        :param last_sequence: Sequence number of the last frame the client received
+        :param timeout: Maximum number of seconds to wait
+        :return: Tuple of (sequence number, frame), or None on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != last_sequence, timeout):
+                return None
+            return (self.sequence, self.frame)
+
+    def add_client(self, address: tuple) -> StreamingClient:
+        """Register a new client of the stream"""
+        client = StreamingClient(address)
+        with self.clients_lock:
+            self.clients.add(client)
+        return client
+
+    def remove_client(self, client: StreamingClient):
+        """Remove a client which has disconnected"""
+        with self.clients_lock:
+            self.clients.discard(client)
+
+    def get_client_stats(self) -> list[dict]:
+        """
+        Get the statistics of all connected clients
+        :return: List of dictionaries containing the client statistics
+        """
+        with self.clients_lock:
+            clients = list(self.clients)
+        return [client.get_stats() for client in clients]
+
 
 output: StreamingOutput = StreamingOutput()
 
 
+# ----------------------------------------------------------------
+def send_buffers(connection: socket.socket, buffers: list[bytes]) -> int:
+    """
+    Send several buffers using a single vectored write where possible
+    :param connection: The client socket
+    :param buffers: List of buffers which are sent in order
+    :return: Total number of bytes sent
+    """
+    views = [memoryview(buffer) for buffer in buffers]
+    total = sum(len(view) for view in views)
+
+    while views:
+        sent = connection.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views and sent:
+            views[0] = views[0][sent:]
+
+    return total
+
+
+# ----------------------------------------------------------------
+def load_picamera2():
+    """
+    Import the camera library, the first time the camera is started
+    :return: The picamera2 module
+    """
+    global picamera2
+    if picamera2 is None:
+        try:
+            import picamera2.encoders
+            import picamera2.outputs
+        except ImportError as ex:
+            raise RuntimeError('The picamera2 library is not installed, so the camera is not available') from ex
+    return picamera2
+
+
+# ----------------------------------------------------------------
+def load_pillow() -> bool:
+    """
+    Import Pillow, the first time a snapshot thumbnail is requested
+    :return: True if Pillow is available, False if it isn't installed
+    """
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            # Remember that it is missing, rather than searching for it again on every request
+            Image = False
+    return Image is not False
+
+
+# ----------------------------------------------------------------
+def make_thumbnail(frame: bytes) -> bytes:
+    """
+    Downscale a JPEG frame
+    The draft mode lets the JPEG decoder skip most of the work of decoding
+    the full resolution image.
+    :param frame: The JPEG frame
+    :return: The thumbnail JPEG
+    """
+    image = Image.open(io.BytesIO(frame))
+    image.draft('RGB', THUMBNAIL_SIZE)
+    image.thumbnail(THUMBNAIL_SIZE)
+    result = io.BytesIO()
+    image.save(result, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return result.getvalue()
+
+
+# ----------------------------------------------------------------
+def get_snapshot_response(stream: StreamingOutput, query: str, if_none_match: str | None) -> tuple[int, list, bytes]:
+    """
+    Create the response for a /snapshot.jpg request, using the newest frame
+    :param stream: The output holding the newest frame
+    :param query: Query string of the request (add "thumbnail" for a downscaled image)
+    :param if_none_match: The If-None-Match header of the request
+    :return: Tuple of (status code, list of (header, value), content)
+    """
+    thumbnail = 'thumbnail' in parse_qs(query, keep_blank_values=True)
+    sequence, frame = stream.get_frame()
+
+    if frame is None:
+        return (503, [('Retry-After', '1'), ('Content-Length', '0')], b'')
+    if thumbnail and not load_pillow():
+        return (404, [('Content-Length', '0')], b'')
+
+    etag = f'"{stream.stream_id}-{sequence}{"-thumbnail" if thumbnail else ""}"'
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+
+    if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return (304, headers, b'')
+
+    content = stream.get_thumbnail(sequence, frame) if thumbnail else frame
+    return (200, headers + [('Content-Type', 'image/jpeg'), ('Content-Length', str(len(content)))], content)
+
+
+# ----------------------------------------------------------------
+def get_frame_header(frame: bytes) -> bytes:
+    """Part header which is sent before each frame of the multipart stream"""
+    return b'--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame)
+
+
 # ================================================================
 class StreamingHandler(server.BaseHTTPRequestHandler):
     """Handle the web server requests"""
     
     def do_GET(self):
+        url = urlsplit(self.path)
+
         if self.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
@@ -60,6 +317,13 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
+        elif url.path == '/snapshot.jpg':
+            status, headers, content = get_snapshot_response(output, url.query, self.headers.get('If-None-Match'))
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
         elif self.path == '/stream.mjpg':
             self.send_response(200)
             self.send_header('Age', 0)
@@ -67,21 +331,30 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+            stream = output
+            client = stream.add_client(self.client_address)
+            sequence = stream.sequence
             try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
+                # Stop once the camera has been restarted with a new output
+                while stream is output:
+                    newest = stream.wait_for_frame(sequence, FRAME_TIMEOUT)
+                    if newest is None:
+                        continue
+
+                    client.frames_skipped += newest[0] - sequence - 1
+                    sequence, frame = newest
+                    send_start = time.perf_counter()
+                    client.bytes_sent += send_buffers(self.connection, [get_frame_header(frame), frame, b'\r\n'])
+                    client.send_time += time.perf_counter() - send_start
+                    client.frames_sent += 1
             except Exception as e:
                 logging.warning(
                     'Removed streaming client %s: %s',
                     self.client_address, str(e))
+            finally:
+                stream.remove_client(client)
         else:
             self.send_error(404)
             self.end_headers()
@@ -93,19 +366,424 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     daemon_threads = True
 
 
+# ================================================================
+class AsyncStreamingServer:
+    """
+    Serve the stream to all clients from a single asyncio event loop
+    Unlike StreamingServer, clients don't each need their own thread.
+    The encoder thread wakes the event loop through an output listener
+    whenever a new frame is available. Provides the same serve_forever,
+    shutdown and server_close methods as StreamingServer.
+    """
+
+    def __init__(self, address: tuple):
+        """
+        Constructor
+        :param address: The (host, port) to listen on
+        """
+        # asyncio is only imported when this server type is used
+        global asyncio
+        import asyncio
+
+        self.socket = socket.create_server(address)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.stop_event = asyncio.Event()
+        self.frame_event = asyncio.Event()
+        self.tasks: set[asyncio.Task] = set()
+        self.stopped = Event()
+
+    # ------------------------------------------------------------
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called"""
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.__serve())
+        finally:
+            self.loop.close()
+            self.stopped.set()
+
+    # ------------------------------------------------------------
+    def shutdown(self):
+        """Stop the event loop, and wait for it to finish"""
+        if self.loop is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.stop_event.set)
+                self.stopped.wait()
+            except RuntimeError:
+                pass
+
+    # ------------------------------------------------------------
+    def server_close(self):
+        """Close the listening socket"""
+        self.socket.close()
+
+    # ------------------------------------------------------------
+    async def __serve(self):
+        """Accept clients until the server is stopped"""
+        stream = output
+        stream.add_listener(self.__on_frame)
+        server = await asyncio.start_server(self.__handle_client, sock=self.socket)
+
+        try:
+            await self.stop_event.wait()
+        finally:
+            stream.remove_listener(self.__on_frame)
+            server.close()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # ------------------------------------------------------------
+    def __on_frame(self):
+        """Called from the encoder thread after each new frame"""
+        try:
+            self.loop.call_soon_threadsafe(self.__notify_clients)
+        except RuntimeError:
+            pass
+
+    # ------------------------------------------------------------
+    def __notify_clients(self):
+        """Wake up all clients waiting for a frame"""
+        event = self.frame_event
+        self.frame_event = asyncio.Event()
+        event.set()
+
+    # ------------------------------------------------------------
+    async def __handle_client(self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter'):
+        """Read the request of a client and send the response"""
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        address = writer.get_extra_info('peername')
+
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            lines = request.decode(errors='replace').split('\r\n')
+            parts = lines[0].split()
+            path = parts[1] if len(parts) > 1 and parts[0] == 'GET' else None
+            url = urlsplit(path or '')
+
+            if path == '/':
+                writer.write(b'HTTP/1.0 301 Moved Permanently\r\nLocation: /index.html\r\n\r\n')
+            elif path == '/index.html':
+                content = PAGE.encode('utf-8')
+                writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n'
+                             b'Content-Length: %d\r\n\r\n' % len(content) + content)
+            elif url.path == '/snapshot.jpg':
+                headers = {name.strip().lower(): value.strip() for name, _, value in
+                           (line.partition(':') for line in lines[1:] if line)}
+                status, headers, content = get_snapshot_response(output, url.query, headers.get('if-none-match'))
+                response = f'HTTP/1.0 {status} {HTTPStatus(status).phrase}\r\n'
+                response += ''.join(f'{name}: {value}\r\n' for name, value in headers)
+                writer.writelines([response.encode() + b'\r\n', content])
+            elif path == '/stream.mjpg':
+                await self.__stream(writer, address)
+            else:
+                writer.write(b'HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logging.warning('Removed streaming client %s: %s', address, str(e))
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+    # ------------------------------------------------------------
+    async def __stream(self, writer: 'asyncio.StreamWriter', address: tuple):
+        """Send the newest frame to the client whenever one is available"""
+        writer.write(b'HTTP/1.0 200 OK\r\nAge: 0\r\nCache-Control: no-cache, private\r\nPragma: no-cache\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n\r\n')
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+
+        stream = output
+        client = stream.add_client(address)
+        sequence = stream.sequence
+        try:
+            # Stop once the camera has been restarted with a new output
+            while stream is output:
+                event = self.frame_event
+                if stream.sequence == sequence:
+                    try:
+                        await asyncio.wait_for(event.wait(), FRAME_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                newest, frame = stream.get_frame()
+                client.frames_skipped += newest - sequence - 1
+                sequence = newest
+
+                # Frames which arrive while waiting for the client to catch up are skipped
+                header = get_frame_header(frame)
+                writer.writelines([header, frame, b'\r\n'])
+                send_start = time.perf_counter()
+                await writer.drain()
+                client.send_time += time.perf_counter() - send_start
+                client.bytes_sent += len(header) + len(frame) + 2
+                client.frames_sent += 1
+        finally:
+            stream.remove_client(client)
+
+
+# ----------------------------------------------------------------
+def read_cpu_times() -> tuple[int, int] | None:
+    """
+    Read the total CPU time counters of the system
+    :return: Tuple of (busy time, total time), or None if not available
+    """
+    try:
+        with open('/proc/stat') as file:
+            times = [int(value) for value in file.readline().split()[1:]]
+        idle = times[3] + (times[4] if len(times) > 4 else 0)
+        return (sum(times) - idle, sum(times))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# ================================================================
+class CameraBackend(ABC):
+    """
+    Source of encoded frames for the stream
+    Subclasses write JPEG frames to the output, using the settings of a profile.
+    """
+
+    def prepare(self, profile: dict):
+        """
+        Do the slow parts of starting ahead of time, such as opening the camera
+        and preparing its configuration, so start() is quick (optional)
+        :param profile: The stream profile which will be used
+        """
+        pass
+
+    @abstractmethod
+    def start(self, output: StreamingOutput, profile: dict):
+        """
+        Start producing frames
+        :param output: The output which receives the frames
+        :param profile: The stream profile to use
+        """
+
+    @abstractmethod
+    def apply(self, profile: dict):
+        """
+        Change the settings of a running camera
+        :param profile: The new stream profile
+        """
+
+    @abstractmethod
+    def stop(self):
+        """Stop producing frames (the camera may stay open for a quick restart)"""
+
+    def close(self):
+        """Stop producing frames and release the camera"""
+        self.stop()
+
+    @abstractmethod
+    def is_active(self) -> bool:
+        """
+        Check if the backend is producing frames
+        :return: True if the backend is running, False otherwise
+        """
+
+
+# ================================================================
+class Picamera2Backend(CameraBackend):
+    """Produce frames from the Raspberry Pi camera using the hardware MJPEG encoder"""
+
+    def __init__(self):
+        """Constructor"""
+        self.picam2 = None
+        self.output: StreamingOutput | None = None
+        self.profile: dict | None = None
+        self.recording: bool = False
+        self.configurations: dict[tuple, object] = {}
+
+    def prepare(self, profile: dict):
+        self.__open()
+        self.__get_configuration(profile['size'])
+
+    def start(self, output: StreamingOutput, profile: dict):
+        self.__open()
+        self.output = output
+        self.profile = profile
+        self.__start_recording()
+        self.recording = True
+
+    def apply(self, profile: dict):
+        old_profile = self.profile
+        self.profile = profile
+
+        # A new resolution needs the camera to be reconfigured
+        if profile['size'] != old_profile['size']:
+            self.picam2.stop_recording()
+            self.__start_recording()
+
+        # A new quality only needs the encoder to be restarted
+        elif profile['quality'] != old_profile['quality']:
+            self.picam2.stop_encoder()
+            self.picam2.start_encoder(picamera2.encoders.MJPEGEncoder(), picamera2.outputs.FileOutput(self.output),
+                                     quality=self.__get_quality())
+
+        # The frame rate can be changed while running
+        if profile['fps'] != old_profile['fps']:
+            self.picam2.set_controls({"FrameDurationLimits": self.__get_frame_limits()})
+
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self.picam2.stop_recording()
+
+    def close(self):
+        self.stop()
+        if self.picam2 is not None:
+            self.picam2.close()
+            self.picam2 = None
+
+    def is_active(self) -> bool:
+        return self.recording
+
+    def __open(self):
+        """Open the camera, which stays open between streams so restarting is quick"""
+        if self.picam2 is None:
+            self.picam2 = load_picamera2().Picamera2()
+
+    def __get_configuration(self, size: tuple) -> object:
+        """Video configuration for a resolution, which is only created once"""
+        configuration = self.configurations.get(size)
+        if configuration is None:
+            configuration = self.picam2.create_video_configuration(main={"size": size})
+            self.configurations[size] = configuration
+        return configuration
+
+    def __start_recording(self):
+        """Configure the camera for the current profile and start encoding"""
+        self.picam2.configure(self.__get_configuration(self.profile['size']))
+        self.picam2.set_controls({"FrameDurationLimits": self.__get_frame_limits(), "ExposureValue": 6.0, "Brightness": 0.1})
+        self.picam2.start_recording(picamera2.encoders.MJPEGEncoder(), picamera2.outputs.FileOutput(self.output),
+                                    quality=self.__get_quality())
+
+    def __get_frame_limits(self) -> tuple[int, int]:
+        """Frame duration limits (us); exposure may lower the frame rate to 10fps in the dark"""
+        duration = int(1000000 / self.profile['fps'])
+        return (duration, max(duration, 100000))
+
+    def __get_quality(self):
+        """Encoder quality of the current profile (None = encoder default)"""
+        return getattr(picamera2.encoders.Quality, self.profile['quality']) if self.profile['quality'] else None
+
+
+# ================================================================
+class QualityController:
+    """
+    Decide which stream profile to use, based on how long the clients wait
+    for their frames to be sent and how many frames they had to skip (signs
+    that the network can't keep up), and the CPU load.
+    Quality is lowered as soon as there is a problem, and raised again only
+    after several good intervals. If a higher profile fails soon after being
+    tried, the wait before trying it again is doubled.
+    """
+
+    def __init__(self, profiles: list[dict], index: int | None = None):
+        """
+        Constructor
+        :param profiles: List of stream profiles, from lowest to highest bandwidth
+        :param index: Index of the initial profile (None = highest)
+        """
+        self.profiles = profiles
+        self.index = len(profiles) - 1 if index is None else index
+        self.good_intervals: int = 0
+        self.step_up_intervals: int = STEP_UP_INTERVALS
+        self.since_step_up: int | None = None
+
+    @property
+    def profile(self) -> dict:
+        return self.profiles[self.index]
+
+    def update(self, skip_ratio: float | None, send_load: float | None, cpu_load: float | None) -> bool:
+        """
+        Check the measurements of the last interval
+        :param skip_ratio: Highest fraction of frames skipped by a client (None = no clients)
+        :param send_load: Highest fraction of the time a client spent sending (None = no clients)
+        :param cpu_load: Fraction of time the CPU was busy (None = unknown)
+        :return: True if the profile has changed, False otherwise
+        """
+        if skip_ratio is None or send_load is None:
+            self.good_intervals = 0
+            return False
+
+        overloaded = (skip_ratio > SKIP_RATIO_HIGH or send_load > SEND_LOAD_HIGH
+                      or (cpu_load is not None and cpu_load > CPU_LOAD_HIGH))
+        idle = (skip_ratio < SKIP_RATIO_LOW and send_load < SEND_LOAD_LOW
+                and (cpu_load is None or cpu_load < CPU_LOAD_LOW))
+
+        # Buffers can hide a problem for a while, so a step up counts
+        # as failed if there is a problem within the next few intervals
+        if self.since_step_up is not None:
+            self.since_step_up += 1
+
+        if overloaded:
+            if self.since_step_up is not None and self.since_step_up <= STEP_UP_INTERVALS:
+                self.step_up_intervals = min(self.step_up_intervals * 2, MAX_STEP_UP_INTERVALS)
+            self.since_step_up = None
+            self.good_intervals = 0
+            if self.index > 0:
+                self.index -= 1
+                return True
+            return False
+
+        if self.since_step_up is not None and self.since_step_up > STEP_UP_INTERVALS:
+            self.step_up_intervals = STEP_UP_INTERVALS
+            self.since_step_up = None
+
+        self.good_intervals = self.good_intervals + 1 if idle else 0
+
+        if self.good_intervals >= self.step_up_intervals and self.index < len(self.profiles) - 1:
+            self.index += 1
+            self.good_intervals = 0
+            self.since_step_up = 0
+            return True
+
+        return False
+
+
 # ================================================================
 class PiCameraStreamer:
     """Class to manage starting and stopping the Pi Camera stream"""
 
     stream_active: bool = False
     stream_thread: Thread | None = None
-    picam2: Picamera2 | None = None
+    adapt_thread: Thread | None = None
     #output: StreamingOutput | None = None
-    streaming_server: StreamingServer | None = None
+    streaming_server: StreamingServer | AsyncStreamingServer | None = None
 
-    def __init__(self):
-        """Constructor"""
-        pass
+    def __init__(self, adaptive: bool = False, backend: CameraBackend | None = None, port: int = 8080,
+                 server_type: str = "threaded"):
+        """
+        Constructor
+        :param adaptive: Adjust the stream quality to the client bandwidth and CPU load
+        :param backend: Source of the camera frames (None = Raspberry Pi camera)
+        :param port: Port of the streaming server
+        :param server_type: "threaded" = one thread per client, "async" = single asyncio event loop
+        """
+        self.adaptive = adaptive
+        self.backend = backend if backend is not None else Picamera2Backend()
+        self.port = port
+        self.server_type = server_type
+        self.controller = QualityController(STREAM_PROFILES)
+        self.exit_flag = Event()
+        self.cpu_load: float | None = None
+        self.metrics_sample: tuple[str, float, int] | None = None
+
+        # Requests only set the target state, which the worker thread then carries out
+        self.state: str = CAMERA_STOPPED
+        self.state_error: str = ""
+        self.state_id: int = 0
+        self.target: bool | None = None
+        self.prepare_requested: bool = False
+        self.state_condition = Condition()
+        self.state_listeners: list = []
+        self.worker: Thread | None = None
 
     # ------------------------------------------------------------
     def is_stream_active(self) -> bool:
@@ -114,7 +792,7 @@ class PiCameraStreamer:
         :return: True is camera stream is active, False otherwise
         """
         global output
-        return (self.stream_active and self.picam2 is not None and output is not None 
+        return (self.stream_active and self.backend.is_active() and output is not None 
             and self.streaming_server is not None and self.stream_thread is not None)
 
     # ------------------------------------------------------------
@@ -128,19 +806,23 @@ class PiCameraStreamer:
 
         try:
             if self.stop_stream():
-                self.picam2 = Picamera2()
                 output = StreamingOutput()
+                self.backend.start(output, self.controller.profile)
 
-                self.picam2.configure(self.picam2.create_video_configuration(main={"size": (640, 480)}))
-                self.picam2.set_controls({"FrameDurationLimits":(33333,100000),"ExposureValue":6.0, "Brightness":0.1})
-                self.picam2.start_recording(MJPEGEncoder(), FileOutput(output))
-
-                address = ('', 8080)
-                self.streaming_server = StreamingServer(address, StreamingHandler)
+                address = ('', self.port)
+                if self.server_type == "async":
+                    self.streaming_server = AsyncStreamingServer(address)
+                else:
+                    self.streaming_server = StreamingServer(address, StreamingHandler)
                 self.stream_thread = Thread(target = self.__stream_thread)
                 self.stream_thread.start()
                 self.stream_active = True
 
+                if self.adaptive:
+                    self.exit_flag.clear()
+                    self.adapt_thread = Thread(target = self.__adapt_thread, daemon=True)
+                    self.adapt_thread.start()
+
         except Exception as ex:
             error = repr(ex)
             logging.error(f'Failed to start PiCamera2 stream: {repr(ex)}')
@@ -148,6 +830,121 @@ class PiCameraStreamer:
 
         return (self.is_stream_active(), error)
 
+    # ------------------------------------------------------------
+    def get_client_stats(self) -> list[dict]:
+        """
+        Get the statistics of each client viewing the stream
+        :return: List of dictionaries containing the client statistics
+        """
+        global output
+        return output.get_client_stats() if output is not None else []
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the state of the stream and the active profile
+        :return: Dictionary containing the stream status
+        """
+        profile = self.controller.profile
+        return {
+            'active': self.is_stream_active(),
+            'adaptive': self.adaptive,
+            'profile': profile['name'],
+            'size': list(profile['size']),
+            'fps': profile['fps'],
+            'cpu': None if self.cpu_load is None else round(self.cpu_load, 2),
+            'clients': self.get_client_stats(),
+            **self.get_state(),
+        }
+
+    # ------------------------------------------------------------
+    def request_start(self) -> dict:
+        """
+        Ask the worker thread to start the stream, without waiting for it
+        :return: The camera state, see get_state()
+        """
+        return self.__request(True)
+
+    # ------------------------------------------------------------
+    def request_stop(self) -> dict:
+        """
+        Ask the worker thread to stop the stream, without waiting for it
+        :return: The camera state, see get_state()
+        """
+        return self.__request(False)
+
+    # ------------------------------------------------------------
+    def request_toggle(self) -> dict:
+        """
+        Start the stream if it is stopped or has failed, otherwise stop it
+        :return: The camera state, see get_state()
+        """
+        with self.state_condition:
+            running = self.state in (CAMERA_STARTING, CAMERA_RUNNING)
+        return self.__request(not running)
+
+    # ------------------------------------------------------------
+    def warm_up(self):
+        """Open the camera and prepare its configuration in the background, so the first start is quick"""
+        with self.state_condition:
+            self.prepare_requested = True
+            self.__start_worker()
+            self.state_condition.notify_all()
+
+    # ------------------------------------------------------------
+    def get_state(self) -> dict:
+        """
+        Get the state of the camera
+        :return: Dictionary with the state ("stopped", "starting", "running", "stopping" or "error"),
+                 the error message of a failed start, and an id which increases with every change
+        """
+        with self.state_condition:
+            return {'state': self.state, 'error': self.state_error, 'id': self.state_id}
+
+    # ------------------------------------------------------------
+    def add_listener(self, listener):
+        """
+        Register a function which is called (from the worker thread) whenever the state changes
+        :param listener: Function which receives the dictionary of get_state()
+        """
+        with self.state_condition:
+            self.state_listeners = self.state_listeners + [listener]
+
+    # ------------------------------------------------------------
+    def collect_metrics(self) -> list[tuple]:
+        """
+        Get the stream metrics, for MetricsRegistry.add_collector()
+        The encoder frame rate is measured since the previous call (or since the stream started).
+        :return: List of (name, type, help, samples)
+        """
+        stream = output
+        if stream is None:
+            return [('camera_active', 'gauge', 'Camera stream is running', [({}, 0)])]
+
+        now = time.monotonic()
+        sequence = stream.sequence
+        if self.metrics_sample is not None and self.metrics_sample[0] == stream.stream_id and now > self.metrics_sample[1]:
+            fps = (sequence - self.metrics_sample[2]) / (now - self.metrics_sample[1])
+        else:
+            fps = sequence / max(now - stream.started, 1e-6)
+        self.metrics_sample = (stream.stream_id, now, sequence)
+
+        clients = stream.get_client_stats()
+        return [
+            ('camera_active', 'gauge', 'Camera stream is running', [({}, int(self.is_stream_active()))]),
+            ('camera_frames_produced', 'counter', 'MJPEG frames produced by the encoder since the stream started',
+             [('camera_frames_produced_total', {}, sequence)]),
+            ('camera_encoder_fps', 'gauge', 'Encoder frame rate since the previous scrape', [({}, round(fps, 2))]),
+            ('camera_profile_fps', 'gauge', 'Frame rate of the active stream profile', [({}, self.controller.profile['fps'])]),
+            ('camera_clients', 'gauge', 'Clients viewing the stream', [({}, len(clients))]),
+            ('camera_client_frames_sent', 'counter', 'Frames sent to each stream client',
+             [('camera_client_frames_sent_total', {'client': c['address']}, c['frames_sent']) for c in clients]),
+            ('camera_client_frames_skipped', 'counter', 'Frames each stream client skipped because it was too slow',
+             [('camera_client_frames_skipped_total', {'client': c['address']}, c['frames_skipped']) for c in clients]),
+            ('camera_client_bytes_sent', 'counter', 'Bytes sent to each stream client',
+             [('camera_client_bytes_sent_total', {'client': c['address']}, c['bytes_sent']) for c in clients]),
+        ]
+
     # ------------------------------------------------------------
     def stop_stream(self) -> bool:
         """
@@ -156,11 +953,13 @@ class PiCameraStreamer:
         """
         try:
             global output
-            
-            if self.picam2 is not None:
-                self.picam2.stop_recording()
-                self.picam2.close()
-                self.picam2 = None
+
+            if self.adapt_thread is not None:
+                self.exit_flag.set()
+                self.adapt_thread.join(1)
+                self.adapt_thread = None
+
+            self.backend.stop()
                 
             if self.streaming_server is not None:
                 self.streaming_server.shutdown()
@@ -180,6 +979,92 @@ class PiCameraStreamer:
 
         return not self.is_stream_active()
 
+    # ------------------------------------------------------------
+    def __request(self, start: bool) -> dict:
+        """Set the target state, showing the transition straight away"""
+        with self.state_condition:
+            self.target = start
+            if start and self.state not in (CAMERA_STARTING, CAMERA_RUNNING):
+                changed = self.__update_state(CAMERA_STARTING, "")
+            elif not start and self.state not in (CAMERA_STOPPING, CAMERA_STOPPED):
+                changed = self.__update_state(CAMERA_STOPPING, "")
+            else:
+                changed = None
+            self.__start_worker()
+            self.state_condition.notify_all()
+
+        if changed is not None:
+            self.__notify_listeners(changed)
+        return self.get_state()
+
+    # ------------------------------------------------------------
+    def __start_worker(self):
+        """Start the worker thread on first use (called with the state lock held)"""
+        if self.worker is None:
+            self.worker = Thread(target=self.__worker_thread, daemon=True)
+            self.worker.start()
+
+    # ------------------------------------------------------------
+    def __set_state(self, state: str, error: str = ""):
+        """Change the state and tell the listeners, unless nothing has changed"""
+        with self.state_condition:
+            changed = self.__update_state(state, error) if (state, error) != (self.state, self.state_error) else None
+        if changed is not None:
+            self.__notify_listeners(changed)
+
+    # ------------------------------------------------------------
+    def __update_state(self, state: str, error: str) -> dict:
+        """Change the state (called with the state lock held), returning the new state"""
+        self.state = state
+        self.state_error = error
+        self.state_id += 1
+        self.state_condition.notify_all()
+        return {'state': state, 'error': error, 'id': self.state_id}
+
+    # ------------------------------------------------------------
+    def __notify_listeners(self, state: dict):
+        """Pass a new state to the listeners"""
+        for listener in self.state_listeners:
+            try:
+                listener(state)
+            except Exception as ex:
+                logging.error(f'Camera state listener failed: {repr(ex)}')
+
+    # ------------------------------------------------------------
+    def __worker_thread(self):
+        """Carry out the requested changes of state one at a time, so slow camera operations never block a request"""
+        while True:
+            with self.state_condition:
+                while self.target is None and not self.prepare_requested:
+                    self.state_condition.wait()
+                target, self.target = self.target, None
+                prepare, self.prepare_requested = self.prepare_requested, False
+
+            if prepare and not self.is_stream_active():
+                try:
+                    self.backend.prepare(self.controller.profile)
+                except Exception as ex:
+                    logging.warning(f'Unable to prepare the camera: {repr(ex)}')
+
+            # Only the newest request counts, so a quick start-stop-start only starts the camera once
+            if target is True and not self.is_stream_active():
+                self.__set_state(CAMERA_STARTING)
+                active, error = self.start_stream()
+                if active:
+                    self.__set_state(CAMERA_RUNNING)
+                else:
+                    self.__set_state(CAMERA_ERROR, error or "Unable to start the stream")
+
+            elif target is True:
+                self.__set_state(CAMERA_RUNNING)
+
+            elif target is False:
+                self.__set_state(CAMERA_STOPPING)
+                if self.stop_stream():
+                    self.__set_state(CAMERA_STOPPED)
+                else:
+                    self.__set_state(CAMERA_ERROR, "Unable to stop the stream")
+
     # ------------------------------------------------------------
     def __stream_thread(self):
         """Run the streaming server in a thread"""
@@ -188,6 +1073,46 @@ class PiCameraStreamer:
         except KeyboardInterrupt:
             pass
 
+    # ------------------------------------------------------------
+    def __adapt_thread(self):
+        """Periodically check the client and CPU load, and change the profile if needed"""
+        last_counts: dict[StreamingClient, tuple[int, int, float]] = {}
+        last_cpu = read_cpu_times()
+        last_check = time.perf_counter()
+        stream = output
+
+        while not self.exit_flag.wait(ADAPT_INTERVAL):
+            # Frames skipped and time spent sending by the slowest client since the last check
+            skip_ratio = None
+            send_load = None
+            with stream.clients_lock:
+                clients = list(stream.clients)
+
+            now = time.perf_counter()
+            counts = {client: (client.frames_sent, client.frames_skipped, client.send_time) for client in clients}
+            for client, (sent, skipped, send_time) in counts.items():
+                last_sent, last_skipped, last_send_time = last_counts.get(client, (0, 0, 0.0))
+                frames = (sent - last_sent) + (skipped - last_skipped)
+                if frames > 0:
+                    skip_ratio = max(skip_ratio or 0, (skipped - last_skipped) / frames)
+                    send_load = max(send_load or 0, (send_time - last_send_time) / (now - last_check))
+            last_counts = counts
+            last_check = now
+
+            cpu = read_cpu_times()
+            if cpu is not None and last_cpu is not None and cpu[1] > last_cpu[1]:
+                self.cpu_load = (cpu[0] - last_cpu[0]) / (cpu[1] - last_cpu[1])
+            last_cpu = cpu
+
+            if self.controller.update(skip_ratio, send_load, self.cpu_load):
+                profile = self.controller.profile
+                logging.info(f'Changing stream profile to {profile["name"]} (skipped: {skip_ratio:.0%}, '
+                             f'sending: {send_load:.0%}, CPU: {self.cpu_load or 0:.0%})')
+                try:
+                    self.backend.apply(profile)
+                except Exception as ex:
+                    logging.error(f'Failed to change stream profile: {repr(ex)}')
+
 
 """
 if not streaming and :
@@ -0,0 +1,259 @@
+#############################################
+# Wall-e Robot Web-interface
+#
+# @file       serial_ports.py
+# @brief      Cached list of serial ports, updated when devices are plugged in or removed
+# @author     Simon Bluett
+# @website    https://wired.chillibasket.com
+# @copyright  Copyright (C) 2021-2024 - Distributed under MIT license
+#############################################
+
+import os
+import time
+import logging
+from collections import deque
+from threading import Event, Lock, Thread
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the watched folder for new or removed devices
+WATCH_INTERVAL: float = 1.0
+
+# Seconds after which the ports are enumerated again even if the watched
+# folder hasn't changed (or how old the cached list can get without a watcher)
+FULL_SCAN_INTERVAL: float = 30.0
+
+# Number of change events which are remembered
+MAX_EVENTS: int = 50
+
+
+
+###############################################################
+#
+# Port Registry Class
+#
+###############################################################
+
+class PortRegistry:
+    """Keep track of the connected serial ports, so callers don't need to walk sysfs"""
+
+    # ---------------------------------------------------------
+    def __init__(self, enumerator=None, watch_path: str | None = "/dev",
+                 interval: float = WATCH_INTERVAL):
+        """
+        Constructor
+        :param enumerator: Function returning the list of ports, whose items have
+                           "device" and "description" attributes (default: pyserial comports)
+        :param watch_path: Folder whose modification time changes when devices are added
+                           or removed (None = enumerate the ports at every interval)
+        :param interval: Seconds between checks by the watcher thread
+        """
+        self.enumerator = enumerator if enumerator is not None else list_ports
+        self.watch_path: str | None = watch_path
+        self.interval: float = interval
+        self.ports: list = []
+        self.version: int = 0
+        self.scan_time: float | None = None
+        self.watch_mtime: int | None = None
+        self.events: deque = deque(maxlen=MAX_EVENTS)
+        self.listeners: list = []
+        self.lock: Lock = Lock()
+        self.exit_flag: Event = Event()
+        self.watcher_thread: Thread | None = None
+        self.scans: int = 0
+
+    # ---------------------------------------------------------
+    def get_ports(self) -> list:
+        """
+        Get the cached list of serial ports
+        If the watcher thread isn't running, the list is refreshed once it is too old.
+        :return: List of port information objects
+        """
+        if not self.is_watching():
+            if self.scan_time is None or time.monotonic() - self.scan_time > FULL_SCAN_INTERVAL:
+                self.refresh()
+            elif self.watch_path is not None and self.__get_watch_mtime() != self.watch_mtime:
+                self.refresh()
+        return self.ports
+
+    # ---------------------------------------------------------
+    def get_devices(self) -> list[str]:
+        """
+        Get the device paths of the serial ports
+        :return: List of device paths, such as "/dev/ttyACM0"
+        """
+        return [p.device for p in self.get_ports()]
+
+    # ---------------------------------------------------------
+    def get_descriptions(self) -> list[str]:
+        """
+        Get the descriptions of the serial ports
+        :return: List of port descriptions, in the same order as get_devices()
+        """
+        return [p.description for p in self.get_ports()]
+
+    # ---------------------------------------------------------
+    def find_port(self, name: str) -> int | None:
+        """
+        Find a port using its device path, or part of its description
+        :param name: The device path or description to look for
+        :return: Index of the port in the list, or None if it isn't connected
+        """
+        for index, port in enumerate(self.get_ports()):
+            if port_matches(port, name):
+                return index
+        return None
+
+    # ---------------------------------------------------------
+    def refresh(self) -> bool:
+        """
+        Enumerate the serial ports, and notify the listeners of any changes
+        :return: True if ports were added or removed
+        """
+        with self.lock:
+            self.watch_mtime = self.__get_watch_mtime()
+
+            try:
+                ports = sorted(self.enumerator(), key=lambda p: p.device)
+            except Exception as ex:
+                logger.error(f'Unable to list serial ports: {repr(ex)}')
+                return False
+
+            self.scan_time = time.monotonic()
+            self.scans += 1
+
+            old_devices = {p.device for p in self.ports}
+            new_devices = {p.device for p in ports}
+            added = [p for p in ports if p.device not in old_devices]
+            removed = [p for p in self.ports if p.device not in new_devices]
+            self.ports = ports
+
+            if not added and not removed:
+                return False
+
+            self.version += 1
+            self.events.append({'version': self.version, 'time': time.time(),
+                                'added': [p.device for p in added], 'removed': [p.device for p in removed]})
+            listeners = list(self.listeners)
+
+        for port in added:
+            logger.info(f'Serial port added: {port.device} ({port.description})')
+        for port in removed:
+            logger.info(f'Serial port removed: {port.device}')
+
+        for listener in listeners:
+            try:
+                listener(added, removed)
+            except Exception as ex:
+                logger.error(f'Serial port listener error: {repr(ex)}')
+
+        return True
+
+    # ---------------------------------------------------------
+    def add_listener(self, listener):
+        """
+        Register a function which is called when ports are added or removed
+        :param listener: Function receiving the lists of added and removed ports
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    # ---------------------------------------------------------
+    def get_events(self, since: int = 0) -> list[dict]:
+        """
+        Get the recent changes to the list of ports
+        :param since: Only return changes newer than this version
+        :return: List of events containing the version, time, and added and removed devices
+        """
+        self.get_ports()
+        with self.lock:
+            return [event for event in self.events if event['version'] > since]
+
+    # ---------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the registry statistics
+        :return: Dictionary containing the number of ports, list version and number of scans
+        """
+        return {'ports': len(self.ports), 'version': self.version, 'scans': self.scans,
+                'watching': self.is_watching()}
+
+    # ---------------------------------------------------------
+    def start(self):
+        """Start the background thread which watches for added or removed devices"""
+        if not self.is_watching():
+            self.exit_flag.clear()
+            self.refresh()
+            self.watcher_thread = Thread(target=self.__watcher_thread, daemon=True)
+            self.watcher_thread.start()
+
+    # ---------------------------------------------------------
+    def stop(self):
+        """Stop the background watcher thread"""
+        self.exit_flag.set()
+        if self.watcher_thread is not None:
+            self.watcher_thread.join()
+            self.watcher_thread = None
+
+    # ---------------------------------------------------------
+    def is_watching(self) -> bool:
+        """
+        Check if the watcher thread is running
+        :return: True if the thread is running, False otherwise
+        """
+        return self.watcher_thread is not None and self.watcher_thread.is_alive()
+
+    # ---------------------------------------------------------
+    def __get_watch_mtime(self) -> int | None:
+        """
+        Get the modification time of the watched folder
+        :return: Modification time in nanoseconds, or None if not available
+        """
+        if self.watch_path is None:
+            return None
+        try:
+            return os.stat(self.watch_path).st_mtime_ns
+        except OSError:
+            return None
+
+    # ---------------------------------------------------------
+    def __watcher_thread(self):
+        """
+        Enumerate the ports whenever a device node is created or removed
+        """
+        logger.info('Starting serial port watcher thread')
+
+        while not self.exit_flag.wait(self.interval):
+            if (self.watch_path is None or self.__get_watch_mtime() != self.watch_mtime
+                    or self.scan_time is None or time.monotonic() - self.scan_time > FULL_SCAN_INTERVAL):
+                self.refresh()
+
+        logger.info('Stopping serial port watcher thread')
+
+
+
+###############################################################
+#
+# Helper Functions
+#
+###############################################################
+
+def port_matches(port, name: str) -> bool:
+    """
+    Check whether a port has the given device path or description
+    :param port: Port information object
+    :param name: The device path, or part of the description
+    :return: True if the port matches
+    """
+    return port.device == name or (name != "" and name in (port.description or ""))
+
+
+def list_ports() -> list:
+    """
+    Enumerate the serial ports using pyserial
+    The port listing is only imported when it is first needed, to keep startup fast
+    :return: List of port information objects
+    """
+    import serial.tools.list_ports
+    return serial.tools.list_ports.comports()
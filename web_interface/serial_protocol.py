@@ -0,0 +1,210 @@
+"""
+Compact binary serial protocol for the Wall-e Arduino
+
+Several commands can be batched into a single frame:
+
+    0xA5 | seq | flags | count | count x (command, int16 value) | crc8
+
+- seq:   Sequence number (0-255) which the device uses in its replies
+- flags: FLAG_ACK asks the device to reply "Ack_<seq>" once the frame
+         has been processed, and FLAG_ECHO to echo every command like
+         the text protocol does. Without flags the device stays silent.
+- value: Little-endian signed 16-bit integer
+- crc8:  CRC-8 (polynomial 0x07) of everything between the start byte
+         and the checksum. Invalid frames are answered with "Nack_<seq>"
+
+The original text protocol ("X50\\n") can still be mixed with frames,
+since the start byte can never appear in a text command. The host asks
+for the binary protocol by sending "V2"; firmware which supports it
+replies "Protocol_2", while older firmware only echoes the command.
+"""
+
+import struct
+
+
+FRAME_START = 0xA5
+PROTOCOL_VERSION = 2
+FLAG_ACK = 0x01
+FLAG_ECHO = 0x02
+MAX_FRAME_COMMANDS = 8     # Must match the frame buffer size in wall-e.ino
+HEADER_LENGTH = 3          # seq, flags, count
+COMMAND_LENGTH = 3         # command character and int16 value
+
+
+# ----------------------------------------------------------------
+def crc8(data: bytes) -> int:
+    """
+    Calculate the CRC-8 checksum used by the frames
+    :param data: The bytes to be checked
+    :return: The checksum (0-255)
+    """
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+# ----------------------------------------------------------------
+def parse_command(command: str) -> tuple[str, int] | None:
+    """
+    Split a text command into its character and number
+    :param command: Text command, such as "X50" or "w"
+    :return: Tuple of (character, value), or None if it can't be encoded
+    """
+    if not command or not command[0].isascii() or not command[0].isalpha():
+        return None
+
+    if len(command) == 1:
+        return (command[0], 0)
+
+    try:
+        value = int(command[1:])
+    except ValueError:
+        return None
+
+    if value < -32768 or value > 32767:
+        return None
+    return (command[0], value)
+
+
+# ----------------------------------------------------------------
+def encode_frame(seq: int, commands: list[tuple[str, int]], flags: int = 0) -> bytes:
+    """
+    Build a single frame
+    :param seq:      Sequence number of the frame
+    :param commands: Up to MAX_FRAME_COMMANDS (character, value) pairs
+    :param flags:    Combination of FLAG_ACK and FLAG_ECHO
+    :return: The encoded frame
+    """
+    if len(commands) > MAX_FRAME_COMMANDS:
+        raise ValueError(f'A frame can contain at most {MAX_FRAME_COMMANDS} commands')
+
+    body = bytearray((seq & 0xFF, flags, len(commands)))
+    for character, value in commands:
+        body += struct.pack('<ch', character.encode(), value)
+
+    return bytes((FRAME_START,)) + bytes(body) + bytes((crc8(body),))
+
+
+# ----------------------------------------------------------------
+def encode_commands(commands: list[str], seq: int, flags: int = 0) -> tuple[bytes, int, list[int]]:
+    """
+    Encode a batch of text commands, preserving their order
+    Commands which don't fit the binary format are sent as text lines.
+    :param commands: List of text commands
+    :param seq:      Sequence number of the first frame
+    :param flags:    Flags which are set on every frame
+    :return: Tuple of (data to send, next sequence number, list of frame sequence numbers)
+    """
+    data = bytearray()
+    pending: list[tuple[str, int]] = []
+    sequences: list[int] = []
+
+    def flush():
+        nonlocal seq
+        if pending:
+            data.extend(encode_frame(seq, pending, flags))
+            sequences.append(seq)
+            seq = (seq + 1) & 0xFF
+            pending.clear()
+
+    for command in commands:
+        parsed = parse_command(command)
+
+        if parsed is None:
+            flush()
+            data.extend(command.encode() + b'\n')
+        else:
+            pending.append(parsed)
+            if len(pending) == MAX_FRAME_COMMANDS:
+                flush()
+
+    flush()
+    return (bytes(data), seq, sequences)
+
+
+# ================================================================
+class FrameDecoder:
+    """
+    Incrementally decode a byte stream containing frames and text lines,
+    in the same way as the parser in wall-e.ino
+    """
+
+    def __init__(self, max_line_length: int | None = None):
+        """
+        Constructor
+        :param max_line_length: Text lines are cut off at this length, like
+                                MAX_SERIAL_LENGTH in wall-e.ino (None = no limit)
+        """
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+        self.in_frame = False
+        self.expected = 0
+
+    # ------------------------------------------------------------
+    def feed(self, data: bytes) -> list[tuple]:
+        """
+        Decode received bytes
+        :param data: The bytes which were received
+        :return: List of decoded items, each of which is one of:
+                 ('text', line), ('frame', seq, flags, [(character, value), ...])
+                 or ('error', seq)
+        """
+        results = []
+
+        for byte in data:
+            if self.in_frame:
+                self.buffer.append(byte)
+
+                if len(self.buffer) == HEADER_LENGTH:
+                    count = self.buffer[2]
+                    if count > MAX_FRAME_COMMANDS:
+                        results.append(('error', self.buffer[0]))
+                        self.__reset()
+                        continue
+                    self.expected = HEADER_LENGTH + COMMAND_LENGTH * count + 1
+
+                if self.expected and len(self.buffer) == self.expected:
+                    results.append(self.__decode_frame())
+                    self.__reset()
+
+            elif byte == FRAME_START and not self.buffer:
+                self.in_frame = True
+
+            elif byte in (0x0A, 0x0D):
+                if self.buffer:
+                    results.append(('text', self.buffer.decode(errors='replace')))
+                self.buffer.clear()
+
+            else:
+                self.buffer.append(byte)
+                if self.max_line_length is not None and len(self.buffer) == self.max_line_length:
+                    results.append(('text', self.buffer.decode(errors='replace')))
+                    self.buffer.clear()
+
+        return results
+
+    # ------------------------------------------------------------
+    def __decode_frame(self) -> tuple:
+        """Check the checksum and unpack the commands of a complete frame"""
+        seq, flags, count = self.buffer[0], self.buffer[1], self.buffer[2]
+
+        if crc8(self.buffer[:-1]) != self.buffer[-1]:
+            return ('error', seq)
+
+        commands = []
+        for i in range(count):
+            offset = HEADER_LENGTH + COMMAND_LENGTH * i
+            character, value = struct.unpack_from('<ch', self.buffer, offset)
+            commands.append((character.decode(errors='replace'), value))
+
+        return ('frame', seq, flags, commands)
+
+    # ------------------------------------------------------------
+    def __reset(self):
+        """Prepare to receive the next frame or line"""
+        self.buffer.clear()
+        self.in_frame = False
+        self.expected = 0
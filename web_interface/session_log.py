@@ -0,0 +1,414 @@
+"""
+Record and replay of the commands sent to the Arduino
+
+While recording, every command passed to ArduinoDevice.send_command()
+(or a group passed to send_commands()) and every message received from
+the Arduino is logged with the time since the recording started. The
+serial threads only append to a deque; the lines are formatted and
+written by a background thread, so recording doesn't slow them down.
+
+A recording is split into numbered segment files, and a new segment is
+started when one reaches the maximum size. Only the newest segments
+are kept, and recording again under the same name replaces them. Each
+segment is line-delimited text:
+
+    #session 1718000000.123           (start of the recording, epoch seconds)
+    1042.7 > X50                      (milliseconds, command sent)
+    1043.9 < X50                      (milliseconds, message received)
+    1500.0 > K50 G40 P                (group of commands sent together)
+
+The replayer sends the commands of a recording through the command
+queue again, at their recorded times (scaled by a speed factor) or as
+fast as possible, giving repeatable demo routines and a repeatable
+load for profiling the serial link.
+"""
+
+import os
+import re
+import time
+import logging
+from collections import deque
+from threading import Thread, Event, Lock
+
+
+FLUSH_INTERVAL = 0.5        # Seconds between writes of the recorded lines
+SENT = ">"                  # Direction of commands sent to the Arduino
+RECEIVED = "<"              # Direction of messages received from the Arduino
+
+# Replay states
+IDLE = "idle"
+PLAYING = "playing"
+FINISHED = "finished"
+STOPPED = "stopped"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------
+def check_name(name: str):
+    """
+    Make sure a recording name can't point outside its folder
+    :param name: Name of the recording
+    :raises ValueError: If the name is invalid
+    """
+    if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_-]{0,63}', name):
+        raise ValueError('Recording names can only contain letters, numbers, "-" and "_"')
+
+
+# ----------------------------------------------------------------
+def list_segments(folder: str, name: str) -> list[str]:
+    """
+    Find the segment files of a recording
+    :param folder: Folder containing the recordings
+    :param name: Name of the recording
+    :return: Paths of the segments, oldest first
+    """
+    check_name(name)
+    if not os.path.isdir(folder):
+        return []
+
+    pattern = re.compile(re.escape(name) + r'\.(\d+)\.log')
+    segments = []
+    for file_name in os.listdir(folder):
+        match = pattern.fullmatch(file_name)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(folder, file_name)))
+    return [path for _, path in sorted(segments)]
+
+
+# ----------------------------------------------------------------
+def list_recordings(folder: str) -> list[dict]:
+    """
+    Get the recordings in a folder
+    :param folder: Folder containing the recordings
+    :return: List of the name, number of segments and size in bytes of each recording
+    """
+    if not os.path.isdir(folder):
+        return []
+
+    recordings: dict[str, dict] = {}
+    for file_name in sorted(os.listdir(folder)):
+        match = re.fullmatch(r'([A-Za-z0-9][A-Za-z0-9_-]*)\.\d+\.log', file_name)
+        if match:
+            entry = recordings.setdefault(match.group(1), {'name': match.group(1), 'segments': 0, 'size': 0})
+            entry['segments'] += 1
+            entry['size'] += os.path.getsize(os.path.join(folder, file_name))
+    return list(recordings.values())
+
+
+# ----------------------------------------------------------------
+def read_recording(folder: str, name: str) -> list[tuple[float, str, str]]:
+    """
+    Read all the segments of a recording
+    :param folder: Folder containing the recordings
+    :param name: Name of the recording
+    :return: List of (milliseconds since the start, direction, text), in order
+    :raises FileNotFoundError: If there is no recording with this name
+    """
+    segments = list_segments(folder, name)
+    if not segments:
+        raise FileNotFoundError(f'No recording called {name}')
+
+    entries = []
+    for path in segments:
+        with open(path, encoding='utf-8', errors='replace') as file:
+            for line in file:
+                if line.startswith('#'):
+                    continue
+                parts = line.rstrip('\n').split(' ', 2)
+                if len(parts) == 3 and parts[1] in (SENT, RECEIVED):
+                    try:
+                        entries.append((float(parts[0]), parts[1], parts[2]))
+                    except ValueError:
+                        pass
+    return entries
+
+
+# ================================================================
+class SessionRecorder:
+    """Log the commands sent to the Arduino, and its replies, to segment files"""
+
+    def __init__(self, folder: str, max_size: int = 1024 * 1024, max_segments: int = 10):
+        """
+        Constructor
+        :param folder: Folder where the recordings are saved
+        :param max_size: Size in bytes at which a new segment is started
+        :param max_segments: Number of segments kept for each recording (older segments are deleted)
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.max_segments = max(1, max_segments)
+        self.lock = Lock()
+        self.entries: deque = deque()
+        self.name: str | None = None
+        self.start_time: float = 0.0
+        self.start_epoch: float = 0.0
+        self.thread: Thread | None = None
+        self.exit_flag = Event()
+        self.file = None
+        self.segment: int = 0
+        self.stats = {'sent': 0, 'received': 0, 'bytes': 0, 'segments': 0}
+
+    # ------------------------------------------------------------
+    def start(self, name: str = "") -> str:
+        """
+        Start a new recording, ending any recording in progress
+        An earlier recording with the same name is deleted
+        :param name: Name of the recording (blank = the current date and time)
+        :return: Name of the recording
+        :raises ValueError: If the name is invalid
+        """
+        name = name or time.strftime('session_%Y%m%d_%H%M%S')
+        check_name(name)
+        self.stop()
+
+        with self.lock:
+            # The times of each recording start from 0, so they can't be added to an earlier one
+            for old in list_segments(self.folder, name):
+                os.remove(old)
+            self.segment = 0
+            self.name = name
+            self.entries = deque()
+            self.stats = {'sent': 0, 'received': 0, 'bytes': 0, 'segments': 0}
+            self.start_time = time.monotonic()
+            self.start_epoch = time.time()
+            self.exit_flag = Event()
+            self.thread = Thread(target=self.__writer_thread, args=(name, self.entries, self.exit_flag), daemon=True)
+            self.thread.start()
+            logger.info(f'Recording session {name}')
+            return name
+
+    # ------------------------------------------------------------
+    def stop(self) -> str | None:
+        """
+        Stop recording, writing any remaining lines
+        :return: Name of the recording which was stopped, or None if nothing was recorded
+        """
+        with self.lock:
+            thread = self.thread
+            name = self.name
+            self.thread = None
+            self.name = None
+            self.exit_flag.set()
+
+        if thread is None:
+            return None
+        thread.join()
+        return name
+
+    # ------------------------------------------------------------
+    def is_recording(self) -> bool:
+        """
+        Check if a recording is in progress
+        :return: True if recording
+        """
+        return self.name is not None
+
+    # ------------------------------------------------------------
+    def record_command(self, command: str | list[str]):
+        """
+        Log a command (or group of commands) sent to the Arduino
+        :param command: The command, or list of commands sent together
+        """
+        if self.name is not None:
+            self.entries.append((time.monotonic(), SENT, command))
+
+    # ------------------------------------------------------------
+    def record_message(self, message: str):
+        """
+        Log a message received from the Arduino
+        :param message: The message, without the line ending
+        """
+        if self.name is not None:
+            self.entries.append((time.monotonic(), RECEIVED, message))
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the state of the recording
+        :return: Dictionary with the name, duration and counters of the current recording
+        """
+        with self.lock:
+            return dict(self.stats, name=self.name, recording=self.name is not None,
+                        elapsed=round(time.monotonic() - self.start_time, 3) if self.name is not None else 0)
+
+    # ------------------------------------------------------------
+    def __open_segment(self, name: str):
+        """Start a new segment file of a recording, and delete its oldest segments"""
+        if self.file is not None:
+            self.file.close()
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f'{name}.{self.segment}.log')
+        self.file = open(path, 'a', encoding='utf-8')
+        header = f'#session {self.start_epoch:.3f}\n'
+        self.file.write(header)
+        self.stats['bytes'] += len(header)
+        self.stats['segments'] += 1
+        self.segment += 1
+
+        for old in list_segments(self.folder, name)[:-self.max_segments]:
+            os.remove(old)
+
+    # ------------------------------------------------------------
+    def __writer_thread(self, name: str, entries: deque, exit_flag: Event):
+        """Write the recorded entries to the log every FLUSH_INTERVAL"""
+        size = 0
+
+        try:
+            self.__open_segment(name)
+
+            while True:
+                stopping = exit_flag.wait(FLUSH_INTERVAL)
+
+                lines = []
+                while entries:
+                    when, direction, text = entries.popleft()
+                    if direction == SENT:
+                        self.stats['sent'] += 1
+                        if type(text) is list:
+                            text = ' '.join(text)
+                    else:
+                        self.stats['received'] += 1
+                    lines.append(f'{(when - self.start_time) * 1000:.1f} {direction} {text}\n')
+
+                for line in lines:
+                    if size >= self.max_size:
+                        self.__open_segment(name)
+                        size = 0
+                    self.file.write(line)
+                    size += len(line)
+                    self.stats['bytes'] += len(line)
+                self.file.flush()
+
+                if stopping:
+                    break
+
+        except Exception as ex:
+            logger.error(f'Session recording error: {repr(ex)}')
+            self.name = None
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# ================================================================
+class SessionReplayer:
+    """Send the commands of a recording to the Arduino again"""
+
+    def __init__(self, arduino):
+        """
+        Constructor
+        :param arduino: The ArduinoDevice which receives the commands
+        """
+        self.arduino = arduino
+        self.lock = Lock()
+        self.thread: Thread | None = None
+        self.exit_flag = Event()
+        self.run_id: int = 0
+        self.status: dict = self.__new_status(IDLE, '', 0, 1.0)
+
+    # ------------------------------------------------------------
+    def play(self, name: str, entries: list[tuple[float, str, str]], speed: float = 1.0) -> int:
+        """
+        Start replaying a recording, stopping any replay in progress
+        :param name: Name of the recording
+        :param entries: Entries returned by read_recording()
+        :param speed: Speed factor (2 = twice as fast), or 0 to send the commands as fast as possible
+        :return: Id of this replay
+        """
+        commands = [(when, text) for when, direction, text in entries if direction == SENT]
+        self.stop()
+
+        with self.lock:
+            self.run_id += 1
+            self.exit_flag = Event()
+            self.status = self.__new_status(PLAYING, name, len(commands), speed)
+            self.thread = Thread(target=self.__replay_thread, args=(commands, speed, self.status, self.exit_flag),
+                                 daemon=True)
+            self.thread.start()
+            return self.run_id
+
+    # ------------------------------------------------------------
+    def stop(self) -> bool:
+        """
+        Stop the replay, and stop the motors
+        :return: True if a replay was in progress
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+            self.exit_flag.set()
+
+        if thread is None:
+            return False
+        thread.join()
+        return True
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the progress of the current (or last) replay
+        :return: Dictionary with the state, commands sent, and how late they were sent (in milliseconds)
+        """
+        with self.lock:
+            status = dict(self.status, id=self.run_id)
+
+        lateness = status.pop('lateness')
+        status['elapsed'] = round((status.pop('finished') or time.monotonic()) - status['started'], 3) if status['started'] else 0
+        status.pop('started')
+        status['timing'] = {
+            'mean_ms': round(sum(lateness) / len(lateness) * 1000, 3) if lateness else 0,
+            'max_ms': round(max(lateness) * 1000, 3) if lateness else 0,
+        }
+        return status
+
+    # ------------------------------------------------------------
+    def __new_status(self, state: str, name: str, commands: int, speed: float) -> dict:
+        """Status of a new replay"""
+        return {'state': state, 'name': name, 'commands': commands, 'sent': 0, 'speed': speed, 'error': '',
+                'lateness': [], 'started': time.monotonic() if state == PLAYING else None, 'finished': None}
+
+    # ------------------------------------------------------------
+    def __replay_thread(self, commands: list[tuple[float, str]], speed: float, status: dict, exit_flag: Event):
+        """Send each command at its recorded time"""
+        start = status['started']
+        first = commands[0][0] if commands else 0.0
+
+        try:
+            for when, text in commands:
+                if speed > 0:
+                    # Sleep until the command is due, unless the replay is stopped in the meantime
+                    due = (when - first) / 1000 / speed
+                    delay = start + due - time.monotonic()
+                    if delay > 0 and exit_flag.wait(delay):
+                        break
+                    status['lateness'].append(max(0.0, time.monotonic() - start - due))
+                if exit_flag.is_set():
+                    break
+
+                group = text.split(' ')
+                sent = self.arduino.send_command(group[0]) if len(group) == 1 else self.arduino.send_commands(group)
+                if not sent and not self.arduino.is_connected():
+                    raise RuntimeError('Arduino not connected')
+                status['sent'] += 1
+
+            else:
+                status['state'] = FINISHED
+
+        except Exception as ex:
+            status['error'] = str(ex)
+            status['state'] = FAILED
+            logger.error(f'Replay failed after {status["sent"]} commands: {repr(ex)}')
+
+        if status['state'] == PLAYING:
+            status['state'] = STOPPED
+
+        # Don't leave the robot driving when a replay is stopped part way through
+        if status['state'] != FINISHED and self.arduino.is_connected():
+            self.arduino.send_command("X0")
+            self.arduino.send_command("Y0")
+
+        status['finished'] = time.monotonic()
@@ -0,0 +1,185 @@
+"""
+Index of the sound clips in the sound folder
+
+Clip names follow the convention "group_name_duration", where the group
+and the duration (in milliseconds) are optional. The folder is only
+listed again when its modification time changes (a clip was added,
+removed or renamed), and then only new clips are examined. If a WAV
+file name has no duration, it is read from the file header instead.
+The catalog can also be provided as JSON, with an ETag which changes
+whenever the catalog does.
+"""
+
+import os
+import json
+import time
+import wave
+import hashlib
+import logging
+from threading import Lock
+
+
+CHECK_INTERVAL = 1.0     # Minimum seconds between checks of the folder's modification time
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------
+def parse_clip_name(clip: str) -> tuple[str, str, float | None]:
+    """
+    Get the details of a clip from its name
+    :param clip: File name of the clip, without the extension
+    :return: Tuple of (group, display name, duration in seconds or None if it isn't in the name)
+    """
+    group = "Other"
+    name = clip
+    duration = None
+
+    details = clip.split('_')
+
+    # Get item details from name, and make sure they are valid
+    if len(details) == 2:
+        if details[1].isdigit():
+            name = details[0]
+            duration = float(details[1]) / 1000.0
+        else:
+            group = details[0]
+            name = details[1]
+    elif len(details) == 3:
+        group = details[0]
+        name = details[1]
+        if details[2].isdigit():
+            duration = float(details[2]) / 1000.0
+
+    return (group, name, duration)
+
+
+# ----------------------------------------------------------------
+def read_wav_duration(path: str) -> float:
+    """
+    Read the duration of a WAV file from its header
+    :param path: Location of the file
+    :return: Duration in seconds, or 0 if the file can't be read
+    """
+    try:
+        with wave.open(path, 'rb') as file:
+            return round(file.getnframes() / file.getframerate(), 2)
+    except (OSError, EOFError, wave.Error, ZeroDivisionError) as ex:
+        logger.warning(f'Unable to read duration of {path}: {repr(ex)}')
+        return 0
+
+
+# ================================================================
+class SoundCatalog:
+    """Cached list of the sound clips in a folder"""
+
+    def __init__(self, sound_folder: str, sound_format: str = "wav"):
+        """
+        Constructor
+        :param sound_folder: Folder containing the sound clips
+        :param sound_format: File extension of the sound clips
+        """
+        self.sound_folder = sound_folder
+        self.sound_format = sound_format
+
+        self.clips: dict[str, tuple[str, str, str, float]] = {}
+        self.entries: list[tuple[str, str, str, float]] = []
+        self.folder_mtime: int | None = None
+        self.check_time: float = 0.0
+        self.json: bytes | None = None
+        self.etag: str | None = None
+        self.lock = Lock()
+        self.stats = {'scans': 0, 'clips_read': 0}
+
+    # ------------------------------------------------------------
+    def get_entries(self) -> list[tuple[str, str, str, float]]:
+        """
+        Get the list of clips, refreshing it if the folder has changed
+        :return: List of (group, clip, display name, duration in seconds), sorted by clip
+        """
+        self.refresh()
+        return self.entries
+
+    # ------------------------------------------------------------
+    def get_groups(self) -> list[tuple[str, int]]:
+        """
+        Get the clip groups
+        :return: List of (group, number of clips), sorted by group
+        """
+        counts: dict[str, int] = {}
+        for entry in self.get_entries():
+            counts[entry[0]] = counts.get(entry[0], 0) + 1
+        return sorted(counts.items())
+
+    # ------------------------------------------------------------
+    def get_json(self, group: str | None = None) -> tuple[bytes, str]:
+        """
+        Get the catalog as JSON
+        :param group: Only include the clips of this group (None = all clips)
+        :return: Tuple of (JSON document, ETag)
+        """
+        self.refresh()
+
+        with self.lock:
+            if group is None and self.json is not None:
+                return (self.json, self.etag)
+
+            entries = [entry for entry in self.entries if group in (None, entry[0])]
+            body = json.dumps({'sounds': [{'group': entry[0], 'clip': entry[1], 'name': entry[2], 'time': entry[3]}
+                                          for entry in entries]}).encode('utf-8')
+            etag = hashlib.sha1(body).hexdigest()
+
+            if group is None:
+                self.json, self.etag = body, etag
+            return (body, etag)
+
+    # ------------------------------------------------------------
+    def refresh(self, force: bool = False):
+        """
+        Update the catalog if the folder has been modified
+        :param force: Check the folder now, even if it was checked recently
+        """
+        now = time.monotonic()
+        if not force and now - self.check_time < CHECK_INTERVAL:
+            return
+
+        with self.lock:
+            self.check_time = now
+            mtime = os.stat(self.sound_folder).st_mtime_ns
+            if mtime == self.folder_mtime and not force:
+                return
+
+            extension = f'.{self.sound_format}'
+            filenames = {item for item in os.listdir(self.sound_folder) if item.endswith(extension)}
+
+            # Forget removed clips and examine new ones
+            self.clips = {filename: self.clips[filename] if filename in self.clips else self.__read_clip(filename)
+                          for filename in filenames}
+            self.entries = [self.clips[filename] for filename in sorted(filenames)]
+            self.folder_mtime = mtime
+            self.json = None
+            self.etag = None
+            self.stats['scans'] += 1
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the catalog statistics
+        :return: Dictionary containing the number of clips, folder scans and clips read
+        """
+        return dict(self.stats, clips=len(self.entries))
+
+    # ------------------------------------------------------------
+    def __read_clip(self, filename: str) -> tuple[str, str, str, float]:
+        """Get the details of a new clip"""
+        clip = os.path.splitext(filename)[0]
+        group, name, duration = parse_clip_name(clip)
+        self.stats['clips_read'] += 1
+
+        if duration is None:
+            if self.sound_format == "wav":
+                duration = read_wav_duration(os.path.join(self.sound_folder, filename))
+            else:
+                duration = 0
+
+        return (group, clip, name, duration)
@@ -0,0 +1,70 @@
+"""
+Startup-time profile of the web-interface
+
+Imports app.py in a fresh Python process with "-X importtime", and
+reports how long the import of each module took. The time of app.py
+itself includes creating the Arduino, audio, speech and camera objects.
+Run it after changing imports, to catch modules which slow down the
+start of walle.service (especially on a Pi Zero):
+    python3 app.py --profile-startup
+"""
+
+import os
+import sys
+import subprocess
+
+
+# ----------------------------------------------------------------
+def parse_import_times(lines: list[str]) -> list[tuple[str, int, int, int]]:
+    """
+    Read the output of "python -X importtime"
+    :param lines: Lines written to stderr by the profiled process
+    :return: List of (module, depth, self microseconds, cumulative microseconds), in import order
+    """
+    modules = []
+    for line in lines:
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(self_time), int(cumulative)))
+    return modules
+
+
+# ----------------------------------------------------------------
+def profile_startup(module: str = "app", top: int = 10) -> int:
+    """
+    Print the import time of a module and of the modules it imports
+    :param module: Name of the module to profile
+    :param top: Number of slowest individual modules to list
+    :return: Exit code of the profiled process
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=folder, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return result.returncode
+
+    modules = parse_import_times(result.stderr.splitlines())
+    index = next(i for i, entry in enumerate(modules) if entry[0] == module and entry[1] == 0)
+
+    # A module is listed after everything it imports, so its direct imports are
+    # the depth 1 entries between it and the previous top-level entry
+    start = index
+    while start > 0 and modules[start - 1][1] > 0:
+        start -= 1
+    children = [entry for entry in modules[start:index] if entry[1] == 1]
+    nested = modules[start:index + 1]
+
+    print(f'{"Imported by " + module:<32} {"Self (ms)":>10} {"Total (ms)":>11}')
+    for name, _, self_time, cumulative in sorted(children, key=lambda entry: -entry[3]):
+        print(f'{name:<32} {self_time / 1000:>10.1f} {cumulative / 1000:>11.1f}')
+    print(f'{module + " itself":<32} {modules[index][2] / 1000:>10.1f}')
+    print(f'{"Total":<32} {"":>10} {modules[index][3] / 1000:>11.1f}')
+
+    print(f'\n{"Slowest modules":<32} {"Self (ms)":>10}')
+    for name, _, self_time, _ in sorted(nested, key=lambda entry: -entry[2])[:top]:
+        print(f'{name:<32} {self_time / 1000:>10.1f}')
+
+    return 0
@@ -8,6 +8,15 @@ var workspace;
 var myInterpreter;
 var fileSelector;
 var runnerPid;
+var programSteps = [];
+var programStack = [];
+var programStepCount = 0;
+var currentBlock = '';
+var programId = -1;
+var programPrinted = 0;
+var maxCompileSteps = 2000000;
+var compileChunkSteps = 20000;
+var maxProgramSteps = 10000;
 
 /*
  * Init Blockly
@@ -79,13 +88,15 @@ function init_blocks() {
 
 /*
  * Create Wrapper functions for JS Interpreter,
- * so the blocks can call external functions
+ * so the blocks can call external functions.
+ * The program isn't run in the browser: the blocks are evaluated once,
+ * and each command is added to a list of steps which is run on the server
  */
 function initApi(interpreter, globalObject) {
     // Add an API function for the alert() block, generated for "text_print" blocks.
 
     const wrapperAlert = function(text) {
-        alert(arguments.length ? text : '');
+        addStep({"type": "print", "text": String(arguments.length ? text : '')});
     };
 
     interpreter.setProperty(
@@ -95,6 +106,7 @@ function initApi(interpreter, globalObject) {
     );
 
     // Add an API function for the prompt() block.
+    // The questions are asked before the program is uploaded
     const wrapperPrompt = function prompt(text) {
         return window.prompt(text);
     };
@@ -107,8 +119,7 @@ function initApi(interpreter, globalObject) {
 
     // Add an API function for highlighting blocks.
     const wrapperHighlight = function (id) {
-        id = String(id || '');
-        return highlightBlock(id);
+        currentBlock = String(id || '');
     };
 
     interpreter.setProperty(
@@ -120,20 +131,20 @@ function initApi(interpreter, globalObject) {
     // Add an API for the wait block
     javascript.javascriptGenerator.addReservedWords('waitForSeconds');
 
-    const wrapperWaitSeconds = interpreter.createAsyncFunction(
-        function (timeInSeconds, callback) {
-            // Delay the call to the callback.
-            setTimeout(callback, timeInSeconds * 1000);
-        }
-    );
+    const wrapperWaitSeconds = function(timeInSeconds) {
+        addStep({"type": "wait", "seconds": Math.max(0, Number(timeInSeconds) || 0)});
+    };
 
-    interpreter.setProperty(globalObject, 'waitForSeconds', wrapperWaitSeconds);
+    interpreter.setProperty(
+        globalObject,
+        'waitForSeconds',
+        interpreter.createNativeFunction(wrapperWaitSeconds),
+    );
 
 
     // Add API for TTS
     const wrapperTTS = interpreter.createNativeFunction(function(text) {
-            text = arguments.length ? text : '';
-            return playTTS(text);
+            addStep({"type": "speak", "text": String(arguments.length ? text : '')});
         }
     );
 
@@ -141,9 +152,7 @@ function initApi(interpreter, globalObject) {
 
     // MoveMotor
     const wrapperMove = function(x,y) {
-        x = parseFloat(x);
-        y = parseFloat(y);
-        return blockMoveMotor(x,y);
+        addStep({"type": "motor", "x": parseFloat(x), "y": parseFloat(y)});
     };
 
     interpreter.setProperty(
@@ -154,18 +163,50 @@ function initApi(interpreter, globalObject) {
 
     //  ServoControl
     const wrapperServo = interpreter.createNativeFunction(function(servo, value) {
-            return blockServo(servo, value);
+            addStep({"type": "servo", "servo": String(servo), "value": Number(value)});
         }
     );
     interpreter.setProperty(globalObject,'blockServo', wrapperServo);
 
+    //  Animation
+    const wrapperAnimation = interpreter.createNativeFunction(function(clip) {
+            addStep({"type": "animation", "clip": String(clip)});
+        }
+    );
+    interpreter.setProperty(globalObject,'blockAnimation', wrapperAnimation);
+
     //  Audioplayer
     const wrapperAudio = interpreter.createNativeFunction(function(clip) {
-            return blockAudio(clip);
+            addStep({"type": "sound", "clip": String(clip)});
         }
     );
     interpreter.setProperty(globalObject,'blockAudio', wrapperAudio);
 
+    // Loops which never end: the steps added until endRepeat() are repeated by the server
+    const wrapperBeginRepeat = interpreter.createNativeFunction(function(count) {
+            var step = {"type": "repeat", "count": Math.max(0, Number(count) || 0), "steps": []};
+            addStep(step);
+            programStack.push(step.steps);
+        }
+    );
+    interpreter.setProperty(globalObject,'beginRepeat', wrapperBeginRepeat);
+
+    const wrapperEndRepeat = interpreter.createNativeFunction(function() {
+            if (programStack.length > 1) programStack.pop();
+        }
+    );
+    interpreter.setProperty(globalObject,'endRepeat', wrapperEndRepeat);
+
+}
+
+
+/*
+ * Add a command to the program, remembering which block it came from
+ */
+function addStep(step) {
+    step.block = currentBlock;
+    programStack[programStack.length - 1].push(step);
+    programStepCount++;
 }
 
 
@@ -177,134 +218,160 @@ function highlightBlock(id) {
 }
 
 /*
- * Reset the block editor and stop code execution
+ * Reset the block editor and stop following the program
  */
 function resetStepUi(clearOutput) {
     clearTimeout(runnerPid);
     workspace.highlightBlock(null);
     myInterpreter = null;
+    if (clearOutput) programId = -1;
 }
 
 /*
- * Generate JavaScript code and run it.
+ * Turn the blocks into a list of steps, by running the generated code
+ * without any effect on the robot (loops and variables are evaluated here).
+ * The code is run a chunk at a time, so the page stays responsive.
+ * Calls done(steps), or done(null) if the program is too long or doesn't end,
+ * or done(null, error) if the code fails
  */
-function runCode() {
-    if (!myInterpreter) {
-        // First statement of this code.
-        // Clear the program output.
-        resetStepUi(true);
-        const latestCode =
-            javascript.javascriptGenerator.workspaceToCode(workspace);
-
-        // And then show generated code in an alert.
-        // In a timeout to allow the outputArea.value to reset first.
-        setTimeout(function () {
-            /*
-            alert(
-                'Ready to execute the following code\n' +
-                '===================================\n' +
-                latestCode,
-            );
-            */
-
-            // Begin execution
-            myInterpreter = new Interpreter(latestCode, initApi);
-
-            function runner() {
-                if (myInterpreter) {
-                    const hasMore = myInterpreter.run();
-                    if (hasMore) {
-                        // Execution is currently blocked by some async call.
-                        // Try again later.
-                        runnerPid = setTimeout(runner, 10);
-                    }
-                    else {
-                        // Program is complete.
-                        resetStepUi(false);
-                    }
+function compileProgram(code, done) {
+    programSteps = [];
+    programStack = [programSteps];
+    programStepCount = 0;
+    currentBlock = '';
+    const interpreter = new Interpreter(code, initApi);
+    myInterpreter = interpreter;
+    let count = 0;
+
+    const compileChunk = function() {
+        // Stopped, or the blocks were changed in the meantime
+        if (myInterpreter !== interpreter) return;
+
+        try {
+            for (const end = Math.min(count + compileChunkSteps, maxCompileSteps); count < end; count++) {
+                if (!interpreter.step()) {
+                    myInterpreter = null;
+                    done(programSteps);
+                    return;
                 }
+                if (programStepCount > maxProgramSteps) break;
             }
+        } catch (error) {
+            myInterpreter = null;
+            done(null, error);
+            return;
+        }
 
-            runner();
-        }, 1);
-        return;
-    }
+        if (count >= maxCompileSteps || programStepCount > maxProgramSteps) {
+            myInterpreter = null;
+            done(null);
+            return;
+        }
+        runnerPid = setTimeout(compileChunk, 0);
+    };
+
+    compileChunk();
 }
 
+/*
+ * Generate JavaScript code, and run it on the server.
+ */
+function runCode() {
+    resetStepUi(true);
+    const latestCode =
+        javascript.javascriptGenerator.workspaceToCode(workspace);
+
+    try {
+        compileProgram(latestCode, uploadProgram);
+    } catch (error) {
+        myInterpreter = null;
+        uploadProgram(null, error);
+    }
+}
 
 /*
- * Send Motor XY commands via Block
+ * Send the compiled program to the server, and follow it
  */
-function blockMoveMotor(x,y) {
+function uploadProgram(steps, error) {
+    if (error !== undefined) {
+        showAlert(1, 'Error!', 'Unable to read the program: ' + error, 1);
+        return;
+    }
+    if (steps === null) {
+        showAlert(1, 'Error!', 'The program is too long, or contains a loop which never ends (use "repeat forever" for those).', 1);
+        return;
+    }
+
     $.ajax({
-        url: "/motor",
+        url: "/programRun",
         type: "POST",
-        data: {"stickX": x, "stickY": y},
+        data: {"program": JSON.stringify({"steps": steps})},
         dataType: "json",
         success: function(data){
             if(data.status == "Error"){
-                showAlert(1, ' Error!', data.msg, 1);
+                showAlert(1, 'Error!', data.msg, 1);
+            } else {
+                programId = data.id;
+                programPrinted = 0;
+                runnerPid = setTimeout(checkProgram, 250);
             }
         },
         error: function(error) {
-            showAlert(1, ' Error!', 'Unable to send movement command.', 1);
+            showAlert(1, 'Unknown Error!', 'Unable to start the program.', 1);
         }
     });
 }
 
 /*
- * Send a manual servo control command via Block
+ * Follow the program running on the server: highlight the current block,
+ * and show what the program prints
  */
-function blockServo(servo, value) {
+function checkProgram() {
     $.ajax({
-        url: "/servoControl",
+        url: "/programStatus",
         type: "POST",
-        data: {"servo": servo, "value": value},
         dataType: "json",
         success: function(data){
-            // If a response is received from the python backend, but it contains an error
-            if(data.status == "Error"){
-                showAlert(1, 'Error!', data.msg, 0);
+            if (data.status != "OK" || data.program.id != programId) return;
+            var program = data.program;
+
+            // Show the messages printed since the last check
+            var count = Math.min(program.printed - programPrinted, program.messages.length);
+            if (count > 0) {
+                var lines = program.messages.slice(-count).map(text => $('<div>').text(text).html());
+                showAlert(0, 'Print: ', lines.join('<br>'), 0);
+            }
+            programPrinted = program.printed;
+
+            if (program.state == "running") {
+                workspace.highlightBlock(program.block || null);
+                runnerPid = setTimeout(checkProgram, 250);
+            } else {
+                resetStepUi(false);
+                if (program.state == "failed") showAlert(1, 'Error!', program.error, 1);
             }
         },
         error: function(error) {
-            // If no response was recevied from the python backend, show an "unknown" error
-            showAlert(1, 'Unknown Error!', 'Unable to update servo position.', 1);
+            runnerPid = setTimeout(checkProgram, 1000);
         }
     });
 }
 
 /*
- * Send a manual servo control command via Block
+ * Stop the code execution and stop motors
  */
-/*
- * Play an audio clip from a blockly block
- */
-function blockAudio(clip) {
+function stopCode() {
+    resetStepUi(false);
     $.ajax({
-        url: "/audio",
+        url: "/programStop",
         type: "POST",
-        data: {"clip": clip},
         dataType: "json",
-
-        success: function(data){
-            // If a response is received from the python backend, but it contains an error
-            if(data.status == "Error") showAlert(1, 'Error!', data.msg, 1);
-        },
         error: function(error) {
-            showAlert(1, 'Unknown Error!', 'Unable to play audio file.', 1);
+            showAlert(1, 'Unknown Error!', 'Unable to stop the program.', 1);
         }
     });
 }
 
-/*
- * Stop the code executions and stop motors
- */
-function stopCode() {
-    blockMoveMotor(0.0, 0.0);
-    resetStepUi(false);
-}
-
 /*
  * Export Blockly code as JSON
  */
@@ -196,6 +196,51 @@ javascript.javascriptGenerator.forBlock['presets'] = function(block, generator)
   return code;
 };
 
+/*
+ * Animation block, which plays one of the animations stored on the Arduino
+ */
+Blockly.defineBlocksWithJsonArray([
+{
+    "type": "animation",
+    "message0": "Animation %1",
+    "args0": [
+      {
+        "type": "field_dropdown",
+        "name": "clip",
+        "options": [
+          [
+            "Reset Servos",
+            "0"
+          ],
+          [
+            "Bootup",
+            "1"
+          ],
+          [
+            "Inquisitive",
+            "2"
+          ]
+        ]
+      }
+    ],
+    "previousStatement": null,
+    "nextStatement": null,
+    "colour": 230,
+    "tooltip": "The animation runs on the Arduino, add a wait block to let it finish",
+    "helpUrl": ""
+  }
+]);
+
+/*
+ * Animation block generator
+ */
+javascript.javascriptGenerator.forBlock['animation'] = function(block, generator) {
+  var dropdown_clip = block.getFieldValue('clip');
+
+  code = "blockAnimation('" + dropdown_clip + "');\n";
+  return code;
+};
+
 /*
  * Start block, which doesn't do anything
  */
@@ -460,3 +505,51 @@ javascript.javascriptGenerator.forBlock['audioplayer'] = function(block, generat
     code = 'blockAudio("' + dropdown_clip + '");\n';
     return code;
 };
+
+/*
+ * Repeat forever block
+ * The blocks inside are evaluated once when the program is uploaded,
+ * and the server repeats the resulting steps until the program is stopped
+ */
+Blockly.defineBlocksWithJsonArray([
+  {
+    "type": "repeat_forever",
+    "message0": "repeat forever",
+    "message1": "do %1",
+    "args1": [
+      {
+        "type": "input_statement",
+        "name": "DO"
+      }
+    ],
+    "previousStatement": null,
+    "colour": "%{BKY_LOOPS_HUE}",
+    "tooltip": "Repeat the blocks inside until the program is stopped. Variables keep the values of the first time through.",
+    "helpUrl": ""
+  }
+]);
+
+/*
+ * Repeat forever generator
+ */
+javascript.javascriptGenerator.forBlock['repeat_forever'] = function(block, generator) {
+    var branch = generator.statementToCode(block, 'DO');
+    return 'beginRepeat(0);\n' + branch + 'endRepeat();\n';
+};
+
+/*
+ * "repeat while true" (or "until false") never ends, so it is run on the server like "repeat forever".
+ * Other loops are evaluated when the program is uploaded, as are loops which contain a break
+ */
+const whileUntilGenerator = javascript.javascriptGenerator.forBlock['controls_whileUntil'];
+
+javascript.javascriptGenerator.forBlock['controls_whileUntil'] = function(block, generator) {
+    var until = block.getFieldValue('MODE') == 'UNTIL';
+    var condition = generator.valueToCode(block, 'BOOL', javascript.Order.NONE) || 'false';
+    var breaks = block.getDescendants(false).some(child => child.type == 'controls_flow_statements');
+
+    if (condition == (until ? 'false' : 'true') && !breaks) {
+        return javascript.javascriptGenerator.forBlock['repeat_forever'](block, generator);
+    }
+    return whileUntilGenerator.call(this, block, generator);
+};
@@ -51,6 +51,10 @@ const toolbox = {
                 "kind": "block",
                 "type": "controls_whileUntil"
             },
+            {
+                "kind": "block",
+                "type": "repeat_forever"
+            },
             {
                 "kind": "block",
                 "type": "controls_for"
@@ -290,6 +294,10 @@ const toolbox = {
         {
             "kind": "block",
             "type": "presets",
+        },
+        {
+            "kind": "block",
+            "type": "animation",
         }
       ]
     },
@@ -206,7 +206,13 @@ VirtualJoystick.prototype._updateValues = function(){
 	this._updateText.innerHTML = 'x: ' + Math.round(stickNormalizedX*100) + ', y: ' + Math.round(stickNormalizedY*100);
 	var text = this._updateText;
 
-	// Send data to python app, so that it can be passed on
+	// Use the control channel if it is connected
+	if (typeof sendControl === "function" && sendControl({"type": "motor", "x": stickNormalizedX, "y": stickNormalizedY})) {
+		text.style.color = "#3498DB";
+		return true;
+	}
+
+	// Otherwise send data to python app, so that it can be passed on
 	$.ajax({
 		url: "/motor",
 		type: "POST",
@@ -17,12 +17,24 @@ var moveArms = [0,50,0,50];
 var moveHead = [50,50];
 var gamepadTimer;
 var gamePadActive = 0;
+var motorHeartbeat = 0;
 var jsJoystick;
 var alertVisible = false
 
 // Timer to periodically check if Arduino has sent a message
 var arduinoTimer;
 
+// Persistent WebSocket connection used to send control commands
+var controlSocket = null;
+
+// Token and path of the fast lane, which is used for control commands when the WebSocket is not connected
+var fastLane = null;
+
+// Timer to check the camera state while it is starting or stopping,
+// and the id of the last camera state which was shown
+var cameraTimer = null;
+var cameraStateId = -1;
+
 
 /*
  * Update Web-Interface Settings
@@ -59,19 +71,9 @@ function sendSettings(type, value) {
 			} else {
 				showAlert(0, 'Success!', 'Settings have been updated.', 1);
 				
-				// If setting related to the camera stream, show/hide the video stream
-				if(typeof data.streamer !== "undefined"){
-						if(data.streamer == "Active"){
-							$('#conn-streamer').html('End Stream');
-							$('#conn-streamer').removeClass('btn-outline-info');
-							$('#conn-streamer').addClass('btn-outline-danger');
-							$("#stream").attr("src","http:/" + "/" + window.location.hostname + ":8080/stream.mjpg");
-						} else if(data.streamer == "Offline"){
-							$('#conn-streamer').html('Reactivate');
-							$('#conn-streamer').addClass('btn-outline-info');
-							$('#conn-streamer').removeClass('btn-outline-danger');
-							$("#stream").attr("src","/static/streamimage.jpg");
-						}
+				// If setting related to the camera stream, follow it while it starts or stops
+				if(typeof data.camera !== "undefined"){
+					updateCameraState(data.camera);
 				}
 				return 1;
 			}
@@ -132,7 +134,7 @@ function arduinoConnect(item) {
 						$('#ardu-area').removeClass('bg-danger');
 						$('#ardu-area').addClass('bg-success');
 						showAlert(0, 'Success!', 'Arduino now connected.', 1);
-						arduinoTimer = setInterval(checkArduinoStatus, 10000);
+						startArduinoPolling();
 						checkArduinoStatus();
 					} else if(data.arduino == "Disconnected"){
 						$('#conn-arduino').html('Reconnect');
@@ -320,10 +322,11 @@ function playTTS(text) {
 				showAlert(1, 'Error!', data.msg, 1);
 				return false;
 
-			// Otherwise set the progress bar to show the audio clip progress
+			// Otherwise the speech is generated in the background, so keep track of the job
 			} else {
 				$('#audio-progress').removeClass('bg-danger');
 				//$('#audio-progress').css("width", "0%").animate({width: 100+"%"}, data.time*1000);
+				watchJob(data.job);
 				return true;
 			}
 		},
@@ -339,10 +342,126 @@ function playTTS(text) {
 }
 
 
+/*
+ * Load the clips of a sound group when it is opened for the first time
+ * (only used for large sound libraries)
+ */
+function loadSoundGroup(element) {
+	if (element.data('loaded')) return;
+	element.data('loaded', true);
+
+	$.ajax({
+		url: "/sounds",
+		type: "GET",
+		data: {"group": element.data('group')},
+		dataType: "json",
+		success: function(data){
+			if(data.status == "Error"){
+				element.data('loaded', false);
+				showAlert(1, 'Error!', data.msg, 1);
+				return false;
+			}
+
+			$.each(data.sounds, function(index, sound) {
+				var item = $('<a href="#" class="list-group-item list-group-item-action"></a>');
+				item.attr('file-name', sound.clip).attr('file-length', sound.time).text(sound.name);
+				item.append($('<i class="entry-time"></i>').html('&nbsp; | &nbsp;' + sound.time + 's'));
+				item.click(function() { playAudio(sound.clip, sound.time); return false; });
+				element.append(item);
+			});
+			return true;
+		},
+		error: function(error) {
+			element.data('loaded', false);
+			showAlert(1, 'Unknown Error!', 'Unable to load the sound clips.', 1);
+			return false;
+		}
+	});
+}
+
+
+/*
+ * Load the names of all sound clips for the automation blocks
+ * (only used for large sound libraries)
+ */
+function loadAudioOptions() {
+	$.ajax({
+		url: "/sounds",
+		type: "GET",
+		dataType: "json",
+		success: function(data){
+			if(data.status != "Error"){
+				audio_options = data.sounds.map(function(sound) { return sound.clip; });
+			}
+		}
+	});
+}
+
+
+/*
+ * Poll the state of a background speech/audio job until it has finished
+ */
+function watchJob(job) {
+	$.ajax({
+		url: "/jobStatus",
+		type: "POST",
+		data: {"job": job},
+		dataType: "json",
+		success: function(data){
+			if(data.status == "Error"){
+				return false;
+			}
+
+			// Show an error if the job failed
+			if(data.job.state == "failed"){
+				$('#audio-progress').addClass('bg-danger');
+				$('#audio-progress').css("width", "0%").animate({width: 100+"%"}, 500);
+				showAlert(1, 'Error!', data.job.error, 1);
+
+			// Keep polling while the job is waiting or running
+			} else if(data.job.state == "queued" || data.job.state == "running"){
+				setTimeout(function() { watchJob(job); }, 500);
+			}
+			return true;
+		}
+	});
+}
+
+
+/*
+ * Cancel all speech/audio jobs and stop all sounds which are playing
+ */
+function stopAudio() {
+	$.ajax({
+		url: "/jobCancel",
+		type: "POST",
+		data: {"job": "all"},
+		dataType: "json",
+		success: function(data){
+			// Reset the audio progress bar
+			$('#audio-progress').stop();
+			$('#audio-progress').css('width', '0%').attr('aria-valuenow', 0);
+			return true;
+		},
+		error: function(error) {
+			showAlert(1, 'Unknown Error!', 'Unable to stop the audio.', 1);
+			return false;
+		}
+	});
+}
+
+
 /*
  * Send a manual servo control command
  */
 function servoControl(item, servo, value) {
+	// Use the control channel if it is connected
+	if (sendControl({"type": "servo", "servo": servo, "value": value})) {
+		item.value = value;
+		item.oldvalue = value;
+		return true;
+	}
+
 	$.ajax({
 		url: "/servoControl",
 		type: "POST",
@@ -513,36 +632,7 @@ function checkArduinoStatus() {
 		dataType: "json",
 		success: function(data){
 			if(data.status != "Error" && data.status != "Info"){
-				var batteryLevel = parseInt(data.battery);
-				if (batteryLevel != -999) {
-					if (batteryLevel < 0) batteryLevel = 0;
-					$('#batt-area').removeClass('d-none');
-					$('#batt-text').html(batteryLevel + '%');
-					if (batteryLevel > 65 && !$('#batt-icon').hasClass('fa-battery-full')) {
-						$('#batt-icon').removeClass('fa-battery-quarter');
-						$('#batt-icon').removeClass('fa-battery-half');
-						$('#batt-icon').addClass('fa-battery-full');
-						$('#batt-area').removeClass('bg-danger');
-						$('#batt-area').removeClass('bg-warning');
-						$('#batt-area').addClass('bg-success');
-					} else if (batteryLevel > 35 && batteryLevel <= 65  && !$('#batt-icon').hasClass('fa-battery-half')) {
-						$('#batt-icon').removeClass('fa-battery-quarter');
-						$('#batt-icon').addClass('fa-battery-half');
-						$('#batt-icon').removeClass('fa-battery-full');
-						$('#batt-area').removeClass('bg-danger');
-						$('#batt-area').addClass('bg-warning');
-						$('#batt-area').removeClass('bg-success');
-					} if (batteryLevel <= 35 && !$('#batt-icon').hasClass('fa-battery-quarter')) {
-						$('#batt-icon').addClass('fa-battery-quarter');
-						$('#batt-icon').removeClass('fa-battery-half');
-						$('#batt-icon').removeClass('fa-battery-full');
-						$('#batt-area').addClass('bg-danger');
-						$('#batt-area').removeClass('bg-warning');
-						$('#batt-area').removeClass('bg-success');
-					}
-				} else {
-					$('#batt-area').addClass('d-none');
-				}
+				updateBatteryLevel(parseInt(data.battery));
 				return true;
 			} else if (data.status == "Error") {
 				showAlert(1, 'Error!', data.msg, 1);
@@ -552,6 +642,236 @@ function checkArduinoStatus() {
 }
 
 
+/*
+ * Poll the Arduino status every 10 seconds, but only while the control
+ * channel is closed; otherwise the robot pushes telemetry as it arrives
+ */
+function startArduinoPolling() {
+	clearInterval(arduinoTimer);
+	if (controlSocket === null) {
+		arduinoTimer = setInterval(checkArduinoStatus, 10000);
+	}
+}
+
+
+/*
+ * Get the state of the camera stream
+ */
+function checkCameraStatus() {
+	$.ajax({
+		url: "/cameraStatus",
+		type: "POST",
+		dataType: "json",
+		success: function(data){
+			if (data.status == "OK") {
+				updateCameraState(data.camera);
+			}
+		}
+	});
+}
+
+
+/*
+ * Show the state of the camera stream, which starts and stops in the background.
+ * While it is changing, the state is checked again shortly (unless the control
+ * channel pushes the change first)
+ */
+function updateCameraState(camera) {
+	// Ignore replies which arrive after a newer state has already been shown
+	if (camera.id < cameraStateId) return;
+	clearTimeout(cameraTimer);
+	cameraTimer = null;
+
+	if (camera.state == "starting" || camera.state == "stopping") {
+		$('#conn-streamer').html(camera.state == "starting" ? 'Starting...' : 'Stopping...');
+		cameraTimer = setTimeout(checkCameraStatus, 250);
+
+	} else if (camera.state == "running") {
+		$('#conn-streamer').html('End Stream');
+		$('#conn-streamer').removeClass('btn-outline-info');
+		$('#conn-streamer').addClass('btn-outline-danger');
+		if ($("#stream").attr("src").indexOf("stream.mjpg") < 0) {
+			$("#stream").attr("src","http:/" + "/" + window.location.hostname + ":8080/stream.mjpg");
+		}
+
+	} else {
+		$('#conn-streamer').html('Reactivate');
+		$('#conn-streamer').addClass('btn-outline-info');
+		$('#conn-streamer').removeClass('btn-outline-danger');
+		$("#stream").attr("src","/static/streamimage.jpg");
+
+		// Only report each failure once, even if it arrives both as a reply and a push
+		if (camera.state == "error" && camera.id > cameraStateId) {
+			showAlert(1, 'Error!', 'Unable to start stream: ' + camera.error, 1);
+		}
+	}
+
+	cameraStateId = Math.max(cameraStateId, camera.id);
+}
+
+
+/*
+ * Update the battery level indicator
+ */
+function updateBatteryLevel(batteryLevel) {
+	if (batteryLevel != -999) {
+		if (batteryLevel < 0) batteryLevel = 0;
+		$('#batt-area').removeClass('d-none');
+		$('#batt-text').html(batteryLevel + '%');
+		if (batteryLevel > 65 && !$('#batt-icon').hasClass('fa-battery-full')) {
+			$('#batt-icon').removeClass('fa-battery-quarter');
+			$('#batt-icon').removeClass('fa-battery-half');
+			$('#batt-icon').addClass('fa-battery-full');
+			$('#batt-area').removeClass('bg-danger');
+			$('#batt-area').removeClass('bg-warning');
+			$('#batt-area').addClass('bg-success');
+		} else if (batteryLevel > 35 && batteryLevel <= 65  && !$('#batt-icon').hasClass('fa-battery-half')) {
+			$('#batt-icon').removeClass('fa-battery-quarter');
+			$('#batt-icon').addClass('fa-battery-half');
+			$('#batt-icon').removeClass('fa-battery-full');
+			$('#batt-area').removeClass('bg-danger');
+			$('#batt-area').addClass('bg-warning');
+			$('#batt-area').removeClass('bg-success');
+		} if (batteryLevel <= 35 && !$('#batt-icon').hasClass('fa-battery-quarter')) {
+			$('#batt-icon').addClass('fa-battery-quarter');
+			$('#batt-icon').removeClass('fa-battery-half');
+			$('#batt-icon').removeClass('fa-battery-full');
+			$('#batt-area').addClass('bg-danger');
+			$('#batt-area').removeClass('bg-warning');
+			$('#batt-area').removeClass('bg-success');
+		}
+	} else {
+		$('#batt-area').addClass('d-none');
+	}
+}
+
+
+/*
+ * Open the WebSocket control channel, which is used instead
+ * of individual POST requests for high-frequency commands
+ */
+function openControlSocket() {
+	$.ajax({
+		url: "/controlToken",
+		type: "POST",
+		dataType: "json",
+		success: function(data){
+			if(data.status != "OK") return;
+
+			var protocol = (window.location.protocol == "https:") ? "wss:/" : "ws:/";
+			var socket = new WebSocket(protocol + "/" + window.location.hostname + ":" + data.port + "/control?token=" + data.token);
+
+			socket.onopen = function() {
+				controlSocket = socket;
+				clearInterval(arduinoTimer);
+			};
+			socket.onmessage = function(event) {
+				handleControlMessage(JSON.parse(event.data));
+			};
+			socket.onclose = function() {
+				// Fall back to POST requests, and try to reconnect later
+				controlSocket = null;
+				if ($('#ardu-area').hasClass('bg-success')) {
+					startArduinoPolling();
+				}
+				setTimeout(openControlSocket, 5000);
+			};
+		}
+	});
+}
+
+
+/*
+ * Get the token for the fast lane control endpoint,
+ * and send a command which is waiting for it (if any)
+ */
+function openFastLane(message) {
+	$.ajax({
+		url: "/fastToken",
+		type: "POST",
+		dataType: "json",
+		success: function(data){
+			if(data.status != "OK") return;
+			fastLane = {"token": data.token, "path": data.path};
+			if (message) sendFastLane(message);
+		}
+	});
+}
+
+
+/*
+ * Send a command to the fast lane control endpoint
+ */
+function sendFastLane(message) {
+	var params = "t=" + fastLane.token;
+	if (message.type == "motor") params += "&m=" + Math.trunc(message.x * 100) + "," + Math.trunc(message.y * 100);
+	else if (message.type == "servo") params += "&s=" + message.servo + Math.round(message.value);
+	else if (message.type == "animate") params += "&a=" + message.clip;
+
+	$.ajax({
+		url: fastLane.path + "?" + params,
+		type: "POST",
+		error: function(error) {
+			if (error.status == 401) {
+				// The server has restarted, so get a new token and try again
+				fastLane = null;
+				openFastLane(message);
+			} else if (error.status == 503) {
+				showAlert(1, 'Error!', 'Arduino not connected', 0);
+			} else if (error.status == 429) {
+				// Commands above the rate limit are dropped, and the next one will get through
+				return;
+			} else {
+				showAlert(1, 'Unknown Error!', 'Unable to send control command.', 0);
+			}
+		}
+	});
+}
+
+
+/*
+ * Send a command over the control channel, or the fast lane if the channel is not connected
+ * Returns false if neither is available
+ */
+function sendControl(message) {
+	if (controlSocket !== null && controlSocket.readyState == WebSocket.OPEN) {
+		controlSocket.send(JSON.stringify(message));
+		return true;
+	}
+	if (fastLane !== null) {
+		sendFastLane(message);
+		return true;
+	}
+	return false;
+}
+
+
+/*
+ * Handle messages pushed by the robot over the control channel
+ */
+function handleControlMessage(message) {
+	if (message.type == "error") {
+		showAlert(1, 'Error!', message.msg, 0);
+	} else if (message.type == "status") {
+		if (message.connected && message.battery !== null) {
+			updateBatteryLevel(parseInt(message.battery));
+		}
+	} else if (message.type == "telemetry") {
+		if (message.event == "battery") {
+			updateBatteryLevel(parseInt(message.value));
+		} else if (message.event == "connection" && !message.value) {
+			$('#batt-area').addClass('d-none');
+		} else if (message.event == "nack") {
+			console.log("Arduino rejected frame " + message.value);
+		}
+	} else if (message.type == "camera") {
+		updateCameraState(message);
+	} else if (message.type == "governor" && message.state == "stopped") {
+		showAlert(1, 'Stopped!', 'No movement commands were received, so the motors have been stopped.', 0);
+	}
+}
+
+
 /*
  * This function displays an alert message at the bottom of the screen
  */
@@ -754,6 +1074,26 @@ function moveAxis(e) {
 	} 
 }
 
+// Send the motor values of the gamepad
+function sendMotorValues(x, y) {
+	if (!sendControl({"type": "motor", "x": x, "y": y})) $.ajax({
+		url: "/motor",
+		type: "POST",
+		data: {"stickX": x, "stickY": y},
+		dataType: "json",
+		success: function(data){
+			if(data.status == "Error"){
+				showAlert(1, 'Error!', data.msg, 0);
+			} else {
+				// Do nothing
+			}
+		},
+		error: function(error) {
+			showAlert(1, 'Unknown Error!', 'Could not send movement command.', 0);
+		}
+	});
+}
+
 // Send the movement values at fixed intervals
 function sendMovementValues() {
 	
@@ -771,25 +1111,17 @@ function sendMovementValues() {
 		$('#joytext').html('x: ' + Math.round(moveXY[1]*100) + ', y: ' + Math.round(moveXY[3]*-100));
 		
 		// Send data to python app, so that it can be passed on
-		$.ajax({
-			url: "/motor",
-			type: "POST",
-			data: {"stickX": moveXY[1], "stickY": -moveXY[3]},
-			dataType: "json",
-			success: function(data){
-				if(data.status == "Error"){
-					showAlert(1, 'Error!', data.msg, 0);
-				} else {
-					// Do nothing
-				}
-			},
-			error: function(error) {
-				showAlert(1, 'Unknown Error!', 'Could not send movement command.', 0);
-			}
-		});
+		sendMotorValues(moveXY[1], -moveXY[3]);
+		motorHeartbeat = 0;
 	} else {
 		moveXY[0] = 0;
 		moveXY[2] = 0;
+
+		// Repeat the values while driving, so the watchdog on the server doesn't stop the motors
+		if ((moveXY[1] != 0 || moveXY[3] != 0) && ++motorHeartbeat >= 3) {
+			sendMotorValues(moveXY[1], -moveXY[3]);
+			motorHeartbeat = 0;
+		}
 	}
 	
 	// Yaw Axis (head rotation left/right)
@@ -951,21 +1283,28 @@ $(document).ready(function () {
 
 	// If arduino has already been connected, start the status check
 	if ($('#ardu-area').hasClass('bg-success')) {
-		arduinoTimer = setInterval(checkArduinoStatus, 10000);
+		startArduinoPolling();
 		checkArduinoStatus();
 	}
 
-	// If camera stream has already been started, show it on the web-interface
+	// If camera stream has been started, show it on the web-interface once it is running
 	if ($('#stream').hasClass('starting')) {
 		$('#stream').removeClass('starting');
-		$('#conn-streamer').html('End Stream');
-		$('#conn-streamer').removeClass('btn-outline-info');
-		$('#conn-streamer').addClass('btn-outline-danger');
-		$("#stream").attr("src","http:/" + "/" + window.location.hostname + ":8080/stream.mjpg");
+		checkCameraStatus();
 	}
 
 	controllerOn();
 	if (joypad.instances[0] != null && joypad.instances[0].connected) updateInfo(joypad.instances[0]);
+
+	// Connect to the control channel for joystick and servo commands
+	openControlSocket();
+	openFastLane();
+
+	// Large sound libraries are loaded when a group is opened
+	if (lazy_sounds) {
+		$('.lazy-sounds').on('show.bs.collapse', function() { loadSoundGroup($(this)); });
+		loadAudioOptions();
+	}
 	
 	// This function runs when a number is inserted into the motor-offset
 	// input box, and ensures the number is valid.
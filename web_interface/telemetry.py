@@ -0,0 +1,418 @@
+"""
+Telemetry received from the Wall-e Arduino
+
+Every line sent by the Arduino is parsed into a typed event:
+
+    Battery_<percent>      -> battery
+    <char><number>         -> echo of a text command (evaluateSerial)
+    Ack_<seq> / Nack_<seq> -> a binary frame was processed / rejected
+    Protocol_<version>     -> protocol
+    Queue_<length>         -> queue (animation queue, after a streamed keyframe)
+    Startup complete...    -> startup
+    anything else          -> log
+
+Echoes and acks are matched with the commands sent, giving the link
+latency. The round-trip times are also collected in a histogram for
+each command type, and commands which are never acknowledged within
+LOST_TIMEOUT (or are rejected) are counted as lost. The latest values are kept in fixed-size ring buffers, and
+changes are added to a numbered event log which clients can wait on,
+so they can be pushed to the browser (see control_socket.py). Echoes
+are frequent, so they are summarised in "link" events at most every
+LINK_INTERVAL seconds instead of being pushed one by one.
+"""
+
+import re
+import time
+from collections import deque
+from threading import Condition
+
+import serial_protocol
+
+
+SERIES_LENGTH = 600        # Number of samples kept for each time series
+EVENT_HISTORY = 200        # Number of events kept for clients which fall behind
+LINK_INTERVAL = 0.5        # Minimum seconds between link summary events
+MAX_PENDING = 64           # Sent commands remembered while waiting for their echo
+LOST_TIMEOUT = 1.0         # Seconds after which an unacknowledged command is counted as lost
+
+# Upper bounds (milliseconds) of the round-trip latency histogram buckets
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+ECHO_PATTERN = re.compile(r'^([A-Za-z])(-?\d+)$')
+
+
+# ----------------------------------------------------------------
+def parse_message(message: str) -> tuple[str, str | int | tuple[str, int]]:
+    """
+    Classify a message received from the Arduino
+    :param message: The message, without the line ending
+    :return: Tuple of (event type, value)
+    """
+    prefix, _, number = message.partition('_')
+
+    if prefix in ('Battery', 'Ack', 'Nack', 'Protocol', 'Queue') and number.lstrip('-').isdigit():
+        return (prefix.lower(), int(number))
+    if message.startswith('Startup complete'):
+        return ('startup', message)
+
+    echo = ECHO_PATTERN.match(message)
+    if echo:
+        return ('echo', (echo.group(1), int(echo.group(2))))
+
+    return ('log', message)
+
+
+# ================================================================
+class LatencyHistogram:
+    """Fixed-bucket histogram of round-trip times, from which percentiles can be estimated"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        """
+        Constructor
+        :param buckets: Upper bounds of the buckets in milliseconds, in increasing order
+        """
+        self.buckets = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+        self.maximum: float = 0.0
+
+    # ------------------------------------------------------------
+    def add(self, value: float):
+        """
+        Add a sample to the histogram
+        :param value: Round-trip time in milliseconds
+        """
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    # ------------------------------------------------------------
+    def get_percentile(self, fraction: float) -> float | None:
+        """
+        Estimate a percentile, by interpolating within the bucket which contains it
+        :param fraction: The percentile as a fraction, such as 0.95
+        :return: Estimated value in milliseconds, or None if there are no samples
+        """
+        if self.count == 0:
+            return None
+
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.maximum
+                return round(min(lower + (upper - lower) * (rank - seen) / count, self.maximum), 3)
+            seen += count
+        return round(self.maximum, 3)
+
+    # ------------------------------------------------------------
+    def to_dict(self) -> dict:
+        """
+        Summarise the histogram
+        :return: Dictionary containing the count, mean, sum, maximum, percentiles and bucket counts
+        """
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'sum': round(self.total, 3),
+            'max': round(self.maximum, 3),
+            'p50': self.get_percentile(0.5),
+            'p95': self.get_percentile(0.95),
+            'p99': self.get_percentile(0.99),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+# ================================================================
+class Telemetry:
+    """Time series and event log of the Arduino status"""
+
+    def __init__(self, series_length: int = SERIES_LENGTH, event_history: int = EVENT_HISTORY):
+        """
+        Constructor
+        :param series_length: Number of samples kept for each time series
+        :param event_history: Number of events kept in the event log
+        """
+        self.series: dict[str, deque] = {name: deque(maxlen=series_length)
+                                         for name in ('battery', 'latency', 'acked')}
+        self.events: deque = deque(maxlen=event_history)
+        self.event_id: int = 0
+        self.condition = Condition()
+
+        self.pending_commands: dict[str, deque] = {}
+        self.pending_frames: dict[int, tuple[float, list[str]]] = {}
+        self.histograms: dict[str, LatencyHistogram] = {}
+        self.lost: dict[str, int] = {}
+        self.expire_time: float = 0.0
+        self.link_time: float = 0.0
+        self.link_latencies: list[float] = []
+        self.counters = {'messages': 0, 'acked': 0, 'nacks': 0, 'unmatched': 0, 'logs': 0}
+        self.battery: int | None = None
+        self.connected: bool = False
+        self.last_message: float | None = None
+
+    # ------------------------------------------------------------
+    def record_sent(self, commands: list[str], frames: list[int] | None = None):
+        """
+        Remember when commands were sent, to measure the time until they are acknowledged
+        :param commands: The text commands which were sent
+        :param frames: Sequence numbers of the binary frames which were sent (None = sent as text)
+        """
+        now = time.monotonic()
+
+        with self.condition:
+            if frames is not None:
+                # Commands were grouped into frames as in serial_protocol.encode_commands();
+                # those which didn't fit the binary format were sent as text, and are echoed
+                groups: list[list[str]] = [[]]
+                for command in commands:
+                    if serial_protocol.parse_command(command) is None:
+                        self.__add_pending(command, now)
+                        groups.append([])
+                    else:
+                        groups[-1].append(command[0])
+                        if len(groups[-1]) == serial_protocol.MAX_FRAME_COMMANDS:
+                            groups.append([])
+
+                for seq, types in zip(frames, [group for group in groups if group]):
+                    if seq in self.pending_frames:
+                        self.__count_lost(self.pending_frames[seq][1])
+                    self.pending_frames[seq] = (now, types)
+                while len(self.pending_frames) > MAX_PENDING:
+                    self.__count_lost(self.pending_frames.pop(next(iter(self.pending_frames)))[1])
+
+            else:
+                for command in commands:
+                    self.__add_pending(command, now)
+
+            while len(self.pending_commands) > MAX_PENDING:
+                key = next(iter(self.pending_commands))
+                self.__count_lost([key[0]] * len(self.pending_commands.pop(key)))
+
+            self.__expire_pending(now)
+
+    # ------------------------------------------------------------
+    def handle_message(self, message: str) -> tuple[str, str | int | tuple[str, int]]:
+        """
+        Parse a message from the Arduino and update the telemetry
+        :param message: The message, without the line ending
+        :return: Tuple of (event type, value), as returned by parse_message()
+        """
+        kind, value = parse_message(message)
+        now = time.monotonic()
+
+        with self.condition:
+            self.counters['messages'] += 1
+            self.last_message = now
+
+            if kind == 'battery':
+                self.series['battery'].append((time.time(), value))
+                if value != self.battery:
+                    self.battery = value
+                    self.__add_event('battery', value)
+
+            elif kind in ('echo', 'ack'):
+                if kind == 'echo':
+                    key = f'{value[0]}{value[1]}'
+                    sent = self.pending_commands.get(key)
+                    pending = (sent.popleft(), [value[0]]) if sent else None
+                    if sent is not None and not sent:
+                        del self.pending_commands[key]
+                else:
+                    pending = self.pending_frames.pop(value, None)
+
+                if pending is None:
+                    self.counters['unmatched'] += 1
+                else:
+                    latency = (now - pending[0]) * 1000
+                    for command_type in pending[1]:
+                        self.__get_histogram(command_type).add(latency)
+                    self.counters['acked'] += 1
+                    self.link_latencies.append(latency)
+                    self.__update_link(now)
+
+            elif kind == 'nack':
+                self.counters['nacks'] += 1
+                pending = self.pending_frames.pop(value, None)
+                if pending is not None:
+                    self.__count_lost(pending[1])
+                self.__add_event('nack', value)
+
+            elif kind in ('protocol', 'startup'):
+                self.__add_event(kind, value)
+
+            elif kind == 'queue':
+                # Length of the animation queue, reported after each streamed keyframe
+                pass
+
+            else:
+                self.counters['logs'] += 1
+                self.__add_event('log', value)
+
+            self.__expire_pending(now)
+
+        return (kind, value)
+
+    # ------------------------------------------------------------
+    def set_connected(self, connected: bool):
+        """
+        Record whether the Arduino is connected
+        :param connected: True if the serial port is open
+        """
+        with self.condition:
+            if connected != self.connected:
+                self.connected = connected
+                if not connected:
+                    self.battery = None
+                    self.__expire_pending(time.monotonic() + LOST_TIMEOUT, force=True)
+                self.__add_event('connection', connected)
+
+    # ------------------------------------------------------------
+    def wait_for_events(self, after_id: int, timeout: float | None = None) -> list[dict]:
+        """
+        Get the events newer than a given event, waiting for one if there are none
+        :param after_id: Id of the last event the caller has seen (0 = all events)
+        :param timeout: Maximum seconds to wait (None = wait forever)
+        :return: List of events, which is empty if the timeout expired
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.event_id > after_id, timeout)
+            return [event for event in self.events if event['id'] > after_id]
+
+    # ------------------------------------------------------------
+    def get_last_event_id(self) -> int:
+        """Id of the newest event"""
+        return self.event_id
+
+    # ------------------------------------------------------------
+    def get_snapshot(self) -> dict:
+        """
+        Get the latest telemetry values
+        :return: Dictionary containing the connection state, battery level, latency and counters
+        """
+        with self.condition:
+            latency = self.series['latency'][-1][1] if self.series['latency'] else None
+            age = round(time.monotonic() - self.last_message, 3) if self.last_message is not None else None
+            return dict(self.counters, connected=self.connected, battery=self.battery, latency=latency,
+                        last_message_age=age, event_id=self.event_id)
+
+    # ------------------------------------------------------------
+    def get_series(self, name: str, since: float = 0.0) -> list[tuple[float, float]]:
+        """
+        Get the samples of a time series
+        :param name: Name of the series ("battery", "latency" or "acked")
+        :param since: Only return samples newer than this time (seconds since the epoch)
+        :return: List of (time, value) tuples, oldest first
+        """
+        with self.condition:
+            return [sample for sample in self.series.get(name, ()) if sample[0] > since]
+
+    # ------------------------------------------------------------
+    def get_latency_stats(self) -> dict:
+        """
+        Get the round-trip latency of each command type
+        :return: Dictionary mapping the command character ("all" for every command) to a
+                 summary of its latency histogram, with the number of lost commands
+        """
+        with self.condition:
+            self.__expire_pending(time.monotonic())
+            types = sorted(set(self.histograms) | set(self.lost))
+            stats = {command_type: dict(self.__get_histogram(command_type).to_dict(),
+                                        lost=self.lost.get(command_type, 0))
+                     for command_type in types}
+
+            total = LatencyHistogram()
+            for command_type in types:
+                histogram = self.histograms[command_type]
+                total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+                total.count += histogram.count
+                total.total += histogram.total
+                total.maximum = max(total.maximum, histogram.maximum)
+            stats['all'] = dict(total.to_dict(), lost=sum(self.lost.values()),
+                                pending=sum(len(sent) for sent in self.pending_commands.values())
+                                + len(self.pending_frames))
+            return stats
+
+    # ------------------------------------------------------------
+    def __add_pending(self, command: str, now: float):
+        """Remember a command sent as text, which the Arduino echoes back"""
+        key = normalise_command(command)
+        if key is not None:
+            sent = self.pending_commands.setdefault(key, deque())
+            if len(sent) == MAX_PENDING:
+                sent.popleft()
+                self.__count_lost([key[0]])
+            sent.append(now)
+
+    # ------------------------------------------------------------
+    def __expire_pending(self, now: float, force: bool = False):
+        """Count the commands which haven't been acknowledged within LOST_TIMEOUT as lost"""
+        if not force and now - self.expire_time < LOST_TIMEOUT / 4:
+            return
+        self.expire_time = now
+        limit = now - LOST_TIMEOUT
+
+        for key in list(self.pending_commands):
+            sent = self.pending_commands[key]
+            while sent and sent[0] < limit:
+                sent.popleft()
+                self.__count_lost([key[0]])
+            if not sent:
+                del self.pending_commands[key]
+
+        for seq in [seq for seq, pending in self.pending_frames.items() if pending[0] < limit]:
+            self.__count_lost(self.pending_frames.pop(seq)[1])
+
+    # ------------------------------------------------------------
+    def __count_lost(self, types: list[str]):
+        """Count commands which were never acknowledged"""
+        for command_type in types:
+            self.__get_histogram(command_type)
+            self.lost[command_type] = self.lost.get(command_type, 0) + 1
+
+    # ------------------------------------------------------------
+    def __get_histogram(self, command_type: str) -> LatencyHistogram:
+        """Get the latency histogram of a command type, creating it if needed"""
+        if command_type not in self.histograms:
+            self.histograms[command_type] = LatencyHistogram()
+        return self.histograms[command_type]
+
+    # ------------------------------------------------------------
+    def __update_link(self, now: float):
+        """Summarise the latency of the acknowledged commands, at most every LINK_INTERVAL"""
+        if now - self.link_time < LINK_INTERVAL:
+            return
+
+        latency = round(sum(self.link_latencies) / len(self.link_latencies), 2)
+        self.series['latency'].append((time.time(), latency))
+        self.series['acked'].append((time.time(), self.counters['acked']))
+        self.__add_event('link', {'latency': latency, 'acked': self.counters['acked'],
+                                  'commands': len(self.link_latencies)})
+        self.link_time = now
+        self.link_latencies = []
+
+    # ------------------------------------------------------------
+    def __add_event(self, kind: str, value):
+        """Add an event to the log and wake up the waiting clients"""
+        self.event_id += 1
+        self.events.append({'id': self.event_id, 'time': round(time.time(), 3), 'type': kind, 'value': value})
+        self.condition.notify_all()
+
+
+# ----------------------------------------------------------------
+def normalise_command(command: str) -> str | None:
+    """
+    Get the echo which the Arduino sends back for a text command
+    :param command: The command, such as "X50"
+    :return: The expected echo, or None if the command isn't a number
+    """
+    number = command[1:].strip() or '0'
+    if not command or not number.lstrip('-').isdigit():
+        return None
+    return f'{command[0]}{int(number)}'
@@ -0,0 +1,58 @@
+"""
+Tokens which let logged-in clients use the control endpoints
+
+The WebSocket control channel and the fast lane don't see the Flask
+session, so a client asks a (session checked) route for a token, and
+sends it with its connection or requests. Tokens are random strings,
+kept in memory until the server restarts; once MAX_TOKENS have been
+issued, the oldest are forgotten.
+"""
+
+import secrets
+from collections import OrderedDict
+from threading import Lock
+
+
+MAX_TOKENS = 64            # Oldest tokens are forgotten once this is reached
+
+
+# ================================================================
+class TokenStore:
+    """Issue and check the tokens of one endpoint"""
+
+    def __init__(self, max_tokens: int = MAX_TOKENS):
+        """
+        Constructor
+        :param max_tokens: Number of tokens which are remembered
+        """
+        self.max_tokens = max_tokens
+        self.lock = Lock()
+        self.tokens: OrderedDict[str, bool] = OrderedDict()
+
+    # ------------------------------------------------------------
+    def issue(self) -> str:
+        """
+        Create a new token
+        :return: The token string
+        """
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            self.tokens[token] = True
+            while len(self.tokens) > self.max_tokens:
+                self.tokens.popitem(last=False)
+        return token
+
+    # ------------------------------------------------------------
+    def is_valid(self, token: str) -> bool:
+        """
+        Check whether a token was issued by this store
+        :param token: The token to check
+        :return: True if the token is valid, False otherwise
+        """
+        return token in self.tokens
+
+    # ------------------------------------------------------------
+    def clear(self):
+        """Forget all the tokens, as after a restart"""
+        with self.lock:
+            self.tokens.clear()
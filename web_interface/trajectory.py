@@ -0,0 +1,421 @@
+"""
+Servo trajectories, streamed to the Arduino as timed keyframes
+
+A trajectory is a list of keyframes, each giving the time (milliseconds
+from the start) and the positions (0-100) of some of the seven servos.
+It is sampled at a fixed rate, interpolating each servo between the
+keyframes which contain it, and every sample is sent to the Arduino as
+one keyframe of its animation queue (see "Streamed keyframes" in
+wall-e.ino), so new animations don't need the sketch to be reflashed.
+Only the servos which changed since the previous sample are sent.
+
+The Arduino reports the length of its queue after each keyframe, and
+the player keeps no more than a window of keyframes waiting there: the
+robot reacts to a stop within a window's time, and the queue (which
+the sketch can't grow) never overflows.
+
+Saved trajectories are JSON files in the trajectory folder:
+
+    {
+        "name": "Wave",
+        "rate": 20,                   (samples per second, optional)
+        "interpolation": "smooth",    ("linear" or "smooth" ease in/out, optional)
+        "keyframes": [
+            {"time": 0,    "head": 50, "arm_right": 40},
+            {"time": 800,  "arm_right": 100},
+            {"time": 1600, "head": 30, "arm_right": 40}
+        ]
+    }
+"""
+
+import os
+import re
+import json
+import math
+import time
+import logging
+from collections import deque
+from threading import Thread, Event, Condition
+
+
+# Servo names, in the order of the animation_t positions, and their serial commands
+SERVOS = (('head', 'G'), ('neck_top', 'T'), ('neck_bottom', 'B'), ('eye_right', 'U'),
+          ('eye_left', 'E'), ('arm_left', 'L'), ('arm_right', 'R'))
+SERVO_NUMBERS = {command: number for number, (_, command) in enumerate(SERVOS)}
+
+DEVICE_QUEUE_LENGTH = 40    # Must match QUEUE_LENGTH in wall-e.ino
+DEFAULT_RATE = 20           # Samples per second, unless the trajectory has its own rate
+MAX_RATE = 200              # Highest sample rate (the sketch updates the servos every 10 ms)
+MAX_DURATION = 600000       # Longest trajectory (milliseconds)
+MIN_RATE = 1 / 600          # Lowest sample rate, one sample for the longest trajectory
+MAX_KEYFRAME_TIME = 9999    # Longest time of one sample (ms), limited by the 5 character text commands
+REPLY_TIMEOUT = 2.0         # Seconds to wait for the Arduino to report its queue length
+
+# Player states
+IDLE = "idle"
+PLAYING = "playing"
+FINISHED = "finished"
+STOPPED = "stopped"
+FAILED = "failed"
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------
+def parse_trajectory(data: dict) -> dict:
+    """
+    Check a trajectory
+    :param data: The trajectory, in the format of the saved files
+    :return: The trajectory, with its keyframes sorted by time
+    :raises ValueError: If the trajectory is invalid
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('keyframes'), list) or not data['keyframes']:
+        raise ValueError('Trajectory has no list of keyframes')
+
+    rate = data.get('rate', DEFAULT_RATE)
+    if type(rate) not in (int, float) or not MIN_RATE <= rate <= MAX_RATE:
+        raise ValueError(f'Rate must be between one sample per {MAX_DURATION // 1000} seconds and {MAX_RATE} samples per second')
+
+    interpolation = data.get('interpolation', 'linear')
+    if interpolation not in ('linear', 'smooth'):
+        raise ValueError(f'Unknown interpolation "{interpolation}"')
+
+    names = {name for name, _ in SERVOS}
+    keyframes = []
+    for index, raw in enumerate(data['keyframes']):
+        if not isinstance(raw, dict) or type(raw.get('time')) not in (int, float):
+            raise ValueError(f'Keyframe {index + 1} has no time')
+        if not 0 <= raw['time'] <= MAX_DURATION:
+            raise ValueError(f'Keyframe {index + 1} must be within {MAX_DURATION} ms')
+
+        keyframe = {'time': int(raw['time'])}
+        for name, value in raw.items():
+            if name == 'time':
+                continue
+            if name not in names:
+                raise ValueError(f'Keyframe {index + 1} has an unknown servo "{name}"')
+            if type(value) not in (int, float) or not 0 <= value <= 100:
+                raise ValueError(f'Keyframe {index + 1} position of {name} must be between 0 and 100')
+            keyframe[name] = value
+        keyframes.append(keyframe)
+
+    keyframes.sort(key=lambda keyframe: keyframe['time'])
+    return {'name': str(data.get('name', '')), 'rate': rate, 'interpolation': interpolation, 'keyframes': keyframes}
+
+
+# ----------------------------------------------------------------
+def interpolate(keys: list[tuple[int, float]], time_ms: float, smooth: bool) -> float | None:
+    """
+    Position of one servo at a point in time
+    :param keys: List of (time, position) of the keyframes containing the servo, sorted by time
+    :param time_ms: Time from the start of the trajectory
+    :param smooth: Ease in and out of each keyframe, instead of moving at a constant speed
+    :return: The position, or None before the first keyframe of the servo
+    """
+    if not keys or time_ms < keys[0][0]:
+        return None
+
+    for (start, value), (end, target) in zip(keys, keys[1:]):
+        if time_ms < end:
+            fraction = (time_ms - start) / (end - start)
+            if smooth:
+                fraction = (1 - math.cos(fraction * math.pi)) / 2
+            return value + (target - value) * fraction
+
+    return keys[-1][1]
+
+
+# ----------------------------------------------------------------
+def sample_trajectory(trajectory: dict) -> list[tuple[int, dict[str, int]]]:
+    """
+    Turn a trajectory into the keyframes which are sent to the Arduino
+    :param trajectory: Trajectory returned by parse_trajectory()
+    :return: List of (milliseconds the sample is held, {servo command: position}),
+             where each sample only contains the servos which changed
+    """
+    interval = 1000 / trajectory['rate']
+    smooth = trajectory['interpolation'] == 'smooth'
+    tracks = {command: [(keyframe['time'], keyframe[name]) for keyframe in trajectory['keyframes'] if name in keyframe]
+              for name, command in SERVOS}
+    duration = trajectory['keyframes'][-1]['time']
+
+    samples = []
+    previous: dict[str, int] = {}
+    sent = 0
+    for index in range(int(duration / interval + 1e-6) + 1):
+        values = {}
+        for command, keys in tracks.items():
+            position = interpolate(keys, index * interval, smooth)
+            if position is not None and previous.get(command) != round(position):
+                values[command] = previous[command] = round(position)
+
+        # Round the times so that they add up to the sample times, without drifting
+        end = round((index + 1) * interval)
+        hold = end - sent
+        # A hold longer than one keyframe can take continues in keyframes which don't move the servos
+        while hold > MAX_KEYFRAME_TIME:
+            samples.append((MAX_KEYFRAME_TIME, values))
+            values = {}
+            hold -= MAX_KEYFRAME_TIME
+        samples.append((hold, values))
+        sent = end
+
+    return samples
+
+
+# ----------------------------------------------------------------
+def keyframe_commands(hold: int, values: dict[str, int]) -> list[str]:
+    """
+    Serial commands which add a keyframe to the animation queue of the Arduino
+    :param hold: Milliseconds before the next keyframe starts
+    :param values: Servo positions, keyed by their commands
+    :return: List of commands
+    """
+    # Positions are sent as "J<servo * 1000 + position>", so they can't be mistaken for manual servo commands
+    return [f'K{hold}'] + [f'J{SERVO_NUMBERS[command] * 1000 + value}' for command, value in values.items()] + ['P']
+
+
+# ================================================================
+class TrajectoryLibrary:
+    """Saved trajectories in a folder"""
+
+    def __init__(self, folder: str):
+        """
+        Constructor
+        :param folder: Folder containing the trajectory files
+        """
+        self.folder = folder
+
+    # ------------------------------------------------------------
+    def list(self) -> list[dict]:
+        """
+        Get the saved trajectories
+        :return: List of the file name, name and duration (seconds) of each trajectory
+        """
+        if not os.path.isdir(self.folder):
+            return []
+
+        trajectories = []
+        for file_name in sorted(os.listdir(self.folder)):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                trajectory = self.load(file_name[:-5])
+                trajectories.append({'file': file_name[:-5], 'name': trajectory['name'] or file_name[:-5],
+                                     'length': trajectory['keyframes'][-1]['time'] / 1000})
+            except (OSError, ValueError) as ex:
+                logger.warning(f'Unable to read trajectory {file_name}: {repr(ex)}')
+        return trajectories
+
+    # ------------------------------------------------------------
+    def load(self, file_name: str) -> dict:
+        """
+        Read a saved trajectory
+        :param file_name: Name of the file, without the extension
+        :return: Trajectory returned by parse_trajectory()
+        :raises ValueError: If the name or the file is invalid
+        :raises OSError: If the file can't be read
+        """
+        with open(self.__path(file_name), encoding='utf-8') as file:
+            try:
+                data = json.load(file)
+            except json.JSONDecodeError as ex:
+                raise ValueError(f'Trajectory is not valid JSON: {ex.msg}') from ex
+        return parse_trajectory(data)
+
+    # ------------------------------------------------------------
+    def save(self, file_name: str, trajectory: dict):
+        """
+        Save a trajectory, replacing any trajectory with the same file name
+        :param file_name: Name of the file, without the extension
+        :param trajectory: Trajectory returned by parse_trajectory()
+        """
+        path = self.__path(file_name)
+        os.makedirs(self.folder, exist_ok=True)
+
+        # Write to a temporary file first, so a half-written file is never read
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(trajectory, file, indent=4)
+        os.replace(path + '.tmp', path)
+
+    # ------------------------------------------------------------
+    def delete(self, file_name: str) -> bool:
+        """
+        Delete a saved trajectory
+        :param file_name: Name of the file, without the extension
+        :return: True if the file was deleted
+        """
+        try:
+            os.remove(self.__path(file_name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    # ------------------------------------------------------------
+    def __path(self, file_name: str) -> str:
+        """Location of a trajectory file, rejecting names which could point outside the folder"""
+        if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9 _-]{0,63}', file_name):
+            raise ValueError('File names can only contain letters, numbers, spaces, "-" and "_"')
+        return os.path.join(self.folder, file_name + '.json')
+
+
+# ================================================================
+class TrajectoryPlayer:
+    """Stream one trajectory at a time to the Arduino, with flow control"""
+
+    def __init__(self, arduino, window: int = 10):
+        """
+        Constructor
+        :param arduino: The ArduinoDevice which receives the keyframes
+        :param window: Most keyframes which can be waiting in the animation queue of the Arduino
+        """
+        self.arduino = arduino
+        self.window: int = max(1, min(window, DEVICE_QUEUE_LENGTH))
+        self.condition = Condition()
+        self.thread: Thread | None = None
+        self.exit_flag = Event()
+        self.run_id: int = 0
+
+        # Replies expected from the Arduino, in order: ('P' for keyframes or 'Q' for queries, time sent)
+        self.expected: deque[tuple[str, float]] = deque()
+        self.device_queue: int = 0
+        self.in_flight: int = 0
+        self.rejected: bool = False
+        self.status: dict = self.__new_status(IDLE, '', 0)
+
+        arduino.add_listener(self.__message_received)
+
+    # ------------------------------------------------------------
+    def play(self, trajectory: dict) -> int:
+        """
+        Start streaming a trajectory, stopping any trajectory which is playing
+        :param trajectory: Trajectory returned by parse_trajectory()
+        :return: Id of this run
+        """
+        samples = sample_trajectory(trajectory)
+        self.stop()
+
+        with self.condition:
+            self.run_id += 1
+            self.exit_flag = Event()
+            self.status = self.__new_status(PLAYING, trajectory['name'], len(samples))
+            self.thread = Thread(target=self.__stream_thread, args=(samples, self.status, self.exit_flag), daemon=True)
+            self.thread.start()
+            return self.run_id
+
+    # ------------------------------------------------------------
+    def stop(self) -> bool:
+        """
+        Stop streaming, and clear the keyframes waiting on the Arduino
+        :return: True if a trajectory was playing
+        """
+        with self.condition:
+            thread = self.thread
+            self.thread = None
+            self.exit_flag.set()
+            self.condition.notify_all()
+
+        if thread is None:
+            return False
+        thread.join()
+        return True
+
+    # ------------------------------------------------------------
+    def get_status(self) -> dict:
+        """
+        Get the progress of the current (or last) trajectory
+        :return: Dictionary with the state (finished once every keyframe has been sent), keyframes sent,
+                 length of the Arduino's queue, bytes sent, and the times the queue ran empty before the end
+        """
+        with self.condition:
+            status = dict(self.status, id=self.run_id, device_queue=self.device_queue)
+
+        status['elapsed'] = round((status.pop('finished') or time.monotonic()) - status['started'], 3) if status['started'] else 0
+        status.pop('started')
+        return status
+
+    # ------------------------------------------------------------
+    def __new_status(self, state: str, name: str, keyframes: int) -> dict:
+        """Status of a new run"""
+        return {'state': state, 'name': name, 'keyframes': keyframes, 'sent': 0, 'bytes': 0, 'underruns': 0,
+                'max_queue': 0, 'error': '', 'started': time.monotonic() if state == PLAYING else None,
+                'finished': None}
+
+    # ------------------------------------------------------------
+    def __message_received(self, kind: str, value):
+        """Keep track of the length of the Arduino's animation queue"""
+        if kind != 'queue':
+            return
+
+        with self.condition:
+            if self.expected and self.expected.popleft()[0] == 'P':
+                self.in_flight = max(0, self.in_flight - 1)
+            if value < 0:
+                self.rejected = True
+            else:
+                self.device_queue = value
+                self.status['max_queue'] = max(self.status['max_queue'], value)
+            self.condition.notify_all()
+
+    # ------------------------------------------------------------
+    def __send(self, commands: list[str], reply: str) -> bool:
+        """Send a group of commands which is answered with the queue length; the lock must be held"""
+        if not self.arduino.send_commands(commands):
+            return False
+        self.expected.append((reply, time.monotonic()))
+        if reply == 'P':
+            self.in_flight += 1
+        return True
+
+    # ------------------------------------------------------------
+    def __stream_thread(self, samples: list[tuple[int, dict]], status: dict, exit_flag: Event):
+        """Send the keyframes as the Arduino makes space for them"""
+        with self.condition:
+            # Replies still due from the previous run (such as to the Q1 which stopped it) would
+            # be taken for replies to this one, so wait for them first
+            deadline = time.monotonic() + REPLY_TIMEOUT
+            while self.expected and not exit_flag.is_set() and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            self.expected.clear()
+            self.in_flight = 0
+            self.device_queue = 0
+            self.rejected = False
+
+            try:
+                index = 0
+                while index < len(samples) and not exit_flag.is_set():
+                    # Something else (such as a preset animation) has filled the queue
+                    if self.rejected:
+                        raise RuntimeError('Animation queue of the Arduino is full')
+                    if self.expected and time.monotonic() - self.expected[0][1] > REPLY_TIMEOUT:
+                        raise RuntimeError('Arduino does not report its animation queue; is the sketch up to date?')
+
+                    # Wait until there is space in the window. If the Arduino hasn't
+                    # reported for a keyframe's time, ask it how long its queue is now
+                    if self.device_queue + self.in_flight >= self.window:
+                        if not self.condition.wait(max(samples[index][0], 10) / 1000) and not self.expected:
+                            self.__send(['Q'], 'Q')
+                        continue
+
+                    if self.device_queue == 0 and self.in_flight == 0 and index > 0:
+                        status['underruns'] += 1
+
+                    commands = keyframe_commands(*samples[index])
+                    if not self.__send(commands, 'P'):
+                        raise RuntimeError('Arduino not connected')
+                    status['bytes'] += sum(len(command) + 1 for command in commands)
+                    index = status['sent'] = index + 1
+
+                if exit_flag.is_set():
+                    status['state'] = STOPPED
+                    self.__send(['Q1'], 'Q')
+                else:
+                    status['state'] = FINISHED
+
+            except Exception as ex:
+                status['error'] = str(ex)
+                status['state'] = FAILED
+                logger.error(f'Trajectory failed after {status["sent"]} keyframes: {repr(ex)}')
+
+            status['finished'] = time.monotonic()
@@ -0,0 +1,316 @@
+"""
+Cache of generated text-to-speech audio
+
+The output of the espeak-ng + rubberband pipeline is stored on disk,
+using a hash of the text and both commands as the file name, so the
+cache is automatically invalidated when the voice configuration
+changes. Recently used phrases are also kept in memory. Both levels
+are limited in size, and the least recently used entries are evicted.
+
+Espeak-NG writes its output to a pipe. Rubberband needs real files, so
+these are placed in a RAM-backed work folder (/dev/shm) if available.
+Long text can be split into sentences with split_sentences(), so the
+first sentence can be played while the next ones are generated.
+"""
+
+import io
+import os
+import re
+import time
+import wave
+import json
+import hashlib
+import logging
+import tempfile
+import subprocess
+from collections import OrderedDict
+from threading import Lock
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+|\n+')
+MAX_CHUNK_LENGTH = 200     # Longer sentences are split at commas or spaces
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------
+def split_sentences(text: str) -> list[str]:
+    """
+    Split text into chunks which can be generated and spoken one after another
+    :param text: The text to be spoken
+    :return: List of sentences, none of which are longer than MAX_CHUNK_LENGTH
+    """
+    chunks = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        sentence = sentence.strip()
+        while len(sentence) > MAX_CHUNK_LENGTH:
+            cut = sentence.rfind(',', 0, MAX_CHUNK_LENGTH)
+            if cut <= 0:
+                cut = sentence.rfind(' ', 0, MAX_CHUNK_LENGTH)
+            if cut <= 0:
+                cut = MAX_CHUNK_LENGTH
+            chunks.append(sentence[:cut + 1].strip())
+            sentence = sentence[cut + 1:].strip()
+        if sentence:
+            chunks.append(sentence)
+    return chunks
+
+
+# ----------------------------------------------------------------
+def fix_wav_header(data: bytes) -> bytes:
+    """
+    Rewrite a WAV file which was written to a pipe, where the lengths in the
+    header are unknown
+    :param data: Contents of the WAV file
+    :return: Contents of the WAV file with a correct header
+    """
+    with wave.open(io.BytesIO(data), 'rb') as source:
+        params = source.getparams()
+        frames = source.readframes(source.getnframes())
+
+    result = io.BytesIO()
+    with wave.open(result, 'wb') as output:
+        output.setparams(params)
+        output.writeframes(frames)
+    return result.getvalue()
+
+
+# ================================================================
+class TTSCache:
+    """Generate speech using espeak-ng and rubberband, reusing earlier results"""
+
+    def __init__(self, cache_folder: str, espeak_cmd: list[str], rb_cmd: list[str] | None,
+                 max_disk_bytes: int = 50 * 1024 * 1024, max_memory_bytes: int = 8 * 1024 * 1024,
+                 work_folder: str | None = '/dev/shm'):
+        """
+        Constructor
+        :param cache_folder: Folder where the generated audio files are stored
+        :param espeak_cmd: Espeak-NG command and voice arguments
+        :param rb_cmd: Rubberband command for pitch shifting (None or empty = no pitch shift)
+        :param max_disk_bytes: Maximum total size of the files in the cache folder
+        :param max_memory_bytes: Maximum total size of the audio kept in memory
+        :param work_folder: Folder for the files used by rubberband, ideally in RAM
+                            (None or missing = use the cache folder)
+        """
+        self.cache_folder = cache_folder
+        self.work_folder = work_folder if work_folder and os.path.isdir(work_folder) else cache_folder
+        self.espeak_cmd = espeak_cmd
+        self.rb_cmd = rb_cmd
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+
+        self.memory: OrderedDict[str, bytes] = OrderedDict()
+        self.memory_size: int = 0
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.disk_size: int = 0
+        self.lock = Lock()
+        self.key_locks: dict[str, Lock] = {}
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'errors': 0, 'render_time': 0.0}
+
+        self.__scan_folder()
+
+    # ------------------------------------------------------------
+    def get_key(self, text: str) -> str:
+        """
+        Get the cache key of a phrase with the current voice configuration
+        :param text: The phrase
+        :return: Hexadecimal hash of the phrase and commands
+        """
+        content = json.dumps([text, self.espeak_cmd, self.rb_cmd or []])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    # ------------------------------------------------------------
+    def get(self, text: str) -> bytes:
+        """
+        Get the WAV audio of a phrase, generating it if it isn't cached
+        :param text: The phrase to be spoken
+        :return: Contents of the WAV file
+        """
+        key = self.get_key(text)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+
+        # Only one thread generates each phrase, the others wait for the result
+        with key_lock:
+            try:
+                with self.lock:
+                    data = self.memory.get(key)
+                    if data is not None:
+                        self.memory.move_to_end(key)
+                        self.stats['memory_hits'] += 1
+                        return data
+
+                data = self.__read_file(key)
+                if data is not None:
+                    with self.lock:
+                        self.stats['disk_hits'] += 1
+                else:
+                    with self.lock:
+                        self.stats['misses'] += 1
+                    data = self.__render(text, key)
+
+                self.__remember(key, data)
+                return data
+
+            finally:
+                with self.lock:
+                    self.key_locks.pop(key, None)
+
+    # ------------------------------------------------------------
+    def warm_up(self, phrases: list[str]):
+        """
+        Generate the audio of phrases in advance
+        :param phrases: List of phrases
+        """
+        for phrase in phrases:
+            try:
+                self.get(phrase)
+            except Exception as ex:
+                logger.error(f'Unable to pre-render phrase "{phrase}": {repr(ex)}')
+
+    # ------------------------------------------------------------
+    def get_stats(self) -> dict:
+        """
+        Get the cache statistics
+        :return: Dictionary containing the hit and miss counters and cache sizes
+        """
+        with self.lock:
+            return dict(self.stats, render_time=round(self.stats['render_time'], 3),
+                        memory_entries=len(self.memory), memory_bytes=self.memory_size,
+                        disk_entries=len(self.files), disk_bytes=self.disk_size)
+
+    # ------------------------------------------------------------
+    def __render(self, text: str, key: str) -> bytes:
+        """Run the speech pipeline and store the result in the cache folder"""
+        start = time.perf_counter()
+
+        try:
+            # Generate Speech
+            speech = subprocess.run(self.espeak_cmd + ['--stdout', text.encode('utf8')], check=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+
+            # Shift pitch
+            if self.rb_cmd:
+                data = self.__shift_pitch(speech)
+            else:
+                data = fix_wav_header(speech)
+
+        except Exception:
+            with self.lock:
+                self.stats['errors'] += 1
+            raise
+
+        finally:
+            with self.lock:
+                self.stats['render_time'] += time.perf_counter() - start
+
+        self.__write_file(key, data)
+        return data
+
+    # ------------------------------------------------------------
+    def __shift_pitch(self, speech: bytes) -> bytes:
+        """Run rubberband on the generated speech, using files in the work folder"""
+        os.makedirs(self.work_folder, exist_ok=True)
+        speech_fd, speech_file = tempfile.mkstemp(suffix='.tmp', dir=self.work_folder)
+        shifted_fd, shifted_file = tempfile.mkstemp(suffix='.tmp', dir=self.work_folder)
+        os.close(shifted_fd)
+
+        try:
+            with os.fdopen(speech_fd, 'wb') as file:
+                file.write(fix_wav_header(speech))
+
+            subprocess.run(self.rb_cmd + [speech_file, shifted_file], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            with open(shifted_file, 'rb') as file:
+                return file.read()
+
+        finally:
+            for path in (speech_file, shifted_file):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # ------------------------------------------------------------
+    def __write_file(self, key: str, data: bytes):
+        """Store generated audio in the cache folder"""
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            fd, temp_file = tempfile.mkstemp(suffix='.tmp', dir=self.cache_folder)
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temp_file, self.__get_path(key))
+        except OSError as ex:
+            logger.error(f'Unable to store generated speech: {repr(ex)}')
+            return
+
+        with self.lock:
+            self.disk_size += len(data) - self.files.pop(key, 0)
+            self.files[key] = len(data)
+            self.__evict_files()
+
+    # ------------------------------------------------------------
+    def __read_file(self, key: str) -> bytes | None:
+        """Read a cached file, marking it as recently used"""
+        path = self.__get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = len(data)
+                self.disk_size += len(data)
+            self.files.move_to_end(key)
+        return data
+
+    # ------------------------------------------------------------
+    def __remember(self, key: str, data: bytes):
+        """Keep the audio in memory, evicting the least recently used entries"""
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.max_memory_bytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    # ------------------------------------------------------------
+    def __evict_files(self):
+        """Delete the least recently used files once the folder is too large"""
+        while self.disk_size > self.max_disk_bytes and len(self.files) > 1:
+            key, size = self.files.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(self.__get_path(key))
+            except OSError:
+                pass
+
+    # ------------------------------------------------------------
+    def __scan_folder(self):
+        """Find files cached by a previous run, ordered by when they were last used"""
+        try:
+            entries = []
+            for name in os.listdir(self.cache_folder):
+                path = os.path.join(self.cache_folder, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                elif name.endswith('.wav'):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        except OSError:
+            return
+
+        for _, key, size in sorted(entries):
+            self.files[key] = size
+            self.disk_size += size
+        self.__evict_files()
+
+    # ------------------------------------------------------------
+    def __get_path(self, key: str) -> str:
+        """Location of the cached file of a key"""
+        return os.path.join(self.cache_folder, f'{key}.wav')